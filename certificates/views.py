@@ -268,7 +268,7 @@ class BaseGradeRecordView(ABC, TemplateView):
             context['courses'].append({
                 "title": course.title,
                 "edx_course_key": best_grade.course_run.edx_course_key if best_grade else "",
-                "attempts": mmtrack.get_course_proctorate_exam_results(course).count(),
+                "attempts": len(mmtrack.get_course_proctorate_exam_results(course)),
                 "letter_grade": letter_grade,
                 "status": "Earned" if earned else "Not Earned",
                 "date_earned": combined_grade.created_on if combined_grade else "",
@@ -2,13 +2,21 @@
 Pytest configuration file for the entire micromasters app
 """
 # pylint: disable=redefined-outer-name
+import uuid
 import warnings
 from types import SimpleNamespace
 from unittest.mock import patch
 
 import pytest
+from django_redis import get_redis_connection
 
-from search import tasks
+from courses import program_structure
+from dashboard import api as dashboard_api
+from dashboard import models as dashboard_models
+from search import connection, index_queue, scope, tasks
+
+# Redis is shared by the test sessions running at the same time, but the database rows its keys describe are not
+REDIS_KEY_SUFFIX = uuid.uuid4().hex
 
 
 @pytest.fixture(autouse=True)
@@ -66,6 +74,67 @@ def warnings_as_errors():
         warnings.resetwarnings()
 
 
+@pytest.fixture(autouse=True)
+def clear_program_structures():
+    """
+    Discard the program structures cached by other tests, since their database changes are rolled back
+    """
+    program_structure.clear_program_structures()
+    yield
+    program_structure.clear_program_structures()
+
+
+@pytest.fixture(autouse=True)
+def clear_aliases():
+    """
+    Discard the aliases looked up by other tests, since the indices they describe are recreated by each test
+    """
+    connection.invalidate_aliases()
+    yield
+    connection.invalidate_aliases()
+
+
+@pytest.fixture(autouse=True)
+def isolated_redis_keys(mocker):
+    """
+    Use versions, generations and queues in Redis that no other test session can change
+    """
+    mocker.patch.object(
+        program_structure,
+        'PROGRAM_STRUCTURE_VERSION_KEY',
+        f'{program_structure.PROGRAM_STRUCTURE_VERSION_KEY}_{REDIS_KEY_SUFFIX}',
+    )
+    mocker.patch.object(
+        dashboard_models,
+        'CACHE_KEY_DASHBOARD_GENERATION_BY_USER',
+        f'{dashboard_models.CACHE_KEY_DASHBOARD_GENERATION_BY_USER}_{REDIS_KEY_SUFFIX}',
+    )
+    mocker.patch.object(
+        connection, 'CACHE_KEY_ALIAS_VERSION', f'{connection.CACHE_KEY_ALIAS_VERSION}_{REDIS_KEY_SUFFIX}'
+    )
+    for key_name in ('CACHE_KEY_DASHBOARD_REFRESHES_IN_FLIGHT', 'CACHE_KEY_INVALID_BACKENDS_BY_USER'):
+        mocker.patch.object(dashboard_api, key_name, f'{getattr(dashboard_api, key_name)}_{REDIS_KEY_SUFFIX}')
+    # the indexing queue is not tied to the database, so it is emptied after each test
+    index_queue_keys = [
+        mocker.patch.object(index_queue, key_name, f'{getattr(index_queue, key_name)}_{uuid.uuid4().hex}')
+        for key_name in (
+            'CACHE_KEY_INDEX_QUEUE_USERS',
+            'CACHE_KEY_INDEX_QUEUE_FORCED_USERS',
+            'CACHE_KEY_INDEX_QUEUE_PROGRAM_ENROLLMENTS',
+            'CACHE_KEY_INDEX_QUEUE_FLUSH_SCHEDULED',
+        )
+    ]
+    # the search scopes describe database rows which are rolled back after each test. The scopes and
+    # generations of the users expire by themselves
+    for key_name in ('CACHE_KEY_SEARCH_SCOPE_BY_USER', 'CACHE_KEY_SEARCH_SCOPE_GENERATION_BY_USER'):
+        mocker.patch.object(scope, key_name, f'{getattr(scope, key_name)}_{uuid.uuid4().hex}')
+    search_scope_version_key = mocker.patch.object(
+        scope, 'CACHE_KEY_SEARCH_SCOPE_VERSION', f'{scope.CACHE_KEY_SEARCH_SCOPE_VERSION}_{uuid.uuid4().hex}'
+    )
+    yield
+    get_redis_connection("redis").delete(*index_queue_keys, search_scope_version_key)
+
+
 @pytest.fixture(autouse=True)
 def settings_defaults(settings):  # pylint: disable=unused-argument
     """No-op fixture for settings defaults, kept for consistency"""
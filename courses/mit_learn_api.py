@@ -136,6 +136,13 @@ def sync_mit_learn_courseruns_for_course(course, raw_course) -> int:
             "courseware_backend": courseware_backend,
             "enrollment_url": raw_courserun.get("url", ""),
         }
+        course_run = CourseRun.objects.filter(course=course, edx_course_key=run_id).first()
+        if course_run is not None and all(
+                getattr(course_run, field) == value for field, value in run_defaults.items()
+        ):
+            # saving an unchanged run would discard the cached structure of the program for nothing
+            log.info("Course run %s for course %s is up to date", course_run.edx_course_key, course.title)
+            continue
         course_run, created = CourseRun.objects.update_or_create(
             course=course, edx_course_key=run_id, defaults=run_defaults
         )
@@ -1,4 +1,5 @@
 """Tests for MIT Learn API integration helpers."""
+from unittest.mock import patch
 
 from backends.constants import BACKEND_EDX_ORG, BACKEND_MITX_ONLINE
 from courses.factories import CourseFactory
@@ -85,6 +86,31 @@ class MITLearnAPITests(MockedESTestCase):
             "missing run_id (title=Missing id)"
         ]
 
+    def test_sync_mit_learn_courseruns_skips_unchanged_runs(self):
+        """A run which did not change should not be saved again."""
+        course = CourseFactory.create(edx_key="MITx+5")
+        raw_course = {
+            "platform": {"code": "edx"},
+            "runs": [
+                {
+                    "run_id": "course-v1:MITx+5+1T2026",
+                    "title": "Valid run",
+                    "start_date": "2026-01-10T00:00:00Z",
+                    "url": "https://example.com/valid-run",
+                }
+            ],
+        }
+        assert sync_mit_learn_courseruns_for_course(course, raw_course) == 1
+
+        with patch("courses.signals.invalidate_program_structure", autospec=True) as invalidate_mock:
+            assert sync_mit_learn_courseruns_for_course(course, raw_course) == 0
+            assert invalidate_mock.called is False
+
+            raw_course["runs"][0]["title"] = "New title"
+            assert sync_mit_learn_courseruns_for_course(course, raw_course) == 0
+            invalidate_mock.assert_called_once_with(course.program_id)
+        assert CourseRun.objects.get(course=course).title == "New title"
+
     def test_sync_mit_learn_courseruns_accepts_edxorg_alias_case_insensitively(self):
         """edX platform aliases should map to the edxorg backend regardless of case."""
         course = CourseFactory.create(edx_key="MITx+3")
@@ -0,0 +1,350 @@
+"""
+Cached, read-only structure of a program: courses, course runs, electives, exam runs and grade freeze status
+"""
+import bisect
+import datetime
+import threading
+from collections import defaultdict
+from types import MappingProxyType
+
+import pytz
+
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from courses.models import Course, CourseRun, ElectivesSet
+from exams.constants import NEXT_SEMESTER_EXAM_DELAY
+from exams.models import ExamRun
+from micromasters.utils import get_redis_counters, incr_redis_counter, now_in_utc
+
+# the version of the structure of a program, incremented when a part of the program changes
+PROGRAM_STRUCTURE_VERSION_KEY = 'program_structure_version_{0}'
+
+# course run dates at which the status of a run for a user may change
+COURSE_RUN_BOUNDARY_FIELDS = (
+    'enrollment_start', 'start_date', 'enrollment_end', 'end_date', 'upgrade_deadline', 'freeze_grade_date',
+)
+
+# program id -> ProgramStructure, shared by all the requests served by this process
+_structures = {}
+_structures_lock = threading.Lock()
+
+
+class ProgramStructure:
+    """
+    An immutable snapshot of the catalog of a program, which does not depend on the user.
+
+    The model instances it holds are shared between requests, so they must be treated as read-only.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, *, program_id, version, courses, course_runs, electives_sets, exam_runs):
+        """
+        Args:
+            program_id (int): the id of the program
+            version (int): the version of the structure of the program at the time the snapshot was loaded
+            courses (iterable of Course): the courses of the program, in program order
+            course_runs (iterable of CourseRun): the not discontinued course runs of the program,
+                with their grading status
+            electives_sets (iterable of ElectivesSet): the electives sets of the program,
+                with their elective courses
+            exam_runs (iterable of ExamRun): the exam runs of the program
+        """
+        self.program_id = program_id
+        self.version = version
+        # set when a part of the program is saved by this process
+        self.discarded = False
+        self.courses = tuple(courses)
+        self.course_runs = tuple(course_runs)
+
+        runs_by_course = defaultdict(list)
+        for course_run in self.course_runs:
+            runs_by_course[course_run.course_id].append(course_run)
+        self._runs_by_course = MappingProxyType({
+            course_id: tuple(course_runs) for course_id, course_runs in runs_by_course.items()
+        })
+        # Maps a CourseRun's edx_course_key to its parent Course id
+        self.edx_key_course_map = MappingProxyType({
+            course_run.edx_course_key: course_run.course_id
+            for course_run in self.course_runs if course_run.edx_course_key
+        })
+        self.frozen_course_run_ids = frozenset(
+            course_run.id for course_run in self.course_runs if course_run.has_frozen_grades
+        )
+
+        self.electives_sets = tuple(electives_sets)
+        self.elective_course_ids_by_set = MappingProxyType({
+            electives_set.id: frozenset(
+                elective_course.course_id for elective_course in electives_set.electivecourse_set.all()
+            ) for electives_set in self.electives_sets
+        })
+        self.elective_course_ids = frozenset().union(*self.elective_course_ids_by_set.values())
+        self.core_course_ids = frozenset(
+            course.id for course in self.courses if course.id not in self.elective_course_ids
+        )
+
+        exam_runs_by_course = defaultdict(list)
+        for exam_run in sorted(exam_runs, key=lambda exam_run: exam_run.id):
+            exam_runs_by_course[exam_run.course_id].append(exam_run)
+        self._exam_runs_by_course = MappingProxyType({
+            course_id: tuple(exam_runs) for course_id, exam_runs in exam_runs_by_course.items()
+        })
+        self.exam_course_ids = frozenset(self._exam_runs_by_course.keys())
+        self.has_exams = bool(self.exam_course_ids)
+        # edx course keys for courses with no exam
+        self.edx_course_keys_no_exam = frozenset(
+            course_run.edx_course_key for course_run in self.course_runs
+            if course_run.course_id not in self.exam_course_ids
+        )
+
+        boundaries = set()
+        for course_run in self.course_runs:
+            boundaries.update(getattr(course_run, field) for field in COURSE_RUN_BOUNDARY_FIELDS)
+        for exam_runs in self._exam_runs_by_course.values():
+            for exam_run in exam_runs:
+                boundaries.update(_get_exam_run_boundaries(exam_run))
+        boundaries.discard(None)
+        # sorted dates at which some time dependent information about the program changes
+        self.boundaries = tuple(sorted(boundaries))
+
+    def __str__(self):
+        return f'Structure of program {self.program_id} at version {self.version}'
+
+    @classmethod
+    def load(cls, program_id, version):
+        """
+        Loads the structure of a program from the database
+
+        Args:
+            program_id (int): the id of the program
+            version (int): the current version of the structure of the program
+
+        Returns:
+            ProgramStructure: the structure of the program
+        """
+        with transaction.atomic():
+            courses = list(Course.objects.filter(program_id=program_id))
+            courses_by_id = {course.id: course for course in courses}
+            course_runs = list(
+                CourseRun.objects.not_discontinued().filter(
+                    course__program_id=program_id
+                ).select_related('courserungradingstatus')
+            )
+            for course_run in course_runs:
+                course_run.course = courses_by_id[course_run.course_id]
+            electives_sets = list(
+                ElectivesSet.objects.filter(program_id=program_id).prefetch_related('electivecourse_set')
+            )
+            exam_runs = list(ExamRun.objects.filter(course__program_id=program_id))
+        for exam_run in exam_runs:
+            exam_run.course = courses_by_id[exam_run.course_id]
+        return cls(
+            program_id=program_id,
+            version=version,
+            courses=courses,
+            course_runs=course_runs,
+            electives_sets=electives_sets,
+            exam_runs=exam_runs,
+        )
+
+    def get_course_runs(self, course_id):
+        """
+        Args:
+            course_id (int): a course id
+
+        Returns:
+            tuple of CourseRun: the not discontinued runs of the course, sorted by start date
+        """
+        return self._runs_by_course.get(course_id, ())
+
+    def get_exam_runs(self, course_id):
+        """
+        Args:
+            course_id (int): a course id
+
+        Returns:
+            tuple of ExamRun: the exam runs of the course, sorted by id
+        """
+        return self._exam_runs_by_course.get(course_id, ())
+
+    def get_currently_schedulable_exam_runs(self, course_id):
+        """
+        Same as ExamRun.get_currently_schedulable
+
+        Args:
+            course_id (int): a course id
+
+        Returns:
+            list of ExamRun: the currently schedulable exam runs of the course, sorted by id
+        """
+        now = now_in_utc()
+        return [
+            exam_run for exam_run in self.get_exam_runs(course_id)
+            if exam_run.date_first_schedulable <= now <= exam_run.date_last_schedulable
+        ]
+
+    def get_exam_runs_schedulable_in_future(self, course_id):
+        """
+        Same as ExamRun.get_schedulable_in_future, sorted by the first schedulable date
+
+        Args:
+            course_id (int): a course id
+
+        Returns:
+            list of ExamRun: the exam runs of the course with a future schedulable window
+        """
+        now = now_in_utc()
+        return sorted(
+            (exam_run for exam_run in self.get_exam_runs(course_id) if exam_run.date_first_schedulable >= now),
+            key=lambda exam_run: exam_run.date_first_schedulable,
+        )
+
+    def get_next_boundary(self, after):
+        """
+        Args:
+            after (datetime.datetime): a date
+
+        Returns:
+            datetime.datetime: the first date after the given one at which some time dependent information
+                about the program changes, or None if there is none
+        """
+        index = bisect.bisect_right(self.boundaries, after)
+        return self.boundaries[index] if index < len(self.boundaries) else None
+
+    def is_elective(self, course_id):
+        """
+        Args:
+            course_id (int): a course id
+
+        Returns:
+            bool: whether the course belongs to an electives set
+        """
+        return course_id in self.elective_course_ids
+
+    def has_exam(self, course_id):
+        """
+        Args:
+            course_id (int): a course id
+
+        Returns:
+            bool: whether the course has exam runs
+        """
+        return course_id in self.exam_course_ids
+
+    def has_frozen_grades(self, course_run_id):
+        """
+        Args:
+            course_run_id (int): a course run id
+
+        Returns:
+            bool: whether the final grades of the course run have been frozen
+        """
+        return course_run_id in self.frozen_course_run_ids
+
+
+def _get_exam_run_boundaries(exam_run):
+    """
+    Returns the dates at which the status of an exam run for a user may change
+
+    Args:
+        exam_run (ExamRun): an exam run
+
+    Returns:
+        list of datetime.datetime: the dates, some of which may be None
+    """
+    def start_of_day(date):
+        """Returns the start of a day in UTC, which is how the eligibility dates are compared"""
+        return datetime.datetime.combine(date, datetime.time.min, tzinfo=pytz.utc) if date else None
+
+    first_schedulable = exam_run.date_first_schedulable
+    return [
+        first_schedulable,
+        # the exam run starts being shown as the one of the next semester
+        first_schedulable - NEXT_SEMESTER_EXAM_DELAY if first_schedulable else None,
+        exam_run.date_last_schedulable,
+        exam_run.date_grades_available,
+        start_of_day(exam_run.date_first_eligible),
+        start_of_day(exam_run.date_last_eligible + datetime.timedelta(days=1) if exam_run.date_last_eligible else None),
+    ]
+
+
+def get_program_structure_versions(program_ids):
+    """
+    Returns the current versions of the structures of some programs, shared by all the processes
+
+    Args:
+        program_ids (iterable of int): the ids of the programs
+
+    Returns:
+        dict: the version of the structure of each program id
+    """
+    program_ids = list(program_ids)
+    if not program_ids:
+        return {}
+    versions = get_redis_counters(
+        get_redis_connection("redis"), [PROGRAM_STRUCTURE_VERSION_KEY.format(program_id) for program_id in program_ids]
+    )
+    return dict(zip(program_ids, versions))
+
+
+def get_program_structure_version(program_id):
+    """
+    Returns the current version of the structure of a program, shared by all the processes
+
+    Args:
+        program_id (int): the id of the program
+    """
+    [version] = get_redis_counters(get_redis_connection("redis"), [PROGRAM_STRUCTURE_VERSION_KEY.format(program_id)])
+    return version
+
+
+def _bump_version(program_id):
+    """
+    Makes all the processes discard the structure of a program they loaded so far
+    """
+    incr_redis_counter(get_redis_connection("redis"), PROGRAM_STRUCTURE_VERSION_KEY.format(program_id))
+
+
+def get_program_structure(program_id):
+    """
+    Returns the structure of a program, loading it only if it changed since it was last loaded by this process
+
+    Args:
+        program_id (int): the id of the program
+
+    Returns:
+        ProgramStructure: the structure of the program
+    """
+    version = get_program_structure_version(program_id)
+    structure = _structures.get(program_id)
+    if structure is not None and structure.version == version:
+        return structure
+    # the version is read before loading so that a change committed meanwhile is not missed
+    structure = ProgramStructure.load(program_id, version)
+    with _structures_lock:
+        _structures[program_id] = structure
+    return structure
+
+
+def invalidate_program_structure(program_id):
+    """
+    Discards the structure of a program in every process right away, and again once the current
+    transaction is committed, so that a structure loaded before the commit is not kept
+
+    Args:
+        program_id (int): the id of the program
+    """
+    with _structures_lock:
+        structure = _structures.pop(program_id, None)
+    if structure is not None:
+        structure.discarded = True
+    _bump_version(program_id)
+    transaction.on_commit(lambda: _bump_version(program_id))
+
+
+def clear_program_structures():
+    """
+    Discards all the structures loaded by this process
+    """
+    with _structures_lock:
+        _structures.clear()
@@ -0,0 +1,147 @@
+"""
+Tests for the program structure cache
+"""
+from datetime import datetime, time, timedelta
+from unittest.mock import patch
+
+import ddt
+import pytz
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from courses import program_structure
+from courses.factories import CourseFactory, CourseRunFactory, ProgramFactory
+from courses.models import ElectiveCourse, ElectivesSet
+from courses.program_structure import COURSE_RUN_BOUNDARY_FIELDS, get_program_structure
+from exams.constants import NEXT_SEMESTER_EXAM_DELAY
+from exams.factories import ExamRunFactory
+from grades.constants import FinalGradeStatus
+from grades.models import CourseRunGradingStatus
+from micromasters.utils import incr_redis_counter, now_in_utc
+from search.base import MockedESTestCase
+
+
+@ddt.ddt
+class ProgramStructureTests(MockedESTestCase):
+    """Tests for ProgramStructure and its cache"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.program = ProgramFactory.create()
+        cls.core_course = CourseFactory.create(program=cls.program, position_in_program=1)
+        cls.elective_course = CourseFactory.create(program=cls.program, position_in_program=2)
+        cls.electives_set = ElectivesSet.objects.create(program=cls.program, required_number=1, title='set')
+        ElectiveCourse.objects.create(course=cls.elective_course, electives_set=cls.electives_set)
+        cls.core_run = CourseRunFactory.create(course=cls.core_course, edx_course_key='core-run')
+        cls.frozen_run = CourseRunFactory.create(course=cls.elective_course, edx_course_key='elective-run')
+        CourseRunGradingStatus.objects.create(course_run=cls.frozen_run, status=FinalGradeStatus.COMPLETE)
+        CourseRunFactory.create(course=cls.core_course, is_discontinued=True)
+        now = now_in_utc()
+        cls.current_exam_run = ExamRunFactory.create(
+            course=cls.core_course,
+            date_first_schedulable=now - timedelta(days=1),
+            date_last_schedulable=now + timedelta(days=1),
+        )
+        cls.future_exam_run = ExamRunFactory.create(
+            course=cls.core_course,
+            date_first_schedulable=now + timedelta(days=10),
+            date_last_schedulable=now + timedelta(days=20),
+        )
+
+    def test_structure(self):
+        """Test that the structure holds the catalog of the program"""
+        structure = get_program_structure(self.program.id)
+        assert structure.courses == (self.core_course, self.elective_course)
+        assert set(structure.course_runs) == {self.core_run, self.frozen_run}
+        assert structure.get_course_runs(self.core_course.id) == (self.core_run, )
+        assert dict(structure.edx_key_course_map) == {
+            'core-run': self.core_course.id,
+            'elective-run': self.elective_course.id,
+        }
+        assert structure.has_frozen_grades(self.frozen_run.id) is True
+        assert structure.has_frozen_grades(self.core_run.id) is False
+        assert structure.is_elective(self.elective_course.id) is True
+        assert structure.is_elective(self.core_course.id) is False
+        assert structure.core_course_ids == {self.core_course.id}
+        assert structure.elective_course_ids_by_set[self.electives_set.id] == {self.elective_course.id}
+        assert structure.has_exams is True
+        assert structure.has_exam(self.core_course.id) is True
+        assert structure.has_exam(self.elective_course.id) is False
+        assert structure.edx_course_keys_no_exam == {'elective-run'}
+        assert structure.get_currently_schedulable_exam_runs(self.core_course.id) == [self.current_exam_run]
+        assert structure.get_exam_runs_schedulable_in_future(self.core_course.id) == [self.future_exam_run]
+
+    def test_boundaries(self):
+        """Test that the structure knows the dates at which the status of its runs and exam runs change"""
+        structure = get_program_structure(self.program.id)
+        assert list(structure.boundaries) == sorted(structure.boundaries)
+        for course_run in (self.core_run, self.frozen_run):
+            for field in COURSE_RUN_BOUNDARY_FIELDS:
+                assert getattr(course_run, field) in structure.boundaries
+        exam_run = self.future_exam_run
+        assert exam_run.date_first_schedulable in structure.boundaries
+        assert exam_run.date_first_schedulable - NEXT_SEMESTER_EXAM_DELAY in structure.boundaries
+        assert exam_run.date_last_schedulable in structure.boundaries
+        assert datetime.combine(
+            exam_run.date_last_eligible + timedelta(days=1), time.min, tzinfo=pytz.utc
+        ) in structure.boundaries
+
+        first, second = structure.boundaries[:2]
+        assert structure.get_next_boundary(first - timedelta(seconds=1)) == first
+        assert structure.get_next_boundary(first) == second
+        assert structure.get_next_boundary(structure.boundaries[-1]) is None
+
+    def test_cached(self):
+        """Test that the structure is loaded only once"""
+        structure = get_program_structure(self.program.id)
+        with self.assertNumQueries(0):
+            assert get_program_structure(self.program.id) is structure
+
+    def test_invalidated_on_save(self):
+        """Test that saving a part of the program discards the cached structure"""
+        for save_func in [
+                lambda: self.program.save(),
+                lambda: self.core_course.save(),
+                lambda: self.core_run.save(),
+                lambda: self.current_exam_run.save(),
+                lambda: self.electives_set.save(),
+                lambda: self.frozen_run.courserungradingstatus.save(),
+        ]:
+            structure = get_program_structure(self.program.id)
+            save_func()
+            assert structure.discarded is True
+            assert get_program_structure(self.program.id) is not structure
+
+    def test_new_course_run(self):
+        """Test that a new course run is part of the structure right away"""
+        get_program_structure(self.program.id)
+        course_run = CourseRunFactory.create(course=self.core_course)
+        assert course_run in get_program_structure(self.program.id).get_course_runs(self.core_course.id)
+
+    @ddt.data(True, False)
+    def test_version_bumped(self, committed):
+        """Test that the structures loaded by other processes are discarded on change and again on commit"""
+        structure = get_program_structure(self.program.id)
+        with patch.object(transaction, 'on_commit', side_effect=lambda callback: callback() if committed else None):
+            ElectivesSet.objects.create(program=self.program, required_number=1, title='other set')
+        new_structure = get_program_structure(self.program.id)
+        assert new_structure.version == structure.version + (2 if committed else 1)
+        assert len(new_structure.electives_sets) == 2
+
+    def test_version_lost(self):
+        """Test that the structures loaded before Redis lost the version of the program are not used again"""
+        structure = get_program_structure(self.program.id)
+        con = get_redis_connection("redis")
+        key = program_structure.PROGRAM_STRUCTURE_VERSION_KEY.format(self.program.id)
+        con.delete(key)
+        # another process changed the program
+        incr_redis_counter(con, key)
+        assert get_program_structure(self.program.id) is not structure
+
+    def test_other_program_saved(self):
+        """Test that saving a part of another program keeps the cached structure"""
+        structure = get_program_structure(self.program.id)
+        CourseRunFactory.create().save()
+        with self.assertNumQueries(0):
+            assert get_program_structure(self.program.id) is structure
@@ -0,0 +1,119 @@
+"""
+Signals for courses
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from cms.models import (CourseCertificateSignatories,
+                        ProgramCertificateSignatories, ProgramLetterSignatory,
+                        ProgramPage)
+from courses.models import Course, CourseRun, ElectiveCourse, ElectivesSet, Program
+from courses.program_structure import invalidate_program_structure
+from exams.models import ExamRun
+from grades.models import CourseRunGradingStatus
+
+
+def _invalidate_course_program_structure(course_filter):
+    """
+    Invalidates the structure of the program of a course, if the course still exists
+
+    Args:
+        course_filter (dict): the filter to find the course
+    """
+    program_id = Course.objects.filter(**course_filter).values_list('program_id', flat=True).first()
+    if program_id is not None:
+        invalidate_program_structure(program_id)
+
+
+@receiver(post_save, sender=Program, dispatch_uid="program_structure_program_post_save")
+@receiver(post_delete, sender=Program, dispatch_uid="program_structure_program_post_delete")
+def handle_program_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a Program is saved or deleted
+    """
+    invalidate_program_structure(instance.id)
+
+
+@receiver(post_save, sender=Course, dispatch_uid="program_structure_course_post_save")
+@receiver(post_delete, sender=Course, dispatch_uid="program_structure_course_post_delete")
+@receiver(post_save, sender=ElectivesSet, dispatch_uid="program_structure_electives_set_post_save")
+@receiver(post_delete, sender=ElectivesSet, dispatch_uid="program_structure_electives_set_post_delete")
+def handle_program_child_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a Course or an ElectivesSet is saved or deleted
+    """
+    invalidate_program_structure(instance.program_id)
+
+
+@receiver(post_save, sender=CourseRun, dispatch_uid="program_structure_course_run_post_save")
+@receiver(post_delete, sender=CourseRun, dispatch_uid="program_structure_course_run_post_delete")
+@receiver(post_save, sender=ExamRun, dispatch_uid="program_structure_exam_run_post_save")
+@receiver(post_delete, sender=ExamRun, dispatch_uid="program_structure_exam_run_post_delete")
+def handle_course_child_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a CourseRun or an ExamRun is saved or deleted
+    """
+    if instance.course_id is not None:
+        _invalidate_course_program_structure({'id': instance.course_id})
+
+
+@receiver(post_save, sender=ElectiveCourse, dispatch_uid="program_structure_elective_course_post_save")
+@receiver(post_delete, sender=ElectiveCourse, dispatch_uid="program_structure_elective_course_post_delete")
+def handle_elective_course_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When an ElectiveCourse is saved or deleted
+    """
+    program_id = ElectivesSet.objects.filter(
+        id=instance.electives_set_id
+    ).values_list('program_id', flat=True).first()
+    if program_id is not None:
+        invalidate_program_structure(program_id)
+
+
+@receiver(post_save, sender=CourseRunGradingStatus, dispatch_uid="program_structure_grading_status_post_save")
+@receiver(post_delete, sender=CourseRunGradingStatus, dispatch_uid="program_structure_grading_status_post_delete")
+def handle_grading_status_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When the grading status of a CourseRun is saved or deleted
+    """
+    _invalidate_course_program_structure({'courserun__id': instance.course_run_id})
+
+
+# the dashboard documents of a program are computed from its certificate signatories and program letter,
+# so a change to them is handled like a change to the structure of the program
+@receiver(post_save, sender=ProgramPage, dispatch_uid="program_structure_program_page_post_save")
+@receiver(post_delete, sender=ProgramPage, dispatch_uid="program_structure_program_page_post_delete")
+def handle_program_page_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a ProgramPage is saved or deleted
+    """
+    if instance.program_id is not None:
+        invalidate_program_structure(instance.program_id)
+
+
+@receiver(post_save, sender=ProgramCertificateSignatories, dispatch_uid="program_structure_program_signatory_post_save")
+@receiver(
+    post_delete, sender=ProgramCertificateSignatories, dispatch_uid="program_structure_program_signatory_post_delete"
+)
+@receiver(post_save, sender=ProgramLetterSignatory, dispatch_uid="program_structure_letter_signatory_post_save")
+@receiver(post_delete, sender=ProgramLetterSignatory, dispatch_uid="program_structure_letter_signatory_post_delete")
+def handle_program_signatory_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a signatory of the program certificate or of the program letter is saved or deleted
+    """
+    program_id = ProgramPage.objects.filter(
+        id=instance.program_page_id
+    ).values_list('program_id', flat=True).first()
+    if program_id is not None:
+        invalidate_program_structure(program_id)
+
+
+@receiver(post_save, sender=CourseCertificateSignatories, dispatch_uid="program_structure_course_signatory_post_save")
+@receiver(
+    post_delete, sender=CourseCertificateSignatories, dispatch_uid="program_structure_course_signatory_post_delete"
+)
+def handle_course_signatory_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a signatory of a course certificate is saved or deleted
+    """
+    _invalidate_course_program_structure({'id': instance.course_id})
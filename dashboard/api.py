@@ -2,37 +2,47 @@
 Apis for the dashboard
 """
 import datetime
+import json
 import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from urllib.parse import urljoin
 
 import pytz
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.exceptions import ImproperlyConfigured
 from django.db import transaction
-from django.db.models import Prefetch
+from django.db.models import Exists, OuterRef, Q
 from django.urls import reverse
 from django_redis import get_redis_connection
 from edx_api.client import EdxApi
+from requests.exceptions import HTTPError
+from rest_framework.utils.encoders import JSONEncoder
+from social_django.models import UserSocialAuth
 
 from backends import utils
 from backends.constants import (BACKEND_EDX_ORG, BACKEND_MITX_ONLINE,
                                 COURSEWARE_BACKEND_URL, COURSEWARE_BACKENDS)
 from backends.exceptions import InvalidCredentialStored
 from backends.utils import has_social_auth
-from courses.models import CourseRun, ElectiveCourse, Program
+from courses.models import Program
+from courses.program_structure import (get_program_structure,
+                                       get_program_structure_version,
+                                       get_program_structure_versions)
 from courses.utils import format_season_year_for_course_run
+from exams.constants import NEXT_SEMESTER_EXAM_DELAY
 from exams.models import ExamAuthorization, ExamRun
-from dashboard.api_edx_cache import CachedEdxDataApi
+from dashboard.api_edx_cache import (CachedEdxDataApi, UserCacheFreshness,
+                                     raise_for_invalid_credentials)
 from dashboard.constants import DEDP_PROGRAM_TITLE
-from dashboard.models import ProgramEnrollment
+from dashboard.models import (CachedEnrollment, DashboardDocument,
+                              ProgramEnrollment, UserCacheRefreshTime)
 from dashboard.utils import get_mmtrack
 from grades import api
 from grades.models import FinalGrade
 from grades.serializers import ProctoredExamGradeSerializer
 from micromasters.utils import now_in_utc
-# key that stores user_key and number of failures in a hash
-from profiles.api import get_social_auth
 
 User = get_user_model()
 
@@ -40,6 +50,22 @@ CACHE_KEY_FAILURE_NUMS_BY_USER = "update_cache_401_failure_numbers"
 # key that stores user ids to exclude from cache update
 CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE = "failed_cache_update_users_not_to_update"
 FIELD_USER_ID_BASE_STR = "user_{0}"
+# maximum number of requests to edX made at the same time to refresh the caches of a user
+DASHBOARD_EDX_REFRESH_MAX_WORKERS = 4
+# sorted set of the ids of the users whose edX caches are refreshed in background, scored by start timestamp
+CACHE_KEY_DASHBOARD_REFRESHES_IN_FLIGHT = "dashboard_refreshes_in_flight"
+# key that stores the courseware backends whose credentials were refused by the last background refresh of a user
+CACHE_KEY_INVALID_BACKENDS_BY_USER = "dashboard_invalid_backend_credentials_{0}"
+# sorted set of the ids of the users who loaded their dashboard, scored by the timestamp of their last visit
+CACHE_KEY_DASHBOARD_ACTIVITY = "dashboard_recent_activity"
+# visits to the dashboard older than this are not taken into account to rank the users in bulk updates
+DASHBOARD_ACTIVITY_WINDOW = datetime.timedelta(days=7)
+# the users enrolled in a run whose final grades are frozen within this delay are refreshed first in bulk updates
+FREEZE_GRADE_HORIZON = datetime.timedelta(days=7)
+# the priority of a user in bulk updates is the sum of the priorities of the reasons why fresh edX data matters
+REFRESH_PRIORITY_FREEZE_APPROACHING = 4
+REFRESH_PRIORITY_LIVE_RUN = 2
+REFRESH_PRIORITY_DASHBOARD_ACTIVITY = 1
 
 log = logging.getLogger(__name__)
 
@@ -138,34 +164,107 @@ def get_user_program_info(user, *, update_cache=True):
     Returns:
         list: Enrolled Program information
     """
+    freshness = UserCacheFreshness(user)
     invalid_backend_credentials = []
     if update_cache:
-        for backend in COURSEWARE_BACKENDS:
-            try:
-                update_cache_for_backend(user, backend)
-            except InvalidCredentialStored:
-                log.info("Invalid credentials token for user: %s, provider: %s", user, backend)
-                invalid_backend_credentials.append(backend)
-            except:  # pylint: disable=bare-except
-                log.exception("Unexpected error refreshing user dashboard")
+        invalid_backend_credentials = refresh_user_caches(user, freshness=freshness)
 
-    response_data = {
-        "programs": [],
-        "is_edx_data_fresh": CachedEdxDataApi.are_all_caches_fresh(user),
+    all_programs = Program.objects.filter(live=True, programenrollment__user=user)
+    return {
+        "programs": get_dashboard_documents(user, all_programs),
+        "is_edx_data_fresh": freshness.are_all_caches_fresh(),
         "invalid_backend_credentials": invalid_backend_credentials,
     }
-    all_programs = (
-        Program.objects.filter(live=True, programenrollment__user=user).prefetch_related(
-            Prefetch(
-                'course_set__courserun_set',
-                queryset=CourseRun.objects.not_discontinued()
-            )
+
+
+def compute_dashboard_document(user, program):
+    """
+    Computes the dashboard information of a user in a program from the database
+
+    Args:
+        user (User): A user
+        program (Program): A program where the user is enrolled
+
+    Returns:
+        dict: the dashboard information of the program
+    """
+    return get_info_for_program(get_mmtrack(user, program, preload=True))
+
+
+def get_dashboard_documents(user, programs):
+    """
+    Returns the dashboard information of a user for some programs. The stored documents are used while
+    none of their inputs changed and no date of their program passed, the others are computed and stored.
+
+    Args:
+        user (User): A user
+        programs (iterable of Program): Programs where the user is enrolled
+
+    Returns:
+        list: the dashboard information of each program
+    """
+    # read before computing, so that a change made meanwhile makes the new documents stale
+    generation = DashboardDocument.get_generation(user.id)
+    programs = list(programs)
+    structure_versions = get_program_structure_versions(program.id for program in programs)
+    now = now_in_utc()
+    documents = {
+        document.program_id: document for document in DashboardDocument.objects.filter(
+            Q(expires_on__isnull=True) | Q(expires_on__gt=now),
+            user=user,
+            program__in=programs,
+            generation=generation,
         )
-    )
-    for program in all_programs:
-        mmtrack_info = get_mmtrack(user, program)
-        response_data['programs'].append(get_info_for_program(mmtrack_info))
-    return response_data
+        if document.structure_version == structure_versions[document.program_id]
+    }
+    programs_data = []
+    for program in programs:
+        document = documents.get(program.id)
+        if document is not None:
+            programs_data.append(document.data)
+            continue
+        program_data = compute_dashboard_document(user, program)
+        DashboardDocument.objects.update_or_create(
+            user=user,
+            program=program,
+            defaults={
+                'data': program_data,
+                'generation': generation,
+                'structure_version': structure_versions[program.id],
+                # the course run statuses and the exam dates may change from then on
+                'expires_on': get_program_structure(program.id).get_next_boundary(now),
+            }
+        )
+        programs_data.append(program_data)
+    return programs_data
+
+
+def check_dashboard_document(document):
+    """
+    Compares a stored dashboard document with a live computation of the same information
+
+    Args:
+        document (DashboardDocument): A stored dashboard document
+
+    Returns:
+        bool: True if the stored document matches the live computation,
+            or None if the document is stale and would not be served anyway
+    """
+    if (
+            document.generation != DashboardDocument.get_generation(document.user_id) or
+            document.structure_version != get_program_structure_version(document.program_id) or
+            (document.expires_on is not None and document.expires_on <= now_in_utc())
+    ):
+        return None
+    program_data = json.loads(json.dumps(compute_dashboard_document(document.user, document.program), cls=JSONEncoder))
+    if program_data != document.data:
+        log.error(
+            'Stored dashboard document of user %s in program %s differs from the live computation',
+            document.user.username,
+            document.program.id,
+        )
+        return False
+    return True
 
 
 def get_info_for_program(mmtrack):
@@ -180,6 +279,7 @@ def get_info_for_program(mmtrack):
     """
     # basic data for the program
     backend = BACKEND_MITX_ONLINE if mmtrack.program.has_mitxonline_courses else BACKEND_EDX_ORG
+    program_structure = get_program_structure(mmtrack.program.id)
     print(has_social_auth(mmtrack.user, backend))
     data = {
         "id": mmtrack.program.pk,
@@ -192,8 +292,8 @@ def get_info_for_program(mmtrack):
         "certificate": mmtrack.get_program_certificate_url(),
         "number_courses_required": (
             mmtrack.program.num_required_courses
-            if mmtrack.program.electives_set.exists()
-            else mmtrack.program.course_set.count()
+            if program_structure.electives_sets
+            else len(program_structure.courses)
         ),
         "number_courses_passed": mmtrack.get_number_of_passed_courses_for_completion(),
         "has_mitxonline_courses": mmtrack.program.has_mitxonline_courses,
@@ -206,7 +306,7 @@ def get_info_for_program(mmtrack):
     program_letter_url = mmtrack.get_program_letter_url()
     if program_letter_url:
         data["program_letter_url"] = program_letter_url
-    for course in mmtrack.program.course_set.all():
+    for course in program_structure.courses:
         data['courses'].append(
             get_info_for_course(course, mmtrack)
         )
@@ -225,6 +325,7 @@ def get_info_for_course(course, mmtrack):
         dict: dictionary representing the course status for the user
     """
     # pylint: disable=too-many-statements
+    program_structure = get_program_structure(course.program_id)
 
     # data about the course to be returned anyway
     course_data = {
@@ -244,8 +345,8 @@ def get_info_for_course(course, mmtrack):
         "proctorate_exams_grades": ProctoredExamGradeSerializer(
             mmtrack.get_course_proctorate_exam_results(course), many=True
         ).data,
-        "is_elective": ElectiveCourse.objects.filter(course=course).exists(),
-        "has_exam": course.has_exam,
+        "is_elective": program_structure.is_elective(course.id),
+        "has_exam": program_structure.has_exam(course.id),
         "certificate_url": get_certificate_url(mmtrack, course),
         "overall_grade": mmtrack.get_overall_final_grade_for_course(course),
         "is_passed": mmtrack.has_passed_course(course)
@@ -267,13 +368,13 @@ def get_info_for_course(course, mmtrack):
         else:
             course_data['runs'].append(formatted_run)
 
+    course_runs = program_structure.get_course_runs(course.id)
+    if not course_runs:
+        return course_data
     with transaction.atomic():
-        runs_qs = course.courserun_set.not_discontinued()
-        if not runs_qs.count():
-            return course_data
         # get all the run statuses
         run_statuses = [get_status_for_courserun(course_run, mmtrack)
-                        for course_run in runs_qs]
+                        for course_run in course_runs]
     # sort them by end date
     run_statuses.sort(key=lambda x: x.course_run.end_date or
                       datetime.datetime(datetime.MAXYEAR, 1, 1, tzinfo=pytz.utc), reverse=True)
@@ -341,6 +442,19 @@ def get_info_for_course(course, mmtrack):
     return course_data
 
 
+def _add_frozen_grade_to_mmtrack(mmtrack, final_grade):
+    """
+    Makes a final grade frozen after the MMTrack was created visible to its preloaded snapshot, if any
+
+    Args:
+        mmtrack (dashboard.utils.MMTrack): a instance of all user information about a program
+        final_grade (FinalGrade): the newly frozen final grade
+    """
+    snapshot = getattr(mmtrack, 'snapshot', None)
+    if snapshot is not None and final_grade is not None:
+        snapshot.add_final_grade(final_grade)
+
+
 def get_final_grade(mmtrack, course_run):
     """
     returns final grade if available otherwise freezes the grade.
@@ -364,6 +478,7 @@ def get_final_grade(mmtrack, course_run):
             course_run.edx_course_key,
         )
         final_grade = api.freeze_user_final_grade(mmtrack.user, course_run, raise_on_exception=True)
+        _add_frozen_grade_to_mmtrack(mmtrack, final_grade)
 
     return final_grade
 
@@ -410,7 +525,10 @@ def get_status_for_courserun(course_run, mmtrack):  # pylint: disable=too-many-r
         elif course_run.has_frozen_grades:
             # be sure that the user has a final grade or freeze now
             if not mmtrack.has_final_grade(course_run.edx_course_key):
-                api.freeze_user_final_grade(mmtrack.user, course_run, raise_on_exception=True)
+                _add_frozen_grade_to_mmtrack(
+                    mmtrack,
+                    api.freeze_user_final_grade(mmtrack.user, course_run, raise_on_exception=True)
+                )
             status = CourseRunStatus.CHECK_IF_PASSED
         # this last check needs to be done as last one
         elif course_run.is_past:
@@ -521,9 +639,9 @@ def get_exam_register_end_date(course):
     """
     Get a formatted string of dates during which the exam is schedulable
     """
-    schedulable_exam_run = ExamRun.get_currently_schedulable(course).first()
-    if schedulable_exam_run is not None:
-        return schedulable_exam_run.date_last_schedulable.strftime("%B %-d, %I:%M %p %Z")
+    schedulable_exam_runs = get_program_structure(course.program_id).get_currently_schedulable_exam_runs(course.id)
+    if schedulable_exam_runs:
+        return schedulable_exam_runs[0].date_last_schedulable.strftime("%B %-d, %I:%M %p %Z")
     return ""
 
 
@@ -562,8 +680,10 @@ def get_future_exam_runs(course):
         list(str): a list of dates when future exams become schedulable
     """
 
-    return (ExamRun.get_schedulable_in_future(course).
-            order_by('date_first_schedulable').values_list('date_first_schedulable', flat=True))
+    return [
+        exam_run.date_first_schedulable
+        for exam_run in get_program_structure(course.program_id).get_exam_runs_schedulable_in_future(course.id)
+    ]
 
 
 def get_exam_date_next_semester(course):
@@ -579,19 +699,24 @@ def get_exam_date_next_semester(course):
     Returns:
         str: a string representation exam start date, example: Apr 5, 2021
     """
-    current_course_run = (
-        CourseRun.objects.not_discontinued()
-        .filter(start_date__lte=now_in_utc(), course=course)
-        .order_by('-start_date').first()
+    program_structure = get_program_structure(course.program_id)
+    now = now_in_utc()
+    current_course_run = max(
+        (
+            course_run for course_run in program_structure.get_course_runs(course.id)
+            if course_run.start_date is not None and course_run.start_date <= now
+        ),
+        key=lambda course_run: course_run.start_date,
+        default=None,
     )
-    three_months = datetime.timedelta(weeks=12)
     if current_course_run is None or current_course_run.upgrade_deadline is None:
-        next_date = now_in_utc() + three_months
+        next_date = now + NEXT_SEMESTER_EXAM_DELAY
     else:
-        next_date = current_course_run.upgrade_deadline + three_months
-    exam_run = ExamRun.get_schedulable_in_future(course).filter(
-        date_first_schedulable__gte=next_date
-    ).order_by('date_first_schedulable').first()
+        next_date = current_course_run.upgrade_deadline + NEXT_SEMESTER_EXAM_DELAY
+    exam_run = next((
+        exam_run for exam_run in program_structure.get_exam_runs_schedulable_in_future(course.id)
+        if exam_run.date_first_schedulable >= next_date
+    ), None)
 
     return exam_run.date_last_eligible.strftime('%b %-d, %Y') if exam_run else ""
 
@@ -607,7 +732,8 @@ def get_current_exam_run_dates(course):
     Returns:
         str: a string representation of scheduling window for current exam run
     """
-    schedulable_exam_run = ExamRun.get_currently_schedulable(course).first()
+    schedulable_exam_runs = get_program_structure(course.program_id).get_currently_schedulable_exam_runs(course.id)
+    schedulable_exam_run = schedulable_exam_runs[0] if schedulable_exam_runs else None
 
     return '{} and {}'.format(
         schedulable_exam_run.date_first_eligible.strftime('%b %-d'),
@@ -640,6 +766,38 @@ def get_certificate_url(mmtrack, course):
     return url
 
 
+def _get_users_to_refresh_in_bulk():
+    """
+    Returns:
+        QuerySet: the users which would be updated when running a bulk update
+    """
+    refresh_time_limit = now_in_utc() - datetime.timedelta(hours=6)
+
+    con = get_redis_connection("redis")
+    user_ids_invalid_credentials = con.smembers(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE)
+
+    # If one of these fields is null in the database the gte expression will be false, so we will refresh those users
+    users = User.objects.filter(
+        Exists(UserSocialAuth.objects.filter(user=OuterRef('pk'))),
+        ~Exists(UserCacheRefreshTime.objects.filter(
+            user=OuterRef('pk'),
+            enrollment__gte=refresh_time_limit,
+            certificate__gte=refresh_time_limit,
+            current_grade__gte=refresh_time_limit,
+        )),
+        is_active=True,
+        profile__fake_user=False,
+    ).exclude(id__in=user_ids_invalid_credentials)
+
+    if not settings.UPDATE_EDX_DATA_FOR_DEDP_PROGRAM_USERS:
+        # the users enrolled only in the DEDP program are left out
+        users = users.exclude(
+            Exists(ProgramEnrollment.objects.filter(user=OuterRef('pk'), program__title=DEDP_PROGRAM_TITLE)) &
+            ~Exists(ProgramEnrollment.objects.filter(user=OuterRef('pk')).exclude(program__title=DEDP_PROGRAM_TITLE))
+        )
+    return users
+
+
 def calculate_users_to_refresh_in_bulk():
     """
     Calculate the set of user ids which would be updated when running a bulk update. This uses a 6 hour delta
@@ -648,38 +806,60 @@ def calculate_users_to_refresh_in_bulk():
     Returns:
         list of int: A list of user ids which need to be updated
     """
-    refresh_time_limit = now_in_utc() - datetime.timedelta(hours=6)
+    return list(_get_users_to_refresh_in_bulk().values_list("id", flat=True).iterator())
 
-    all_users = User.objects.filter(is_active=True, profile__fake_user=False).exclude(social_auth=None)
 
-    con = get_redis_connection("redis")
-    user_ids_invalid_credentials = con.smembers(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE)
+def rank_users_to_refresh_in_bulk():
+    """
+    Ranks the users returned by calculate_users_to_refresh_in_bulk by how much fresh edX data matters for them:
+    the users enrolled in a run whose final grades are about to be frozen come first, then the users
+    enrolled in a run which is currently running, then the users who recently loaded their dashboard.
 
-    # If one of these fields is null in the database the gte expression will be false, so we will refresh those users
-    users_not_expired = all_users.filter(
-        usercacherefreshtime__enrollment__gte=refresh_time_limit,
-        usercacherefreshtime__certificate__gte=refresh_time_limit,
-        usercacherefreshtime__current_grade__gte=refresh_time_limit
+    Returns:
+        dict: the priority of each user id to update, the higher the sooner
+    """
+    now = now_in_utc()
+    con = get_redis_connection("redis")
+    con.zremrangebyscore(
+        CACHE_KEY_DASHBOARD_ACTIVITY, "-inf", (now - DASHBOARD_ACTIVITY_WINDOW).timestamp()
     )
-
-    only_dedp_users = []
-    if not settings.UPDATE_EDX_DATA_FOR_DEDP_PROGRAM_USERS:
-        dedp_users = ProgramEnrollment.objects.filter(
-            program__title=DEDP_PROGRAM_TITLE
-        ).values_list('user__id', flat=True)
-        non_dedp_users = ProgramEnrollment.objects.exclude(
-            program__title=DEDP_PROGRAM_TITLE
-        ).filter(
-            user__id__in=dedp_users
-        ).values_list('user__id', flat=True).distinct()
-        only_dedp_users = list(set(dedp_users) - set(non_dedp_users))
-    return list(
-        all_users
-        .exclude(id__in=users_not_expired.values_list("id", flat=True))
-        .exclude(id__in=user_ids_invalid_credentials)
-        .exclude(id__in=only_dedp_users)
-        .values_list("id", flat=True)
+    active_user_ids = {int(user_id) for user_id in con.zrange(CACHE_KEY_DASHBOARD_ACTIVITY, 0, -1)}
+
+    users = _get_users_to_refresh_in_bulk().annotate(
+        freeze_approaching=Exists(CachedEnrollment.objects.filter(
+            user=OuterRef('pk'),
+            course_run__freeze_grade_date__gte=now,
+            course_run__freeze_grade_date__lte=now + FREEZE_GRADE_HORIZON,
+        )),
+        in_live_run=Exists(CachedEnrollment.objects.filter(
+            Q(course_run__end_date__isnull=True) | Q(course_run__end_date__gte=now),
+            user=OuterRef('pk'),
+            course_run__start_date__lte=now,
+        )),
     )
+    priorities = {}
+    for user_id, freeze_approaching, in_live_run in users.values_list(
+            "id", "freeze_approaching", "in_live_run"
+    ).iterator():
+        priority = 0
+        if freeze_approaching:
+            priority += REFRESH_PRIORITY_FREEZE_APPROACHING
+        if in_live_run:
+            priority += REFRESH_PRIORITY_LIVE_RUN
+        if user_id in active_user_ids:
+            priority += REFRESH_PRIORITY_DASHBOARD_ACTIVITY
+        priorities[user_id] = priority
+    return priorities
+
+
+def record_dashboard_activity(user_id):
+    """
+    Records that a user loaded their dashboard, so their edX data is refreshed sooner by bulk updates
+
+    Args:
+        user_id (int): The user id
+    """
+    get_redis_connection("redis").zadd(CACHE_KEY_DASHBOARD_ACTIVITY, {user_id: time.time()})
 
 
 def refresh_user_data(user_id, provider):
@@ -687,45 +867,59 @@ def refresh_user_data(user_id, provider):
     Refresh the edx cache data for a user.
 
     Note that this function will not raise an exception on error, instead the errors are logged.
+    If edX throttles the requests the caches left are not refreshed, and this is not counted as a failure.
 
     Args:
         provider (str): name of the courseware backend
         user_id (int): The user id
+
+    Returns:
+        bool: True if edX responded with a 429 status code
     """
     # pylint: disable=bare-except
     try:
         user = User.objects.get(pk=user_id)
     except:
         log.exception('edX data refresh task: unable to get user "%s"', user_id)
-        return
+        return False
 
+    freshness = UserCacheFreshness(user)
     # get the credentials for the current user for edX
-    try:
-        user_social = get_social_auth(user, provider)
-    except ObjectDoesNotExist:
+    user_social = freshness.get_social_auth(provider)
+    if user_social is None:
         log.info('No social auth for %s for user %s', provider, user.username)
-        return
+        return False
 
     try:
         utils.refresh_user_token(user_social)
     except:
         save_cache_update_failure(user_id)
         log.exception("Unable to refresh token for student %s", user.username)
-        return
+        return False
 
     try:
         edx_client = EdxApi(user_social.extra_data, COURSEWARE_BACKEND_URL[provider])
     except:
         log.exception("Unable to create an edX client object for student %s", user.username)
-        return
+        return False
 
-    for cache_type in CachedEdxDataApi.CACHE_TYPES_BACKEND[provider]:
-        try:
-            CachedEdxDataApi.update_cache_if_expired(user, edx_client, cache_type, provider)
-        except:
-            save_cache_update_failure(user_id)
-            log.exception("Unable to refresh cache %s for student %s", cache_type, user.username)
-            continue
+    try:
+        for cache_type in CachedEdxDataApi.CACHE_TYPES_BACKEND[provider]:
+            try:
+                CachedEdxDataApi.update_cache_if_expired(user, edx_client, cache_type, provider, freshness=freshness)
+            except HTTPError as exc:
+                if exc.response is not None and exc.response.status_code == 429:
+                    log.warning("edX throttled the refresh of cache %s for student %s", cache_type, user.username)
+                    return True
+                save_cache_update_failure(user_id)
+                log.exception("Unable to refresh cache %s for student %s", cache_type, user.username)
+            except:
+                save_cache_update_failure(user_id)
+                log.exception("Unable to refresh cache %s for student %s", cache_type, user.username)
+                continue
+    finally:
+        freshness.save()
+    return False
 
 
 def save_cache_update_failure(user_id):
@@ -742,36 +936,263 @@ def save_cache_update_failure(user_id):
         con.sadd(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, user_id)
 
 
-def update_cache_for_backend(user, provider):
+def _get_dashboard_edx_client(user, provider, timeout=None, freshness=None):
     """
-    Update learners cache based on courseware backend
+    Refreshes the credentials of a user for a courseware backend and returns an edX client using them
 
     Args:
         provider (str): name of the courseware backend
         user (django.contrib.auth.models.User): A user
+        timeout (float): optional timeout in seconds of the requests made by the client
+        freshness (UserCacheFreshness): the freshness state of the user holding the social auths, if any
+
+    Returns:
+        EdxApi: an edX client, or None if the user has no social auth for the backend
     """
-    user_social = None
-    try:
-        user_social = get_social_auth(user, provider)
-    except ObjectDoesNotExist:
+    if freshness is None:
+        freshness = UserCacheFreshness(user)
+    user_social = freshness.get_social_auth(provider)
+    if user_social is None:
         log.info('No social auth for %s for user %s', provider, user.username)
+        return None
 
-    if user_social is not None:
-        try:
-            utils.refresh_user_token(user_social)
-        except InvalidCredentialStored:
-            raise
-        except:  # pylint: disable=bare-except
-            log.exception('Impossible to refresh user credentials in dashboard view')
-        # create an instance of the client to query edX
-        edx_client = EdxApi(user_social.extra_data, COURSEWARE_BACKEND_URL[provider])
+    try:
+        utils.refresh_user_token(user_social)
+    except InvalidCredentialStored:
+        raise
+    except:  # pylint: disable=bare-except
+        log.exception('Impossible to refresh user credentials in dashboard view')
+    # create an instance of the client to query edX
+    if timeout is None:
+        return EdxApi(user_social.extra_data, COURSEWARE_BACKEND_URL[provider])
+    return EdxApi(user_social.extra_data, COURSEWARE_BACKEND_URL[provider], timeout=timeout)
+
+
+def _fetch_edx_data(fetch):
+    """
+    Runs the step of a cache update making the requests to edX
+
+    Args:
+        fetch (callable): a function fetching some data from edX
+
+    Returns:
+        the data fetched from edX
+    """
+    try:
+        return fetch()
+    except HTTPError as exc:
+        raise_for_invalid_credentials(exc)
+        raise
+
+
+def refresh_user_caches(user, budget_ms=None, freshness=None):
+    """
+    Refreshes the expired edX caches of a user for all the courseware backends. The requests to edX are
+    made concurrently, the enrollments first and then the certificates and the current grades,
+    while the data is saved by the calling thread. The caches whose requests are still running once
+    the budget is spent are left expired.
+
+    Args:
+        user (django.contrib.auth.models.User): A user
+        budget_ms (int): the time in milliseconds given to the refresh,
+            settings.DASHBOARD_EDX_REFRESH_BUDGET_MS by default
+        freshness (UserCacheFreshness): the freshness state of the user, if already loaded.
+            The refresh times are saved with one query at the end.
+
+    Returns:
+        list of str: the courseware backends for which the credentials of the user are invalid
+    """
+    if budget_ms is None:
+        budget_ms = settings.DASHBOARD_EDX_REFRESH_BUDGET_MS
+    if freshness is None:
+        freshness = UserCacheFreshness(user)
+    budget = budget_ms / 1000
+    deadline = time.monotonic() + budget
+    invalid_backend_credentials = []
+    # future -> (provider, cache type, function saving the fetched data)
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=DASHBOARD_EDX_REFRESH_MAX_WORKERS)
+
+    def submit(provider, edx_client, cache_types):
+        """Starts fetching the expired caches"""
+        for cache_type in cache_types:
+            if freshness.is_cache_fresh(cache_type):
+                continue
+            fetch, save = CachedEdxDataApi.get_cache_update_steps(
+                user, edx_client, cache_type, provider, freshness=freshness
+            )
+            pending[executor.submit(_fetch_edx_data, fetch)] = (provider, cache_type, save)
+
+    def invalidate_backend(provider):
+        """Stops refreshing a backend whose credentials were refused"""
+        log.info("Invalid credentials token for user: %s, provider: %s", user, provider)
+        if provider not in invalid_backend_credentials:
+            invalid_backend_credentials.append(provider)
+        for future, (future_provider, _, _) in list(pending.items()):
+            if future_provider == provider:
+                future.cancel()
+                del pending[future]
+
+    edx_clients = {}
+    try:
+        for provider in COURSEWARE_BACKENDS:
+            try:
+                edx_client = _get_dashboard_edx_client(user, provider, timeout=budget, freshness=freshness)
+            except InvalidCredentialStored:
+                invalid_backend_credentials.append(provider)
+                log.info("Invalid credentials token for user: %s, provider: %s", user, provider)
+                continue
+            except:  # pylint: disable=bare-except
+                log.exception("Unexpected error refreshing user dashboard")
+                continue
+            if edx_client is None:
+                continue
+            edx_clients[provider] = edx_client
+            # the other caches depend on the enrollments, so they are fetched once the enrollments are saved
+            enrollment_cache_type, *other_cache_types = CachedEdxDataApi.CACHE_TYPES_BACKEND[provider]
+            if freshness.is_cache_fresh(enrollment_cache_type):
+                submit(provider, edx_client, other_cache_types)
+            else:
+                submit(provider, edx_client, [enrollment_cache_type])
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning(
+                    "edX data refresh for user %s ran out of time, the dashboard is shown with stale data",
+                    user.username,
+                )
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in pending:
+                    continue
+                provider, cache_type, save = pending.pop(future)
+                try:
+                    save(future.result())
+                except InvalidCredentialStored:
+                    invalidate_backend(provider)
+                    continue
+                except:  # pylint: disable=bare-except
+                    log.exception('Impossible to refresh edX cache')
+                    continue
+                enrollment_cache_type, *other_cache_types = CachedEdxDataApi.CACHE_TYPES_BACKEND[provider]
+                if cache_type == enrollment_cache_type:
+                    submit(provider, edx_clients[provider], other_cache_types)
+    finally:
+        # the requests still running are abandoned, their threads end with the client timeout
+        executor.shutdown(wait=False, cancel_futures=True)
+        freshness.save()
+    return invalid_backend_credentials
+
+
+def start_background_refresh(user_id):
+    """
+    Marks the edX caches of a user as being refreshed in background, unless they already are.
+    A refresh started more than settings.DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS ago is considered lost.
+
+    Args:
+        user_id (int): The user id
+
+    Returns:
+        bool: True if the caller should start the refresh, False if one is already running
+    """
+    now = time.time()
+    con = get_redis_connection("redis")
+    con.zremrangebyscore(
+        CACHE_KEY_DASHBOARD_REFRESHES_IN_FLIGHT, "-inf", now - settings.DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS
+    )
+    return con.zadd(CACHE_KEY_DASHBOARD_REFRESHES_IN_FLIGHT, {user_id: now}, nx=True) == 1
+
+
+def finish_background_refresh(user_id, invalid_backend_credentials):
+    """
+    Records the end of the background refresh of the edX caches of a user
+
+    Args:
+        user_id (int): The user id
+        invalid_backend_credentials (list of str): the courseware backends whose credentials were refused
+    """
+    pipe = get_redis_connection("redis").pipeline()
+    pipe.set(CACHE_KEY_INVALID_BACKENDS_BY_USER.format(user_id), json.dumps(invalid_backend_credentials))
+    pipe.zrem(CACHE_KEY_DASHBOARD_REFRESHES_IN_FLIGHT, user_id)
+    pipe.execute()
+
+
+def is_background_refresh_running(user_id):
+    """
+    Args:
+        user_id (int): The user id
+
+    Returns:
+        bool: whether the edX caches of the user are being refreshed in background
+    """
+    started_on = get_redis_connection("redis").zscore(CACHE_KEY_DASHBOARD_REFRESHES_IN_FLIGHT, user_id)
+    return started_on is not None and (
+        started_on > time.time() - settings.DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS
+    )
+
+
+def get_background_invalid_backend_credentials(user_id):
+    """
+    Args:
+        user_id (int): The user id
+
+    Returns:
+        list of str: the courseware backends whose credentials were refused by the last background refresh
+    """
+    invalid_backend_credentials = get_redis_connection("redis").get(CACHE_KEY_INVALID_BACKENDS_BY_USER.format(user_id))
+    return json.loads(invalid_backend_credentials) if invalid_backend_credentials is not None else []
+
+
+def get_dashboard_freshness(user):
+    """
+    Returns the information needed by the dashboard to know whether it should be reloaded
+
+    Args:
+        user (django.contrib.auth.models.User): A user
+
+    Returns:
+        dict: whether the edX data is fresh and is being refreshed, and a version
+            which changes whenever the dashboard information of the user may have changed
+    """
+    is_edx_data_fresh = UserCacheFreshness(user).are_all_caches_fresh()
+    is_refreshing = is_background_refresh_running(user.id)
+    structure_versions = get_program_structure_versions(
+        ProgramEnrollment.objects.filter(user=user).order_by('program_id').values_list('program_id', flat=True)
+    )
+    return {
+        "is_edx_data_fresh": is_edx_data_fresh,
+        "is_refreshing": is_refreshing,
+        "version": "{generation}.{structure_version}.{fresh:d}.{refreshing:d}".format(
+            generation=DashboardDocument.get_generation(user.id),
+            structure_version="-".join(str(version) for version in structure_versions.values()),
+            fresh=is_edx_data_fresh,
+            refreshing=is_refreshing,
+        ),
+    }
+
+
+def update_cache_for_backend(user, provider):
+    """
+    Update learners cache based on courseware backend
+
+    Args:
+        provider (str): name of the courseware backend
+        user (django.contrib.auth.models.User): A user
+    """
+    freshness = UserCacheFreshness(user)
+    edx_client = _get_dashboard_edx_client(user, provider, freshness=freshness)
+    if edx_client is not None:
         try:
             for cache_type in CachedEdxDataApi.CACHE_TYPES_BACKEND[provider]:
-                CachedEdxDataApi.update_cache_if_expired(user, edx_client, cache_type, provider)
+                CachedEdxDataApi.update_cache_if_expired(user, edx_client, cache_type, provider, freshness=freshness)
         except InvalidCredentialStored:
             raise
         except:  # pylint: disable=bare-except
             log.exception('Impossible to refresh edX cache')
+        finally:
+            freshness.save()
 
 
 def is_user_enrolled_in_exam_course(edx_client, exam_run):
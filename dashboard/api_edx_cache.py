@@ -6,14 +6,15 @@ import logging
 from collections import namedtuple
 
 from django.db import transaction
+from django.utils.functional import cached_property
 from edx_api.client import EdxApi
 from requests.exceptions import HTTPError
+from social_django.models import UserSocialAuth
 
 from backends import utils
 from backends.constants import (BACKEND_EDX_ORG, BACKEND_MITX_ONLINE,
                                 COURSEWARE_BACKEND_URL)
 from backends.exceptions import InvalidCredentialStored
-from backends.utils import has_social_auth
 from courses.models import CourseRun
 from dashboard import models
 from micromasters.utils import now_in_utc
@@ -26,23 +27,83 @@ UserCachedRunData = namedtuple(
     'UserCachedRunData', ['edx_course_key', 'enrollment', 'certificate', 'current_grade'])
 
 
+def raise_for_invalid_credentials(exc):
+    """
+    Raises InvalidCredentialStored if an HTTP error from edX means that the access token was refused
+
+    Args:
+        exc (HTTPError): an error from a request to edX
+    """
+    if exc.response.status_code in (400, 401,):
+        raise InvalidCredentialStored(
+            message=f'Received a {exc.response.status_code} status code from the server even'
+            ' if access token was supposed to be valid',
+            http_status_code=exc.response.status_code
+        )
+
+
 class CachedEdxUserData:
     """Represents all edX data related to a User"""
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, user, program=None):
+    def __init__(self, user, program=None, *, enrollments=None, certificates=None, current_grades=None):
         """
         Fetches the given User's edx data and sets object properties
 
         Args:
             user (User): a User object
             program (Program): an optional Program to filter on
+            enrollments (Enrollments): optional preloaded enrollments of the user
+            certificates (Certificates): optional preloaded certificates of the user
+            current_grades (CurrentGradesByUser): optional preloaded current grades of the user
         """
         self.user = user
         self.program = program
-        self.enrollments = models.CachedEnrollment.get_edx_data(self.user, program=self.program)
-        self.certificates = models.CachedCertificate.get_edx_data(self.user, program=self.program)
-        self.current_grades = models.CachedCurrentGrade.get_edx_data(self.user, program=self.program)
+        self.enrollments = (
+            enrollments if enrollments is not None
+            else models.CachedEnrollment.get_edx_data(self.user, program=self.program)
+        )
+        self.certificates = (
+            certificates if certificates is not None
+            else models.CachedCertificate.get_edx_data(self.user, program=self.program)
+        )
+        self.current_grades = (
+            current_grades if current_grades is not None
+            else models.CachedCurrentGrade.get_edx_data(self.user, program=self.program)
+        )
+
+    @classmethod
+    def for_users(cls, users, program=None, course_run=None):
+        """
+        Fetches the edx data of many users with one query per cached model
+
+        Args:
+            users (iterable of User): User objects
+            program (Program): an optional Program to filter on
+            course_run (CourseRun): an optional CourseRun to filter on
+
+        Returns:
+            dict: a map of user id to CachedEdxUserData
+        """
+        users = list(users)
+        enrollments = models.CachedEnrollment.get_edx_data_for_users(
+            users, program=program, course_run=course_run
+        )
+        certificates = models.CachedCertificate.get_edx_data_for_users(
+            users, program=program, course_run=course_run
+        )
+        current_grades = models.CachedCurrentGrade.get_edx_data_for_users(
+            users, program=program, course_run=course_run
+        )
+        return {
+            user.id: cls(
+                user,
+                program=program,
+                enrollments=enrollments[user.id],
+                certificates=certificates[user.id],
+                current_grades=current_grades[user.id],
+            ) for user in users
+        }
 
     def get_run_data(self, course_id):
         """
@@ -133,47 +194,35 @@ class CachedEdxDataApi:
         models.UserCacheRefreshTime.objects.update_or_create(user=user, defaults=updated_values)
 
     @classmethod
-    def is_cache_fresh(cls, user, cache_type):
+    def is_cache_fresh(cls, user, cache_type, freshness=None):
         """
         Checks if the specified cache type is fresh.
 
         Args:
             user (django.contrib.auth.models.User): A user
             cache_type (str): a string representing one of the cached data types
+            freshness (UserCacheFreshness): the already loaded refresh times of the user, if any
         Returns:
             bool
         """
-        if cache_type not in cls.ALL_CACHE_TYPES:
-            raise ValueError(f"{cache_type} is an unsupported cache type")
-        try:
-            cache_timestamps = models.UserCacheRefreshTime.objects.get(user=user)
-        except models.UserCacheRefreshTime.DoesNotExist:
-            return False
-        cache_timestamp = getattr(cache_timestamps, cache_type)
-        return cache_timestamp is not None and cache_timestamp > (
-            now_in_utc() - cls.CACHE_EXPIRATION_DELTAS[cache_type]
-        )
+        if freshness is None:
+            freshness = UserCacheFreshness(user)
+        return freshness.is_cache_fresh(cache_type)
 
     @classmethod
-    def are_all_caches_fresh(cls, user):
+    def are_all_caches_fresh(cls, user, freshness=None):
         """
         Checks if all cache types are fresh.
 
         Args:
             user (django.contrib.auth.models.User): A user
+            freshness (UserCacheFreshness): the already loaded refresh times of the user, if any
         Returns:
             bool
         """
-        edx_cache_fresh = True
-        mitxonline_cache_fresh = True
-
-        if has_social_auth(user, BACKEND_EDX_ORG):
-            edx_cache_fresh = all(cls.is_cache_fresh(user, cache_type) for cache_type in cls.EDX_SUPPORTED_CACHES)
-        if has_social_auth(user, BACKEND_MITX_ONLINE):
-            mitxonline_cache_fresh = all(
-                cls.is_cache_fresh(user, cache_type) for cache_type in cls.MITXONLINE_SUPPORTED_CACHES)
-        return edx_cache_fresh and mitxonline_cache_fresh
-
+        if freshness is None:
+            freshness = UserCacheFreshness(user)
+        return freshness.are_all_caches_fresh()
 
     @classmethod
     def update_cached_enrollment(cls, user, enrollment, course_id, index_user=False):
@@ -206,11 +255,11 @@ class CachedEdxDataApi:
                 defaults=updated_values
             )
         if index_user:
-            # submit a celery task to reindex the user
-            tasks.index_users.delay([user.id], check_if_changed=True)
+            # queue the user to be reindexed
+            tasks.queue_index_users([user.id], check_if_changed=True)
 
     @classmethod
-    def update_cached_enrollments(cls, user, edx_client, provider):
+    def update_cached_enrollments(cls, user, edx_client, provider, freshness=None):
         """
         Updates cached enrollment data for an user for the given courseware backend.
 
@@ -218,29 +267,75 @@ class CachedEdxDataApi:
             provider (str): name of the courseware backend
             user (django.contrib.auth.models.User): A user
             edx_client (EdxApi): EdX client to retrieve enrollments
+            freshness (UserCacheFreshness): the freshness state of the user, if any
         Returns:
             None
         """
         # Fetch new data from edX.
         enrollments = edx_client.enrollments.get_student_enrollments()
+        cls.save_cached_enrollments(user, enrollments, provider, freshness=freshness)
+
+    @staticmethod
+    def _get_social_username(user, provider, freshness):
+        """
+        Returns the edX username of a user, from the freshness state of the user if there is one
+        """
+        if freshness is None:
+            return get_social_username(user, provider)
+        return freshness.get_social_username(provider)
+
+    @classmethod
+    def _record_refresh(cls, user, cache_type, freshness):
+        """
+        Records that a cache type was just refreshed, in the database or in the freshness state of the user
+        """
+        if freshness is None:
+            cls.update_cache_last_access(user, cache_type)
+        else:
+            freshness.mark_refreshed(cache_type)
+
+    @classmethod
+    def _record_change(cls, user, freshness):
+        """
+        Reindexes a user whose cached data changed, or leaves it to the end of the refresh
+        if there is a freshness state, so that a single reindex is made for all the cache types
+        """
+        if freshness is None:
+            # queue the user to be reindexed
+            tasks.queue_index_users([user.id], check_if_changed=True)
+        else:
+            freshness.mark_data_changed()
+
+    @classmethod
+    def save_cached_enrollments(cls, user, enrollments, provider, freshness=None):
+        """
+        Replaces the cached enrollment data of an user for the given courseware backend.
 
+        Args:
+            provider (str): name of the courseware backend
+            user (django.contrib.auth.models.User): A user
+            enrollments (Enrollments): the enrollments fetched from edX
+            freshness (UserCacheFreshness): if given, the refresh time and the need to reindex the user
+                are recorded there instead of being handled right away
+        Returns:
+            None
+        """
         # Make sure all cached enrollments are updated atomically
         with transaction.atomic():
-            # update the current ones
+            # replace the cached enrollments for given courseware backend with the current ones
             all_enrolled_course_ids = enrollments.get_enrolled_course_ids()
-            for course_run in CourseRun.objects.filter(edx_course_key__in=all_enrolled_course_ids):
-                enrollment = enrollments.get_enrollment_for_course(course_run.edx_course_key)
-                cls.update_cached_enrollment(user, enrollment, course_run.edx_course_key)
-            # delete anything is not in the current enrollments for given courseware backend
-            models.CachedEnrollment.delete_all_but(user, list(all_enrolled_course_ids), provider)
+            changed = models.CachedEnrollment.replace_user_data(user, {
+                course_run: enrollments.get_enrollment_for_course(course_run.edx_course_key).json
+                for course_run in CourseRun.objects.filter(edx_course_key__in=all_enrolled_course_ids)
+            }, provider)
             # update the last refresh timestamp
             cache_type = cls.ENROLLMENT if provider == BACKEND_EDX_ORG else cls.ENROLLMENT_MITXONLINE
-            cls.update_cache_last_access(user, cache_type)
-        # submit a celery task to reindex the user
-        tasks.index_users.delay([user.id], check_if_changed=True)
+            cls._record_refresh(user, cache_type, freshness)
+        if changed:
+            cls._record_change(user, freshness)
 
     @classmethod
-    def update_cached_certificates(cls, user, edx_client, provider):
+    def update_cached_certificates(cls, user, edx_client, provider, freshness=None):
         """
         Updates cached certificate data.
 
@@ -248,6 +343,7 @@ class CachedEdxDataApi:
             provider (str): name of the courseware backend
             user (django.contrib.auth.models.User): A user
             edx_client (EdxApi): EdX client to retrieve enrollments
+            freshness (UserCacheFreshness): the freshness state of the user, if any
         Returns:
             None
         """
@@ -258,32 +354,38 @@ class CachedEdxDataApi:
 
         # Certificates are out of date, so fetch new data from edX.
         certificates = edx_client.certificates.get_student_certificates(
-            get_social_username(user, provider), course_ids)
+            cls._get_social_username(user, provider, freshness), course_ids)
+        cls.save_cached_certificates(user, certificates, provider, freshness=freshness)
+
+    @classmethod
+    def save_cached_certificates(cls, user, certificates, provider, freshness=None):
+        """
+        Replaces the cached certificate data of an user.
 
+        Args:
+            provider (str): name of the courseware backend
+            user (django.contrib.auth.models.User): A user
+            certificates (Certificates): the certificates fetched from edX
+            freshness (UserCacheFreshness): if given, the refresh time and the need to reindex the user
+                are recorded there instead of being handled right away
+        Returns:
+            None
+        """
         # This must be done atomically
         with transaction.atomic():
+            # replace the cached certificates with the current ones
             all_cert_course_ids = certificates.all_courses_verified_certs
-            for course_run in CourseRun.objects.filter(edx_course_key__in=all_cert_course_ids):
-                certificate = certificates.get_verified_cert(course_run.edx_course_key)
-                updated_values = {
-                    'user': user,
-                    'course_run': course_run,
-                    'data': certificate.json,
-                }
-                models.CachedCertificate.objects.update_or_create(
-                    user=user,
-                    course_run=course_run,
-                    defaults=updated_values
-                )
-            # delete anything is not in the current certificates
-            models.CachedCertificate.delete_all_but(user, all_cert_course_ids, provider)
+            changed = models.CachedCertificate.replace_user_data(user, {
+                course_run: certificates.get_verified_cert(course_run.edx_course_key).json
+                for course_run in CourseRun.objects.filter(edx_course_key__in=all_cert_course_ids)
+            }, provider)
             # update the last refresh timestamp
-            cls.update_cache_last_access(user, cls.CERTIFICATE)
-        # submit a celery task to reindex the user
-        tasks.index_users.delay([user.id], check_if_changed=True)
+            cls._record_refresh(user, cls.CERTIFICATE, freshness)
+        if changed:
+            cls._record_change(user, freshness)
 
     @classmethod
-    def update_cached_current_grades(cls, user, edx_client, provider):
+    def update_cached_current_grades(cls, user, edx_client, provider, freshness=None):
         """
         Updates cached current grade data for given courseware provider
 
@@ -291,6 +393,7 @@ class CachedEdxDataApi:
             provider (str): name of the courseware backend
             user (django.contrib.auth.models.User): A user
             edx_client (EdxApi): EdX client to retrieve enrollments
+            freshness (UserCacheFreshness): the freshness state of the user, if any
         Returns:
             None
         """
@@ -299,33 +402,39 @@ class CachedEdxDataApi:
 
         # Current Grades are out of date, so fetch new data from edX.
         current_grades = edx_client.current_grades.get_student_current_grades(
-            get_social_username(user, provider), course_ids)
+            cls._get_social_username(user, provider, freshness), course_ids)
+        cls.save_cached_current_grades(user, current_grades, provider, freshness=freshness)
 
+    @classmethod
+    def save_cached_current_grades(cls, user, current_grades, provider, freshness=None):
+        """
+        Replaces the cached current grade data of an user for given courseware provider
+
+        Args:
+            provider (str): name of the courseware backend
+            user (django.contrib.auth.models.User): A user
+            current_grades (CurrentGradesByUser): the current grades fetched from edX
+            freshness (UserCacheFreshness): if given, the refresh time and the need to reindex the user
+                are recorded there instead of being handled right away
+        Returns:
+            None
+        """
         # the update must be done atomically
         with transaction.atomic():
+            # replace the cached current grades with the current ones
             all_grade_course_ids = current_grades.all_course_ids
-            for course_run in CourseRun.objects.filter(edx_course_key__in=all_grade_course_ids):
-                current_grade = current_grades.get_current_grade(course_run.edx_course_key)
-                updated_values = {
-                    'user': user,
-                    'course_run': course_run,
-                    'data': current_grade.json,
-                }
-                models.CachedCurrentGrade.objects.update_or_create(
-                    user=user,
-                    course_run=course_run,
-                    defaults=updated_values
-                )
-            # delete anything is not in the current grades
-            models.CachedCurrentGrade.delete_all_but(user, all_grade_course_ids, provider)
+            changed = models.CachedCurrentGrade.replace_user_data(user, {
+                course_run: current_grades.get_current_grade(course_run.edx_course_key).json
+                for course_run in CourseRun.objects.filter(edx_course_key__in=all_grade_course_ids)
+            }, provider)
             # update the last refresh timestamp
             cache_type = cls.CURRENT_GRADE if provider == BACKEND_EDX_ORG else cls.CURRENT_GRADE_MITXONLINE
-            cls.update_cache_last_access(user, cache_type)
-        # submit a celery task to reindex the user
-        tasks.index_users.delay([user.id], check_if_changed=True)
+            cls._record_refresh(user, cache_type, freshness)
+        if changed:
+            cls._record_change(user, freshness)
 
     @classmethod
-    def update_cache_if_expired(cls, user, edx_client, cache_type, provider):
+    def update_cache_if_expired(cls, user, edx_client, cache_type, provider, freshness=None):
         """
         Checks if the specified cache type is expired and in case takes care to update it.
 
@@ -334,6 +443,8 @@ class CachedEdxDataApi:
             user (django.contrib.auth.models.User): A user
             edx_client (EdxApi): EdX client to retrieve enrollments
             cache_type (str): a string representing one of the cached data types
+            freshness (UserCacheFreshness): the freshness state of the user, if any.
+                The new refresh time is recorded there instead of being saved right away.
         Returns:
             None
         """
@@ -346,19 +457,52 @@ class CachedEdxDataApi:
         }
         if cache_type not in cls.ALL_CACHE_TYPES:
             raise ValueError(f"{cache_type} is an unsupported cache type")
-        if not cls.is_cache_fresh(user, cache_type):
+        if not cls.is_cache_fresh(user, cache_type, freshness=freshness):
             update_func = cache_update_methods[cache_type]
             try:
-                update_func(user, edx_client, provider)
+                update_func(user, edx_client, provider, freshness=freshness)
             except HTTPError as exc:
-                if exc.response.status_code in (400, 401,):
-                    raise InvalidCredentialStored(
-                        message=f'Received a {exc.response.status_code} status code from the server even'
-                        ' if access token was supposed to be valid',
-                        http_status_code=exc.response.status_code
-                    )
+                raise_for_invalid_credentials(exc)
                 raise
 
+    @classmethod
+    def get_cache_update_steps(cls, user, edx_client, cache_type, provider, freshness=None):
+        """
+        Splits the update of a cache type in a step which only makes the requests to edX,
+        so it can run in another thread, and a step saving the fetched data in the database.
+
+        Args:
+            provider (str): name of the courseware backend
+            user (django.contrib.auth.models.User): A user
+            edx_client (EdxApi): EdX client to retrieve the data
+            cache_type (str): a string representing one of the cached data types
+            freshness (UserCacheFreshness): the freshness state of the user, if any
+        Returns:
+            tuple: a function without arguments returning the data fetched from edX,
+                and a function saving that data
+        """
+        if cache_type in (cls.ENROLLMENT, cls.ENROLLMENT_MITXONLINE):
+            return (
+                edx_client.enrollments.get_student_enrollments,
+                lambda enrollments: cls.save_cached_enrollments(user, enrollments, provider, freshness=freshness),
+            )
+        # the user data is looked up here, since the database should not be used by the fetching step
+        username = cls._get_social_username(user, provider, freshness)
+        course_ids = models.CachedEnrollment.active_course_ids(user, provider=provider)
+        if cache_type == cls.CERTIFICATE:
+            return (
+                lambda: edx_client.certificates.get_student_certificates(username, course_ids),
+                lambda certificates: cls.save_cached_certificates(user, certificates, provider, freshness=freshness),
+            )
+        if cache_type in (cls.CURRENT_GRADE, cls.CURRENT_GRADE_MITXONLINE):
+            return (
+                lambda: edx_client.current_grades.get_student_current_grades(username, course_ids),
+                lambda current_grades: cls.save_cached_current_grades(
+                    user, current_grades, provider, freshness=freshness
+                ),
+            )
+        raise ValueError(f"{cache_type} is an unsupported cache type")
+
     @classmethod
     def update_all_cached_grade_data(cls, user, provider):
         """
@@ -376,5 +520,199 @@ class CachedEdxDataApi:
         utils.refresh_user_token(user_social)
         # create an instance of the client to query edX
         edx_client = EdxApi(user_social.extra_data, COURSEWARE_BACKEND_URL[provider])
-        cls.update_cached_certificates(user, edx_client, provider)
-        cls.update_cached_current_grades(user, edx_client, provider)
+        freshness = UserCacheFreshness(user)
+        try:
+            cls.update_cached_certificates(user, edx_client, provider, freshness=freshness)
+            cls.update_cached_current_grades(user, edx_client, provider, freshness=freshness)
+        finally:
+            freshness.save()
+
+    @staticmethod
+    def can_update_course_run_grade_data(course_run):
+        """
+        Whether the current grades of a whole course run can be fetched with the staff credentials
+
+        Args:
+            course_run (CourseRun): a course run
+        Returns:
+            bool
+        """
+        return (
+            course_run.courseware_backend == BACKEND_MITX_ONLINE and
+            utils.get_staff_edx_client_credentials()['access_token'] is not None
+        )
+
+    @classmethod
+    def update_course_run_grade_data(cls, course_run, users):
+        """
+        Updates the cached current grades of many users in a course run with the grades of the whole
+        course run, fetched page by page with the staff credentials.
+        Used before a final grade freeze, in place of update_all_cached_grade_data for each user.
+        MITx Online has no certificates, so only the current grades are updated.
+
+        Args:
+            course_run (CourseRun): a course run for which can_update_course_run_grade_data is true
+            users (iterable of User): the users to update
+        Returns:
+            list of User: the users whose cached current grade was updated,
+                which leaves out the users without a social auth for the courseware backend
+        """
+        provider = course_run.courseware_backend
+        edx_client = EdxApi(utils.get_staff_edx_client_credentials(), COURSEWARE_BACKEND_URL[provider])
+        try:
+            course_grades = edx_client.current_grades.get_course_current_grades(course_run.edx_course_key)
+        except HTTPError as exc:
+            raise_for_invalid_credentials(exc)
+            raise
+
+        users = list(users)
+        user_ids_by_username = dict(
+            UserSocialAuth.objects.filter(provider=provider, user__in=users).values_list('uid', 'user_id')
+        )
+        changed_user_ids = models.CachedCurrentGrade.replace_course_run_data(
+            course_run,
+            user_ids_by_username.values(),
+            {
+                user_ids_by_username[username]: course_grades.current_grades[username].json
+                for username in course_grades.all_usernames
+                if username in user_ids_by_username
+            },
+        )
+        if changed_user_ids:
+            # queue the users to be reindexed
+            tasks.queue_index_users(list(changed_user_ids), check_if_changed=True)
+        refreshed_user_ids = set(user_ids_by_username.values())
+        return [user for user in users if user.id in refreshed_user_ids]
+
+
+class UserCacheFreshness:
+    """
+    The refresh times of the edX caches of a user and the social auths of the user, loaded once
+    to answer every freshness question of a request or a task. The refresh times recorded with
+    mark_refreshed are written back with a single UPDATE by save, which also makes a single reindex
+    of the user if any cached data changed meanwhile.
+    """
+
+    def __init__(self, user):
+        """
+        Args:
+            user (django.contrib.auth.models.User): A user
+        """
+        self.user = user
+        self._refreshed = {}
+        self._data_changed = False
+
+    @cached_property
+    def refresh_time(self):
+        """The UserCacheRefreshTime of the user, or None if there is none yet"""
+        return models.UserCacheRefreshTime.objects.filter(user=self.user).first()
+
+    @cached_property
+    def social_auths(self):
+        """A map of courseware backend to the UserSocialAuth of the user"""
+        return {social_auth.provider: social_auth for social_auth in self.user.social_auth.all()}
+
+    def get_social_auth(self, provider):
+        """
+        Args:
+            provider (str): name of the courseware backend
+
+        Returns:
+            UserSocialAuth: the social auth of the user for the backend, or None if there is none
+        """
+        return self.social_auths.get(provider)
+
+    def has_social_auth(self, provider):
+        """
+        Args:
+            provider (str): name of the courseware backend
+
+        Returns:
+            bool: whether the user has a social auth for the backend
+        """
+        return provider in self.social_auths
+
+    def get_social_username(self, provider):
+        """
+        Args:
+            provider (str): name of the courseware backend
+
+        Returns:
+            str: the username of the user for the backend, or None if there is none
+        """
+        social_auth = self.get_social_auth(provider)
+        return social_auth.uid if social_auth is not None else None
+
+    def is_cache_fresh(self, cache_type):
+        """
+        Checks if the specified cache type is fresh.
+
+        Args:
+            cache_type (str): a string representing one of the cached data types
+        Returns:
+            bool
+        """
+        if cache_type not in CachedEdxDataApi.ALL_CACHE_TYPES:
+            raise ValueError(f"{cache_type} is an unsupported cache type")
+        if cache_type in self._refreshed:
+            cache_timestamp = self._refreshed[cache_type]
+        elif self.refresh_time is not None:
+            cache_timestamp = getattr(self.refresh_time, cache_type)
+        else:
+            return False
+        return cache_timestamp is not None and cache_timestamp > (
+            now_in_utc() - CachedEdxDataApi.CACHE_EXPIRATION_DELTAS[cache_type]
+        )
+
+    def are_all_caches_fresh(self):
+        """
+        Checks if all cache types of the backends of the user are fresh.
+
+        Returns:
+            bool
+        """
+        return all(
+            self.is_cache_fresh(cache_type)
+            for provider, cache_types in CachedEdxDataApi.CACHE_TYPES_BACKEND.items()
+            if self.has_social_auth(provider)
+            for cache_type in cache_types
+        )
+
+    def mark_refreshed(self, cache_type, timestamp=None):
+        """
+        Records that a cache type was refreshed. The refresh time is saved by save.
+
+        Args:
+            cache_type (str): a string representing one of the cached data types
+            timestamp (datetime.datetime): a timestamp, now by default
+        """
+        if cache_type not in CachedEdxDataApi.ALL_CACHE_TYPES:
+            raise ValueError(f"{cache_type} is an unsupported cache type")
+        self._refreshed[cache_type] = timestamp if timestamp is not None else now_in_utc()
+
+    def mark_data_changed(self):
+        """
+        Records that the cached data of the user changed, so that the user is reindexed by save
+        """
+        self._data_changed = True
+
+    def save(self):
+        """
+        Saves the refresh times recorded since the last save, and reindexes the user if the cached data changed
+        """
+        if self._data_changed:
+            self._data_changed = False
+            # queue the user to be reindexed
+            tasks.queue_index_users([self.user.id], check_if_changed=True)
+        if not self._refreshed:
+            return
+        refreshed, self._refreshed = self._refreshed, {}
+        if self.refresh_time is None or not models.UserCacheRefreshTime.objects.filter(
+                user=self.user
+        ).update(**refreshed):
+            self.refresh_time, _ = models.UserCacheRefreshTime.objects.update_or_create(
+                user=self.user, defaults=refreshed
+            )
+        else:
+            for cache_type, timestamp in refreshed.items():
+                setattr(self.refresh_time, cache_type, timestamp)
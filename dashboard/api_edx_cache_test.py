@@ -6,9 +6,11 @@ from datetime import timedelta
 from unittest.mock import ANY, MagicMock, patch
 
 import ddt
+from django.test import override_settings
 from edx_api.certificates.models import Certificate, Certificates
 from edx_api.enrollments.models import Enrollment, Enrollments
-from edx_api.grades.models import CurrentGrade, CurrentGradesByUser
+from edx_api.grades.models import (CurrentGrade, CurrentGradesByCourse,
+                                   CurrentGradesByUser)
 from requests.exceptions import HTTPError
 
 from backends.constants import BACKEND_EDX_ORG, BACKEND_MITX_ONLINE
@@ -18,12 +20,13 @@ from courses.factories import (CourseFactory, CourseRunFactory,
                                FullProgramFactory)
 from dashboard import models
 from dashboard.api_edx_cache import (CachedEdxDataApi, CachedEdxUserData,
-                                     UserCachedRunData)
+                                     UserCachedRunData, UserCacheFreshness)
 from dashboard.factories import (CachedCertificateFactory,
                                  CachedCurrentGradeFactory,
                                  CachedEnrollmentFactory,
                                  UserCacheRefreshTimeFactory)
-from dashboard.models import CachedEnrollment, UserCacheRefreshTime
+from dashboard.models import (CachedEnrollment, DashboardDocument,
+                              UserCacheRefreshTime)
 from micromasters.factories import UserFactory
 from micromasters.utils import load_json_from_file, now_in_utc
 from search.base import MockedESTestCase
@@ -93,6 +96,20 @@ class CachedEdxUserDataTests(MockedESTestCase):
         assert run_data.certificate.course_id == self.p1_course_run_keys[0]
         assert run_data.current_grade.course_id == self.p1_course_run_keys[0]
 
+    def test_for_users(self):
+        """Test that the edX data of many users is fetched with one query per cached model"""
+        other_user = UserFactory.create()
+        CachedEnrollmentFactory.create(user=other_user, course_run=self.p2_course_run_1)
+        p2_course_run_program = self.p2_course_run_1.course.program
+        with self.assertNumQueries(3):
+            edx_user_data = CachedEdxUserData.for_users([self.user, other_user], program=p2_course_run_program)
+        assert edx_user_data[self.user.id].user == self.user
+        self.assert_edx_data_has_given_ids(edx_user_data[self.user.id], self.p2_course_run_keys)
+        other_user_data = edx_user_data[other_user.id]
+        assert list(other_user_data.enrollments.get_enrolled_course_ids()) == [self.p2_course_run_keys[0]]
+        assert list(other_user_data.certificates.all_courses_verified_certs) == []
+        assert list(other_user_data.current_grades.all_course_ids) == []
+
 
 @ddt.ddt
 class CachedEdxDataApiTests(MockedESTestCase):
@@ -316,7 +333,47 @@ class CachedEdxDataApiTests(MockedESTestCase):
         user_cache.save()
         assert CachedEdxDataApi.are_all_caches_fresh(self.user) is False
 
-    @patch('search.tasks.index_users', autospec=True)
+    def test_user_cache_freshness(self):
+        """UserCacheFreshness answers the freshness questions with two queries and saves with one"""
+        self.create_mitxonline_data()
+        yesterday = now_in_utc() - timedelta(days=1)
+        UserCacheRefreshTimeFactory.create(user=self.user, unexpired=True, current_grade_mitxonline=yesterday)
+        freshness = UserCacheFreshness(self.user)
+        with self.assertNumQueries(2):
+            for cache_type in CachedEdxDataApi.ALL_CACHE_TYPES:
+                assert freshness.is_cache_fresh(cache_type) is (
+                    cache_type != CachedEdxDataApi.CURRENT_GRADE_MITXONLINE
+                )
+            assert freshness.has_social_auth(BACKEND_MITX_ONLINE) is True
+            assert freshness.are_all_caches_fresh() is False
+            assert CachedEdxDataApi.are_all_caches_fresh(self.user, freshness=freshness) is False
+        with self.assertRaises(ValueError):
+            freshness.mark_refreshed('footype')
+
+        freshness.mark_refreshed(CachedEdxDataApi.CURRENT_GRADE_MITXONLINE)
+        freshness.mark_refreshed(CachedEdxDataApi.ENROLLMENT, yesterday)
+        with self.assertNumQueries(0):
+            assert freshness.are_all_caches_fresh() is False
+            assert freshness.is_cache_fresh(CachedEdxDataApi.CURRENT_GRADE_MITXONLINE) is True
+        with self.assertNumQueries(1):
+            freshness.save()
+        with self.assertNumQueries(0):
+            freshness.save()
+        cache_time = UserCacheRefreshTime.objects.get(user=self.user)
+        assert cache_time.enrollment == yesterday
+        assert cache_time.current_grade_mitxonline > yesterday
+
+    def test_user_cache_freshness_no_refresh_time(self):
+        """UserCacheFreshness creates the refresh times of the user if there are none"""
+        freshness = UserCacheFreshness(self.user)
+        assert freshness.is_cache_fresh(CachedEdxDataApi.ENROLLMENT) is False
+        freshness.mark_refreshed(CachedEdxDataApi.ENROLLMENT)
+        freshness.save()
+        cache_time = UserCacheRefreshTime.objects.get(user=self.user)
+        assert cache_time.enrollment is not None
+        assert cache_time.certificate is None
+
+    @patch('search.tasks.queue_index_users', autospec=True)
     def test_update_cached_enrollment(self, mocked_index):
         """Test for update_cached_enrollment"""
         course_id = list(self.enrollment_ids)[0]
@@ -328,7 +385,7 @@ class CachedEdxDataApiTests(MockedESTestCase):
         self.assert_cache_in_db(enrollment_keys=[course_id])
         cached_enr = CachedEnrollment.objects.get(user=self.user, course_run__edx_course_key=course_id)
         assert cached_enr.data == enrollment.json
-        assert mocked_index.delay.called is False
+        assert mocked_index.called is False
         # update of different data with indexing
         enr_json = {
             "course_details": {
@@ -343,9 +400,9 @@ class CachedEdxDataApiTests(MockedESTestCase):
         self.assert_cache_in_db(enrollment_keys=[course_id])
         cached_enr.refresh_from_db()
         assert cached_enr.data == enr_json
-        mocked_index.delay.assert_any_call([self.user.id], check_if_changed=True)
+        mocked_index.assert_any_call([self.user.id], check_if_changed=True)
 
-    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.queue_index_users', autospec=True)
     def test_update_cached_enrollments(self, mocked_index):
         """Test for update_cached_enrollments."""
         self.assert_cache_in_db()
@@ -355,7 +412,7 @@ class CachedEdxDataApiTests(MockedESTestCase):
         cache_time = UserCacheRefreshTime.objects.get(user=self.user)
         now = now_in_utc()
         assert cache_time.enrollment <= now
-        assert mocked_index.delay.called is True
+        assert mocked_index.called is True
         mocked_index.reset_mock()
 
         # add another cached element for another course that will be removed by the refresh
@@ -365,9 +422,9 @@ class CachedEdxDataApiTests(MockedESTestCase):
         self.assert_cache_in_db(enrollment_keys=self.enrollment_ids)
         cache_time.refresh_from_db()
         assert cache_time.enrollment >= now
-        mocked_index.delay.assert_called_once_with([self.user.id], check_if_changed=True)
+        mocked_index.assert_called_once_with([self.user.id], check_if_changed=True)
 
-    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.queue_index_users', autospec=True)
     def test_update_cached_certificates(self, mocked_index):
         """Test for update_cached_certificates."""
         assert self.verified_certificates_ids.issubset(self.certificates_ids)
@@ -378,7 +435,7 @@ class CachedEdxDataApiTests(MockedESTestCase):
         cache_time = UserCacheRefreshTime.objects.get(user=self.user)
         now = now_in_utc()
         assert cache_time.certificate <= now
-        assert mocked_index.delay.called is True
+        assert mocked_index.called is True
         mocked_index.reset_mock()
 
         # add another cached element for another course that will be removed by the refresh
@@ -389,9 +446,9 @@ class CachedEdxDataApiTests(MockedESTestCase):
         self.assert_cache_in_db(certificate_keys=self.verified_certificates_ids)
         cache_time.refresh_from_db()
         assert cache_time.certificate >= now
-        mocked_index.delay.assert_called_once_with([self.user.id], check_if_changed=True)
+        mocked_index.assert_called_once_with([self.user.id], check_if_changed=True)
 
-    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.queue_index_users', autospec=True)
     def test_update_cached_current_grades(self, mocked_index):
         """Test for update_cached_current_grades."""
         self.assert_cache_in_db()
@@ -401,7 +458,7 @@ class CachedEdxDataApiTests(MockedESTestCase):
         cache_time = UserCacheRefreshTime.objects.get(user=self.user)
         now = now_in_utc()
         assert cache_time.current_grade <= now
-        assert mocked_index.delay.called is True
+        assert mocked_index.called is True
         mocked_index.reset_mock()
 
         # add another cached element for another course that will be removed by the refresh
@@ -411,7 +468,60 @@ class CachedEdxDataApiTests(MockedESTestCase):
         self.assert_cache_in_db(grades_keys=self.grades_ids)
         cache_time.refresh_from_db()
         assert cache_time.current_grade >= now
-        mocked_index.delay.assert_called_once_with([self.user.id], check_if_changed=True)
+        mocked_index.assert_called_once_with([self.user.id], check_if_changed=True)
+
+    @patch('search.tasks.queue_index_users', autospec=True)
+    def test_save_cached_unchanged(self, mocked_index):
+        """Saving the data fetched from edX again does not write anything and does not reindex the user"""
+        CachedEdxDataApi.save_cached_enrollments(self.user, self.enrollments, BACKEND_EDX_ORG)
+        CachedEdxDataApi.save_cached_certificates(self.user, self.certificates, BACKEND_EDX_ORG)
+        CachedEdxDataApi.save_cached_current_grades(self.user, self.current_grades, BACKEND_EDX_ORG)
+        assert mocked_index.call_count == 3
+        mocked_index.reset_mock()
+        generation = DashboardDocument.get_generation(self.user.id)
+
+        # only the course runs and the cached rows are read, in a savepoint
+        for save_func, data in [
+                (CachedEdxDataApi.save_cached_enrollments, self.enrollments),
+                (CachedEdxDataApi.save_cached_certificates, self.certificates),
+                (CachedEdxDataApi.save_cached_current_grades, self.current_grades),
+        ]:
+            with self.assertNumQueries(4):
+                save_func(self.user, data, BACKEND_EDX_ORG, freshness=UserCacheFreshness(self.user))
+        self.assert_cache_in_db(self.enrollment_ids, self.verified_certificates_ids, self.grades_ids)
+        assert mocked_index.called is False
+        assert DashboardDocument.get_generation(self.user.id) == generation
+
+    @patch('search.tasks.queue_index_users', autospec=True)
+    def test_save_cached_single_reindex(self, mocked_index):
+        """With a freshness state, a refresh changing all the caches reindexes the user once when it is saved"""
+        freshness = UserCacheFreshness(self.user)
+        CachedEdxDataApi.save_cached_enrollments(self.user, self.enrollments, BACKEND_EDX_ORG, freshness=freshness)
+        CachedEdxDataApi.save_cached_certificates(self.user, self.certificates, BACKEND_EDX_ORG, freshness=freshness)
+        CachedEdxDataApi.save_cached_current_grades(
+            self.user, self.current_grades, BACKEND_EDX_ORG, freshness=freshness
+        )
+        assert mocked_index.called is False
+        freshness.save()
+        mocked_index.assert_called_once_with([self.user.id], check_if_changed=True)
+        freshness.save()
+        assert mocked_index.call_count == 1
+
+    @patch('search.tasks.queue_index_users', autospec=True)
+    def test_save_cached_changed(self, mocked_index):
+        """Changed rows are written with one query and discard the dashboard documents of the user"""
+        CachedEdxDataApi.save_cached_enrollments(self.user, self.enrollments, BACKEND_EDX_ORG)
+        course_id = list(self.enrollment_ids)[0]
+        cached_enrollment = CachedEnrollment.objects.get(user=self.user, course_run__edx_course_key=course_id)
+        cached_enrollment.data = {**cached_enrollment.data, 'mode': 'changed'}
+        cached_enrollment.save()
+        generation = DashboardDocument.get_generation(self.user.id)
+
+        CachedEdxDataApi.save_cached_enrollments(self.user, self.enrollments, BACKEND_EDX_ORG)
+        cached_enrollment.refresh_from_db()
+        assert cached_enrollment.data == self.enrollments.get_enrollment_for_course(course_id).json
+        assert DashboardDocument.get_generation(self.user.id) > generation
+        assert mocked_index.call_count == 2
 
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_current_grades')
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_certificates')
@@ -491,6 +601,71 @@ class CachedEdxDataApiTests(MockedESTestCase):
             with self.assertRaises(HTTPError):
                 CachedEdxDataApi.update_cache_if_expired(self.user, self.edx_client, CachedEdxDataApi.ENROLLMENT, BACKEND_EDX_ORG)
 
+    @ddt.data(
+        (BACKEND_MITX_ONLINE, 'staff-access-token', True),
+        (BACKEND_MITX_ONLINE, None, False),
+        (BACKEND_EDX_ORG, 'staff-access-token', False),
+    )
+    @ddt.unpack
+    def test_can_update_course_run_grade_data(self, backend, staff_token, expected):
+        """Course-wide grades can only be fetched from MITx Online with a staff token"""
+        course_run = CourseRunFactory.create(courseware_backend=backend)
+        with override_settings(MITXONLINE_STAFF_ACCESS_TOKEN=staff_token):
+            assert CachedEdxDataApi.can_update_course_run_grade_data(course_run) is expected
+
+    @override_settings(MITXONLINE_STAFF_ACCESS_TOKEN='staff-access-token')
+    @patch('search.tasks.queue_index_users', autospec=True)
+    @patch('dashboard.api_edx_cache.EdxApi', autospec=True)
+    def test_update_course_run_grade_data(self, mock_edx_api, mock_index):
+        """update_course_run_grade_data should replace the cached grades of the run with the course-wide grades"""
+        self.create_mitxonline_data()
+        course_run = CourseRunFactory.create(courseware_backend=BACKEND_MITX_ONLINE)
+        unchanged_user, ungraded_user, no_auth_user = UserFactory.create_batch(3)
+        for user in (unchanged_user, ungraded_user):
+            user.social_auth.create(provider=BACKEND_MITX_ONLINE, uid=f"{user.username}_mitxonline")
+
+        def grade_json(user):
+            """The current grade of a user in the course run"""
+            return {
+                'username': f"{user.username}_mitxonline",
+                'course_id': course_run.edx_course_key,
+                'passed': True,
+                'percent': 0.8,
+                'letter_grade': 'B',
+            }
+
+        CachedCurrentGradeFactory.create(user=unchanged_user, course_run=course_run, data=grade_json(unchanged_user))
+        CachedCurrentGradeFactory.create(user=ungraded_user, course_run=course_run)
+        mock_edx_api.return_value.current_grades.get_course_current_grades.return_value = CurrentGradesByCourse([
+            CurrentGrade(grade_json(user)) for user in (self.user, unchanged_user, no_auth_user)
+        ])
+
+        refreshed_users = CachedEdxDataApi.update_course_run_grade_data(
+            course_run, [self.user, unchanged_user, ungraded_user, no_auth_user]
+        )
+
+        assert refreshed_users == [self.user, unchanged_user, ungraded_user]
+        mock_edx_api.assert_called_once_with({'access_token': 'staff-access-token'}, ANY)
+        mock_edx_api.return_value.current_grades.get_course_current_grades.assert_called_once_with(
+            course_run.edx_course_key
+        )
+        assert dict(models.CachedCurrentGrade.objects.filter(course_run=course_run).values_list(
+            'user_id', 'data'
+        )) == {self.user.id: grade_json(self.user), unchanged_user.id: grade_json(unchanged_user)}
+        mock_index.assert_called_once_with(ANY, check_if_changed=True)
+        assert sorted(mock_index.call_args[0][0]) == sorted([self.user.id, ungraded_user.id])
+
+    @override_settings(MITXONLINE_STAFF_ACCESS_TOKEN='staff-access-token')
+    @patch('dashboard.api_edx_cache.EdxApi', autospec=True)
+    def test_update_course_run_grade_data_invalid_credentials(self, mock_edx_api):
+        """A refused staff token should raise InvalidCredentialStored"""
+        course_run = CourseRunFactory.create(courseware_backend=BACKEND_MITX_ONLINE)
+        error = HTTPError()
+        error.response = MagicMock(status_code=401)
+        mock_edx_api.return_value.current_grades.get_course_current_grades.side_effect = error
+        with self.assertRaises(InvalidCredentialStored):
+            CachedEdxDataApi.update_course_run_grade_data(course_run, [self.user])
+
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_current_grades')
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_certificates')
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_enrollments')
@@ -503,4 +678,4 @@ class CachedEdxDataApiTests(MockedESTestCase):
         assert mock_enr.called is False
         mock_refr.assert_called_once_with(self.user.social_auth.get(provider=EdxOrgOAuth2.name))
         for mock_func in (mock_cert, mock_grade, ):
-            mock_func.assert_called_once_with(self.user, ANY, BACKEND_EDX_ORG)
+            mock_func.assert_called_once_with(self.user, ANY, BACKEND_EDX_ORG, freshness=ANY)
@@ -1,8 +1,9 @@
 """
 Tests for the dashboard api functions
 """
+import threading
 from datetime import timedelta
-from unittest.mock import MagicMock, Mock, PropertyMock, patch
+from unittest.mock import ANY, MagicMock, Mock, PropertyMock, patch
 from urllib.parse import urljoin
 
 import ddt
@@ -13,11 +14,13 @@ from django.urls import reverse
 from django_redis import get_redis_connection
 from edx_api.client import EdxApi
 from edx_api.enrollments import Enrollments
+from requests.exceptions import HTTPError
 
 from backends.constants import (BACKEND_EDX_ORG, BACKEND_MITX_ONLINE,
                                 COURSEWARE_BACKEND_URL, COURSEWARE_BACKENDS)
 from backends.exceptions import InvalidCredentialStored
-from cms.factories import CourseCertificateSignatoriesFactory
+from cms.factories import (CourseCertificateSignatoriesFactory,
+                           ProgramLetterSignatoryFactory)
 from courses.factories import (CourseFactory, CourseRunFactory,
                                FullProgramFactory, ProgramFactory)
 from courses.models import ElectiveCourse, ElectivesSet
@@ -53,6 +56,7 @@ from seed_data.lib import add_paid_order_for_course, set_course_run_current
 
 TEST_CACHE_KEY_USER_IDS_NOT_TO_UPDATE = "test_users_not_to_update"
 TEST_CACHE_KEY_FAILURES_BY_USER = "test_failure_nums_by_user"
+TEST_CACHE_KEY_DASHBOARD_ACTIVITY = "test_dashboard_recent_activity"
 
 social_extra_data = {
     "access_token": "fooooootoken",
@@ -1448,12 +1452,13 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
 
     @ddt.data([[True], [False]])
     @patch('backends.edxorg.EdxOrgOAuth2.refresh_token', return_value=social_extra_data, autospec=True)
-    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cache_if_expired', new_callable=MagicMock)
-    def test_format(self, update_cache, mock_cache_refresh, mock_refresh_token):
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.get_cache_update_steps', autospec=True)
+    def test_format(self, update_cache, mock_update_steps, mock_refresh_token):
         """Test that get_user_program_info fetches edx data and returns a list of Program data"""
+        mock_update_steps.return_value = (MagicMock(), MagicMock())
         result = api.get_user_program_info(self.user)
         assert mock_refresh_token.call_count == (1 if update_cache else 0)
-        assert mock_cache_refresh.call_count == (len(CachedEdxDataApi.EDX_SUPPORTED_CACHES) if update_cache else 0)
+        assert mock_update_steps.call_count == (len(CachedEdxDataApi.EDX_SUPPORTED_CACHES) if update_cache else 0)
 
         assert isinstance(result, dict)
         assert 'is_edx_data_fresh' in result
@@ -1469,7 +1474,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
             assert is_subset_dict(expected, result['programs'][i])
         assert not result["invalid_backend_credentials"]
 
-    @patch('dashboard.api.update_cache_for_backend', autospec=True, return_value=True)
+    @patch('dashboard.api.refresh_user_caches', autospec=True, return_value=[])
     def test_past_course_runs(self, mock_refresh):  # pylint: disable=unused-argument
         """Test that past course runs are returned in the API results"""
         # Set a course run to be failed
@@ -1536,7 +1541,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         )
         assert not result["invalid_backend_credentials"]
 
-    @patch('dashboard.api.update_cache_for_backend', autospec=True, return_value=True)
+    @patch('dashboard.api.refresh_user_caches', autospec=True, return_value=[])
     def test_current_run_first(self, _mock_update):  # pylint: disable=unused-argument
         """Test that current course runs is on top of returned in the API results"""
         now = now_in_utc()
@@ -1578,7 +1583,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         assert result['programs'][0]['courses'][0]['runs'][0]['status'] == api.CourseRunStatus.CURRENTLY_ENROLLED
         assert not result["invalid_backend_credentials"]
 
-    @patch('dashboard.api.update_cache_for_backend', autospec=True, return_value=True)
+    @patch('dashboard.api.refresh_user_caches', autospec=True, return_value=[])
     def test_when_enroll_in_only_future_run(self, _mock_update):  # pylint: disable=unused-argument
         """Test that user in enrolled in future run but not enrolled in current course runs"""
         now = now_in_utc()
@@ -1619,7 +1624,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         assert result['programs'][0]['courses'][0]['runs'][0]['status'] == api.CourseRunStatus.WILL_ATTEND
         assert not result["invalid_backend_credentials"]
 
-    @patch('dashboard.api.update_cache_for_backend', autospec=True, return_value=True)
+    @patch('dashboard.api._get_dashboard_edx_client', autospec=True, return_value=None)
     def test_exception_in_refresh_cache(self, mock_cache_refresh):
         """Test in case the backend refresh cache raises any other exception"""
         mock_cache_refresh.side_effect = ZeroDivisionError
@@ -1633,7 +1638,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         assert not result["invalid_backend_credentials"]
 
 
-    @patch('dashboard.api.update_cache_for_backend', autospec=True, return_value=True)
+    @patch('dashboard.api._get_dashboard_edx_client', autospec=True, return_value=None)
     def test_returns_courseruns_for_different_backends(self, mock_cache_refresh):
         """Test that user in enrolled in future run but not enrolled in current course runs"""
         # create course runs for mitxonline backend
@@ -1663,7 +1668,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
             assert len(program_result['courses'][0]['runs']) == 1
         assert not result["invalid_backend_credentials"]
 
-    @patch('dashboard.api.update_cache_for_backend', autospec=True, return_value=True)
+    @patch('dashboard.api._get_dashboard_edx_client', autospec=True, return_value=None)
     @ddt.data(
         [BACKEND_EDX_ORG],
         [BACKEND_MITX_ONLINE],
@@ -1689,7 +1694,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         CachedCurrentGradeFactory.create(user=self.user, course_run=current_run)
         add_paid_order_for_course(self.user, current_run)
 
-        def _raise_invalid_backend(_, provider):
+        def _raise_invalid_backend(_, provider, **kwargs):  # pylint: disable=unused-argument
             if provider in invalid_backends:
                 raise InvalidCredentialStored("invalid", 400)
 
@@ -1705,6 +1710,104 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         assert result["invalid_backend_credentials"] == invalid_backends
 
 
+class DashboardDocumentTest(MockedESTestCase):
+    """Tests for the stored dashboard documents"""
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory.create()
+        cls.program = FullProgramFactory.create(live=True)
+        models.ProgramEnrollment.objects.create(user=cls.user, program=cls.program)
+        cls.course_run = cls.program.course_set.first().courserun_set.first()
+
+    def setUp(self):
+        super().setUp()
+        compute_patcher = patch(
+            'dashboard.api.compute_dashboard_document', autospec=True, side_effect=api.compute_dashboard_document
+        )
+        self.compute_mock = compute_patcher.start()
+        self.addCleanup(compute_patcher.stop)
+
+    def get_programs(self):
+        """Returns the dashboard information of the programs of the user"""
+        return api.get_dashboard_documents(self.user, [self.program])
+
+    def test_stored(self):
+        """Test that the document is computed once and then served from the database"""
+        programs = self.get_programs()
+        assert self.compute_mock.call_count == 1
+        document = models.DashboardDocument.objects.get(user=self.user, program=self.program)
+        assert document.data['id'] == programs[0]['id'] == self.program.id
+        assert self.get_programs() == [document.data]
+        assert self.compute_mock.call_count == 1
+
+    def test_invalidated_by_user_data(self):
+        """Test that a change to the data of the user makes the document be computed again"""
+        self.get_programs()
+        FinalGradeFactory.create(user=self.user, course_run=self.course_run, passed=True)
+        self.get_programs()
+        assert self.compute_mock.call_count == 2
+
+    def test_not_invalidated_by_other_user_data(self):
+        """Test that a change to the data of another user keeps the document"""
+        self.get_programs()
+        FinalGradeFactory.create(course_run=self.course_run, passed=True)
+        self.get_programs()
+        assert self.compute_mock.call_count == 1
+
+    def test_invalidated_by_program_change(self):
+        """Test that a change to the program makes the document be computed again"""
+        self.get_programs()
+        self.course_run.save()
+        self.get_programs()
+        assert self.compute_mock.call_count == 2
+
+    def test_invalidated_by_cms_change(self):
+        """Test that a change to the signatories or the letter of the program makes the document be computed again"""
+        letter_signatory = ProgramLetterSignatoryFactory.create(program_page__program=self.program)
+        course_signatory = CourseCertificateSignatoriesFactory.create(
+            program_page=letter_signatory.program_page, course=self.course_run.course
+        )
+        self.get_programs()
+        for change in [letter_signatory.program_page.save, course_signatory.delete, letter_signatory.delete]:
+            change()
+            self.get_programs()
+        assert self.compute_mock.call_count == 4
+
+    def test_generation_lost(self):
+        """Test that the documents stored before Redis lost the generation of the user are not served again"""
+        self.get_programs()
+        get_redis_connection("redis").delete(models.CACHE_KEY_DASHBOARD_GENERATION_BY_USER.format(self.user.id))
+        FinalGradeFactory.create(user=self.user, course_run=self.course_run, passed=True)
+        self.get_programs()
+        assert self.compute_mock.call_count == 2
+
+    def test_expires_on_next_boundary(self):
+        """Test that the document expires when the next date of the program passes"""
+        self.course_run.start_date = now_in_utc() + timedelta(minutes=5)
+        self.course_run.save()
+        with patch('courses.program_structure.ProgramStructure.get_next_boundary', autospec=True) as boundary_mock:
+            boundary_mock.return_value = self.course_run.start_date
+            self.get_programs()
+        document = models.DashboardDocument.objects.get(user=self.user, program=self.program)
+        assert document.expires_on == self.course_run.start_date
+        self.get_programs()
+        assert self.compute_mock.call_count == 1
+        models.DashboardDocument.objects.update(expires_on=now_in_utc() - timedelta(seconds=1))
+        self.get_programs()
+        assert self.compute_mock.call_count == 2
+
+    def test_check_dashboard_document(self):
+        """Test that check_dashboard_document compares the stored document with a live computation"""
+        self.get_programs()
+        document = models.DashboardDocument.objects.get(user=self.user, program=self.program)
+        assert api.check_dashboard_document(document) is True
+        document.data['title'] = 'outdated title'
+        assert api.check_dashboard_document(document) is False
+        FinalGradeFactory.create(user=self.user, course_run=self.course_run, passed=True)
+        assert api.check_dashboard_document(document) is None
+
+
 class InfoProgramTest(MockedESTestCase):
     """Tests for get_info_for_program"""
     @classmethod
@@ -2264,6 +2367,68 @@ def test_calculate_excludes_dedp_users(users_without_with_cache):
     assert sorted(api.calculate_users_to_refresh_in_bulk()) == sorted([user.id for user in needs_update[1:]])
 
 
+@pytest.fixture
+def patched_activity_key(mocker):
+    """Patch the redis key of the dashboard activity"""
+    mocker.patch("dashboard.api.CACHE_KEY_DASHBOARD_ACTIVITY", TEST_CACHE_KEY_DASHBOARD_ACTIVITY)
+    yield
+    get_redis_connection("redis").delete(TEST_CACHE_KEY_DASHBOARD_ACTIVITY)
+
+
+@pytest.mark.usefixtures("patched_activity_key")
+def test_rank_users_to_refresh(users_without_with_cache):
+    """
+    rank_users_to_refresh_in_bulk should rank the users to refresh by how much fresh edX data matters for them
+    """
+    needs_update, up_to_date = users_without_with_cache
+    now = now_in_utc()
+    live_run = CourseRunFactory.create(
+        start_date=now - timedelta(days=10),
+        end_date=now + timedelta(days=10),
+        freeze_grade_date=now + timedelta(days=20),
+    )
+    freezing_run = CourseRunFactory.create(
+        start_date=now - timedelta(days=100),
+        end_date=now - timedelta(days=1),
+        freeze_grade_date=now + timedelta(days=2),
+    )
+    past_run = CourseRunFactory.create(
+        start_date=now - timedelta(days=100),
+        end_date=now - timedelta(days=10),
+        freeze_grade_date=now - timedelta(days=5),
+    )
+    CachedEnrollmentFactory.create(user=needs_update[0], course_run=freezing_run)
+    CachedEnrollmentFactory.create(user=needs_update[0], course_run=live_run)
+    CachedEnrollmentFactory.create(user=needs_update[1], course_run=freezing_run)
+    CachedEnrollmentFactory.create(user=needs_update[2], course_run=live_run)
+    CachedEnrollmentFactory.create(user=needs_update[3], course_run=past_run)
+    CachedEnrollmentFactory.create(user=up_to_date[0], course_run=live_run)
+    api.record_dashboard_activity(needs_update[2].id)
+    api.record_dashboard_activity(needs_update[4].id)
+    api.record_dashboard_activity(up_to_date[1].id)
+
+    assert api.rank_users_to_refresh_in_bulk() == {
+        needs_update[0].id: api.REFRESH_PRIORITY_FREEZE_APPROACHING + api.REFRESH_PRIORITY_LIVE_RUN,
+        needs_update[1].id: api.REFRESH_PRIORITY_FREEZE_APPROACHING,
+        needs_update[2].id: api.REFRESH_PRIORITY_LIVE_RUN + api.REFRESH_PRIORITY_DASHBOARD_ACTIVITY,
+        needs_update[3].id: 0,
+        needs_update[4].id: api.REFRESH_PRIORITY_DASHBOARD_ACTIVITY,
+    }
+
+
+@pytest.mark.usefixtures("patched_activity_key")
+def test_rank_users_to_refresh_old_activity(users_without_with_cache):
+    """The visits to the dashboard older than DASHBOARD_ACTIVITY_WINDOW are forgotten"""
+    needs_update, _ = users_without_with_cache
+    con = get_redis_connection("redis")
+    con.zadd(TEST_CACHE_KEY_DASHBOARD_ACTIVITY, {
+        needs_update[0].id: (now_in_utc() - api.DASHBOARD_ACTIVITY_WINDOW - timedelta(minutes=1)).timestamp(),
+    })
+
+    assert api.rank_users_to_refresh_in_bulk() == {user.id: 0 for user in needs_update}
+    assert con.zcard(TEST_CACHE_KEY_DASHBOARD_ACTIVITY) == 0
+
+
 def test_refresh_user_data(db, mocker):
     """refresh_user_data should refresh the cache on all cache types"""
     user = _make_fake_real_user()
@@ -2273,12 +2438,12 @@ def test_refresh_user_data(db, mocker):
     edx_api_init = mocker.patch('dashboard.api.EdxApi', autospec=True, return_value=edx_api)
     update_cache_mock = mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired')
 
-    api.refresh_user_data(user.id, BACKEND_EDX_ORG)
+    assert api.refresh_user_data(user.id, BACKEND_EDX_ORG) is False
 
     refresh_user_token_mock.assert_called_once_with(user_social)
     edx_api_init.assert_called_once_with(user_social.extra_data, settings.EDXORG_CALLBACK_URL)
     for cache_type in CachedEdxDataApi.EDX_SUPPORTED_CACHES:
-        update_cache_mock.assert_any_call(user, edx_api, cache_type, BACKEND_EDX_ORG)
+        update_cache_mock.assert_any_call(user, edx_api, cache_type, BACKEND_EDX_ORG, freshness=ANY)
 
 
 @pytest.mark.parametrize("provider", COURSEWARE_BACKENDS)
@@ -2296,7 +2461,7 @@ def test_update_cache_for_backend(db, mocker, provider):
     refresh_user_token_mock.assert_called_once_with(user_social)
     edx_api_init.assert_called_once_with(user_social.extra_data, COURSEWARE_BACKEND_URL[provider])
     for cache_type in CachedEdxDataApi.CACHE_TYPES_BACKEND[provider]:
-        update_cache_mock.assert_any_call(user, edx_api, cache_type, provider)
+        update_cache_mock.assert_any_call(user, edx_api, cache_type, provider, freshness=ANY)
 
 
 @pytest.mark.parametrize("provider", COURSEWARE_BACKENDS)
@@ -2336,6 +2501,159 @@ def test_update_cache_for_backend_update_cache_error(db, mocker, provider):
     edx_api_init.assert_called_once_with(user_social.extra_data, COURSEWARE_BACKEND_URL[provider])
 
 
+def _mock_refresh_clients(mocker):
+    """Patch the token refresh and the edX clients used to refresh the caches of a user"""
+    mocker.patch('dashboard.api.utils.refresh_user_token', autospec=True)
+    edx_apis = {backend: mocker.Mock() for backend in COURSEWARE_BACKENDS}
+    mocker.patch(
+        'dashboard.api.EdxApi',
+        autospec=True,
+        side_effect=lambda credentials, base_url, **kwargs: next(
+            edx_apis[backend] for backend in COURSEWARE_BACKENDS if COURSEWARE_BACKEND_URL[backend] == base_url
+        ),
+    )
+    return edx_apis
+
+
+def test_refresh_user_caches(db, mocker):
+    """refresh_user_caches should fetch the enrollments first and then the other caches, for all backends"""
+    user = _make_fake_real_user()
+    models.UserCacheRefreshTime.objects.filter(user=user).delete()
+    edx_apis = _mock_refresh_clients(mocker)
+    saved = []
+    for name in ('save_cached_enrollments', 'save_cached_certificates', 'save_cached_current_grades'):
+        mocker.patch.object(
+            CachedEdxDataApi,
+            name,
+            side_effect=lambda user, data, provider, name=name, **kwargs: saved.append((name, data, provider)),
+        )
+
+    assert api.refresh_user_caches(user) == []
+
+    edx_api = edx_apis[BACKEND_EDX_ORG]
+    mitxonline_api = edx_apis[BACKEND_MITX_ONLINE]
+    assert len(saved) == 5
+    assert set(saved) == {
+        ('save_cached_enrollments', edx_api.enrollments.get_student_enrollments.return_value, BACKEND_EDX_ORG),
+        ('save_cached_certificates', edx_api.certificates.get_student_certificates.return_value, BACKEND_EDX_ORG),
+        (
+            'save_cached_current_grades',
+            edx_api.current_grades.get_student_current_grades.return_value,
+            BACKEND_EDX_ORG,
+        ),
+        (
+            'save_cached_enrollments',
+            mitxonline_api.enrollments.get_student_enrollments.return_value,
+            BACKEND_MITX_ONLINE,
+        ),
+        (
+            'save_cached_current_grades',
+            mitxonline_api.current_grades.get_student_current_grades.return_value,
+            BACKEND_MITX_ONLINE,
+        ),
+    }
+    for backend in COURSEWARE_BACKENDS:
+        enrollments_index = saved.index(
+            ('save_cached_enrollments', edx_apis[backend].enrollments.get_student_enrollments.return_value, backend)
+        )
+        assert all(index > enrollments_index for index, item in enumerate(saved) if item[2] == backend and
+                   item[0] != 'save_cached_enrollments')
+
+
+def test_refresh_user_caches_fresh(db, mocker):
+    """refresh_user_caches should not fetch the caches which are fresh"""
+    user = _make_fake_real_user()
+    now = now_in_utc()
+    models.UserCacheRefreshTime.objects.filter(user=user).update(
+        enrollment=now, certificate=now, current_grade=now, enrollment_mitxonline=now, current_grade_mitxonline=None,
+    )
+    edx_apis = _mock_refresh_clients(mocker)
+    save_mock = mocker.patch.object(CachedEdxDataApi, 'save_cached_current_grades')
+
+    assert api.refresh_user_caches(user) == []
+
+    edx_api = edx_apis[BACKEND_EDX_ORG]
+    assert edx_api.enrollments.get_student_enrollments.called is False
+    assert edx_api.certificates.get_student_certificates.called is False
+    assert edx_api.current_grades.get_student_current_grades.called is False
+    # only the MITx Online current grades are expired
+    save_mock.assert_called_once_with(
+        user,
+        edx_apis[BACKEND_MITX_ONLINE].current_grades.get_student_current_grades.return_value,
+        BACKEND_MITX_ONLINE,
+        freshness=ANY,
+    )
+
+
+@pytest.mark.parametrize("status_code", [400, 401])
+def test_refresh_user_caches_invalid_credentials(db, mocker, status_code):
+    """refresh_user_caches should stop refreshing a backend whose credentials are refused"""
+    user = _make_fake_real_user()
+    models.UserCacheRefreshTime.objects.filter(user=user).delete()
+    edx_apis = _mock_refresh_clients(mocker)
+    error = HTTPError()
+    error.response = MagicMock(status_code=status_code)
+    edx_apis[BACKEND_EDX_ORG].enrollments.get_student_enrollments.side_effect = error
+    save_mock = mocker.patch.object(CachedEdxDataApi, 'save_cached_enrollments')
+    mocker.patch.object(CachedEdxDataApi, 'save_cached_current_grades')
+
+    assert api.refresh_user_caches(user) == [BACKEND_EDX_ORG]
+
+    save_mock.assert_called_once_with(
+        user,
+        edx_apis[BACKEND_MITX_ONLINE].enrollments.get_student_enrollments.return_value,
+        BACKEND_MITX_ONLINE,
+        freshness=ANY,
+    )
+    assert edx_apis[BACKEND_EDX_ORG].current_grades.get_student_current_grades.called is False
+
+
+def test_refresh_user_caches_budget(db, mocker, settings):
+    """refresh_user_caches should give up on the requests which take longer than the budget"""
+    settings.DASHBOARD_EDX_REFRESH_BUDGET_MS = 1000
+    user = _make_fake_real_user()
+    models.UserCacheRefreshTime.objects.filter(user=user).delete()
+    edx_apis = _mock_refresh_clients(mocker)
+    release = threading.Event()
+    edx_apis[BACKEND_EDX_ORG].enrollments.get_student_enrollments.side_effect = lambda: release.wait(10)
+    save_mock = mocker.patch.object(CachedEdxDataApi, 'save_cached_enrollments')
+    mocker.patch.object(CachedEdxDataApi, 'save_cached_current_grades')
+
+    try:
+        assert api.refresh_user_caches(user) == []
+    finally:
+        release.set()
+
+    save_mock.assert_called_once_with(
+        user,
+        edx_apis[BACKEND_MITX_ONLINE].enrollments.get_student_enrollments.return_value,
+        BACKEND_MITX_ONLINE,
+        freshness=ANY,
+    )
+    assert CachedEdxDataApi.are_all_caches_fresh(user) is False
+
+
+def test_background_refresh(settings):
+    """Only one background refresh of the caches of a user runs at a time, unless it got lost"""
+    settings.DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS = 60
+    user_id = 123
+    assert api.is_background_refresh_running(user_id) is False
+    assert api.start_background_refresh(user_id) is True
+    assert api.is_background_refresh_running(user_id) is True
+    assert api.start_background_refresh(user_id) is False
+
+    api.finish_background_refresh(user_id, [BACKEND_MITX_ONLINE])
+    assert api.is_background_refresh_running(user_id) is False
+    assert api.get_background_invalid_backend_credentials(user_id) == [BACKEND_MITX_ONLINE]
+    assert api.get_background_invalid_backend_credentials(user_id + 1) == []
+
+    assert api.start_background_refresh(user_id) is True
+    settings.DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS = -1
+    assert api.is_background_refresh_running(user_id) is False
+    assert api.start_background_refresh(user_id) is True
+    api.finish_background_refresh(user_id, [])
+
+
 def test_refresh_missing_user(db, mocker):
     """If the user doesn't exist we should skip the refresh"""
     refresh_user_token_mock = mocker.patch('dashboard.api.utils.refresh_user_token', autospec=True)
@@ -2415,7 +2733,7 @@ def test_refresh_update_cache(db, mocker, provider):
     edx_api_init = mocker.patch('dashboard.api.EdxApi', autospec=True, return_value=edx_api)
     failed_cache_type = CachedEdxDataApi.CACHE_TYPES_BACKEND[provider][0]
 
-    def _update_cache(user, edx_client, cache_type, provider):
+    def _update_cache(user, edx_client, cache_type, provider, **kwargs):
         """Fail updating the cache for only the given cache type"""
         if cache_type == failed_cache_type:
             raise KeyError()
@@ -2431,7 +2749,24 @@ def test_refresh_update_cache(db, mocker, provider):
     edx_api_init.assert_called_once_with(user_social.extra_data, COURSEWARE_BACKEND_URL[provider])
     assert save_failure_mock.call_count == 1
     for cache_type in CachedEdxDataApi.CACHE_TYPES_BACKEND[provider]:
-        update_cache_mock.assert_any_call(user, edx_api, cache_type, provider)
+        update_cache_mock.assert_any_call(user, edx_api, cache_type, provider, freshness=ANY)
+
+
+def test_refresh_throttled(db, mocker):
+    """If edX throttles the requests the caches left are not refreshed and no failure is saved"""
+    user = _make_fake_real_user()
+    mocker.patch('dashboard.api.utils.refresh_user_token', autospec=True)
+    mocker.patch('dashboard.api.EdxApi', autospec=True)
+    response = Mock(status_code=429)
+    update_cache_mock = mocker.patch(
+        'dashboard.api.CachedEdxDataApi.update_cache_if_expired', side_effect=HTTPError(response=response),
+    )
+    save_failure_mock = mocker.patch('dashboard.api.save_cache_update_failure', autospec=True)
+
+    assert api.refresh_user_data(user.id, BACKEND_MITX_ONLINE) is True
+
+    assert update_cache_mock.call_count == 1
+    assert save_failure_mock.called is False
 
 
 def test_save_cache_update_failures(db, patched_redis_keys):
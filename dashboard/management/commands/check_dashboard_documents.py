@@ -0,0 +1,36 @@
+"""
+Compares the stored dashboard documents with a live computation
+"""
+from django.core.management import BaseCommand
+
+from dashboard.api import check_dashboard_document
+from dashboard.models import DashboardDocument
+
+
+class Command(BaseCommand):
+    """
+    Compares the stored dashboard documents with a live computation
+    """
+    help = "Compares the stored dashboard documents with a live computation of the same information"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--username", help="only check the documents of this user")
+
+    def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
+        documents = DashboardDocument.objects.select_related('user', 'program').order_by('id')
+        if kwargs.get('username'):
+            documents = documents.filter(user__username=kwargs['username'])
+
+        total = 0
+        mismatches = 0
+        for document in documents.iterator():
+            result = check_dashboard_document(document)
+            if result is None:
+                continue
+            total += 1
+            if not result:
+                mismatches += 1
+                self.stdout.write(self.style.ERROR(f'Mismatch for {document}'))
+
+        style = self.style.ERROR if mismatches else self.style.SUCCESS
+        self.stdout.write(style(f'{mismatches}/{total} stored dashboard documents differ from the live computation'))
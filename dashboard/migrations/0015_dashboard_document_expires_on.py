@@ -0,0 +1,18 @@
+# Generated by Django 5.2.15 on 2026-10-18 20:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0014_dashboard_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboarddocument',
+            name='expires_on',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.15 on 2026-10-18 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0015_dashboard_document_expires_on'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dashboarddocument',
+            name='generation',
+            field=models.BigIntegerField(),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.15 on 2026-10-18 21:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0016_dashboard_document_generation_bigint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dashboarddocument',
+            name='structure_version',
+            field=models.BigIntegerField(),
+        ),
+    ]
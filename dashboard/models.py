@@ -4,19 +4,27 @@ Models for dashboard
 import uuid
 
 from django.contrib.auth import get_user_model
-
-from django.db.models import (CASCADE, CharField, DateTimeField, ForeignKey,
-                              JSONField, Model, OneToOneField)
+from django.db import transaction
+from django.db.models import (CASCADE, BigIntegerField, CharField,
+                              DateTimeField, ForeignKey, JSONField, Model,
+                              OneToOneField)
+from django_redis import get_redis_connection
 from edx_api.certificates import Certificate, Certificates
 from edx_api.enrollments import Enrollments
 from edx_api.grades import CurrentGrade, CurrentGradesByUser
+from rest_framework.utils.encoders import JSONEncoder
 
 from courses.models import CourseRun, Program
 from mail.models import PartnerSchool
 from micromasters.models import TimestampedModel
+from micromasters.utils import get_redis_counters, incr_redis_counter
 
 
 User = get_user_model()
+# key that stores the generation of the dashboard inputs of a user
+CACHE_KEY_DASHBOARD_GENERATION_BY_USER = "dashboard_document_generation_{0}"
+
+
 class CachedEdxInfoModel(Model):
     """
     Base class to define other cached models
@@ -94,6 +102,81 @@ class CachedEdxInfoModel(Model):
         """
         cls.user_qset(user, provider=provider).exclude(course_run__edx_course_key__in=course_ids_list).delete()
 
+    @classmethod
+    def replace_user_data(cls, user, data_by_course_run, provider):
+        """
+        Replaces the cached data of an user for a provider: the rows whose data changed are upserted with
+        a single query and the rows of the other course runs are deleted, while unchanged rows are not written.
+        Since the upsert does not send signals, the dashboard documents of the user are invalidated here.
+
+        Args:
+            provider (str): name of the courseware backend
+            user (User): an User object
+            data_by_course_run (dict): a map of CourseRun to the raw data to cache for it
+
+        Returns:
+            bool: whether any row was written or deleted
+        """
+        cached_data = dict(cls.user_qset(user, provider=provider).values_list('course_run_id', 'data'))
+        changed = [
+            cls(user=user, course_run=course_run, data=data)
+            for course_run, data in data_by_course_run.items()
+            if course_run.id not in cached_data or cached_data[course_run.id] != data
+        ]
+        if changed:
+            cls.objects.bulk_create(
+                changed,
+                update_conflicts=True,
+                unique_fields=['user', 'course_run'],
+                update_fields=['data'],
+            )
+            DashboardDocument.invalidate(user.id)
+        kept_course_run_ids = {course_run.id for course_run in data_by_course_run}
+        stale_course_run_ids = [
+            course_run_id for course_run_id in cached_data if course_run_id not in kept_course_run_ids
+        ]
+        if stale_course_run_ids:
+            cls.objects.filter(user=user, course_run_id__in=stale_course_run_ids).delete()
+        return bool(changed or stale_course_run_ids)
+
+    @classmethod
+    def replace_course_run_data(cls, course_run, user_ids, data_by_user_id):
+        """
+        Replaces the cached data of many users in a course run: the rows whose data changed are upserted with
+        a single query and the rows of the users without data are deleted, while unchanged rows are not written.
+
+        Args:
+            course_run (CourseRun): a CourseRun object
+            user_ids (iterable of int): the ids of the users whose rows are replaced
+            data_by_user_id (dict): a map of user id to the raw data to cache for it, for some of user_ids
+
+        Returns:
+            set of int: the ids of the users whose rows were written or deleted
+        """
+        user_ids = set(user_ids)
+        cached_data = dict(
+            cls.objects.filter(course_run=course_run, user_id__in=user_ids).values_list('user_id', 'data')
+        )
+        changed = [
+            cls(user_id=user_id, course_run=course_run, data=data)
+            for user_id, data in data_by_user_id.items()
+            if user_id in user_ids and (user_id not in cached_data or cached_data[user_id] != data)
+        ]
+        if changed:
+            cls.objects.bulk_create(
+                changed,
+                update_conflicts=True,
+                unique_fields=['user', 'course_run'],
+                update_fields=['data'],
+            )
+        stale_user_ids = [user_id for user_id in cached_data if user_id not in data_by_user_id]
+        if stale_user_ids:
+            cls.objects.filter(course_run=course_run, user_id__in=stale_user_ids).delete()
+        changed_user_ids = {row.user_id for row in changed}.union(stale_user_ids)
+        for user_id in changed_user_ids:
+            DashboardDocument.invalidate(user_id)
+        return changed_user_ids
+
     @staticmethod
     def deserialize_edx_data(data_iter):
         """
@@ -109,6 +192,31 @@ class CachedEdxInfoModel(Model):
         """
         return cls.deserialize_edx_data(cls.data_qset(user, program=program))
 
+    @classmethod
+    def get_edx_data_for_users(cls, users, program=None, course_run=None):
+        """
+        Retrieves the cached data for many users at once and encapsulates it
+        in specific edx-api-client classes.
+
+        Args:
+            users (iterable of User): User objects
+            program (Program): optional Program to filter on
+            course_run (CourseRun): optional CourseRun to filter on
+
+        Returns:
+            dict: a map of user id to the edx-api-client object for that user
+        """
+        user_ids = [user.id for user in users]
+        query_set = cls.objects.filter(user_id__in=user_ids)
+        if program is not None:
+            query_set = query_set.filter(course_run__course__program=program)
+        if course_run is not None:
+            query_set = query_set.filter(course_run=course_run)
+        data_by_user = {user_id: [] for user_id in user_ids}
+        for user_id, data in query_set.values_list('user_id', 'data'):
+            data_by_user[user_id].append(data)
+        return {user_id: cls.deserialize_edx_data(data) for user_id, data in data_by_user.items()}
+
     @classmethod
     def get_cached_users(cls, course_run):
         """
@@ -242,6 +350,66 @@ class ProgramEnrollment(Model):
         return f'user "{self.user.username}" enrolled in program "{self.program.title}"'
 
 
+class DashboardDocument(TimestampedModel):
+    """
+    Model for the precomputed dashboard information of a user in a program
+    """
+    user = ForeignKey(User, on_delete=CASCADE)
+    program = ForeignKey(Program, on_delete=CASCADE)
+    # encoded the same way the dashboard API renders it
+    data = JSONField(encoder=JSONEncoder)
+    # generation of the user's dashboard inputs the document was computed from
+    generation = BigIntegerField()
+    # version of the program structures the document was computed from
+    structure_version = BigIntegerField()
+    # first date of the program passing after the document was computed, if any
+    expires_on = DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (('user', 'program'), )
+
+    @staticmethod
+    def get_generation(user_id):
+        """
+        Returns the generation of the dashboard inputs of a user, which changes every time one of them changes
+
+        Args:
+            user_id (int): A user id
+
+        Returns:
+            int: the generation of the dashboard inputs of the user
+        """
+        [generation] = get_redis_counters(
+            get_redis_connection("redis"), [CACHE_KEY_DASHBOARD_GENERATION_BY_USER.format(user_id)]
+        )
+        return generation
+
+    @staticmethod
+    def _bump_generation(user_id):
+        """
+        Makes the stored dashboard documents of a user stale
+        """
+        incr_redis_counter(get_redis_connection("redis"), CACHE_KEY_DASHBOARD_GENERATION_BY_USER.format(user_id))
+
+    @classmethod
+    def invalidate(cls, user_id):
+        """
+        Discards the stored dashboard documents of a user right away, and again once the current
+        transaction is committed, so that a document computed before the commit is not kept
+
+        Args:
+            user_id (int): A user id
+        """
+        cls._bump_generation(user_id)
+        transaction.on_commit(lambda: cls._bump_generation(user_id))
+
+    def __str__(self):
+        """
+        String representation of the model object
+        """
+        return f'dashboard of user "{self.user.username}" in program "{self.program.title}"'
+
+
 class MicromastersLearnerRecordShare(TimestampedModel):
     """
     Model for learner record sharing
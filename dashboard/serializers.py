@@ -3,6 +3,7 @@ Provides functionality for serializing a ProgramEnrollment for the ES index
 """
 from rest_framework import serializers
 
+from courses.program_structure import get_program_structure
 from courses.utils import get_year_season_from_course_run
 from dashboard.utils import get_mmtrack
 from roles.api import is_learner
@@ -49,7 +50,7 @@ class UserProgramSearchSerializer:
         course_title = course_run.course.title
         payment_status = cls.PAID_STATUS if mmtrack.has_verified_enrollment(course_run.edx_course_key) else cls.UNPAID_STATUS
 
-        final_grade = mmtrack.get_final_grades_for_course(course_run.course).first()
+        final_grade = mmtrack.get_highest_final_grade_for_course(course_run.course)
         semester = cls.serialize_semester(course_run)
         return {
             'final_grade': final_grade.grade_percent if final_grade else None,
@@ -92,7 +93,7 @@ class UserProgramSearchSerializer:
         course_title = course_run.course.title
         payment_status = cls.PAID_STATUS if mmtrack.has_verified_enrollment(course_run.edx_course_key) else cls.UNPAID_STATUS
 
-        final_grade = mmtrack.get_final_grades_for_course(course_run.course).first()
+        final_grade = mmtrack.get_highest_final_grade_for_course(course_run.course)
         return {
             'final_grade': final_grade.grade_percent if final_grade else None,
             'course_title': course_title,
@@ -131,11 +132,14 @@ class UserProgramSearchSerializer:
     @classmethod
     def serialize(cls, program_enrollment):
         """
-        Serializes a ProgramEnrollment object
+        Serializes a ProgramEnrollment object, using the mmtrack attached by
+        dashboard.utils.prefetch_mmtracks if there is one
         """
         user = program_enrollment.user
         program = program_enrollment.program
-        mmtrack = get_mmtrack(user, program)
+        mmtrack = getattr(program_enrollment, 'prefetched_mmtrack', None)
+        if mmtrack is None:
+            mmtrack = get_mmtrack(user, program, preload=True)
 
         return {
             'id': program.id,
@@ -145,7 +149,7 @@ class UserProgramSearchSerializer:
             'grade_average': mmtrack.calculate_final_grade_average(),
             'is_learner': is_learner(user, program),
             'num_courses_passed': mmtrack.count_courses_passed(),
-            'total_courses': program.course_set.count()
+            'total_courses': len(get_program_structure(program.id).courses)
         }
 
 
@@ -2,26 +2,79 @@
 Signals for user profiles
 """
 from django.db import transaction
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
+from social_django.models import UserSocialAuth
 
-from dashboard.models import ProgramEnrollment
-from search.tasks import (index_program_enrolled_users,
+from dashboard.models import (CachedCertificate, CachedCurrentGrade,
+                              CachedEnrollment, DashboardDocument,
+                              ProgramEnrollment)
+from exams.models import ExamAuthorization, ExamProfile
+from grades.models import (CombinedFinalGrade, FinalGrade,
+                           MicromastersCourseCertificate,
+                           MicromastersProgramCertificate,
+                           MicromastersProgramCommendation, ProctoredExamGrade)
+from search.scope import invalidate_search_scope
+from search.tasks import (queue_index_program_enrolled_users,
                           remove_program_enrolled_user)
 
+# models with a user field which are read to compute the dashboard of that user
+DASHBOARD_INPUT_MODELS = (
+    CachedEnrollment,
+    CachedCertificate,
+    CachedCurrentGrade,
+    ProgramEnrollment,
+    FinalGrade,
+    CombinedFinalGrade,
+    ProctoredExamGrade,
+    MicromastersCourseCertificate,
+    MicromastersProgramCertificate,
+    MicromastersProgramCommendation,
+    ExamAuthorization,
+    UserSocialAuth,
+)
+
 
 @receiver(post_save, sender=ProgramEnrollment, dispatch_uid="programenrollment_post_save")
 def handle_create_programenrollment(sender, instance, created, **kwargs):  # pylint: disable=unused-argument
     """
-    When a ProgramEnrollment model is created/updated, update index.
+    When a ProgramEnrollment model is created/updated, update index and search scope.
     """
-    transaction.on_commit(lambda: index_program_enrolled_users.delay([instance.id]))
+    invalidate_search_scope(instance.user_id)
+    transaction.on_commit(lambda: queue_index_program_enrolled_users([instance.id]))
 
 
 @receiver(pre_delete, sender=ProgramEnrollment, dispatch_uid="programenrollment_pre_delete")
 def handle_delete_programenrollment(sender, instance, **kwargs):  # pylint: disable=unused-argument
     """
-    When a ProgramEnrollment model is deleted, update index.
+    When a ProgramEnrollment model is deleted, update index and search scope.
     """
+    invalidate_search_scope(instance.user_id)
     enrollment_id = instance.id  # this is modified in-place on delete, so store it on a local
     transaction.on_commit(lambda: remove_program_enrolled_user.delay(enrollment_id))
+
+
+def handle_dashboard_input_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a model read by the dashboard of a user is saved or deleted, discard the stored dashboard documents
+    """
+    if instance.user_id is not None:
+        DashboardDocument.invalidate(instance.user_id)
+
+
+for model in DASHBOARD_INPUT_MODELS:
+    post_save.connect(
+        handle_dashboard_input_change, sender=model, dispatch_uid=f"{model.__name__.lower()}_dashboard_post_save"
+    )
+    post_delete.connect(
+        handle_dashboard_input_change, sender=model, dispatch_uid=f"{model.__name__.lower()}_dashboard_post_delete"
+    )
+
+
+@receiver(post_save, sender=ExamProfile, dispatch_uid="examprofile_dashboard_post_save")
+@receiver(post_delete, sender=ExamProfile, dispatch_uid="examprofile_dashboard_post_delete")
+def handle_examprofile_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When an ExamProfile is saved or deleted, discard the stored dashboard documents of its user
+    """
+    DashboardDocument.invalidate(instance.profile.user_id)
@@ -2,88 +2,231 @@
 Periodic task that updates user data.
 """
 import logging
-from datetime import datetime, timedelta
+import time
+import uuid
+from datetime import timedelta
 
-import pytz
-from celery import group
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django_redis import get_redis_connection
 
 from backends.constants import COURSEWARE_BACKENDS
-from dashboard.api import calculate_users_to_refresh_in_bulk, refresh_user_data
+from dashboard.api import (finish_background_refresh,
+                           rank_users_to_refresh_in_bulk, refresh_user_caches,
+                           refresh_user_data)
 from micromasters.celery import app
-from micromasters.locks import Lock, release_lock
+from micromasters.locks import Lock
 from micromasters.utils import chunks, now_in_utc
 
 log = logging.getLogger(__name__)
+User = get_user_model()
 
 
 LOCK_ID = 'batch_update_user_data_lock'
+# sorted set of the ids of the users waiting for a refresh of their edX data, scored by priority
+CACHE_KEY_BATCH_UPDATE_QUEUE = "batch_update_user_data_queue"
+# key set while the queue of users is ranked, once it expires the users to refresh are ranked again
+CACHE_KEY_BATCH_UPDATE_QUEUE_RANKED = "batch_update_user_data_queue_ranked"
+# sorted set of the ids of the chunks of users being refreshed, scored by dispatch timestamp
+CACHE_KEY_BATCH_UPDATE_IN_FLIGHT = "batch_update_user_data_in_flight"
+# sorted set of the ids of the users in the chunks being refreshed, scored by dispatch timestamp
+CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS = "batch_update_user_data_in_flight_users"
+# number of chunks of users refreshed at the same time, adapted to how edX responds
+CACHE_KEY_BATCH_UPDATE_CONCURRENCY = "batch_update_user_data_concurrency"
+# key set while edX throttles the requests, no chunk of users is dispatched until it expires
+CACHE_KEY_BATCH_UPDATE_THROTTLED = "batch_update_user_data_throttled"
+
+BATCH_UPDATE_QUEUE_RANKING_SECONDS = 15 * 60
+BATCH_UPDATE_THROTTLE_BACKOFF_SECONDS = 5 * 60
+# a chunk still running after this time is considered lost and frees its slot
+BATCH_UPDATE_CHUNK_TIMEOUT_SECONDS = 10 * 60
+BATCH_UPDATE_MIN_CONCURRENCY = 1
+
+
+def _get_batch_update_concurrency(con):
+    """
+    Args:
+        con (redis.Redis): a redis connection
 
+    Returns:
+        float: the number of chunks of users which can be refreshed at the same time
+    """
+    concurrency = con.get(CACHE_KEY_BATCH_UPDATE_CONCURRENCY)
+    return float(concurrency) if concurrency is not None else BATCH_UPDATE_MIN_CONCURRENCY
 
-@app.task
-def release_batch_update_user_data_lock(*args, token):  # pylint: disable=unused-argument
+
+def _rank_batch_update_queue(con):
+    """
+    Replaces the queue of the users to refresh with the users whose edX data is expired, ranked by priority.
+    The users of the chunks being refreshed are left out, they would be refreshed twice otherwise.
+
+    Args:
+        con (redis.Redis): a redis connection
+    """
+    in_flight_user_ids = {
+        int(user_id) for user_id in con.zrangebyscore(
+            CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS, time.time() - BATCH_UPDATE_CHUNK_TIMEOUT_SECONDS, "+inf"
+        )
+    }
+    priorities = {
+        user_id: priority for user_id, priority in rank_users_to_refresh_in_bulk().items()
+        if user_id not in in_flight_user_ids
+    }
+    pipe = con.pipeline()
+    pipe.delete(CACHE_KEY_BATCH_UPDATE_QUEUE)
+    for priorities_chunk in chunks(priorities.items(), chunk_size=1000):
+        pipe.zadd(CACHE_KEY_BATCH_UPDATE_QUEUE, dict(priorities_chunk))
+    pipe.set(CACHE_KEY_BATCH_UPDATE_QUEUE_RANKED, 1, ex=BATCH_UPDATE_QUEUE_RANKING_SECONDS)
+    pipe.execute()
+    log.info("%d users are queued for a refresh of their edX data", len(priorities))
+
+
+def _dispatch_batch_update_chunks(con):
     """
-    Task which releases the lock acquired in batch_update_user_data
+    Pops the users with the highest priority from the queue and starts refreshing them,
+    as many chunks of users as the concurrency allows, unless edX throttles the requests
 
     Args:
-        token (str): The token used with the lock
+        con (redis.Redis): a redis connection
     """
-    release_lock(LOCK_ID, token.encode())
-    log.info("Released batch_update_user_data lock")
+    now = time.time()
+    for key in (CACHE_KEY_BATCH_UPDATE_IN_FLIGHT, CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS):
+        con.zremrangebyscore(key, "-inf", now - BATCH_UPDATE_CHUNK_TIMEOUT_SECONDS)
+    free_slots = int(_get_batch_update_concurrency(con)) - con.zcard(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT)
+    for _ in range(free_slots):
+        if con.exists(CACHE_KEY_BATCH_UPDATE_THROTTLED):
+            break
+        students = [
+            [int(user_id), priority]
+            for user_id, priority in con.zpopmax(CACHE_KEY_BATCH_UPDATE_QUEUE, settings.BATCH_UPDATE_CHUNK_SIZE)
+        ]
+        if not students:
+            break
+        chunk_id = uuid.uuid4().hex
+        con.zadd(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT, {chunk_id: now})
+        con.zadd(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS, {user_id: now for user_id, _ in students})
+        batch_update_user_data_subtasks.delay(students, chunk_id)
+
+
+def _finish_batch_update_chunk(con, students, chunk_id):
+    """
+    Frees the slot of a chunk of users, so that its users can be queued again
+
+    Args:
+        con (redis.Redis): a redis connection
+        students (list of (int, float)): the user ids of the chunk, with their priority
+        chunk_id (str): the id of the chunk
+    """
+    pipe = con.pipeline()
+    pipe.zrem(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT, chunk_id)
+    pipe.zrem(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS, *[user_id for user_id, _ in students])
+    pipe.execute()
+
+
+def _adapt_batch_update_concurrency(con, latency, throttled):
+    """
+    Adapts the number of chunks of users refreshed at the same time to how edX responded to a chunk:
+    it grows by one chunk for each round of chunks refreshed fast enough, shrinks by one chunk
+    when the refresh of a user is slower than settings.BATCH_UPDATE_TARGET_LATENCY_SECONDS,
+    and is halved when edX throttles the requests, in which case the refresh is paused for a while.
+    Concurrent chunks may overwrite each other's adjustment, which only slows down the adaptation.
+
+    Args:
+        con (redis.Redis): a redis connection
+        latency (float): the average time in seconds spent refreshing a user of the chunk
+        throttled (bool): True if edX responded with a 429 status code
+    """
+    concurrency = _get_batch_update_concurrency(con)
+    if throttled:
+        concurrency = concurrency / 2
+        con.set(CACHE_KEY_BATCH_UPDATE_THROTTLED, 1, ex=BATCH_UPDATE_THROTTLE_BACKOFF_SECONDS)
+    elif latency > settings.BATCH_UPDATE_TARGET_LATENCY_SECONDS:
+        concurrency = concurrency - 1
+    else:
+        concurrency = concurrency + 1 / concurrency
+    concurrency = min(max(concurrency, BATCH_UPDATE_MIN_CONCURRENCY), settings.BATCH_UPDATE_MAX_CONCURRENCY)
+    con.set(CACHE_KEY_BATCH_UPDATE_CONCURRENCY, concurrency)
 
 
-# This lock is not safe against repeated executions of the task since there is no logic
-# to stop the batch update halfway through and the lock expiration might be shorter than the length of time this
-# executes.
 @app.task
 def batch_update_user_data():
     """
     Create sub tasks to update user data like enrollments,
-    certificates and grades from edX platform.
+    certificates and grades from edX platform, the users for whom it matters most first.
+    This runs every minute and whenever a sub task is done, so the users are refreshed continuously.
     """
     if not settings.EDX_BATCH_UPDATES_ENABLED:
         log.debug("Edx batch updates disabled via EDX_BATCH_UPDATES_ENABLED")
         return
 
-    expiration = now_in_utc() + timedelta(hours=5)
-    lock = Lock(LOCK_ID, expiration)
-    if not lock.acquire():
-        # Lock should have expired by now
-        log.error("Unable to acquire lock for batch_update_user_data")
-        return
-
-    users_to_refresh = calculate_users_to_refresh_in_bulk()
+    with Lock(LOCK_ID, now_in_utc() + timedelta(minutes=1)) as lock:
+        if not lock.acquired:
+            log.debug("Unable to acquire lock for batch_update_user_data")
+            return
 
-    jobs = release_batch_update_user_data_lock.s(token=lock.token.decode())
-    try:
-        if len(users_to_refresh) > 0:
-            user_id_chunks = chunks(users_to_refresh)
-
-            job = group(
-                batch_update_user_data_subtasks.s(user_id_chunk, expiration.timestamp())
-                for user_id_chunk in user_id_chunks
-            )
-            jobs = job | jobs
-    finally:
-        jobs.delay()
+        con = get_redis_connection("redis")
+        if con.exists(CACHE_KEY_BATCH_UPDATE_THROTTLED):
+            log.info("edX throttled the batch updates, they are paused")
+            return
+        if not con.exists(CACHE_KEY_BATCH_UPDATE_QUEUE_RANKED):
+            _rank_batch_update_queue(con)
+        _dispatch_batch_update_chunks(con)
 
 
-@app.task(rate_limit=settings.BATCH_UPDATE_RATE_LIMIT)
-def batch_update_user_data_subtasks(students, expiration_timestamp):
+@app.task
+def batch_update_user_data_subtasks(students, chunk_id):
     """
     Update user data like enrollments, certificates and grades from edX platform.
+    If edX throttles the requests, the users left are queued again.
 
     Args:
-        students (list of int): List of user ids for students.
-        expiration_timestamp (float): A timestamp indicating when the tasks should stop processing
+        students (list of (int, float)): List of user ids for students, with their priority
+        chunk_id (str): The id of the chunk of users in the batch updates
     """
+    con = get_redis_connection("redis")
     if not settings.EDX_BATCH_UPDATES_ENABLED:
         log.debug("Edx batch updates disabled via EDX_BATCH_UPDATES_ENABLED")
+        _finish_batch_update_chunk(con, students, chunk_id)
         return
 
-    expiration = datetime.fromtimestamp(expiration_timestamp, tz=pytz.utc)
-    for user_id in students:
-        # if we are past the expiration time we should stop any extra work
-        if expiration > now_in_utc():
+    throttled = False
+    refreshed_count = 0
+    start = time.monotonic()
+    try:
+        for user_id, _ in students:
             for backend in COURSEWARE_BACKENDS:
-                refresh_user_data(user_id, backend)
+                throttled = refresh_user_data(user_id, backend)
+                if throttled:
+                    break
+            if throttled:
+                break
+            refreshed_count += 1
+    finally:
+        _finish_batch_update_chunk(con, students, chunk_id)
+    latency = (time.monotonic() - start) / max(refreshed_count, 1)
+    if throttled:
+        # the user being refreshed is queued again too, its fresh caches are not requested twice
+        con.zadd(CACHE_KEY_BATCH_UPDATE_QUEUE, dict(students[refreshed_count:]))
+    _adapt_batch_update_concurrency(con, latency, throttled)
+    batch_update_user_data.delay()
+
+
+@app.task
+def refresh_user_caches_in_background(user_id):
+    """
+    Refresh the expired edX caches of a user whose dashboard was served from stale data.
+    The refresh must have been marked as started with dashboard.api.start_background_refresh.
+
+    Args:
+        user_id (int): The user id
+    """
+    invalid_backend_credentials = []
+    try:
+        user = User.objects.get(id=user_id)
+        invalid_backend_credentials = refresh_user_caches(
+            user, budget_ms=settings.DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS * 1000
+        )
+    except:  # pylint: disable=bare-except
+        log.exception('Background edX data refresh failed for user "%s"', user_id)
+    finally:
+        finish_background_refresh(user_id, invalid_backend_credentials)
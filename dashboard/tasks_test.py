@@ -1,68 +1,175 @@
 """
 Tests for tasks
 """
+import time
 from datetime import timedelta
+from unittest.mock import ANY, call
 
 import pytest
-
-from backends.constants import COURSEWARE_BACKENDS
-from dashboard.tasks import (LOCK_ID, batch_update_user_data,
-                             batch_update_user_data_subtasks)
+from django_redis import get_redis_connection
+
+from backends.constants import BACKEND_EDX_ORG, COURSEWARE_BACKENDS
+from dashboard.tasks import (BATCH_UPDATE_CHUNK_TIMEOUT_SECONDS,
+                             CACHE_KEY_BATCH_UPDATE_CONCURRENCY,
+                             CACHE_KEY_BATCH_UPDATE_IN_FLIGHT,
+                             CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS,
+                             CACHE_KEY_BATCH_UPDATE_QUEUE,
+                             CACHE_KEY_BATCH_UPDATE_QUEUE_RANKED,
+                             CACHE_KEY_BATCH_UPDATE_THROTTLED, LOCK_ID,
+                             _adapt_batch_update_concurrency,
+                             batch_update_user_data,
+                             batch_update_user_data_subtasks,
+                             refresh_user_caches_in_background)
 from micromasters.factories import SocialUserFactory
-from micromasters.utils import is_near_now, now_in_utc
+from micromasters.locks import Lock
+from micromasters.utils import now_in_utc
+
+
+@pytest.fixture
+def batch_update_redis(settings):
+    """Clears the redis keys of the batch updates"""
+    settings.BATCH_UPDATE_CHUNK_SIZE = 2
+    settings.BATCH_UPDATE_MAX_CONCURRENCY = 10
+    settings.BATCH_UPDATE_TARGET_LATENCY_SECONDS = 10
+    con = get_redis_connection("redis")
+    keys = [
+        CACHE_KEY_BATCH_UPDATE_CONCURRENCY,
+        CACHE_KEY_BATCH_UPDATE_IN_FLIGHT,
+        CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS,
+        CACHE_KEY_BATCH_UPDATE_QUEUE,
+        CACHE_KEY_BATCH_UPDATE_QUEUE_RANKED,
+        CACHE_KEY_BATCH_UPDATE_THROTTLED,
+        LOCK_ID,
+    ]
+    con.delete(*keys)
+    yield con
+    con.delete(*keys)
+
+
+def test_batch_update(mocker, batch_update_redis):
+    """
+    batch_update_user_data should refresh the users with the highest priority first,
+    as many chunks of users as the concurrency allows
+    """
+    con = batch_update_redis
+    con.set(CACHE_KEY_BATCH_UPDATE_CONCURRENCY, 2)
+    rank_mock = mocker.patch('dashboard.tasks.rank_users_to_refresh_in_bulk', autospec=True, return_value={
+        1: 0, 2: 4, 3: 1, 4: 6, 5: 2, 6: 0,
+    })
+    refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True, return_value=False)
+
+    batch_update_user_data()
+
+    rank_mock.assert_called_once_with()
+    assert refresh_mock.call_args_list == [
+        call(user_id, backend) for user_id in [4, 2, 5, 3] for backend in COURSEWARE_BACKENDS
+    ]
+    assert sorted(int(user_id) for user_id in con.zrange(CACHE_KEY_BATCH_UPDATE_QUEUE, 0, -1)) == [1, 6]
+    assert con.zcard(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT) == 0
+    assert con.zcard(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS) == 0
+    # the concurrency grows while the chunks are refreshed fast enough
+    assert float(con.get(CACHE_KEY_BATCH_UPDATE_CONCURRENCY)) == pytest.approx(2.9)
+
+
+def test_batch_update_ranked(mocker, batch_update_redis):
+    """The users are ranked again only once the queue ranking expired"""
+    con = batch_update_redis
+    con.set(CACHE_KEY_BATCH_UPDATE_QUEUE_RANKED, 1)
+    con.zadd(CACHE_KEY_BATCH_UPDATE_QUEUE, {7: 1})
+    rank_mock = mocker.patch('dashboard.tasks.rank_users_to_refresh_in_bulk', autospec=True)
+    refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True, return_value=False)
+
+    batch_update_user_data()
+
+    assert rank_mock.called is False
+    assert refresh_mock.call_args_list == [call(7, backend) for backend in COURSEWARE_BACKENDS]
+
+
+def test_batch_update_in_flight_users(mocker, batch_update_redis):
+    """The users of the chunks being refreshed are not queued again when the users are ranked"""
+    con = batch_update_redis
+    con.zadd(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS, {
+        1: time.time() - BATCH_UPDATE_CHUNK_TIMEOUT_SECONDS - 1,
+        2: time.time(),
+    })
+    mocker.patch('dashboard.tasks.rank_users_to_refresh_in_bulk', autospec=True, return_value={1: 1, 2: 2, 3: 3})
+    subtask_mock = mocker.patch('dashboard.tasks.batch_update_user_data_subtasks', autospec=True)
+
+    batch_update_user_data()
+
+    # the user of a lost chunk is queued again
+    subtask_mock.delay.assert_called_once_with([[3, 3], [1, 1]], ANY)
+    assert con.zcard(CACHE_KEY_BATCH_UPDATE_QUEUE) == 0
+    assert sorted(int(user_id) for user_id in con.zrange(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT_USERS, 0, -1)) == [1, 2, 3]
 
 
-def test_nothing_to_do(mocker):
+def test_batch_update_throttled(mocker, batch_update_redis):
     """
-    If there's nothing to update batch_update_user_date should only acquire and release the lock
+    If edX throttles the requests the users left are queued again, the concurrency is halved
+    and the batch updates are paused
     """
-    calc_mock = mocker.patch('dashboard.tasks.calculate_users_to_refresh_in_bulk', autospec=True, return_value=[])
-    lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
-    lock_mock = lock_mock_init.return_value
-    token = b'token'
-    lock_mock.token = token
-    lock_mock.acquire.return_value = True
-    refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True)
-    release_mock = mocker.patch('dashboard.tasks.release_lock', autospec=True)
+    con = batch_update_redis
+    con.set(CACHE_KEY_BATCH_UPDATE_CONCURRENCY, 4)
+    mocker.patch('dashboard.tasks.rank_users_to_refresh_in_bulk', autospec=True, return_value={1: 3, 2: 2})
+    refresh_mock = mocker.patch(
+        'dashboard.tasks.refresh_user_data', autospec=True, side_effect=lambda user_id, backend: user_id == 2
+    )
 
     batch_update_user_data()
 
-    assert lock_mock_init.call_args[0][0] == LOCK_ID
-    assert is_near_now(lock_mock_init.call_args[0][1] - timedelta(hours=5))
-    calc_mock.assert_called_once_with()
-    lock_mock.acquire.assert_called_once_with()
+    assert refresh_mock.call_args_list == [
+        call(1, backend) for backend in COURSEWARE_BACKENDS
+    ] + [call(2, COURSEWARE_BACKENDS[0])]
+    assert con.zrange(CACHE_KEY_BATCH_UPDATE_QUEUE, 0, -1, withscores=True) == [(b'2', 2)]
+    assert float(con.get(CACHE_KEY_BATCH_UPDATE_CONCURRENCY)) == 2
+    assert con.exists(CACHE_KEY_BATCH_UPDATE_THROTTLED)
+
+    refresh_mock.reset_mock()
+    batch_update_user_data()
     assert refresh_mock.called is False
-    assert release_mock.call_count == 1
-    release_mock.assert_called_once_with(LOCK_ID, token)
 
 
-def test_batch_update(mocker, db):  # pylint: disable=unused-argument
+def test_batch_update_lost_chunks(mocker, batch_update_redis):
+    """The chunks running for too long are considered lost and free their slot"""
+    con = batch_update_redis
+    con.set(CACHE_KEY_BATCH_UPDATE_CONCURRENCY, 2)
+    con.set(CACHE_KEY_BATCH_UPDATE_QUEUE_RANKED, 1)
+    con.zadd(CACHE_KEY_BATCH_UPDATE_QUEUE, {1: 1, 2: 2, 3: 3})
+    con.zadd(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT, {
+        "lost": time.time() - BATCH_UPDATE_CHUNK_TIMEOUT_SECONDS - 1,
+        "running": time.time(),
+    })
+    subtask_mock = mocker.patch('dashboard.tasks.batch_update_user_data_subtasks', autospec=True)
+
+    batch_update_user_data()
+
+    subtask_mock.delay.assert_called_once_with([[3, 3], [2, 2]], ANY)
+    assert con.zcard(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT) == 2
+    assert con.zscore(CACHE_KEY_BATCH_UPDATE_IN_FLIGHT, "lost") is None
+
+
+@pytest.mark.parametrize("concurrency,latency,throttled,expected", [
+    [4, 1, False, 4.25],
+    [4, 20, False, 3],
+    [4, 1, True, 2],
+    [1, 20, False, 1],
+    [1, 1, True, 1],
+    [10, 1, False, 10],
+])
+def test_adapt_batch_update_concurrency(
+        batch_update_redis, concurrency, latency, throttled, expected
+):  # pylint: disable=too-many-arguments
     """
-    batch_update_user_data should create a group of tasks operating on chunks of users to refresh their caches
+    The concurrency grows by one chunk for each round of chunks refreshed fast enough,
+    shrinks by one chunk when they are slow and is halved when edX throttles the requests
     """
-    users = SocialUserFactory.create_batch(25)
-    calc_mock = mocker.patch('dashboard.tasks.calculate_users_to_refresh_in_bulk', autospec=True, return_value=[
-        user.id for user in users
-    ])
-    lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
-    lock_mock = lock_mock_init.return_value
-    token = b'token'
-    lock_mock.token = token
-    lock_mock.acquire.return_value = True
-    refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True)
-    release_mock = mocker.patch('dashboard.tasks.release_lock', autospec=True)
+    con = batch_update_redis
+    con.set(CACHE_KEY_BATCH_UPDATE_CONCURRENCY, concurrency)
 
-    batch_update_user_data()
+    _adapt_batch_update_concurrency(con, latency, throttled)
 
-    assert lock_mock_init.call_args[0][0] == LOCK_ID
-    assert is_near_now(lock_mock_init.call_args[0][1] - timedelta(hours=5))
-    calc_mock.assert_called_once_with()
-    lock_mock.acquire.assert_called_once_with()
-    assert refresh_mock.call_count == len(users) * len(COURSEWARE_BACKENDS)
-    for backend in COURSEWARE_BACKENDS:
-        for user in users:
-            refresh_mock.assert_any_call(user.id, backend)
-    release_mock.assert_called_once_with(LOCK_ID, token)
+    assert float(con.get(CACHE_KEY_BATCH_UPDATE_CONCURRENCY)) == pytest.approx(expected)
+    assert bool(con.exists(CACHE_KEY_BATCH_UPDATE_THROTTLED)) is throttled
 
 
 @pytest.mark.usefixtures("db")
@@ -70,43 +177,30 @@ def test_batch_update_disabled(mocker, settings):
     """batch_update_user_data should not run if it's disabled"""
     settings.EDX_BATCH_UPDATES_ENABLED = False
     users = SocialUserFactory.create_batch(25)
-    calc_mock = mocker.patch('dashboard.tasks.calculate_users_to_refresh_in_bulk', autospec=True, return_value=[
-        user.id for user in users
-    ])
-    lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
-    lock_mock = lock_mock_init.return_value
-    token = b'token'
-    lock_mock.token = token
-    lock_mock.acquire.return_value = True
+    rank_mock = mocker.patch('dashboard.tasks.rank_users_to_refresh_in_bulk', autospec=True, return_value={
+        user.id: 0 for user in users
+    })
     mocker.patch('dashboard.tasks.refresh_user_data', autospec=True)
-    mocker.patch('dashboard.tasks.release_lock', autospec=True)
     mock_log = mocker.patch('dashboard.tasks.log', autospec=True)
 
     batch_update_user_data.delay()
 
-    calc_mock.assert_not_called()
+    rank_mock.assert_not_called()
     mock_log.debug.assert_called_once_with("Edx batch updates disabled via EDX_BATCH_UPDATES_ENABLED")
 
 
-def test_failed_to_acquire(mocker):
+def test_failed_to_acquire(mocker, batch_update_redis):  # pylint: disable=unused-argument
     """
     If the lock is held there should be nothing else done
     """
-    calc_mock = mocker.patch('dashboard.tasks.calculate_users_to_refresh_in_bulk', autospec=True, return_value=[])
-    lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
-    lock_mock = lock_mock_init.return_value
-    lock_mock.acquire.return_value = False
+    rank_mock = mocker.patch('dashboard.tasks.rank_users_to_refresh_in_bulk', autospec=True, return_value={})
     refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True)
-    release_mock = mocker.patch('dashboard.tasks.release_lock', autospec=True)
 
-    batch_update_user_data()
+    with Lock(LOCK_ID, now_in_utc() + timedelta(minutes=1)):
+        batch_update_user_data()
 
-    assert lock_mock_init.call_args[0][0] == LOCK_ID
-    assert is_near_now(lock_mock_init.call_args[0][1] - timedelta(hours=5))
-    assert calc_mock.called is False
-    lock_mock.acquire.assert_called_once_with()
+    assert rank_mock.called is False
     assert refresh_mock.called is False
-    assert release_mock.called is False
 
 
 @pytest.mark.usefixtures("db")
@@ -115,6 +209,26 @@ def batch_update_user_data_subtasks_disabled(mocker, settings):
     settings.EDX_BATCH_UPDATES_ENABLED = False
     mock_log = mocker.patch('dashboard.tasks.log', autospec=True)
     mock_refresh_user_data = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True)
-    batch_update_user_data_subtasks.delay([1, 2, 3], (now_in_utc() + timedelta(hours=5)).timestamp())
+    batch_update_user_data_subtasks.delay([[1, 0], [2, 0], [3, 0]], "chunk")
     mock_refresh_user_data.assert_not_called()
     mock_log.debug.assert_called_once_with("Edx batch updates disabled via EDX_BATCH_UPDATES_ENABLED")
+
+
+@pytest.mark.parametrize("raises", [True, False])
+def test_refresh_user_caches_in_background(mocker, db, settings, raises):  # pylint: disable=unused-argument
+    """
+    refresh_user_caches_in_background should refresh the caches of the user and record the end of the refresh
+    """
+    settings.DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS = 30
+    user = SocialUserFactory.create()
+    refresh_mock = mocker.patch(
+        'dashboard.tasks.refresh_user_caches',
+        autospec=True,
+        **({'side_effect': Exception} if raises else {'return_value': [BACKEND_EDX_ORG]})
+    )
+    finish_mock = mocker.patch('dashboard.tasks.finish_background_refresh', autospec=True)
+
+    refresh_user_caches_in_background(user.id)
+
+    refresh_mock.assert_called_once_with(user, budget_ms=30000)
+    finish_mock.assert_called_once_with(user.id, [] if raises else [BACKEND_EDX_ORG])
@@ -2,13 +2,13 @@
 Utility functions and classes for the dashboard
 """
 import logging
+from collections import defaultdict
 from decimal import Decimal
 
-from django.db import transaction
-from django.db.models import Count, Q
+from django.db.models import Count
 from django.urls import reverse
 
-from courses.models import CourseRun
+from courses.program_structure import get_program_structure
 from dashboard.api_edx_cache import CachedEdxUserData
 from dashboard.models import ProgramEnrollment
 from grades.constants import FinalGradeStatus, NEW_COMBINED_FINAL_GRADES_DATE
@@ -33,6 +33,195 @@ ATTEMPTS_PER_PAID_RUN = 1
 log = logging.getLogger(__name__)
 
 
+def _final_grades_by_grade_desc(final_grades):
+    """
+    Sorts final grades the same way the database does for an `order_by('-grade')`,
+    meaning that null grades come first.
+
+    Args:
+        final_grades (iterable of FinalGrade): final grades to sort
+
+    Returns:
+        list of FinalGrade: the sorted final grades
+    """
+    return sorted(
+        final_grades,
+        key=lambda final_grade: (final_grade.grade is None, final_grade.grade or 0),
+        reverse=True,
+    )
+
+
+class MMTrackSnapshot:
+    """
+    In-memory indexes of the grade and exam records of a user in a program.
+
+    A snapshot is loaded with a fixed number of queries, regardless of the number of courses
+    and course runs in the program, so that a MMTrack can answer from it without querying again.
+    """
+
+    def __init__(self, *, final_grades=(), combined_grades=(), course_certificates=(),
+                 exam_grades=(), exam_authorizations=(), has_exam_profile=False):
+        """
+        Args:
+            final_grades (iterable of FinalGrade): all the final grades, with their course runs
+            combined_grades (iterable of CombinedFinalGrade): all the combined final grades
+            course_certificates (iterable of MicromastersCourseCertificate):
+                all the course certificates, annotated with the number of signatories
+            exam_grades (iterable of ProctoredExamGrade): the proctored exam grades with available results
+            exam_authorizations (iterable of ExamAuthorization): the successful exam authorizations
+            has_exam_profile (bool): whether the user has an ExamProfile
+        """
+        # course id -> list of FinalGrade with any status
+        self.final_grades_by_course = defaultdict(list)
+        # edx_course_key -> FinalGrade with complete status
+        self.complete_final_grades = {}
+        for final_grade in final_grades:
+            self.add_final_grade(final_grade)
+
+        self.combined_grades = {combined_grade.course_id: combined_grade for combined_grade in combined_grades}
+
+        self.course_certificates = defaultdict(list)
+        for certificate in sorted(course_certificates, key=lambda cert: cert.id):
+            self.course_certificates[certificate.course_id].append(certificate)
+
+        self.exam_grades = defaultdict(list)
+        for exam_grade in exam_grades:
+            self.exam_grades[exam_grade.course_id].append(exam_grade)
+
+        self.exam_authorizations = list(exam_authorizations)
+        self.has_exam_profile = has_exam_profile
+
+    @classmethod
+    def load(cls, user, program):
+        """
+        Loads the snapshot of a user in a program
+
+        Args:
+            user (User): a Django user
+            program (programs.models.Program): program where the user is enrolled
+
+        Returns:
+            MMTrackSnapshot: the snapshot of the user data in the program
+        """
+        return cls.load_for_users([user], program)[user.id]
+
+    @classmethod
+    def load_for_users(cls, users, program):
+        """
+        Loads the snapshots of many users in a program, with the same number of queries as for a single user
+
+        Args:
+            users (iterable of User): Django users
+            program (programs.models.Program): program where the users are enrolled
+
+        Returns:
+            dict: a map of user id to the MMTrackSnapshot of the user data in the program
+        """
+        user_ids = [user.id for user in users]
+        records = {
+            'final_grades': FinalGrade.objects.filter(
+                user_id__in=user_ids, course_run__course__program=program
+            ).select_related('course_run'),
+            'combined_grades': CombinedFinalGrade.objects.filter(user_id__in=user_ids, course__program=program),
+            'course_certificates': MicromastersCourseCertificate.objects.filter(
+                user_id__in=user_ids, course__program=program
+            ).annotate(signatories=Count('course__signatories')),
+            'exam_grades': ProctoredExamGrade.objects.filter(
+                user_id__in=user_ids,
+                course__program=program,
+                exam_run__date_grades_available__lte=now_in_utc(),
+            ),
+            'exam_authorizations': ExamAuthorization.objects.filter(
+                user_id__in=user_ids,
+                status=ExamAuthorization.STATUS_SUCCESS,
+                exam_run__course__program=program,
+            ).select_related('exam_run'),
+        }
+        records_by_user = {user_id: defaultdict(list) for user_id in user_ids}
+        for name, query_set in records.items():
+            for record in query_set:
+                records_by_user[record.user_id][name].append(record)
+        users_with_exam_profile = set(
+            ExamProfile.objects.filter(profile__user_id__in=user_ids).values_list('profile__user_id', flat=True)
+        )
+        return {
+            user_id: cls(
+                has_exam_profile=user_id in users_with_exam_profile,
+                **user_records,
+            ) for user_id, user_records in records_by_user.items()
+        }
+
+    def add_final_grade(self, final_grade):
+        """
+        Adds a final grade to the indexes, for instance after a grade has been frozen
+
+        Args:
+            final_grade (FinalGrade): a final grade with its course run
+        """
+        course_run = final_grade.course_run
+        grades_for_course = self.final_grades_by_course[course_run.course_id]
+        grades_for_course[:] = [grade for grade in grades_for_course if grade.course_run_id != course_run.id]
+        grades_for_course.append(final_grade)
+        if final_grade.status == FinalGradeStatus.COMPLETE:
+            self.complete_final_grades[course_run.edx_course_key] = final_grade
+        else:
+            self.complete_final_grades.pop(course_run.edx_course_key, None)
+
+    def get_complete_final_grades_for_course(self, course_id):
+        """
+        Args:
+            course_id (int): a course id
+
+        Returns:
+            list of FinalGrade: the complete final grades for the course, best grade first
+        """
+        return _final_grades_by_grade_desc(
+            final_grade for final_grade in self.final_grades_by_course.get(course_id, [])
+            if final_grade.status == FinalGradeStatus.COMPLETE
+        )
+
+    def get_passed_course_ids_for_keys(self, edx_course_keys):
+        """
+        Args:
+            edx_course_keys (iterable of str): edX course run keys
+
+        Returns:
+            set of int: the ids of the courses with a complete and passed final grade in one of the runs
+        """
+        return {
+            self.complete_final_grades[edx_course_key].course_run.course_id
+            for edx_course_key in edx_course_keys
+            if edx_course_key in self.complete_final_grades and self.complete_final_grades[edx_course_key].passed
+        }
+
+    def get_passed_course_ids(self, course_ids, *, combined_grades_date=False, complete_only=True):
+        """
+        Args:
+            course_ids (iterable of int): course ids
+            combined_grades_date (bool):
+                if True only the course runs started after NEW_COMBINED_FINAL_GRADES_DATE are considered
+            complete_only (bool): if True only the final grades with complete status are considered
+
+        Returns:
+            set of int: the ids of the courses with a passed final grade in one of the runs
+        """
+        passed_course_ids = set()
+        for course_id in course_ids:
+            for final_grade in self.final_grades_by_course.get(course_id, []):
+                if not final_grade.passed:
+                    continue
+                if complete_only and final_grade.status != FinalGradeStatus.COMPLETE:
+                    continue
+                if combined_grades_date and not (
+                        final_grade.course_run.start_date is not None and
+                        final_grade.course_run.start_date > NEW_COMBINED_FINAL_GRADES_DATE
+                ):
+                    continue
+                passed_course_ids.add(course_id)
+                break
+        return passed_course_ids
+
+
 class MMTrack:
     """
     Abstraction around the user status in courses.
@@ -51,12 +240,16 @@ class MMTrack:
     exam_card_status = None
     has_exams = False
 
-    def __init__(self, user, program, edx_user_data):
+    def __init__(self, user, program, edx_user_data, snapshot=None, program_structure=None):
         """
         Args:
             user (User): a Django user
             program (programs.models.Program): program where the user is enrolled
             edx_user_data (dashboard.api_edx_cache.CachedEdxUserData): A CachedEdxUserData object
+            snapshot (MMTrackSnapshot): optional preloaded grade and exam records of the user in the program.
+                If provided, all the grade and exam lookups are answered from it instead of the database.
+            program_structure (courses.program_structure.ProgramStructure): optional structure of the program.
+                If not provided, it is taken from the program structure cache.
         """
         self.now = now_in_utc()
         self.user = user
@@ -64,27 +257,32 @@ class MMTrack:
         self.enrollments = edx_user_data.enrollments
         self.current_grades = edx_user_data.current_grades
         self.certificates = edx_user_data.certificates
+        self.snapshot = snapshot
         self.paid_course_fa = {}  # courses_id -> payment number association for financial aid courses
 
-        with transaction.atomic():
-            # Maps a CourseRun's edx_course_key to its parent Course id
-            self.edx_key_course_map = dict(
-                CourseRun.objects.not_discontinued().filter(course__program=program).exclude(
-                    Q(edx_course_key__isnull=True) | Q(edx_course_key__exact='')
-                ).values_list("edx_course_key", "course__id")
-            )
-            self.edx_course_keys = set(self.edx_key_course_map.keys())
+        if program_structure is None:
+            program_structure = get_program_structure(program.id)
+        self._program_structure = program_structure
+        # Maps a CourseRun's edx_course_key to its parent Course id
+        self.edx_key_course_map = program_structure.edx_key_course_map
+        self.edx_course_keys = set(self.edx_key_course_map.keys())
+        self.has_exams = program_structure.has_exams
+        if self.has_exams:
+            # edx course keys for courses with no exam
+            self.edx_course_keys_no_exam = set(program_structure.edx_course_keys_no_exam)
 
-            self.has_exams = ExamRun.objects.filter(course__program=self.program).exists()
-            if self.has_exams:
-                # edx course keys for courses with no exam
-                self.edx_course_keys_no_exam = set(CourseRun.objects.not_discontinued().filter(
-                    course__program=program, course__exam_runs__isnull=True
-                ).values_list("edx_course_key", flat=True))
+            # Payments are no longer accepted, so all courses are unpaid
+            for course in program_structure.courses:
+                self.paid_course_fa[course.id] = False
 
-                # Payments are no longer accepted, so all courses are unpaid
-                for course in self.program.course_set.all():
-                    self.paid_course_fa[course.id] = False
+    @property
+    def program_structure(self):
+        """
+        Returns the structure of the program, reloaded if this process changed the program meanwhile
+        """
+        if self._program_structure.discarded:
+            self._program_structure = get_program_structure(self.program.id)
+        return self._program_structure
 
     def __str__(self):
         return f'MMTrack for user {self.user.username} on program "{self.program.title}"'
@@ -178,6 +376,8 @@ class MMTrack:
         Returns:
             FinalGrade: a Final Grade object or None
         """
+        if self.snapshot is not None:
+            return self.snapshot.complete_final_grades.get(edx_course_key)
         return self.final_grade_qset.for_course_run_key(edx_course_key).first()
 
     def get_required_final_grade(self, edx_course_key):
@@ -192,6 +392,11 @@ class MMTrack:
         Returns:
             FinalGrade: a Final Grade object
         """
+        if self.snapshot is not None:
+            final_grade = self.snapshot.complete_final_grades.get(edx_course_key)
+            if final_grade is None:
+                raise FinalGrade.DoesNotExist(f'No final grade for course run "{edx_course_key}"')
+            return final_grade
         return self.final_grade_qset.for_course_run_key(edx_course_key).get()
 
     def has_final_grade(self, edx_course_key):
@@ -203,6 +408,8 @@ class MMTrack:
         Returns:
             bool: whether a frozen final grade exists
         """
+        if self.snapshot is not None:
+            return edx_course_key in self.snapshot.complete_final_grades
         return self.final_grade_qset.for_course_run_key(edx_course_key).exists()
 
     def has_final_grade_paid_on_edx(self, edx_course_key):
@@ -214,6 +421,9 @@ class MMTrack:
         Returns:
             bool: whether or not a user has a final grade and has paid
         """
+        if self.snapshot is not None:
+            final_grade = self.snapshot.complete_final_grades.get(edx_course_key)
+            return final_grade is not None and final_grade.course_run_paid_on_edx
         return self.final_grade_qset.paid_on_edx().for_course_run_key(edx_course_key).exists()
 
     def has_passed_course_run(self, edx_course_key):
@@ -237,6 +447,14 @@ class MMTrack:
         Returns:
             bool: whether the user has passed the course
         """
+        if self.snapshot is not None:
+            if self.has_exams:
+                return bool(self.snapshot.course_certificates.get(course.id)) or bool(
+                    self.snapshot.get_passed_course_ids(
+                        [course.id], combined_grades_date=True, complete_only=False
+                    )
+                )
+            return bool(self.snapshot.get_passed_course_ids([course.id]))
         if self.has_exams:
             course_cert = MicromastersCourseCertificate.objects.filter(
                 user=self.user,
@@ -271,6 +489,12 @@ class MMTrack:
         Returns:
             dict: dictionary of course_ids: FinalGrade objects
         """
+        if self.snapshot is not None:
+            return {
+                edx_course_key: final_grade
+                for edx_course_key, final_grade in self.snapshot.complete_final_grades.items()
+                if edx_course_key in self.edx_course_keys
+            }
         grades = (
             self.final_grade_qset
             .for_course_run_keys(self.edx_course_keys)
@@ -297,8 +521,29 @@ class MMTrack:
         Returns:
             grades.models.FinalGrade: the best final grade
         """
+        if self.snapshot is not None:
+            return next(
+                (
+                    final_grade for final_grade in self.snapshot.get_complete_final_grades_for_course(course.id)
+                    if final_grade.passed
+                ),
+                None
+            )
         return self.get_final_grades_for_course(course).passed().first()
 
+    def get_highest_final_grade_for_course(self, course):
+        """
+        Return the highest final grade for given course, passed or not
+
+        Args:
+            course (courses.models.Course): a course
+        Returns:
+            grades.models.FinalGrade: the highest final grade
+        """
+        if self.snapshot is not None:
+            return next(iter(self.snapshot.get_complete_final_grades_for_course(course.id)), None)
+        return self.get_final_grades_for_course(course).first()
+
     def get_overall_final_grade_for_course(self, course):
         """
         Calculate overall grade for course
@@ -311,9 +556,13 @@ class MMTrack:
         best_grade = self.get_best_final_grade_for_course(course)
         if best_grade is None:
             return ""
-        if not course.has_exam or best_grade.is_already_combined:
+        if not self.program_structure.has_exam(course.id) or best_grade.is_already_combined:
             return str(round(best_grade.grade_percent))
 
+        if self.snapshot is not None:
+            combined_grade = self.snapshot.combined_grades.get(course.id)
+            return str(round(combined_grade.grade)) if combined_grade is not None else ""
+
         combined_grade = CombinedFinalGrade.objects.filter(user=self.user, course=course)
         if combined_grade.exists():
             return str(round(combined_grade.first().grade))
@@ -333,7 +582,11 @@ class MMTrack:
             if course_id in final_grades or self.enrollments.is_enrolled_in(course_id):
                 enrolled_course_ids.append(course_id)
 
-        return list(CourseRun.objects.not_discontinued().filter(edx_course_key__in=enrolled_course_ids).select_related('course'))
+        enrolled_course_ids = set(enrolled_course_ids)
+        return [
+            course_run for course_run in self.program_structure.course_runs
+            if course_run.edx_course_key in enrolled_course_ids
+        ]
 
     def calculate_final_grade_average(self):
         """
@@ -342,7 +595,10 @@ class MMTrack:
         Returns:
             float: The average final grade or None if no final grades
         """
-        final_grades = self.final_grade_qset.for_course_run_keys(self.edx_course_keys)
+        if self.snapshot is not None:
+            final_grades = list(self.get_all_final_grades().values())
+        else:
+            final_grades = self.final_grade_qset.for_course_run_keys(self.edx_course_keys)
         if final_grades:
             return round(
                 sum(Decimal(final_grade.grade_percent) for final_grade in final_grades) /
@@ -374,8 +630,14 @@ class MMTrack:
             int: A number of passed courses.
         """
         if self.has_exams:
+            if self.snapshot is not None:
+                num_combined_grades = len(self.snapshot.combined_grades)
+            else:
+                num_combined_grades = CombinedFinalGrade.objects.filter(
+                    user=self.user, course__program=self.program
+                ).count()
             return sum([
-                CombinedFinalGrade.objects.filter(user=self.user, course__program=self.program).count(),
+                num_combined_grades,
                 self.count_passing_courses_for_keys(self.edx_course_keys_no_exam)
             ])
         else:
@@ -390,6 +652,8 @@ class MMTrack:
         Returns:
             int: A number of passed courses
         """
+        if self.snapshot is not None:
+            return len(self.snapshot.get_passed_course_ids_for_keys(edx_course_keys))
         return (
             self.final_grade_qset.for_course_run_keys(edx_course_keys).passed()
             .values_list('course_run__course__id', flat=True)
@@ -406,6 +670,8 @@ class MMTrack:
         Returns:
             int: the number of passed unique courses
         """
+        if self.snapshot is not None:
+            return len(self.snapshot.get_passed_course_ids(course_ids))
         return (
             self.final_grade_qset.filter(
                 course_run__course_id__in=course_ids
@@ -421,6 +687,17 @@ class MMTrack:
         Returns:
             int: the number of passed unique courses
         """
+        if self.snapshot is not None:
+            if self.has_exams:
+                course_ids_passing_grade = self.snapshot.get_passed_course_ids(
+                    course_ids, combined_grades_date=True, complete_only=False
+                )
+                num_certs = len([
+                    course_id for course_id in set(course_ids) - course_ids_passing_grade
+                    if self.snapshot.course_certificates.get(course_id)
+                ])
+                return num_certs + len(course_ids_passing_grade)
+            return self.count_passed_final_grades_for_course_ids(course_ids)
         if self.has_exams:
             course_ids_passing_grade = FinalGrade.objects.filter(
                 user=self.user,
@@ -445,16 +722,17 @@ class MMTrack:
             int: the number of passed unique courses
         """
 
-        if self.program.electives_set.exists():
+        program_structure = self.program_structure
+        if program_structure.electives_sets:
             passed_courses = 0
-            for electives_set in self.program.electives_set.all():
-                elective_courses_id = set(electives_set.electivecourse_set.all().values_list('course__id', flat=True))
+            for electives_set in program_structure.electives_sets:
+                elective_courses_id = set(program_structure.elective_course_ids_by_set[electives_set.id])
 
                 # each elective set should be fulfilled
                 passed_courses += min(
                     electives_set.required_number, self.get_number_of_passed_courses(elective_courses_id)
                 )
-            core_courses_ids = set(self.program.course_set.filter(electivecourse=None).values_list('id', flat=True))
+            core_courses_ids = set(program_structure.core_course_ids)
 
             # checking the number of core courses passed
             passed_courses += self.get_number_of_passed_courses(core_courses_ids)
@@ -469,13 +747,25 @@ class MMTrack:
         Returns:
             str: description of Pearson profile status
         """
+        if self.snapshot is not None:
+            if not self.has_exams:
+                return ""
+            if not self.snapshot.has_exam_profile:
+                return ExamProfile.PROFILE_ABSENT
+            if any(
+                    auth.exam_run.date_last_eligible >= self.now.date()
+                    for auth in self.snapshot.exam_authorizations
+            ):
+                return ExamProfile.PROFILE_SCHEDULABLE
+            return ExamProfile.PROFILE_SUCCESS
+
+        if not self.has_exams:
+            return ""
+
         exam_runs = ExamRun.objects.filter(
             course__program=self.program,
         )
 
-        if not exam_runs.exists():
-            return ""
-
         future_runs = exam_runs.filter(
             date_last_eligible__gte=self.now.date(),
         )
@@ -507,21 +797,29 @@ class MMTrack:
         Returns:
             grades.models.ProctoredExamGrade: the best exam grade
         """
-        return self.get_course_proctorate_exam_results(course).filter(
+        if self.snapshot is not None:
+            passed_exam_grades = [
+                exam_grade for exam_grade in self.snapshot.exam_grades.get(course.id, []) if exam_grade.passed
+            ]
+            return max(passed_exam_grades, key=lambda exam_grade: exam_grade.percentage_grade, default=None)
+        return ProctoredExamGrade.for_user_course(self.user, course).filter(
             passed=True
         ).order_by('-percentage_grade').first()
 
     def get_course_proctorate_exam_results(self, course):
         """
-        Returns the queryset of the proctorate exams results for the user in a course
+        Returns the proctorate exams results for the user in a course
 
         Args:
             course (courses.models.Course): a course
 
         Returns:
-            qset: a queryset of grades.models.ProctoredExamGrade
+            list of grades.models.ProctoredExamGrade: the proctorate exams results, whether the MMTrack
+                has a snapshot or not
         """
-        return ProctoredExamGrade.for_user_course(self.user, course)
+        if self.snapshot is not None:
+            return list(self.snapshot.exam_grades.get(course.id, []))
+        return list(ProctoredExamGrade.for_user_course(self.user, course))
 
     def get_course_certificate(self, course):
         """
@@ -532,6 +830,14 @@ class MMTrack:
         Returns:
             grades.models.MicromastersCourseCertificate: a course certificate
         """
+        if self.snapshot is not None:
+            return next(
+                (
+                    certificate for certificate in self.snapshot.course_certificates.get(course.id, [])
+                    if certificate.signatories > 0
+                ),
+                None
+            )
         return MicromastersCourseCertificate.objects.filter(user=self.user, course=course).annotate(
             signatories=Count('course__signatories')
         ).filter(signatories__gt=0).first()
@@ -587,13 +893,15 @@ class MMTrack:
             return reverse('program_letter', args=[letter.uuid])
 
 
-def get_mmtrack(user, program):
+def get_mmtrack(user, program, preload=False):
     """
     Creates mmtrack object for given user.
 
     Args:
         user (User): a Django user.
         program (programs.models.Program): program where the user is enrolled.
+        preload (bool): if True, load a snapshot of all the grade and exam records of the user
+            in the program, so that the mmtrack does not need to query them again.
 
     Returns:
         mmtrack (dashboard.utils.MMTrack): a instance of all user information about a program
@@ -602,10 +910,62 @@ def get_mmtrack(user, program):
     return MMTrack(
         user,
         program,
-        edx_user_data
+        edx_user_data,
+        snapshot=MMTrackSnapshot.load(user, program) if preload else None,
     )
 
 
+def get_mmtracks(users, program):
+    """
+    Creates mmtrack objects for many users in a program, with a fixed number of queries
+    regardless of the number of users. The mmtracks are preloaded as in get_mmtrack(..., preload=True).
+
+    Args:
+        users (iterable of User): Django users.
+        program (programs.models.Program): program where the users are enrolled.
+
+    Returns:
+        dict: a map of user id to the mmtrack (dashboard.utils.MMTrack) of the user in the program
+    """
+    users = list(users)
+    if not users:
+        return {}
+    program_structure = get_program_structure(program.id)
+    edx_user_data = CachedEdxUserData.for_users(users, program=program)
+    snapshots = MMTrackSnapshot.load_for_users(users, program)
+    return {
+        user.id: MMTrack(
+            user,
+            program,
+            edx_user_data[user.id],
+            snapshot=snapshots[user.id],
+            program_structure=program_structure,
+        ) for user in users
+    }
+
+
+def prefetch_mmtracks(program_enrollments):
+    """
+    Creates the mmtracks of many program enrollments with get_mmtracks, one program at a time,
+    and attaches each of them to its enrollment as `prefetched_mmtrack`.
+
+    Args:
+        program_enrollments (iterable of ProgramEnrollment): program enrollments with their users and programs
+    """
+    enrollments_by_program = defaultdict(list)
+    for program_enrollment in program_enrollments:
+        # unsaved enrollments cannot be looked up in bulk
+        if program_enrollment.user_id is not None and program_enrollment.program_id is not None:
+            enrollments_by_program[program_enrollment.program_id].append(program_enrollment)
+    for enrollments in enrollments_by_program.values():
+        mmtracks = get_mmtracks(
+            [program_enrollment.user for program_enrollment in enrollments],
+            enrollments[0].program,
+        )
+        for program_enrollment in enrollments:
+            program_enrollment.prefetched_mmtrack = mmtracks[program_enrollment.user_id]
+
+
 def convert_to_letter(grade):
     """Convert a decimal number to letter grade"""
     grade = round(grade, 1)
@@ -10,15 +10,31 @@ from unittest.mock import (
 import pytz
 import ddt
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from courses.factories import ProgramFactory, CourseFactory, CourseRunFactory
 from courses.models import ElectivesSet, ElectiveCourse
+from courses.program_structure import get_program_structure
 from dashboard.api_edx_cache import CachedEdxUserData
+from dashboard.factories import CachedCurrentGradeFactory, CachedEnrollmentFactory, ProgramEnrollmentFactory
 from dashboard.models import CachedEnrollment, CachedCertificate, CachedCurrentGrade
-from dashboard.utils import MMTrack, convert_to_letter
+from dashboard.utils import (
+    MMTrack,
+    MMTrackSnapshot,
+    convert_to_letter,
+    get_mmtrack,
+    get_mmtracks,
+    prefetch_mmtracks,
+)
 from exams.factories import ExamProfileFactory, ExamAuthorizationFactory, ExamRunFactory
 from exams.models import ExamProfile, ExamAuthorization
-from grades.constants import NEW_COMBINED_FINAL_GRADES_DATE
-from grades.factories import FinalGradeFactory, ProctoredExamGradeFactory
+from grades.constants import NEW_COMBINED_FINAL_GRADES_DATE, FinalGradeStatus
+from grades.factories import (
+    FinalGradeFactory,
+    MicromastersCourseCertificateFactory,
+    ProctoredExamGradeFactory,
+)
 from grades.models import FinalGrade, CombinedFinalGrade, CourseRunGradingStatus
 from micromasters.factories import UserFactory
 from micromasters.utils import load_json_from_file, now_in_utc
@@ -608,6 +624,176 @@ class MMTrackTest(MockedESTestCase):
             mmtrack.now = now_value
             assert mmtrack.get_exam_card_status() == ExamProfile.PROFILE_SUCCESS
 
+    @ddt.data(True, False)
+    def test_snapshot_matches_queries(self, has_exams):
+        """
+        Test that a MMTrack with a snapshot gives the same answers as one querying the database,
+        without running any query
+        """
+        course = self.cruns[0].course
+        other_course = CourseFactory.create(program=self.program)
+        other_run = CourseRunFactory.create(course=other_course)
+        FinalGradeFactory.create(user=self.user, course_run=self.cruns[0], grade=0.4, passed=False)
+        FinalGradeFactory.create(user=self.user, course_run=self.cruns[1], grade=0.8, passed=True)
+        FinalGradeFactory.create(
+            user=self.user, course_run=other_run, grade=0.9, passed=True, status=FinalGradeStatus.PENDING
+        )
+        # records of another user should never be part of the snapshot
+        FinalGradeFactory.create(course_run=self.cruns[2], passed=True)
+        if has_exams:
+            exam_run = ExamRunFactory.create(
+                course=course,
+                date_first_eligible=now_in_utc() - timedelta(weeks=1),
+                date_last_eligible=now_in_utc() + timedelta(weeks=1),
+            )
+            CombinedFinalGrade.objects.create(user=self.user, course=course, grade=0.7)
+            MicromastersCourseCertificateFactory.create(user=self.user, course=other_course)
+            ProctoredExamGradeFactory.create(
+                user=self.user, course=course, exam_run=exam_run, passed=True,
+                exam_run__date_grades_available=now_in_utc() - timedelta(weeks=1),
+            )
+            ExamProfileFactory.create(profile=self.user.profile, status=ExamProfile.PROFILE_SUCCESS)
+            ExamAuthorizationFactory.create(
+                user=self.user, course=course, exam_run=exam_run, status=ExamAuthorization.STATUS_SUCCESS
+            )
+
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
+        snapshot_mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data,
+            snapshot=MMTrackSnapshot.load(self.user, self.program),
+        )
+        course_keys = [run.edx_course_key for run in self.cruns] + [other_run.edx_course_key, 'random-course-id']
+        course_ids = {course.id, other_course.id}
+        expected = {
+            'all_final_grades': mmtrack.get_all_final_grades(),
+            'average': mmtrack.calculate_final_grade_average(),
+            'count_courses_passed': mmtrack.count_courses_passed(),
+            'number_passed': mmtrack.get_number_of_passed_courses(course_ids),
+            'exam_card_status': mmtrack.get_exam_card_status(),
+            'final_grades': [mmtrack.get_final_grade(key) for key in course_keys],
+            'has_final_grades': [mmtrack.has_final_grade(key) for key in course_keys],
+            'paid_on_edx': [mmtrack.has_final_grade_paid_on_edx(key) for key in course_keys],
+            'passed_runs': [mmtrack.has_passed_course_run(key) for key in course_keys],
+            'passed_courses': [mmtrack.has_passed_course(item) for item in (course, other_course)],
+            'best_grades': [mmtrack.get_best_final_grade_for_course(item) for item in (course, other_course)],
+            'highest_grades': [mmtrack.get_highest_final_grade_for_course(item) for item in (course, other_course)],
+            'overall_grades': [mmtrack.get_overall_final_grade_for_course(item) for item in (course, other_course)],
+            'best_exams': [mmtrack.get_best_proctored_exam_grade(item) for item in (course, other_course)],
+            # a list in both modes
+            'exam_results': [mmtrack.get_course_proctorate_exam_results(item) for item in (course, other_course)],
+        }
+        with self.assertNumQueries(0):
+            actual = {
+                'all_final_grades': snapshot_mmtrack.get_all_final_grades(),
+                'average': snapshot_mmtrack.calculate_final_grade_average(),
+                'count_courses_passed': snapshot_mmtrack.count_courses_passed(),
+                'number_passed': snapshot_mmtrack.get_number_of_passed_courses(course_ids),
+                'exam_card_status': snapshot_mmtrack.get_exam_card_status(),
+                'final_grades': [snapshot_mmtrack.get_final_grade(key) for key in course_keys],
+                'has_final_grades': [snapshot_mmtrack.has_final_grade(key) for key in course_keys],
+                'paid_on_edx': [snapshot_mmtrack.has_final_grade_paid_on_edx(key) for key in course_keys],
+                'passed_runs': [snapshot_mmtrack.has_passed_course_run(key) for key in course_keys],
+                'passed_courses': [snapshot_mmtrack.has_passed_course(item) for item in (course, other_course)],
+                'best_grades': [
+                    snapshot_mmtrack.get_best_final_grade_for_course(item) for item in (course, other_course)
+                ],
+                'highest_grades': [
+                    snapshot_mmtrack.get_highest_final_grade_for_course(item) for item in (course, other_course)
+                ],
+                'overall_grades': [
+                    snapshot_mmtrack.get_overall_final_grade_for_course(item) for item in (course, other_course)
+                ],
+                'best_exams': [snapshot_mmtrack.get_best_proctored_exam_grade(item) for item in (course, other_course)],
+                'exam_results': [
+                    snapshot_mmtrack.get_course_proctorate_exam_results(item) for item in (course, other_course)
+                ],
+            }
+        assert actual == expected
+
+    def test_snapshot_query_count(self):
+        """
+        Test that loading a snapshot takes the same number of queries no matter how many courses the program has
+        """
+        with self.assertNumQueries(6):
+            MMTrackSnapshot.load(self.user, self.program)
+        for _ in range(3):
+            FinalGradeFactory.create(user=self.user, course_run__course__program=self.program)
+        with self.assertNumQueries(6):
+            MMTrackSnapshot.load(self.user, self.program)
+
+    def test_snapshot_add_final_grade(self):
+        """
+        Test that a final grade frozen after the snapshot was loaded is visible to the mmtrack
+        """
+        mmtrack = get_mmtrack(self.user, self.program, preload=True)
+        edx_course_key = self.cruns[0].edx_course_key
+        assert mmtrack.has_final_grade(edx_course_key) is False
+        final_grade = FinalGradeFactory.create(user=self.user, course_run=self.cruns[0], passed=True)
+        mmtrack.snapshot.add_final_grade(final_grade)
+        assert mmtrack.get_required_final_grade(edx_course_key) == final_grade
+        assert mmtrack.has_passed_course_run(edx_course_key) is True
+
+    def test_get_mmtracks(self):
+        """
+        Test that get_mmtracks returns the same answers as get_mmtrack for each user
+        """
+        users = [self.user, UserFactory.create(), UserFactory.create()]
+        for user, passed in zip(users, (True, False, True)):
+            CachedEnrollmentFactory.create(user=user, course_run=self.cruns[0], verified=True)
+            CachedCurrentGradeFactory.create(user=user, course_run=self.cruns[0])
+            FinalGradeFactory.create(user=user, course_run=self.cruns[0], passed=passed)
+        mmtracks = get_mmtracks(users, self.program)
+        assert set(mmtracks.keys()) == {user.id for user in users}
+        edx_course_key = self.cruns[0].edx_course_key
+        for user in users:
+            bulk_mmtrack = mmtracks[user.id]
+            mmtrack = get_mmtrack(user, self.program, preload=True)
+            assert bulk_mmtrack.user == user
+            assert bulk_mmtrack.edx_course_keys == mmtrack.edx_course_keys
+            assert bulk_mmtrack.is_enrolled(edx_course_key) is mmtrack.is_enrolled(edx_course_key) is True
+            assert bulk_mmtrack.has_verified_enrollment(edx_course_key) is True
+            assert bulk_mmtrack.current_grades.all_course_ids == mmtrack.current_grades.all_course_ids
+            assert bulk_mmtrack.get_final_grade(edx_course_key) == mmtrack.get_final_grade(edx_course_key)
+            assert bulk_mmtrack.count_courses_passed() == mmtrack.count_courses_passed()
+        assert get_mmtracks([], self.program) == {}
+
+    def test_prefetch_mmtracks(self):
+        """
+        Test that prefetch_mmtracks attaches the mmtrack of each saved enrollment to it
+        """
+        enrollments = [
+            ProgramEnrollmentFactory.create(user=self.user, program=self.program),
+            ProgramEnrollmentFactory.create(program=self.program),
+            ProgramEnrollmentFactory.create(),
+        ]
+        unsaved_enrollment = ProgramEnrollmentFactory.build()
+        prefetch_mmtracks(enrollments + [unsaved_enrollment])
+        for enrollment in enrollments:
+            assert enrollment.prefetched_mmtrack.user == enrollment.user
+            assert enrollment.prefetched_mmtrack.program == enrollment.program
+            assert enrollment.prefetched_mmtrack.snapshot is not None
+        assert not hasattr(unsaved_enrollment, 'prefetched_mmtrack')
+
+    def test_get_mmtracks_query_count(self):
+        """
+        Test that get_mmtracks takes the same number of queries no matter how many users are loaded
+        """
+        get_program_structure(self.program.id)
+        with CaptureQueriesContext(connection) as single_user_queries:
+            get_mmtracks([self.user], self.program)
+        users = [self.user] + [UserFactory.create() for _ in range(3)]
+        for user in users:
+            CachedEnrollmentFactory.create(user=user, course_run=self.cruns[0])
+            FinalGradeFactory.create(user=user, course_run=self.cruns[0])
+        with self.assertNumQueries(len(single_user_queries)):
+            get_mmtracks(users, self.program)
+
 
 @ddt.ddt
 class ConvertLetterGradeTests(MockedESTestCase):
@@ -4,6 +4,7 @@ Views for dashboard REST APIs
 import logging
 from urllib.parse import urljoin
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 
 from django.urls import reverse
@@ -18,12 +19,17 @@ from rest_framework.views import APIView
 from backends import utils
 from backends.constants import BACKEND_MITX_ONLINE, COURSEWARE_BACKEND_URL
 from courses.models import CourseRun
-from dashboard.api import (get_user_program_info,
-                           is_user_enrolled_in_exam_course)
+from dashboard.api import (get_background_invalid_backend_credentials,
+                           get_dashboard_freshness, get_user_program_info,
+                           is_background_refresh_running,
+                           is_user_enrolled_in_exam_course,
+                           record_dashboard_activity,
+                           start_background_refresh)
 from dashboard.api_edx_cache import CachedEdxDataApi
 from dashboard.models import ProgramEnrollment
 from dashboard.permissions import CanReadIfStaffOrSelf
 from dashboard.serializers import UnEnrollProgramsSerializer
+from dashboard.tasks import refresh_user_caches_in_background
 from exams.models import ExamAuthorization, ExamRun
 from micromasters.exceptions import PossiblyImproperlyConfigured
 from profiles.api import get_social_auth
@@ -54,9 +60,19 @@ class UserDashboard(APIView):
 
         # if the requesting user is the same as the user whose dashboard we're loading, update the cache
         update_cache = user == request.user
+        if update_cache:
+            record_dashboard_activity(user.id)
 
-        # get the credentials for the current user for edX
-        program_dashboard = get_user_program_info(user, update_cache=update_cache)
+        if update_cache and settings.DASHBOARD_STALE_WHILE_REVALIDATE:
+            # serve the cached data right away, the UI polls UserDashboardFreshness to know when to reload
+            program_dashboard = get_user_program_info(user, update_cache=False)
+            program_dashboard["invalid_backend_credentials"] = get_background_invalid_backend_credentials(user.id)
+            if not program_dashboard["is_edx_data_fresh"] and start_background_refresh(user.id):
+                refresh_user_caches_in_background.delay(user.id)
+            program_dashboard["is_refreshing"] = is_background_refresh_running(user.id)
+        else:
+            # get the credentials for the current user for edX
+            program_dashboard = get_user_program_info(user, update_cache=update_cache)
 
         return Response(
             status=status.HTTP_200_OK,
@@ -64,6 +80,35 @@ class UserDashboard(APIView):
         )
 
 
+class UserDashboardFreshness(APIView):
+    """
+    Lightweight view polled by the dashboard to know whether the information it shows changed.
+    The response carries the version as ETag, and is empty with a 304 status if it matches If-None-Match.
+    """
+    authentication_classes = (
+        authentication.SessionAuthentication,
+        authentication.TokenAuthentication,
+    )
+    permission_classes = (permissions.IsAuthenticated, CanReadIfStaffOrSelf)
+
+    def get(self, request, username, *args, **kargs):  # pylint: disable=unused-argument
+        """
+        Returns whether the edX data of the user is fresh or being refreshed, and the version of the dashboard
+        """
+        user = get_object_or_404(
+            User,
+            username=username,
+        )
+        freshness = get_dashboard_freshness(user)
+        etag = '"{}"'.format(freshness["version"])
+        if request.headers.get('If-None-Match') == etag:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(status=status.HTTP_200_OK, data=freshness)
+        response['ETag'] = etag
+        return response
+
+
 class UserCourseEnrollment(APIView):
     """
     Create an audit enrollment for the user in a given course run identified by course_id.
@@ -2,7 +2,7 @@
 Tests for the dashboard views
 """
 from datetime import timedelta
-from unittest.mock import MagicMock, call, patch
+from unittest.mock import ANY, MagicMock, call, patch
 from urllib.parse import urljoin
 
 import ddt
@@ -18,10 +18,11 @@ from backends.constants import (BACKEND_EDX_ORG, BACKEND_MITX_ONLINE,
 from backends.utils import InvalidCredentialStored
 from courses.factories import CourseRunFactory, ProgramFactory
 from courses.models import CourseRun
-from dashboard.api_edx_cache import CachedEdxDataApi
+from dashboard.api import finish_background_refresh
 from dashboard.factories import (ProgramEnrollmentFactory,
                                  UserCacheRefreshTimeFactory)
-from dashboard.models import CachedEnrollment, ProgramEnrollment
+from dashboard.models import (CachedEnrollment, DashboardDocument,
+                              ProgramEnrollment, UserCacheRefreshTime)
 from exams.factories import ExamAuthorizationFactory, ExamRunFactory
 from exams.models import ExamAuthorization
 from micromasters.exceptions import PossiblyImproperlyConfigured
@@ -77,12 +78,13 @@ class DashboardTest(MockedESTestCase, APITestCase):
         res = self.client.get(self.url)
         assert res.status_code == status.HTTP_403_FORBIDDEN
 
-    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cache_if_expired', new_callable=MagicMock)
-    def test_get_dashboard(self, mock_cache_refresh):
+    @patch('dashboard.views.record_dashboard_activity', autospec=True)
+    @patch('dashboard.api.refresh_user_caches', autospec=True, return_value=[])
+    def test_get_dashboard(self, mock_cache_refresh, activity_mock):
         """Test for GET"""
-        with patch('backends.utils.refresh_user_token', autospec=True):
-            result = self.client.get(self.url)
-        assert mock_cache_refresh.call_count == len(CachedEdxDataApi.EDX_SUPPORTED_CACHES)
+        result = self.client.get(self.url)
+        mock_cache_refresh.assert_called_once_with(self.user, freshness=ANY)
+        activity_mock.assert_called_once_with(self.user.id)
         assert 'programs' in result.data
         assert 'is_edx_data_fresh' in result.data
         assert result.data['is_edx_data_fresh'] is True
@@ -93,8 +95,9 @@ class DashboardTest(MockedESTestCase, APITestCase):
         assert result.data["invalid_backend_credentials"] == []
 
     @ddt.data(Instructor, Staff)
-    @patch('dashboard.api.update_cache_for_backend')
-    def test_edx_is_not_refreshed_if_not_own_dashboard(self, role, update_mock):
+    @patch('dashboard.views.record_dashboard_activity', autospec=True)
+    @patch('dashboard.api.refresh_user_caches')
+    def test_edx_is_not_refreshed_if_not_own_dashboard(self, role, update_mock, activity_mock):
         """
         If the dashboard being queried is not the user's own dashboard
         the cached edx data should not be refreshed
@@ -118,6 +121,76 @@ class DashboardTest(MockedESTestCase, APITestCase):
         assert result.data["invalid_backend_credentials"] == []
 
         update_mock.assert_not_called()
+        activity_mock.assert_not_called()
+
+    @override_settings(DASHBOARD_STALE_WHILE_REVALIDATE=True)
+    @patch('dashboard.views.refresh_user_caches_in_background', autospec=True)
+    @patch('dashboard.api.refresh_user_caches', autospec=True)
+    def test_get_dashboard_stale_while_revalidate(self, refresh_mock, task_mock):
+        """
+        With stale-while-revalidate the cached dashboard is returned right away,
+        and a single background refresh is started while the edX data is expired
+        """
+        UserCacheRefreshTime.objects.filter(user=self.user).update(enrollment=None)
+        self.addCleanup(finish_background_refresh, self.user.id, [])
+        for _ in range(2):
+            result = self.client.get(self.url)
+            assert result.status_code == status.HTTP_200_OK
+            assert len(result.data['programs']) == 2
+            assert result.data['is_edx_data_fresh'] is False
+            assert result.data['is_refreshing'] is True
+            assert result.data["invalid_backend_credentials"] == []
+        assert refresh_mock.called is False
+        task_mock.delay.assert_called_once_with(self.user.id)
+
+        finish_background_refresh(self.user.id, [BACKEND_EDX_ORG])
+        result = self.client.get(self.url)
+        assert result.data['is_refreshing'] is True
+        assert result.data["invalid_backend_credentials"] == [BACKEND_EDX_ORG]
+        assert task_mock.delay.call_count == 2
+
+    @override_settings(DASHBOARD_STALE_WHILE_REVALIDATE=True)
+    @patch('dashboard.views.refresh_user_caches_in_background', autospec=True)
+    def test_get_dashboard_stale_while_revalidate_fresh(self, task_mock):
+        """No background refresh is started while the edX data is fresh"""
+        result = self.client.get(self.url)
+        assert result.data['is_edx_data_fresh'] is True
+        assert result.data['is_refreshing'] is False
+        assert task_mock.delay.called is False
+
+    def test_freshness(self):
+        """The freshness view returns a version which changes with the dashboard information of the user"""
+        url = reverse('dashboard_freshness_api', args=[self.user.username])
+        result = self.client.get(url)
+        assert result.status_code == status.HTTP_200_OK
+        assert result.data['is_edx_data_fresh'] is True
+        assert result.data['is_refreshing'] is False
+        etag = result['ETag']
+        assert etag == '"{}"'.format(result.data['version'])
+
+        result = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert result.status_code == status.HTTP_304_NOT_MODIFIED
+        assert result['ETag'] == etag
+
+        DashboardDocument.invalidate(self.user.id)
+        result = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert result.status_code == status.HTTP_200_OK
+        assert result['ETag'] != etag
+
+        # the version changes with the structure of the programs of the user, not of the other programs
+        etag = result['ETag']
+        self.program_not_enrolled.save()
+        assert self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_304_NOT_MODIFIED
+        self.program_1.save()
+        result = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert result.status_code == status.HTTP_200_OK
+        assert result['ETag'] != etag
+
+    def test_freshness_other_user(self):
+        """A user without any role cannot poll the freshness of the dashboard of another user"""
+        self.client.force_login(UserFactory.create())
+        result = self.client.get(reverse('dashboard_freshness_api', args=[self.user.username]))
+        assert result.status_code == status.HTTP_404_NOT_FOUND
 
 
 @ddt.ddt
@@ -303,7 +376,7 @@ class UserCourseEnrollmentTest(MockedESTestCase, APITestCase):
         assert 'error' in resp.data
 
     @ddt.data(BACKEND_EDX_ORG, BACKEND_MITX_ONLINE)
-    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.queue_index_users', autospec=True)
     @patch('dashboard.views.EdxApi', autospec=True)
     @patch('backends.utils.refresh_user_token', autospec=True)
     def test_enrollment(
@@ -327,7 +400,7 @@ class UserCourseEnrollmentTest(MockedESTestCase, APITestCase):
         assert resp.data == enr_json
         mock_edx_api.assert_called_once_with(user_social.extra_data, COURSEWARE_BACKEND_URL[backend])
         mock_edx_enr.assert_called_once_with(self.course_id)
-        mock_index.delay.assert_called_once_with([self.user.id], check_if_changed=True)
+        mock_index.assert_called_once_with([self.user.id], check_if_changed=True)
 
         cache_enr = CachedEnrollment.objects.filter(
             user=self.user, course_run__edx_course_key=self.course_id).first()
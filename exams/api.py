@@ -22,17 +22,19 @@ MESSAGE_NO_ATTEMPTS_TEMPLATE = (
 log = logging.getLogger(__name__)
 
 
-def authorize_for_exam_run(user, course_run, exam_run):
+def authorize_for_exam_run(user, course_run, exam_run, mmtrack=None):
     """
     Authorize user for an exam if they are eligible and have passed the course.
 
     Args:
-        mmtrack (dashboard.utils.MMTrack): a instance of all user information about a program.
+        user (django.contib.auth.models.User): the user to authorize
         course_run (courses.models.CourseRun): A CourseRun object.
         exam_run (exams.models.ExamRun): the ExamRun we're authorizing for
+        mmtrack (dashboard.utils.MMTrack): an optional preloaded instance of all user information about a program.
     """
 
-    mmtrack = get_mmtrack(user, course_run.course.program)
+    if mmtrack is None:
+        mmtrack = get_mmtrack(user, course_run.course.program)
     if not mmtrack.user.is_active:
         raise ExamAuthorizationException(
             "Inactive user '{}' cannot be authorized for the exam for course id '{}'".format(
@@ -71,13 +73,14 @@ def authorize_for_exam_run(user, course_run, exam_run):
     )
 
 
-def authorize_for_latest_passed_course(user, exam_run):
+def authorize_for_latest_passed_course(user, exam_run, mmtrack=None):
     """
     This walks the FinalGrade backwards chronologically and authorizes the first eligible one.
 
     Args:
-        mmtrack (dashboard.utils.MMTrack): An instance of all user information about a program
+        user (django.contib.auth.models.User): the user to authorize
         exam_run (exams.models.ExamRun): the ExamRun to authorize the learner for
+        mmtrack (dashboard.utils.MMTrack): an optional preloaded instance of all user information about a program
     """
     final_grades = FinalGrade.objects.filter(
         user=user,
@@ -91,7 +94,7 @@ def authorize_for_latest_passed_course(user, exam_run):
 
     for final_grade in final_grades:
         try:
-            authorize_for_exam_run(user, final_grade.course_run, exam_run)
+            authorize_for_exam_run(user, final_grade.course_run, exam_run, mmtrack=mmtrack)
         except ExamAuthorizationException:
             log.debug(
                 'Unable to authorize user: %s for exam on course_id: %s',
@@ -121,3 +124,26 @@ def authorize_user_for_schedulable_exam_runs(user, course_run):
                 user.username,
                 course_run.course.id
             )
+
+
+def authorize_users_for_schedulable_exam_runs(mmtracks, course_run):
+    """
+    Authorizes many users for all schedulable ExamRuns for a CourseRun
+
+    Args:
+        mmtracks (iterable of dashboard.utils.MMTrack): the preloaded mmtracks of the users to authorize
+        course_run (courses.models.CourseRun): the course run to check
+    """
+    exam_runs = list(ExamRun.get_currently_schedulable(course_run.course))
+    if not exam_runs:
+        return
+    for mmtrack in mmtracks:
+        for exam_run in exam_runs:
+            try:
+                authorize_for_exam_run(mmtrack.user, course_run, exam_run, mmtrack=mmtrack)
+            except ExamAuthorizationException:
+                log.debug(
+                    'Unable to authorize user: %s for exam on course_id: %s',
+                    mmtrack.user.username,
+                    course_run.course.id
+                )
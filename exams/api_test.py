@@ -119,6 +119,19 @@ class ExamAuthorizationApiTests(TestCase):
             course=self.course_run.course
         ).exists() is True
 
+    def test_exam_authorization_with_mmtrack(self):
+        """
+        test exam_authorization uses the provided mmtrack instead of loading a new one
+        """
+        mmtrack = get_mmtrack(self.user, self.program, preload=True)
+        with patch('exams.api.get_mmtrack', autospec=True) as get_mmtrack_mock:
+            authorize_for_exam_run(self.user, self.course_run, self.exam_run, mmtrack=mmtrack)
+        assert get_mmtrack_mock.call_count == 0
+        assert ExamAuthorization.objects.filter(
+            user=self.user,
+            course=self.course_run.course
+        ).exists() is True
+
     def test_exam_authorization_course_mismatch(self):
         """
         test exam_authorization fails if course_run and exam_run courses mismatch
@@ -215,4 +228,4 @@ class ExamLatestCourseAuthorizationApiTests(TestCase):
 
         assert mock.call_count == 2
         for enrollment in self.final_grades[:2]:  # two most recent runs
-            mock.assert_any_call(self.user, enrollment.course_run, exam_run)
+            mock.assert_any_call(self.user, enrollment.course_run, exam_run, mmtrack=None)
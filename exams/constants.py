@@ -1,4 +1,5 @@
 """Pearson-related constants"""
+import datetime
 
 # EXAM constants
 EXAM_GRADE_PASS = 'pass'
@@ -8,3 +9,6 @@ EXAM_GRADES = (
     EXAM_GRADE_FAIL,
 )
 BACKEND_MITX_ONLINE= 'mitxonline'
+
+# delay after the upgrade deadline of the current course run from which the exams of the next semester are shown
+NEXT_SEMESTER_EXAM_DELAY = datetime.timedelta(weeks=12)
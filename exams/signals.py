@@ -9,10 +9,12 @@ from django.dispatch import receiver
 
 from dashboard.models import CachedEnrollment
 from dashboard.utils import get_mmtrack
-from exams.api import authorize_user_for_schedulable_exam_runs
+from exams.api import (authorize_user_for_schedulable_exam_runs,
+                       authorize_users_for_schedulable_exam_runs)
 from exams.models import ExamProfile, ExamRun
 from exams.utils import is_eligible_for_exam
-from grades.api import update_existing_combined_final_grade_for_exam_run
+from grades.api import (final_grades_frozen,
+                        update_existing_combined_final_grade_for_exam_run)
 from grades.models import FinalGrade
 
 log = logging.getLogger(__name__)
@@ -40,6 +42,19 @@ def update_exam_authorization_final_grade(sender, instance, **kwargs):  # pylint
     authorize_user_for_schedulable_exam_runs(instance.user, instance.course_run)
 
 
+@receiver(final_grades_frozen, dispatch_uid="update_exam_authorization_final_grades_frozen")
+def update_exam_authorization_final_grades_frozen(
+        sender, course_run, final_grades, mmtracks, **kwargs
+):  # pylint: disable=unused-argument
+    """
+    Signal handler to trigger exam profiles and authorizations for FinalGrades created in bulk.
+    """
+    authorize_users_for_schedulable_exam_runs(
+        [mmtracks[final_grade.user_id] for final_grade in final_grades if final_grade.course_run_paid_on_edx],
+        course_run,
+    )
+
+
 @receiver(post_save, sender=CachedEnrollment, dispatch_uid="update_exam_authorization_cached_enrollment")
 def update_exam_authorization_cached_enrollment(sender, instance, **kwargs):  # pylint: disable=unused-argument
     """
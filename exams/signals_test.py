@@ -17,12 +17,15 @@ from dashboard.factories import (
     CachedCurrentGradeFactory,
     CachedEnrollmentFactory,
 )
+from dashboard.utils import get_mmtracks
 from exams.factories import ExamRunFactory
 from exams.models import (
     ExamProfile,
     ExamAuthorization
 )
+from grades.api import final_grades_frozen
 from grades.factories import FinalGradeFactory
+from grades.models import FinalGrade
 from micromasters.utils import now_in_utc
 from profiles.factories import ProfileFactory
 from search.base import MockedESTestCase
@@ -116,6 +119,33 @@ class ExamSignalsTest(MockedESTestCase):
             course=self.course_run.course
         ).exists() is False
 
+    @ddt.data(True, False)
+    def test_update_exam_authorization_final_grades_frozen(self, paid_on_edx):
+        """
+        Verify that paid users of final grades frozen in bulk are authorized for the exam
+        """
+        with mute_signals(post_save):
+            CachedEnrollmentFactory.create(user=self.profile.user, course_run=self.course_run)
+            final_grade = FinalGradeFactory.create(
+                user=self.profile.user,
+                course_run=self.course_run,
+                passed=True,
+                course_run_paid_on_edx=paid_on_edx,
+            )
+
+        final_grades_frozen.send(
+            sender=FinalGrade,
+            course_run=self.course_run,
+            final_grades=[final_grade],
+            mmtracks=get_mmtracks([self.profile.user], self.program),
+        )
+
+        assert ExamProfile.objects.filter(profile=self.profile).exists() is paid_on_edx
+        assert ExamAuthorization.objects.filter(
+            user=self.profile.user,
+            course=self.course_run.course
+        ).exists() is paid_on_edx
+
     def test_update_exam_authorization_cached_enrollment(self):
         """
         Test exam profile creation when user enroll in course.
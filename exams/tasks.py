@@ -2,10 +2,14 @@
 import logging
 
 from celery import group
+from django.db.models import Exists, OuterRef
 
 from dashboard.models import ProgramEnrollment
+from dashboard.utils import get_mmtracks
 from exams.api import authorize_for_latest_passed_course
-from exams.models import ExamRun
+from exams.models import ExamAuthorization, ExamRun
+from grades.constants import FinalGradeStatus
+from grades.models import FinalGrade
 from micromasters.celery import app
 from micromasters.utils import chunks, now_in_utc
 
@@ -21,12 +25,25 @@ def authorize_exam_runs():
             authorized=False,
             date_first_schedulable__lte=now_in_utc(),
     ):
+        # only the enrollments of users with a passed final grade in the course who aren't authorized yet
         enrollment_ids_qset = ProgramEnrollment.objects.filter(
-            program=exam_run.course.program).values_list('id', flat=True)
+            Exists(FinalGrade.objects.filter(
+                user=OuterRef('user'),
+                course_run__course=exam_run.course,
+                passed=True,
+                status=FinalGradeStatus.COMPLETE,
+            )),
+            ~Exists(ExamAuthorization.objects.filter(
+                user=OuterRef('user'),
+                exam_run=exam_run,
+                status=ExamAuthorization.STATUS_SUCCESS,
+            )),
+            program=exam_run.course.program,
+        ).values_list('id', flat=True)
         # create a group of subtasks
         job = group(
             authorize_enrollment_for_exam_run.s(enrollment_ids, exam_run.id)
-            for enrollment_ids in chunks(enrollment_ids_qset)
+            for enrollment_ids in chunks(enrollment_ids_qset.iterator())
         )
         job.apply_async()
         exam_run.authorized = True
@@ -45,10 +62,12 @@ def authorize_enrollment_for_exam_run(enrollment_ids, exam_run_id):
     Returns:
         None
     """
-    exam_run = ExamRun.objects.get(id=exam_run_id)
-    for enrollment in ProgramEnrollment.objects.filter(id__in=enrollment_ids).prefetch_related('user'):
+    exam_run = ExamRun.objects.select_related('course__program').get(id=exam_run_id)
+    enrollments = list(ProgramEnrollment.objects.filter(id__in=enrollment_ids).select_related('user'))
+    mmtracks = get_mmtracks([enrollment.user for enrollment in enrollments], exam_run.course.program)
+    for enrollment in enrollments:
         try:
-            authorize_for_latest_passed_course(enrollment.user, exam_run)
+            authorize_for_latest_passed_course(enrollment.user, exam_run, mmtrack=mmtracks[enrollment.user_id])
         # pylint: disable=bare-except
         except:
             log.exception(
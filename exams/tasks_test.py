@@ -1,15 +1,21 @@
 """
 Tests for exam tasks
 """
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
 from ddt import data, ddt
+from django.db.models.signals import post_save
+from factory.django import mute_signals
 
 from dashboard.factories import ProgramEnrollmentFactory
 from courses.factories import create_program
 from exams.factories import (
+    ExamAuthorizationFactory,
     ExamRunFactory,
 )
+from exams.models import ExamAuthorization
+from grades.constants import FinalGradeStatus
+from grades.factories import FinalGradeFactory
 from exams.tasks import (
     authorize_exam_runs,
     authorize_enrollment_for_exam_run)
@@ -27,6 +33,15 @@ class ExamRunTasksTest(MockedESTestCase):
         program, _ = create_program()
         course = program.course_set.first()
         enrollment = ProgramEnrollmentFactory.create(program=program)
+        # users who haven't passed the course are not authorized
+        ProgramEnrollmentFactory.create(program=program)
+        with mute_signals(post_save):
+            FinalGradeFactory.create(
+                user=enrollment.user,
+                course_run=course.courserun_set.first(),
+                passed=True,
+                status=FinalGradeStatus.COMPLETE,
+            )
         current_run = ExamRunFactory.create(course=course, authorized=authorized)
         past_run = ExamRunFactory.create(course=course, scheduling_future=True, authorized=authorized)
         future_run = ExamRunFactory.create(course=course, scheduling_past=True, authorized=authorized)
@@ -37,8 +52,10 @@ class ExamRunTasksTest(MockedESTestCase):
         else:
             assert authorize_for_latest_passed_course_mock.call_count == 2
 
-            authorize_for_latest_passed_course_mock.assert_any_call(enrollment.user, current_run)
-            authorize_for_latest_passed_course_mock.assert_any_call(enrollment.user, future_run)
+            for exam_run in (current_run, future_run):
+                authorize_for_latest_passed_course_mock.assert_any_call(enrollment.user, exam_run, mmtrack=ANY)
+            for call in authorize_for_latest_passed_course_mock.call_args_list:
+                assert call[1]['mmtrack'].user == enrollment.user
 
             for exam_run in (current_run, future_run):
                 exam_run.refresh_from_db()
@@ -46,6 +63,32 @@ class ExamRunTasksTest(MockedESTestCase):
             past_run.refresh_from_db()
             assert past_run.authorized is False
 
+    @patch('exams.tasks.authorize_for_latest_passed_course')
+    def test_authorize_exam_runs_already_authorized(self, authorize_for_latest_passed_course_mock):
+        """authorize_exam_runs() should skip the users already authorized for the exam run"""
+        program, _ = create_program()
+        course = program.course_set.first()
+        enrollment = ProgramEnrollmentFactory.create(program=program)
+        with mute_signals(post_save):
+            FinalGradeFactory.create(
+                user=enrollment.user,
+                course_run=course.courserun_set.first(),
+                passed=True,
+                status=FinalGradeStatus.COMPLETE,
+            )
+        exam_run = ExamRunFactory.create(course=course, authorized=False)
+        ExamAuthorizationFactory.create(
+            user=enrollment.user,
+            course=course,
+            exam_run=exam_run,
+            status=ExamAuthorization.STATUS_SUCCESS,
+        )
+        authorize_exam_runs()
+
+        assert authorize_for_latest_passed_course_mock.call_count == 0
+        exam_run.refresh_from_db()
+        assert exam_run.authorized is True
+
     @patch('exams.tasks.authorize_for_latest_passed_course')
     def test_authorize_enrollment_for_exam_run(self, authorize_for_latest_passed_course_mock):
         """Test authorize_enrollment_for_exam_run()"""
@@ -58,5 +101,11 @@ class ExamRunTasksTest(MockedESTestCase):
         authorize_enrollment_for_exam_run([enrollment_1.id, enrollment_2.id], exam_run.id)
 
         assert authorize_for_latest_passed_course_mock.call_count == 2
-        authorize_for_latest_passed_course_mock.assert_any_call(enrollment_1.user, exam_run)
-        authorize_for_latest_passed_course_mock.assert_any_call(enrollment_2.user, exam_run)
+        for enrollment in (enrollment_1, enrollment_2):
+            authorize_for_latest_passed_course_mock.assert_any_call(enrollment.user, exam_run, mmtrack=ANY)
+        for call in authorize_for_latest_passed_course_mock.call_args_list:
+            user, _ = call[0]
+            mmtrack = call[1]['mmtrack']
+            assert mmtrack.user == user
+            assert mmtrack.program == program
+            assert mmtrack.snapshot is not None
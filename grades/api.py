@@ -5,16 +5,20 @@ import logging
 from collections import namedtuple
 
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.dispatch import Signal
 from django_redis import get_redis_connection
 
-from courses.models import ElectivesSet
+from courses.program_structure import get_program_structure
 from dashboard.api_edx_cache import CachedEdxDataApi, CachedEdxUserData
-from dashboard.models import CachedCurrentGrade, CachedEnrollment
-from dashboard.utils import get_mmtrack
+from dashboard.models import (CachedCurrentGrade, CachedEnrollment,
+                              DashboardDocument)
+from dashboard.utils import get_mmtrack, get_mmtracks
 from grades.constants import COURSE_GRADE_WEIGHT, EXAM_GRADE_WEIGHT
 from grades.exceptions import FreezeGradeFailedException
-from grades.models import (CombinedFinalGrade, FinalGrade, FinalGradeStatus,
-                           MicromastersProgramCertificate,
+from grades.models import (CombinedFinalGrade, FinalGrade, FinalGradeAudit,
+                           FinalGradeStatus, MicromastersProgramCertificate,
                            MicromastersProgramCommendation, ProctoredExamGrade)
 
 User = get_user_model()
@@ -25,6 +29,10 @@ log = logging.getLogger(__name__)
 
 UserFinalGrade = namedtuple('UserFinalGrade', ['grade', 'passed', 'payed_on_edx'])
 
+# Sent once the final grades frozen by freeze_users_final_grades are committed, in place of the post_save
+# of each of them. The receivers get the course_run, the final_grades and the preloaded mmtracks of their users.
+final_grades_frozen = Signal()
+
 
 def _compute_grade_for_fa(user_edx_run_data):
     """
@@ -123,13 +131,14 @@ def get_users_without_frozen_final_grade(course_run):
     Returns:
         queryset: a queryset of users
     """
-    # get the list of users enrolled in the course and have current grade
-    users_in_cache = set(CachedEnrollment.get_cached_users(course_run)).intersection(
-        set(CachedCurrentGrade.get_cached_users(course_run))
+    # the users enrolled in the course who have a current grade and no frozen final grade, in a single query
+    return User.objects.filter(
+        Exists(CachedEnrollment.objects.filter(user=OuterRef('pk'), course_run=course_run)),
+        Exists(CachedCurrentGrade.objects.filter(user=OuterRef('pk'), course_run=course_run)),
+        ~Exists(FinalGrade.objects.filter(
+            user=OuterRef('pk'), course_run=course_run, status=FinalGradeStatus.COMPLETE
+        )),
     )
-    # get all the users with already frozen final grade
-    users_already_processed = set(FinalGrade.get_frozen_users(course_run))
-    return User.objects.filter(pk__in=users_in_cache.difference(users_already_processed))
 
 
 def freeze_user_final_grade(user, course_run, raise_on_exception=False):
@@ -201,7 +210,170 @@ def freeze_user_final_grade(user, course_run, raise_on_exception=False):
     return final_grade_obj
 
 
-def generate_program_certificate(user, program):
+def freeze_users_final_grades(users, course_run, refresh_cache=True):
+    """
+    Public function to freeze final grades for many users in a course run at once.
+
+    The cached edX data of the users is loaded with one query per cached model, and the final grades are
+    inserted with their audits in bulk. Users who already have a final grade in the course run are skipped.
+
+    Args:
+        users (iterable of User): django users
+        course_run (CourseRun): a course run model object
+        refresh_cache (bool): If false, the cache of the users was already refreshed for the whole course run
+
+    Returns:
+        list of FinalGrade: The final grades created
+    """
+    # no need to do anything if the course run is not ready
+    if not course_run.can_freeze_grades:
+        log.info('The grades for course "%s" cannot be frozen yet', course_run.edx_course_key)
+        return []
+
+    con = get_redis_connection("redis")
+    failed_users_cache_key = CACHE_KEY_FAILED_USERS_BASE_STR.format(course_run.edx_course_key)
+    if refresh_cache:
+        # update one last time the users' certificates and current grades
+        refreshed_users = _refresh_users_cached_grade_data(users, course_run, failed_users_cache_key)
+    else:
+        refreshed_users = list(users)
+
+    frozen_user_ids = set(
+        FinalGrade.objects.filter(course_run=course_run, user__in=refreshed_users).values_list('user_id', flat=True)
+    )
+    users_to_freeze = [user for user in refreshed_users if user.id not in frozen_user_ids]
+    edx_user_data = CachedEdxUserData.for_users(
+        users_to_freeze, program=course_run.course.program, course_run=course_run
+    )
+    final_grade_func = _get_compute_func(course_run)
+    final_grades = []
+    for user in users_to_freeze:
+        try:
+            final_grade = final_grade_func(edx_user_data[user.id].get_run_data(course_run.edx_course_key))
+        except:  # pylint: disable=bare-except
+            # If user doesn't have a grade no need to freeze
+            con.lpush(failed_users_cache_key, user.id)
+            log.exception(
+                'Impossible to get final grade for user "%s" in course %s', user.username, course_run.edx_course_key)
+            continue
+        final_grades.append(FinalGrade(
+            user=user,
+            course_run=course_run,
+            grade=final_grade.grade,
+            passed=final_grade.passed,
+            status=FinalGradeStatus.COMPLETE,
+            course_run_paid_on_edx=final_grade.payed_on_edx
+        ))
+    if not final_grades:
+        return []
+
+    with transaction.atomic():
+        # the users may have been frozen meanwhile, by another delivery of the chunk or one at a time
+        frozen_user_ids = set(FinalGrade.objects.filter(
+            course_run=course_run, user_id__in=[final_grade.user_id for final_grade in final_grades]
+        ).values_list('user_id', flat=True))
+        final_grades = [final_grade for final_grade in final_grades if final_grade.user_id not in frozen_user_ids]
+        if not final_grades:
+            return []
+        # a user frozen since then is skipped too, instead of rolling back the whole chunk
+        FinalGrade.objects.bulk_create(final_grades, ignore_conflicts=True)
+        # the ids of the final grades are not set when the conflicts are ignored
+        created_final_grades = {
+            final_grade.user_id: final_grade for final_grade in FinalGrade.objects.filter(
+                course_run=course_run, user_id__in=[final_grade.user_id for final_grade in final_grades]
+            ).select_related('user')
+        }
+        final_grades = [created_final_grades[final_grade.user_id] for final_grade in final_grades]
+        FinalGradeAudit.objects.bulk_create(
+            FinalGradeAudit(final_grade=final_grade, data_after=final_grade.to_dict())
+            for final_grade in final_grades
+        )
+        # bulk_create does not send post_save, so the dashboard documents of the users are invalidated here
+        for final_grade in final_grades:
+            DashboardDocument.invalidate(final_grade.user_id)
+        transaction.on_commit(lambda: _send_final_grades_frozen(course_run, final_grades))
+    return final_grades
+
+
+def refresh_course_run_cached_grade_data(course_run, users):
+    """
+    Public function to update before a freeze the current grades of many users in a course run with a single
+    sweep of the grades of the whole course run, made with the staff credentials. Unlike the refresh
+    of each user, this doesn't depend on the credentials of the users.
+    The users whose cache can't be updated this way are added to the list of failed users.
+
+    Args:
+        course_run (CourseRun): a course run model object
+        users (iterable of User): django users
+
+    Returns:
+        list of User: The users whose cache was updated,
+            or None if the cache of the course run can't be updated as a whole
+    """
+    if not CachedEdxDataApi.can_update_course_run_grade_data(course_run):
+        return None
+    users = list(users)
+    try:
+        refreshed_users = CachedEdxDataApi.update_course_run_grade_data(course_run, users)
+    except:  # pylint: disable=bare-except
+        log.exception('Impossible to refresh the edX cache of course %s with the staff credentials',
+                      course_run.edx_course_key)
+        return None
+    refreshed_user_ids = {user.id for user in refreshed_users}
+    failed_user_ids = [user.id for user in users if user.id not in refreshed_user_ids]
+    if failed_user_ids:
+        con = get_redis_connection("redis")
+        con.lpush(CACHE_KEY_FAILED_USERS_BASE_STR.format(course_run.edx_course_key), *failed_user_ids)
+    return refreshed_users
+
+
+def _refresh_users_cached_grade_data(users, course_run, failed_users_cache_key):
+    """
+    Updates one last time the certificates and current grades of each user with their own credentials
+
+    Args:
+        users (iterable of User): django users
+        course_run (CourseRun): a course run model object
+        failed_users_cache_key (str): the key of the redis list of the users whose cache could not be updated
+
+    Returns:
+        list of User: the users whose cache was updated
+    """
+    con = get_redis_connection("redis")
+    refreshed_users = []
+    for user in users:
+        try:
+            CachedEdxDataApi.update_all_cached_grade_data(user, course_run.courseware_backend)
+        except:  # pylint: disable=bare-except
+            con.lpush(failed_users_cache_key, user.id)
+            log.exception(
+                'Impossible to refresh the edX cache for user "%s" in course %s',
+                user.username,
+                course_run.edx_course_key
+            )
+        else:
+            refreshed_users.append(user)
+    return refreshed_users
+
+
+def _send_final_grades_frozen(course_run, final_grades):
+    """
+    Sends final_grades_frozen for final grades created in bulk, with the mmtracks of their users
+
+    Args:
+        course_run (CourseRun): a course run model object
+        final_grades (list of FinalGrade): the final grades created in the course run
+    """
+    mmtracks = get_mmtracks([final_grade.user for final_grade in final_grades], course_run.course.program)
+    final_grades_frozen.send(
+        sender=FinalGrade,
+        course_run=course_run,
+        final_grades=final_grades,
+        mmtracks=mmtracks,
+    )
+
+
+def generate_program_certificate(user, program, mmtrack=None):
     """
     Create a program certificate if the user has a MM course certificate
     for each course in the program
@@ -209,12 +381,13 @@ def generate_program_certificate(user, program):
     Args:
         user (User): a Django user.
         program (programs.models.Program): program where the user is enrolled.
+        mmtrack (dashboard.utils.MMTrack): an optional preloaded mmtrack of the user in the program
     """
 
     if MicromastersProgramCertificate.objects.filter(user=user, program=program).exists():
         log.warning('User [%s] already has a certificate for program [%s]', user, program)
         return
-    if completed_program(user, program):
+    if completed_program(user, program, mmtrack=mmtrack):
         MicromastersProgramCertificate.objects.create(user=user, program=program)
         log.info(
             'Created MM program certificate for [%s] in program [%s]',
@@ -223,7 +396,7 @@ def generate_program_certificate(user, program):
         )
 
 
-def completed_program(user, program):
+def completed_program(user, program, mmtrack=None):
     """
     Check if the user passed all required courses and satisfied all elective
     requirements.
@@ -231,20 +404,23 @@ def completed_program(user, program):
     Args:
         user (User): a Django user.
         program (programs.models.Program): program where the user is enrolled.
+        mmtrack (dashboard.utils.MMTrack): an optional preloaded mmtrack of the user in the program
 
     Returns:
         bool: if user passed all requirements to complete the program
     """
-    mmtrack = get_mmtrack(user, program)
-    for electives_set in ElectivesSet.objects.filter(program=program):
-        elective_courses_id = set(electives_set.electivecourse_set.all().values_list('course__id', flat=True))
+    if mmtrack is None:
+        mmtrack = get_mmtrack(user, program, preload=True)
+    program_structure = get_program_structure(program.id)
+    for electives_set in program_structure.electives_sets:
+        elective_courses_id = set(program_structure.elective_course_ids_by_set[electives_set.id])
 
         # each elective set should be fulfilled
         if electives_set.required_number > mmtrack.get_number_of_passed_courses(elective_courses_id):
             return False
 
     # filtering out the courses that are not elective
-    core_courses_ids = set(program.course_set.filter(electivecourse=None).values_list('id', flat=True))
+    core_courses_ids = set(program_structure.core_course_ids)
 
     # checking all core courses are passed
     if len(core_courses_ids) > mmtrack.get_number_of_passed_courses(core_courses_ids):
@@ -253,7 +429,7 @@ def completed_program(user, program):
     return True
 
 
-def generate_program_letter(user, program):
+def generate_program_letter(user, program, mmtrack=None):
     """
     Create a program letter based on:
 
@@ -264,12 +440,13 @@ def generate_program_letter(user, program):
     Args:
         user (User): a Django user.
         program (programs.models.Program): program where the user is enrolled.
+        mmtrack (dashboard.utils.MMTrack): an optional preloaded mmtrack of the user in the program
     """
     if MicromastersProgramCommendation.objects.filter(user=user, program=program, is_active=True).exists():
         log.info('User [%s] already has a letter for program [%s]', user, program)
         return
 
-    if completed_program(user, program):
+    if completed_program(user, program, mmtrack=mmtrack):
         _, created = MicromastersProgramCommendation.objects.update_or_create(user=user, program=program,
                                                                               defaults={"is_active": True})
         log.info(
@@ -280,17 +457,19 @@ def generate_program_letter(user, program):
         )
 
 
-def update_or_create_combined_final_grade(user, course):
+def update_or_create_combined_final_grade(user, course, mmtrack=None):
     """
     Update or create CombinedFinalGrade
 
     Args:
         user (User): a django User
         course (Course): a course model object
+        mmtrack (dashboard.utils.MMTrack): an optional preloaded mmtrack of the user in the program
     """
     if not course.has_exam:
         return
-    mmtrack = get_mmtrack(user, course.program)
+    if mmtrack is None:
+        mmtrack = get_mmtrack(user, course.program)
     final_grade = mmtrack.get_best_final_grade_for_course(course)
     if final_grade is None:
         log.warning('User [%s] does not have a final for course [%s]', user, course)
@@ -18,6 +18,7 @@ from dashboard.api_edx_cache import CachedEdxUserData, UserCachedRunData
 from dashboard.factories import (CachedCertificateFactory,
                                  CachedCurrentGradeFactory,
                                  CachedEnrollmentFactory)
+from dashboard.models import DashboardDocument
 from exams.factories import ExamRunFactory
 from grades import api
 from grades.exceptions import FreezeGradeFailedException
@@ -395,6 +396,156 @@ class GradeAPITests(MockedESTestCase):
         assert fg_qset.count() == 1
 
 
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_all_cached_grade_data', new_callable=MagicMock)
+    def test_freeze_users_final_grades(self, mock_refr):
+        """
+        Test for happy path for freeze_users_final_grades function
+        """
+        other_user = SocialUserFactory.create()
+        CachedEnrollmentFactory.create(user=other_user, course_run=self.run_fa)
+        CachedCurrentGradeFactory.create(user=other_user, course_run=self.run_fa)
+        users = [self.user, other_user]
+        generations = {user.id: DashboardDocument.get_generation(user.id) for user in users}
+
+        with patch.object(api.final_grades_frozen, 'send') as mock_send, self.captureOnCommitCallbacks(execute=True):
+            final_grades = api.freeze_users_final_grades(users, self.run_fa)
+        # the dashboard documents of the users are stale
+        for user in users:
+            assert DashboardDocument.get_generation(user.id) > generations[user.id]
+        assert sorted(final_grade.user_id for final_grade in final_grades) == sorted(user.id for user in users)
+        assert mock_refr.call_count == len(users)
+        for user in users:
+            mock_refr.assert_any_call(user, self.run_fa.courseware_backend)
+            expected = api.get_final_grade(user, self.run_fa)
+            final_grade = FinalGrade.objects.get(user=user, course_run=self.run_fa)
+            assert final_grade.status == FinalGradeStatus.COMPLETE
+            assert final_grade.grade == expected.grade
+            assert final_grade.passed == expected.passed
+            assert final_grade.course_run_paid_on_edx == expected.payed_on_edx
+            assert final_grade.finalgradeaudit_set.get().data_after == final_grade.to_dict()
+
+        mock_send.assert_called_once()
+        send_kwargs = mock_send.call_args[1]
+        assert send_kwargs['course_run'] == self.run_fa
+        assert send_kwargs['final_grades'] == final_grades
+        assert sorted(send_kwargs['mmtracks']) == sorted(user.id for user in users)
+
+        # users who already have a final grade are skipped
+        assert api.freeze_users_final_grades(users, self.run_fa) == []
+        assert FinalGrade.objects.filter(course_run=self.run_fa).count() == len(users)
+
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_all_cached_grade_data', new_callable=MagicMock)
+    def test_freeze_users_final_grades_twice(self, mock_refr):  # pylint: disable=unused-argument
+        """
+        A user frozen while the chunk is frozen is skipped instead of failing the whole chunk,
+        and freezing the same chunk again does nothing
+        """
+        other_user = SocialUserFactory.create()
+        CachedEnrollmentFactory.create(user=other_user, course_run=self.run_fa)
+        CachedCurrentGradeFactory.create(user=other_user, course_run=self.run_fa)
+        users = [self.user, other_user]
+        compute_func = api._get_compute_func(self.run_fa)  # pylint: disable=protected-access
+        frozen_meanwhile = FinalGradeFactory.build(
+            user=self.user, course_run=self.run_fa, status=FinalGradeStatus.COMPLETE
+        )
+
+        def freeze_meanwhile(course_run):  # pylint: disable=unused-argument
+            """The final grade of one of the users is frozen once the chunk computed which users to freeze"""
+            frozen_meanwhile.save()
+            return compute_func
+
+        with patch('grades.api._get_compute_func', autospec=True, side_effect=freeze_meanwhile):
+            final_grades = api.freeze_users_final_grades(users, self.run_fa)
+        assert [final_grade.user_id for final_grade in final_grades] == [other_user.id]
+        assert final_grades[0].id is not None
+        assert final_grades[0].finalgradeaudit_set.count() == 1
+        assert FinalGrade.objects.get(user=self.user, course_run=self.run_fa) == frozen_meanwhile
+        assert frozen_meanwhile.finalgradeaudit_set.exists() is False
+
+        assert api.freeze_users_final_grades(users, self.run_fa) == []
+        assert FinalGrade.objects.filter(course_run=self.run_fa).count() == len(users)
+
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_all_cached_grade_data', new_callable=MagicMock)
+    def test_freeze_users_final_grades_errors(self, mock_refr):
+        """
+        Users whose cache can't be refreshed or who have no grade are left out and listed as failed
+        """
+        refresh_failed_user = SocialUserFactory.create()
+        no_grade_user = SocialUserFactory.create()
+        CachedEnrollmentFactory.create(user=no_grade_user, course_run=self.run_fa)
+
+        def refresh(user, backend):  # pylint: disable=unused-argument
+            """Fails to refresh the cache of one of the users"""
+            if user == refresh_failed_user:
+                raise AttributeError
+
+        mock_refr.side_effect = refresh
+
+        final_grades = api.freeze_users_final_grades([self.user, refresh_failed_user, no_grade_user], self.run_fa)
+        assert [final_grade.user_id for final_grade in final_grades] == [self.user.id]
+        assert list(FinalGrade.objects.filter(course_run=self.run_fa).values_list('user_id', flat=True)) == [
+            self.user.id
+        ]
+
+        con = get_redis_connection("redis")
+        failed_users_cache_key = api.CACHE_KEY_FAILED_USERS_BASE_STR.format(self.run_fa.edx_course_key)
+        failed_users_list = list(map(int, con.lrange(failed_users_cache_key, 0, -1)))
+        assert sorted(failed_users_list) == sorted([refresh_failed_user.id, no_grade_user.id])
+
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_all_cached_grade_data', new_callable=MagicMock)
+    def test_freeze_users_final_grades_not_ready(self, mock_refr):
+        """
+        No final grade is frozen if the course run is not ready
+        """
+        assert api.freeze_users_final_grades([self.user], self.run_no_fa) == []
+        assert mock_refr.called is False
+        assert FinalGrade.objects.filter(course_run=self.run_no_fa).exists() is False
+
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_all_cached_grade_data', new_callable=MagicMock)
+    def test_freeze_users_final_grades_no_refresh(self, mock_refr):
+        """
+        The cache of the users is not refreshed if it was refreshed for the whole course run
+        """
+        final_grades = api.freeze_users_final_grades([self.user], self.run_fa, refresh_cache=False)
+        assert [final_grade.user_id for final_grade in final_grades] == [self.user.id]
+        assert mock_refr.called is False
+
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_course_run_grade_data', autospec=True)
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.can_update_course_run_grade_data', autospec=True)
+    @ddt.data(True, False)
+    def test_refresh_course_run_cached_grade_data(self, can_update, mock_can_update, mock_update):
+        """
+        The users left out of the refresh of the course run are listed as failed
+        """
+        other_user = SocialUserFactory.create()
+        mock_can_update.return_value = can_update
+        mock_update.return_value = [self.user]
+
+        refreshed_users = api.refresh_course_run_cached_grade_data(self.run_fa, [self.user, other_user])
+
+        con = get_redis_connection("redis")
+        failed_users_cache_key = api.CACHE_KEY_FAILED_USERS_BASE_STR.format(self.run_fa.edx_course_key)
+        failed_users_list = list(map(int, con.lrange(failed_users_cache_key, 0, -1)))
+        if can_update:
+            assert refreshed_users == [self.user]
+            mock_update.assert_called_once_with(self.run_fa, [self.user, other_user])
+            assert failed_users_list == [other_user.id]
+        else:
+            assert refreshed_users is None
+            assert mock_update.called is False
+            assert failed_users_list == []
+
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_course_run_grade_data', autospec=True)
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.can_update_course_run_grade_data', autospec=True,
+           return_value=True)
+    def test_refresh_course_run_cached_grade_data_error(self, mock_can_update, mock_update):
+        """
+        If the course run can't be refreshed as a whole, the users are left to be refreshed one by one
+        """
+        mock_update.side_effect = AttributeError
+        assert api.refresh_course_run_cached_grade_data(self.run_fa, [self.user]) is None
+
+
 @ddt.ddt
 class GenerateCertificatesAPITests(MockedESTestCase):
     """
@@ -4,13 +4,14 @@ Checks the freeze status for a final grade
 from celery.result import GroupResult
 from django.core.cache import caches
 from django.core.management import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
 from django_redis import get_redis_connection
 
 from courses.models import CourseRun
 from dashboard.models import CachedCurrentGrade, CachedEnrollment
 from grades.api import CACHE_KEY_FAILED_USERS_BASE_STR
 from grades.models import CourseRunGradingStatus, FinalGrade
-from grades.tasks import CACHE_ID_BASE_STR
+from grades.tasks import CACHE_ID_BASE_STR, CHUNKS_CACHE_KEY_BASE_STR
 from micromasters.celery import app
 
 cache_redis = caches['redis']
@@ -47,9 +48,11 @@ class Command(BaseCommand):
             if group_results_id is not None:
                 results = GroupResult.restore(group_results_id, app=app)
                 if not results.ready():
+                    pending_chunks_count = con.hlen(CHUNKS_CACHE_KEY_BASE_STR.format(edx_course_key))
                     self.stdout.write(
                         self.style.WARNING(
-                            f'Final grades for course "{edx_course_key}" are being processed'
+                            f'Final grades for course "{edx_course_key}" are being processed, '
+                            f'with {pending_chunks_count} chunks of users left'
                         )
                     )
                 else:
@@ -73,14 +76,15 @@ class Command(BaseCommand):
                 )
             )
         message_detail = f', where {failed_users_count} failed authentication' if failed_users_count else ''
-        users_in_cache = set(CachedEnrollment.get_cached_users(run)).intersection(
-            set(CachedCurrentGrade.get_cached_users(run))
-        )
+        users_in_cache_count = CachedEnrollment.objects.filter(
+            Exists(CachedCurrentGrade.objects.filter(user=OuterRef('user'), course_run=run)),
+            course_run=run,
+        ).count()
         self.stdout.write(
             self.style.SUCCESS(
                 'The students with a final grade are {}/{}{}'.format(
                     FinalGrade.objects.filter(course_run=run).count(),
-                    len(users_in_cache),
+                    users_in_cache_count,
                     message_detail
                 )
             )
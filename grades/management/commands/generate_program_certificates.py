@@ -1,11 +1,14 @@
 """
 Find all users that completed the program and create certificates
 """
+from django.conf import settings
 from django.core.management import BaseCommand
 
 from courses.models import Program
 from dashboard.models import ProgramEnrollment
+from dashboard.utils import get_mmtracks
 from grades.api import generate_program_certificate
+from micromasters.utils import chunks
 
 
 class Command(BaseCommand):
@@ -18,6 +21,9 @@ class Command(BaseCommand):
         programs = Program.objects.filter(live=True)
         for program in programs:
             if program.has_frozen_grades_for_all_courses():
-                enrollments = ProgramEnrollment.objects.filter(program=program)
-                for enrollment in enrollments:
-                    generate_program_certificate(enrollment.user, program)
+                enrollments = ProgramEnrollment.objects.filter(program=program).select_related('user')
+                for enrollments_chunk in chunks(enrollments, chunk_size=settings.MMTRACK_BULK_CHUNK_SIZE):
+                    users = [enrollment.user for enrollment in enrollments_chunk]
+                    mmtracks = get_mmtracks(users, program)
+                    for user in users:
+                        generate_program_certificate(user, program, mmtrack=mmtracks[user.id])
@@ -1,11 +1,14 @@
 """
 Finds users that have passed all courses in non-FA programs and generates commendation letters for them
 """
+from django.conf import settings
 from django.core.management import BaseCommand
 
 from courses.models import Program
 from dashboard.models import ProgramEnrollment
+from dashboard.utils import get_mmtracks
 from grades.api import generate_program_letter
+from micromasters.utils import chunks
 
 
 class Command(BaseCommand):
@@ -24,5 +27,8 @@ class Command(BaseCommand):
                 )
                 continue
             enrollments = ProgramEnrollment.objects.filter(program=program).select_related('user')
-            for enrollment in enrollments:
-                generate_program_letter(enrollment.user, program)
+            for enrollments_chunk in chunks(enrollments, chunk_size=settings.MMTRACK_BULK_CHUNK_SIZE):
+                users = [enrollment.user for enrollment in enrollments_chunk]
+                mmtracks = get_mmtracks(users, program)
+                for user in users:
+                    generate_program_letter(user, program, mmtrack=mmtracks[user.id])
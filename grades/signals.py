@@ -5,7 +5,8 @@ from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from grades.api import (generate_program_certificate, generate_program_letter,
+from grades.api import (final_grades_frozen, generate_program_certificate,
+                        generate_program_letter,
                         update_or_create_combined_final_grade)
 from grades.models import (FinalGrade, MicromastersCourseCertificate,
                            MicromastersProgramCertificate)
@@ -46,3 +47,15 @@ def handle_create_final_grade(sender, instance, created, **kwargs):  # pylint: d
             generate_program_letter(instance.user, course.program)
 
     transaction.on_commit(_on_transaction_commit)
+
+
+@receiver(final_grades_frozen, dispatch_uid="final_grades_frozen")
+def handle_frozen_final_grades(sender, course_run, final_grades, mmtracks, **kwargs):  # pylint: disable=unused-argument
+    """
+    When many FinalGrade models are created at once
+    """
+    course = course_run.course
+    for final_grade in final_grades:
+        mmtrack = mmtracks[final_grade.user_id]
+        update_or_create_combined_final_grade(final_grade.user, course, mmtrack=mmtrack)
+        generate_program_letter(final_grade.user, course.program, mmtrack=mmtrack)
@@ -1,16 +1,17 @@
 """
 Tests for signals
 """
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from django.db.models.signals import post_save
 from factory.django import mute_signals
 
 from courses.factories import CourseFactory, CourseRunFactory, ProgramFactory
+from grades.api import final_grades_frozen
 from grades.factories import (FinalGradeFactory,
                               MicromastersCourseCertificateFactory,
                               ProctoredExamGradeFactory)
-from grades.models import MicromastersProgramCertificate
+from grades.models import FinalGrade, MicromastersProgramCertificate
 from profiles.factories import ProfileFactory
 from search.base import MockedESTestCase
 
@@ -126,3 +127,21 @@ class FinalGradeTests(MockedESTestCase):
         FinalGradeFactory.create(user=self.user, course_run=course_run, grade=0.9)
         update_grade_mock.assert_called_once_with(self.user, course_run.course)
         generate_letter_mock.assert_called_once_with(self.user, course_run.course.program)
+
+    def test_final_grades_frozen(self, generate_letter_mock, update_grade_mock, mock_on_commit):
+        """
+        Test that final grades frozen in bulk will update combined final grades and
+        generate program commendation letters with the preloaded mmtracks.
+        """
+        course_run = CourseRunFactory.create()
+        with mute_signals(post_save):
+            final_grade = FinalGradeFactory.create(user=self.user, course_run=course_run, grade=0.9)
+        mmtrack = Mock()
+        final_grades_frozen.send(
+            sender=FinalGrade,
+            course_run=course_run,
+            final_grades=[final_grade],
+            mmtracks={self.user.id: mmtrack},
+        )
+        update_grade_mock.assert_called_once_with(self.user, course_run.course, mmtrack=mmtrack)
+        generate_letter_mock.assert_called_once_with(self.user, course_run.course.program, mmtrack=mmtrack)
@@ -1,6 +1,7 @@
 """
 Tasks for the grades app
 """
+import json
 import logging
 
 from celery import group
@@ -18,6 +19,8 @@ from micromasters.utils import chunks
 
 User = get_user_model()
 CACHE_ID_BASE_STR = "freeze_grade_{0}"
+# redis hash of the chunks of users dispatched for a course run which haven't reported back yet
+CHUNKS_CACHE_KEY_BASE_STR = "freeze_grade_chunks_{0}"
 
 log = logging.getLogger(__name__)
 cache_redis = caches['redis']
@@ -45,6 +48,10 @@ def freeze_course_run_final_grades(course_run_id):
     """
     Async task manager to freeze all the users' final grade in a course run
 
+    The users are frozen by chunks, and each chunk dispatched is recorded in a redis hash until it reports
+    back, so that a later run of this task only dispatches again the chunks which didn't finish.
+    The course run is completed by the last chunk to report back, or else by a later run of this task.
+
     Args:
         course_run_id (int): a course run id
 
@@ -80,35 +87,55 @@ def freeze_course_run_final_grades(course_run_id):
         # delete the results anyway
         results.delete()
 
-    # extract the users to be frozen for this course
-    user_ids_qset = api.get_users_without_frozen_final_grade(course_run).values_list('id', flat=True)
-
-    # find number of users for which cache could not be updated
     con = get_redis_connection("redis")
-    failed_users_cache_key = api.CACHE_KEY_FAILED_USERS_BASE_STR.format(course_run.edx_course_key)
-    failed_users_count = con.llen(failed_users_cache_key)
-
-    # get the list of users that failed authentication last run of the task
-    failed_users_list = list(map(int, con.lrange(failed_users_cache_key, 0, failed_users_count)))
-    users_need_freeze = list(user_ids_qset)
-    users_left = list(set(users_need_freeze) - set(failed_users_list))
-    # if there are no more users to be frozen, just complete the task
-    if not users_left:
-        log.info('Completing grading with %d users getting refresh cache errors', len(failed_users_list))
-        CourseRunGradingStatus.set_to_complete(course_run)
-        con.delete(failed_users_cache_key)
-        return
-
-    # if the task reaches this point, it means there are users still to be processed
-
-    # clear the list for users for whom cache update failed
-    con.delete(failed_users_cache_key)
-    # create an entry in with pending status ('pending' is the default status)
-    CourseRunGradingStatus.create_pending(course_run=course_run)
+    chunks_cache_key = CHUNKS_CACHE_KEY_BASE_STR.format(course_run.edx_course_key)
+    pending_chunks = {
+        int(chunk_id): json.loads(chunk) for chunk_id, chunk in con.hgetall(chunks_cache_key).items()
+    }
+    if pending_chunks:
+        # the chunks of a previous iteration which didn't report back are dispatched again
+        log.info(
+            'Dispatching again %d unfinished chunks of the final grades freeze of course run "%s"',
+            len(pending_chunks),
+            course_run.edx_course_key,
+        )
+    else:
+        # if there are no more users to be frozen, just complete the task
+        if _complete_if_all_frozen(course_run):
+            return
+
+        # if the task reaches this point, it means there are users still to be processed
+
+        # clear the list for users for whom cache update failed
+        con.delete(api.CACHE_KEY_FAILED_USERS_BASE_STR.format(course_run.edx_course_key))
+        # create an entry in with pending status ('pending' is the default status)
+        CourseRunGradingStatus.create_pending(course_run=course_run)
+
+        users_qset = api.get_users_without_frozen_final_grade(course_run)
+        # refresh the cache of the whole course run at once if possible, otherwise each user is refreshed by the
+        # subtasks
+        refreshed_users = api.refresh_course_run_cached_grade_data(course_run, users_qset.iterator())
+        refresh_cache = refreshed_users is None
+        if refresh_cache:
+            user_ids = list(users_qset.values_list('id', flat=True).iterator())
+        else:
+            user_ids = [user.id for user in refreshed_users]
+        pending_chunks = {
+            chunk_id: {'user_ids': list_user_ids, 'refresh_cache': refresh_cache}
+            for chunk_id, list_user_ids in enumerate(chunks(user_ids))
+        }
+        if not pending_chunks:
+            return
+        con.hset(chunks_cache_key, mapping={
+            chunk_id: json.dumps(chunk) for chunk_id, chunk in pending_chunks.items()
+        })
 
     # create a group of subtasks to be run in parallel
     job = group(
-        freeze_users_final_grade_async.s(list_user_ids, course_run.id) for list_user_ids in chunks(user_ids_qset)
+        freeze_users_final_grade_async.s(
+            chunk['user_ids'], course_run.id, refresh_cache=chunk['refresh_cache'], chunk_id=chunk_id
+        )
+        for chunk_id, chunk in pending_chunks.items()
     )
     results = job.apply_async()
     # save the result ID in the celery backend
@@ -117,25 +144,67 @@ def freeze_course_run_final_grades(course_run_id):
     cache_redis.set(cache_id, results.id, None)
 
 
+def _complete_if_all_frozen(course_run):
+    """
+    Completes the final grades freeze of a course run if all its users were either frozen or
+    failed to be refreshed
+
+    Args:
+        course_run (CourseRun): a course run
+
+    Returns:
+        bool: whether the course run was completed
+    """
+    # find the users for which cache could not be updated in the last run of the task
+    con = get_redis_connection("redis")
+    failed_users_cache_key = api.CACHE_KEY_FAILED_USERS_BASE_STR.format(course_run.edx_course_key)
+    failed_users_list = set(map(int, con.lrange(failed_users_cache_key, 0, -1)))
+    users_left = api.get_users_without_frozen_final_grade(course_run).exclude(id__in=failed_users_list)
+    if users_left.exists():
+        return False
+    log.info('Completing grading with %d users getting refresh cache errors', len(failed_users_list))
+    CourseRunGradingStatus.set_to_complete(course_run)
+    con.delete(failed_users_cache_key)
+    return True
+
+
+def _report_chunk_done(course_run, chunk_id):
+    """
+    Records that a chunk of the final grades freeze of a course run is done,
+    and completes the course run if it was the last chunk and nothing is left to freeze
+
+    Args:
+        course_run (CourseRun): a course run
+        chunk_id (int): the id of the chunk in the course run
+    """
+    con = get_redis_connection("redis")
+    chunks_cache_key = CHUNKS_CACHE_KEY_BASE_STR.format(course_run.edx_course_key)
+    # removing the chunk and counting the others is atomic, so that a single chunk sees that it was the last one
+    pipe = con.pipeline()
+    pipe.hdel(chunks_cache_key, chunk_id)
+    pipe.hlen(chunks_cache_key)
+    removed, remaining = pipe.execute()
+    if removed and not remaining and _complete_if_all_frozen(course_run):
+        cache_redis.delete(CACHE_ID_BASE_STR.format(course_run.edx_course_key))
+
+
 @app.task
-def freeze_users_final_grade_async(user_ids, course_run_id):
+def freeze_users_final_grade_async(user_ids, course_run_id, refresh_cache=True, chunk_id=None):
     """
     Async task to freeze the final grade in a course run for a list of users.
 
     Args:
         user_ids (list): a list of django user ids
         course_run_id (int): a course run id
+        refresh_cache (bool): If false, the cache of the users was already refreshed for the whole course run
+        chunk_id (int): the id of the chunk of the users, if they were dispatched by freeze_course_run_final_grades
 
     Returns:
         None
     """
-    # pylint: disable=bare-except
     course_run = CourseRun.objects.get(id=course_run_id)
-    for user in User.objects.filter(id__in=user_ids):
-        try:
-            api.freeze_user_final_grade(user, course_run)
-        except:
-            log.exception(
-                'Impossible to freeze final grade for user "%s" in course %s',
-                user.username, course_run.edx_course_key
-            )
+    api.freeze_users_final_grades(
+        User.objects.filter(id__in=user_ids).select_related('profile'), course_run, refresh_cache=refresh_cache
+    )
+    if chunk_id is not None:
+        _report_chunk_done(course_run, chunk_id)
@@ -1,6 +1,7 @@
 """
 Tests for grades tasks
 """
+import json
 from datetime import timedelta
 from unittest.mock import MagicMock, patch
 
@@ -22,6 +23,17 @@ cache_redis = caches['redis']
 # pylint: disable=protected-access
 
 
+def frozen_users(mock_freeze_func, course_run):
+    """
+    Returns the ids of the users passed to a mocked freeze_users_final_grades for a course run
+    """
+    user_ids = set()
+    for (users, run), _ in mock_freeze_func.call_args_list:
+        assert run == course_run
+        user_ids.update(user.id for user in users)
+    return user_ids
+
+
 class GradeTasksTests(MockedESTestCase):
     """
     Tests for final grades tasks
@@ -57,24 +69,78 @@ class GradeTasksTests(MockedESTestCase):
         for run in self.all_freezable_runs:
             mock_freeze.delay.assert_any_call(run.id)
 
-    @patch('grades.api.freeze_user_final_grade', autospec=True)
+    @patch('grades.api.freeze_users_final_grades', autospec=True)
     def test_freeze_users_final_grade_async(self, mock_freeze_func):
         """
         Test for the freeze_users_final_grade_async task
         """
         tasks.freeze_users_final_grade_async.delay([user.id for user in self.users], self.course_run1.id)
-        assert mock_freeze_func.call_count == len(self.users)
-        for user in self.users:
-            mock_freeze_func.assert_any_call(user, self.course_run1)
+        mock_freeze_func.assert_called_once()
+        users, course_run = mock_freeze_func.call_args[0]
+        assert sorted(users, key=lambda user: user.id) == sorted(self.users, key=lambda user: user.id)
+        assert course_run == self.course_run1
 
-        # even if the function gives errors, it still completes
-        mock_freeze_func.reset_mock()
-        mock_freeze_func.side_effect = AttributeError
+    @patch('celery.result.GroupResult.restore', new_callable=MagicMock)
+    @patch('grades.api.freeze_users_final_grades', autospec=True, return_value=[])
+    @patch('grades.api.refresh_course_run_cached_grade_data', autospec=True)
+    def test_freeze_course_run_final_grades_refreshed_run(self, mock_refresh, freeze_users, mock_restore):
+        """
+        If the cache of the course run is refreshed as a whole, only the refreshed users are frozen
+        and their cache is not refreshed again
+        """
+        refreshed_users = self.users[5:]
+        mock_refresh.return_value = refreshed_users
+        tasks.freeze_course_run_final_grades.delay(self.course_run1.id)
+        mock_refresh.assert_called_once()
+        assert frozen_users(freeze_users, self.course_run1) == {user.id for user in refreshed_users}
+        for _, called_kwargs in freeze_users.call_args_list:
+            assert called_kwargs == {'refresh_cache': False}
 
-        tasks.freeze_users_final_grade_async.delay([user.id for user in self.users], self.course_run1.id)
-        assert mock_freeze_func.call_count == len(self.users)
-        for user in self.users:
-            mock_freeze_func.assert_any_call(user, self.course_run1)
+    @patch('grades.api.freeze_users_final_grades', autospec=True)
+    def test_freeze_course_run_final_grades_last_chunk(self, freeze_users):
+        """
+        The course run is completed as soon as its last chunk reports back, without waiting for the next run
+        """
+        def freeze(users, course_run, refresh_cache=True):
+            """Freezes the final grades of the users"""
+            for user in users:
+                FinalGrade.objects.create(
+                    user=user,
+                    grade=0.6,
+                    passed=True,
+                    course_run=course_run,
+                    status=FinalGradeStatus.COMPLETE
+                )
+        freeze_users.side_effect = freeze
+
+        tasks.freeze_course_run_final_grades.delay(self.course_run1.id)
+        assert frozen_users(freeze_users, self.course_run1) == {user.id for user in self.users}
+        assert CourseRunGradingStatus.is_complete(self.course_run1) is True
+        con = get_redis_connection("redis")
+        assert con.exists(tasks.CHUNKS_CACHE_KEY_BASE_STR.format(self.course_run1.edx_course_key)) == 0
+
+    @patch('celery.result.GroupResult.restore', new_callable=MagicMock)
+    @patch('grades.api.freeze_users_final_grades', autospec=True, return_value=[])
+    def test_freeze_course_run_final_grades_unfinished_chunks(self, freeze_users, mock_restore):
+        """
+        Only the chunks which didn't report back are dispatched again
+        """
+        cache_redis.set(tasks.CACHE_ID_BASE_STR.format(self.course_run1.edx_course_key), 'group-id', None)
+        CourseRunGradingStatus.create_pending(course_run=self.course_run1)
+        unfinished_users = self.users[:3]
+        con = get_redis_connection("redis")
+        chunks_cache_key = tasks.CHUNKS_CACHE_KEY_BASE_STR.format(self.course_run1.edx_course_key)
+        con.hset(chunks_cache_key, 1, json.dumps({
+            'user_ids': [user.id for user in unfinished_users], 'refresh_cache': True,
+        }))
+
+        tasks.freeze_course_run_final_grades.delay(self.course_run1.id)
+        mock_restore.return_value.revoke.assert_called_once_with()
+        freeze_users.assert_called_once()
+        assert frozen_users(freeze_users, self.course_run1) == {user.id for user in unfinished_users}
+        assert con.exists(chunks_cache_key) == 0
+        # the users are not frozen, so the course run is left to the next run of the task
+        assert CourseRunGradingStatus.is_pending(self.course_run1) is True
 
     def test_freeze_course_run_final_grades_1(self):
         """
@@ -108,8 +174,8 @@ class GradeTasksTests(MockedESTestCase):
         assert info_run.status == FinalGradeStatus.COMPLETE
 
     @patch('celery.result.GroupResult.restore', new_callable=MagicMock)
-    @patch('grades.api.freeze_user_final_grade', autospec=True, return_value=None)
-    def test_freeze_course_run_final_grades_4(self, freeze_single_user, mock_restore):
+    @patch('grades.api.freeze_users_final_grades', autospec=True, return_value=[])
+    def test_freeze_course_run_final_grades_4(self, freeze_users, mock_restore):
         """
         Test for the test_freeze_course_run_final_grades
         task in case there are users to be processed
@@ -132,9 +198,7 @@ class GradeTasksTests(MockedESTestCase):
         cache_id = tasks.CACHE_ID_BASE_STR.format(self.course_run1.edx_course_key)
         cached_celery_task_id_1 = cache_redis.get(cache_id)
         assert cached_celery_task_id_1 is not None
-        assert freeze_single_user.call_count == len(self.users)
-        for user in self.users:
-            freeze_single_user.assert_any_call(user, self.course_run1)
+        assert frozen_users(freeze_users, self.course_run1) == {user.id for user in self.users}
 
         # simulate successful freeze for most users
         successful_users = self.users[5:]
@@ -148,7 +212,7 @@ class GradeTasksTests(MockedESTestCase):
             )
 
         # new call will process all the remaining users without changing the status of the course run
-        freeze_single_user.reset_mock()
+        freeze_users.reset_mock()
         tasks.freeze_course_run_final_grades.delay(self.course_run1.id)
         info_run.refresh_from_db()
         assert info_run.status == FinalGradeStatus.PENDING
@@ -156,9 +220,7 @@ class GradeTasksTests(MockedESTestCase):
         assert cached_celery_task_id_2 is not None
         assert cached_celery_task_id_2 != cached_celery_task_id_1
         remaining_users = self.users[:5]
-        assert freeze_single_user.call_count == len(remaining_users)
-        for user in remaining_users:
-            freeze_single_user.assert_any_call(user, self.course_run1)
+        assert frozen_users(freeze_users, self.course_run1) == {user.id for user in remaining_users}
 
         # simulate successful freeze for remaining users users
         for user in remaining_users:
@@ -171,16 +233,16 @@ class GradeTasksTests(MockedESTestCase):
             )
 
         # a new call will just change the status of the course and clean up the cache
-        freeze_single_user.reset_mock()
+        freeze_users.reset_mock()
         tasks.freeze_course_run_final_grades.delay(self.course_run1.id)
         info_run.refresh_from_db()
         assert info_run.status == FinalGradeStatus.COMPLETE
         assert cache_redis.get(cache_id) is None
-        assert freeze_single_user.call_count == 0
+        assert freeze_users.call_count == 0
 
     @patch('celery.result.GroupResult.restore', new_callable=MagicMock)
-    @patch('grades.api.freeze_user_final_grade', autospec=True, return_value=None)
-    def test_freeze_course_run_final_grades_5(self, freeze_single_user, mock_restore):
+    @patch('grades.api.freeze_users_final_grades', autospec=True, return_value=[])
+    def test_freeze_course_run_final_grades_5(self, freeze_users, mock_restore):
         """
         Test for the test_freeze_course_run_final_grades
         task in case there are users that failed authentication
@@ -200,9 +262,7 @@ class GradeTasksTests(MockedESTestCase):
         cache_id = tasks.CACHE_ID_BASE_STR.format(self.course_run1.edx_course_key)
         cached_celery_task_id_1 = cache_redis.get(cache_id)
         assert cached_celery_task_id_1 is not None
-        assert freeze_single_user.call_count == len(self.users)
-        for user in self.users:
-            freeze_single_user.assert_any_call(user, self.course_run1)
+        assert frozen_users(freeze_users, self.course_run1) == {user.id for user in self.users}
 
         # simulate successful freeze for most users
         successful_users = self.users[5:]
@@ -222,7 +282,7 @@ class GradeTasksTests(MockedESTestCase):
             con.lpush(failed_users_cache_key, user.id)
 
         # second call
-        freeze_single_user.reset_mock()
+        freeze_users.reset_mock()
         tasks.freeze_course_run_final_grades.delay(self.course_run1.id)
 
         # new call will not try to process any failed users and will set status to COMPLETE
@@ -230,4 +290,4 @@ class GradeTasksTests(MockedESTestCase):
         assert info_run.status == FinalGradeStatus.COMPLETE
         assert con.llen(failed_users_cache_key) == 0
         assert cache_redis.get(cache_id) is None
-        assert freeze_single_user.call_count == 0
+        assert freeze_users.call_count == 0
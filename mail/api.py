@@ -22,7 +22,10 @@ from mail.models import (
 from mail.utils import filter_recipient_variables
 from micromasters.utils import chunks
 from profiles.models import Profile
-from search.api import adjust_search_for_percolator, search_percolate_queries
+from search.api import (adjust_search_for_percolator,
+                        search_percolate_queries,
+                        search_percolate_queries_in_bulk)
+from search.indexing_api import serialize_program_enrolled_user
 from search.models import PercolateQuery
 
 User = get_user_model()
@@ -249,6 +252,50 @@ def send_automatic_emails(program_enrollment):
         program_enrollment (ProgramEnrollment): A ProgramEnrollment
     """
     percolate_queries = search_percolate_queries(program_enrollment.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+    _send_matching_automatic_emails(program_enrollment, percolate_queries)
+
+
+def send_automatic_emails_in_bulk(program_enrollments, documents_by_enrollment_id=None):
+    """
+    Send all automatic emails which match the search criteria for some program enrollments,
+    which are percolated together
+
+    Args:
+        program_enrollments (list of ProgramEnrollment): A list of ProgramEnrollments
+        documents_by_enrollment_id (dict):
+            ProgramEnrollment id -> the private document of the enrollment, for the enrollments which were just
+            serialized for indexing. The other enrollments are serialized again.
+    """
+    documents_by_enrollment_id = documents_by_enrollment_id or {}
+    documents = {}
+    for program_enrollment in program_enrollments:
+        document = documents_by_enrollment_id.get(program_enrollment.id)
+        if document is None:
+            document = serialize_program_enrolled_user(program_enrollment)
+        if document is not None:
+            documents[program_enrollment.id] = document
+
+    query_ids_by_enrollment = search_percolate_queries_in_bulk(documents, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+    for program_enrollment in program_enrollments:
+        query_ids = query_ids_by_enrollment.get(program_enrollment.id)
+        if not query_ids:
+            continue
+        try:
+            _send_matching_automatic_emails(program_enrollment, query_ids)
+        except:  # pylint: disable=bare-except
+            log.exception("Error sending automatic email for enrollment %s", program_enrollment)
+
+
+def _send_matching_automatic_emails(program_enrollment, percolate_queries):
+    """
+    Send the enabled automatic emails of some percolate queries to the user of a program enrollment,
+    unless they were already sent to the user
+
+    Args:
+        program_enrollment (ProgramEnrollment): A ProgramEnrollment
+        percolate_queries (iterable of PercolateQuery or int): The percolate queries, or their ids,
+            which match the enrollment
+    """
     automatic_emails = AutomaticEmail.objects.filter(
         query__in=percolate_queries,
         enabled=True,
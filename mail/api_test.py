@@ -28,6 +28,7 @@ from mail.api import (
     get_mail_vars,
     mark_emails_as_sent,
     send_automatic_emails,
+    send_automatic_emails_in_bulk,
 )
 from mail.models import (
     AutomaticEmail,
@@ -501,6 +502,59 @@ class AutomaticEmailTests(MockedESTestCase):
         mock_search_queries.assert_called_with(self.program_enrollment_unsent.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
         assert mock_mailgun.send_batch.call_count == 2
 
+    def test_send_automatic_emails_in_bulk(self):
+        """
+        send_automatic_emails_in_bulk should percolate the enrollments together, reusing the documents given,
+        and send the matching emails to each of them
+        """
+        other_enrollment = ProgramEnrollmentFactory.create()
+        document = {'id': self.program_enrollment_unsent.id}
+        with patch(
+            'mail.api.search_percolate_queries_in_bulk', autospec=True, return_value={
+                self.program_enrollment_unsent.id: {self.percolate_query.id},
+                self.program_enrollment_sent.id: {self.percolate_query.id},
+            },
+        ) as mock_search_queries, patch(
+            'mail.api.serialize_program_enrolled_user', autospec=True, side_effect=lambda enrollment: {
+                'id': enrollment.id
+            }
+        ) as mock_serialize, patch('mail.api.MailgunClient') as mock_mailgun:
+            send_automatic_emails_in_bulk(
+                [self.program_enrollment_unsent, self.program_enrollment_sent, other_enrollment],
+                {self.program_enrollment_unsent.id: document},
+            )
+
+        mock_search_queries.assert_called_once_with({
+            self.program_enrollment_unsent.id: document,
+            self.program_enrollment_sent.id: {'id': self.program_enrollment_sent.id},
+            other_enrollment.id: {'id': other_enrollment.id},
+        }, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+        assert mock_serialize.call_count == 2
+        # the email was already sent to the user of the other enrollment
+        mock_mailgun.send_batch.assert_called_once_with(
+            self.automatic_email.email_subject,
+            self.automatic_email.email_body,
+            [(context['email'], context) for context in get_mail_vars([self.program_enrollment_unsent.user.email])],
+            sender_name=self.automatic_email.sender_name,
+        )
+
+    def test_send_automatic_emails_in_bulk_failure(self):
+        """If sending the emails of an enrollment fails the emails of the other enrollments should still be sent"""
+        other_enrollment = ProgramEnrollmentFactory.create()
+        with patch(
+            'mail.api.search_percolate_queries_in_bulk', autospec=True, return_value={
+                self.program_enrollment_unsent.id: {self.percolate_query.id},
+                other_enrollment.id: {self.percolate_query.id},
+            },
+        ), patch(
+            'mail.api._send_matching_automatic_emails', autospec=True, side_effect=[KeyError(), None]
+        ) as mock_send:
+            send_automatic_emails_in_bulk([self.program_enrollment_unsent, other_enrollment], {
+                self.program_enrollment_unsent.id: {}, other_enrollment.id: {},
+            })
+        assert mock_send.call_count == 2
+        mock_send.assert_called_with(other_enrollment, {self.percolate_query.id})
+
     def test_add_automatic_email(self):
         """Add an AutomaticEmail entry with associated PercolateQuery"""
         assert AutomaticEmail.objects.count() == 3
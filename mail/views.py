@@ -9,6 +9,7 @@ from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
 from django.urls import reverse
 from rest_framework import authentication, permissions, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import GenericAPIView, ListAPIView
 from rest_framework.mixins import UpdateModelMixin
 from rest_framework.response import Response
@@ -33,7 +34,7 @@ from mail.serializers import AutomaticEmailSerializer, GenericMailSerializer
 from mail.utils import generate_mailgun_response_json, get_email_footer
 from profiles.models import Profile
 from profiles.util import full_name
-from search.api import create_search_obj, get_all_query_matching_emails
+from search.api import create_search_obj, iter_query_matching_email_pages
 
 User = get_user_model()
 log = logging.getLogger(__name__)
@@ -129,42 +130,67 @@ class SearchResultMailView(APIView):
             search_param_dict=request.data.get('search_request'),
             filter_on_email_optin=True
         )
-        emails = get_all_query_matching_emails(search_obj)
-
+        search_after = request.data.get('search_after')
+        automatic_email = None
         if request.data.get('send_automatic_emails'):
-            automatic_email = add_automatic_email(
-                search_obj,
-                email_subject=request.data['email_subject'],
-                email_body=email_body,
-                sender_name=sender_name,
-                staff_user=request.user,
-            )
+            if search_after is not None:
+                # a resumed mailing keeps the automatic email created when it started, another one would
+                # email the learners matching the search from now on a second time
+                automatic_email_id = request.data.get('automatic_email_id')
+                if automatic_email_id is None:
+                    raise ValidationError({
+                        'automatic_email_id': 'The automatic email is required to resume the mailing'
+                    })
+                automatic_email = get_object_or_404(AutomaticEmail, id=automatic_email_id, staff_user=request.user)
+            else:
+                automatic_email = add_automatic_email(
+                    search_obj,
+                    email_subject=request.data['email_subject'],
+                    email_body=email_body,
+                    sender_name=sender_name,
+                    staff_user=request.user,
+                )
 
+        # emails are sent a page at a time so memory stays bounded however many learners match. If the mailing
+        # is interrupted it can be resumed from the last logged cursor by passing it back as search_after,
+        # along with the logged automatic_email_id if automatic emails are sent.
+        exception_pairs = []
+        for emails, cursor in iter_query_matching_email_pages(search_obj, search_after=search_after):
             try:
-                with mark_emails_as_sent(automatic_email, emails) as user_ids:
-                    # user_ids should be all users with the matching email in emails
-                    # except some who were already sent email in the meantime
-                    recipient_emails = list(User.objects.filter(id__in=user_ids).values_list('email', flat=True))
+                if automatic_email is not None:
+                    with mark_emails_as_sent(automatic_email, emails) as user_ids:
+                        # user_ids should be all users with the matching email in emails
+                        # except some who were already sent email in the meantime
+                        recipient_emails = list(User.objects.filter(id__in=user_ids).values_list('email', flat=True))
+                        MailgunClient.send_batch(
+                            subject=email_subject,
+                            body=email_body,
+                            recipients=((context['email'], context) for context in get_mail_vars(recipient_emails)),
+                            sender_name=sender_name,
+                        )
+                else:
                     MailgunClient.send_batch(
                         subject=email_subject,
                         body=email_body,
-                        recipients=((context['email'], context) for context in get_mail_vars(recipient_emails)),
+                        recipients=((context['email'], context) for context in get_mail_vars(emails)),
                         sender_name=sender_name,
                     )
             except SendBatchException as send_batch_exception:
-                success_emails = set(emails).difference(send_batch_exception.failed_recipient_emails)
-                with mark_emails_as_sent(automatic_email, success_emails):
-                    pass
-                raise
-
-        else:
-            MailgunClient.send_batch(
-                subject=email_subject,
-                body=email_body,
-                recipients=((context['email'], context) for context in get_mail_vars(emails)),
-                sender_name=sender_name,
+                if automatic_email is not None:
+                    success_emails = set(emails).difference(send_batch_exception.failed_recipient_emails)
+                    with mark_emails_as_sent(automatic_email, success_emails):
+                        pass
+                exception_pairs.extend(send_batch_exception.exception_pairs)
+            log.info(
+                "Sent search result mail from %s up to search_after=%s, automatic_email_id=%s",
+                request.user.username,
+                cursor,
+                automatic_email.id if automatic_email is not None else None,
             )
 
+        if exception_pairs:
+            raise SendBatchException(exception_pairs)
+
         return Response(status=status.HTTP_200_OK, data={})
 
 
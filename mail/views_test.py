@@ -72,6 +72,7 @@ class SearchResultMailViewsBase(MockedESTestCase, APITestCase):
             'email_body': 'email body'
         }
         self.email_results = {'a@example.com', 'b@example.com'}
+        self.email_pages = [(sorted(self.email_results), ['b@example.com', 2])]
         self.email_vars = [{
             'email': 'a@example.com',
             'mail_id': 'id1',
@@ -92,7 +93,7 @@ class SearchResultMailViewsTests(SearchResultMailViewsBase):
         Test that the SearchResultMailView will accept and return expected values
         """
         with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
+            'mail.views.iter_query_matching_email_pages', autospec=True, return_value=self.email_pages
         ) as mock_get_emails, patch(
             'mail.views.MailgunClient'
         ) as mock_mailgun_client, patch(
@@ -115,7 +116,30 @@ class SearchResultMailViewsTests(SearchResultMailViewsBase):
         self.assertIn(self.request_data['email_body'], called_kwargs['body'])
         self.assertIn('edit your settings', called_kwargs['body'])
         assert list(called_kwargs['recipients']) == self.recipient_tuples
-        mock_get_mail_vars.assert_called_once_with(self.email_results)
+        mock_get_mail_vars.assert_called_once_with(sorted(self.email_results))
+
+    def test_send_view_pages(self):
+        """
+        Each page of emails should be sent in its own batch, starting after the search_after cursor if one is given
+        """
+        email_pages = [(['a@example.com'], ['a@example.com', 1]), (['b@example.com'], ['b@example.com', 2])]
+        request_data = {**self.request_data, 'search_after': ['0@example.com', 0]}
+        with patch(
+            'mail.views.iter_query_matching_email_pages', autospec=True, return_value=email_pages
+        ) as mock_get_email_pages, patch(
+            'mail.views.MailgunClient'
+        ) as mock_mailgun_client, patch(
+            'mail.views.get_mail_vars', autospec=True, side_effect=lambda emails: [
+                context for context in self.email_vars if context['email'] in emails
+            ],
+        ):
+            mock_mailgun_client.send_batch.return_value = [Response()]
+            resp_post = self.client.post(self.search_result_mail_url, data=request_data, format='json')
+        assert resp_post.status_code == status.HTTP_200_OK
+        assert mock_get_email_pages.call_args[1] == {'search_after': request_data['search_after']}
+        assert [
+            list(called_kwargs['recipients']) for _, called_kwargs in mock_mailgun_client.send_batch.call_args_list
+        ] == [[recipient_tuple] for recipient_tuple in self.recipient_tuples]
 
     def test_view_response_error(self):
         """
@@ -125,7 +149,7 @@ class SearchResultMailViewsTests(SearchResultMailViewsBase):
             ['b@example.com'], HTTPError()
         ]
         with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
+            'mail.views.iter_query_matching_email_pages', autospec=True, return_value=self.email_pages
         ), patch(
             'mail.views.MailgunClient'
         ) as mock_mailgun_client, patch(
@@ -136,7 +160,7 @@ class SearchResultMailViewsTests(SearchResultMailViewsBase):
                 self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
 
         assert send_batch_exception.exception.exception_pairs == exception_pairs
-        mock_get_mail_vars.assert_called_once_with(self.email_results)
+        mock_get_mail_vars.assert_called_once_with(sorted(self.email_results))
 
     def test_view_response_improperly_configured(self):
         """
@@ -144,7 +168,7 @@ class SearchResultMailViewsTests(SearchResultMailViewsBase):
         results in returning 500 since micromasters.utils.custom_exception_handler catches ImproperlyConfigured
         """
         with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
+            'mail.views.iter_query_matching_email_pages', autospec=True, return_value=self.email_pages
         ), patch(
             'mail.views.MailgunClient'
         ) as mock_mailgun_client, patch(
@@ -153,7 +177,7 @@ class SearchResultMailViewsTests(SearchResultMailViewsBase):
             mock_mailgun_client.send_batch.side_effect = ImproperlyConfigured
             resp = self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
         assert resp.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
-        mock_get_mail_vars.assert_called_once_with(self.email_results)
+        mock_get_mail_vars.assert_called_once_with(sorted(self.email_results))
 
     def test_no_program_user_response(self):
         """
@@ -190,7 +214,7 @@ class AutomaticEmailTests(SearchResultMailViewsBase):
         If send_automatic_emails is set to true, we should save the information in the AutomaticEmail model
         """
         with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
+            'mail.views.iter_query_matching_email_pages', autospec=True, return_value=self.email_pages
         ) as mock_get_emails, patch(
             'mail.views.MailgunClient', send_batch=Mock(return_value=Response())
         ) as mock_mailgun_client, patch(
@@ -236,7 +260,7 @@ class AutomaticEmailTests(SearchResultMailViewsBase):
         ]
 
         with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
+            'mail.views.iter_query_matching_email_pages', autospec=True, return_value=self.email_pages
         ), patch(
             'mail.views.MailgunClient', send_batch=Mock(side_effect=SendBatchException(exception_pairs))
         ) as mock_mailgun_client, patch(
@@ -272,6 +296,58 @@ class AutomaticEmailTests(SearchResultMailViewsBase):
         ).values_list('user__email', flat=True)) == sorted(success_emails)
 
 
+    def test_automatic_email_resume(self):
+        """
+        A mailing resumed from a search_after cursor should keep sending the automatic email it created
+        """
+        automatic_email = AutomaticEmailFactory.create(staff_user=self.staff)
+        request_data = {
+            **self.request_data, 'search_after': ['0@example.com', 0], 'automatic_email_id': automatic_email.id,
+        }
+        with patch(
+            'mail.views.iter_query_matching_email_pages', autospec=True, return_value=self.email_pages
+        ) as mock_get_email_pages, patch(
+            'mail.views.MailgunClient', send_batch=Mock(return_value=Response())
+        ), patch(
+            'mail.views.add_automatic_email', autospec=True,
+        ) as mock_add_automatic_email, patch(
+            'mail.views.get_mail_vars', autospec=True, return_value=self.email_vars,
+        ):
+            resp_post = self.client.post(self.search_result_mail_url, data=request_data, format='json')
+        assert resp_post.status_code == status.HTTP_200_OK
+        assert mock_get_email_pages.call_args[1] == {'search_after': request_data['search_after']}
+        assert mock_add_automatic_email.called is False
+        assert SentAutomaticEmail.objects.filter(
+            user__email__in=self.email_results,
+            automatic_email=automatic_email,
+            status=SentAutomaticEmail.SENT,
+        ).count() == len(self.email_results)
+
+    def test_automatic_email_resume_invalid(self):
+        """
+        A mailing can't be resumed from a search_after cursor without the automatic email of the staff user
+        """
+        request_data = {**self.request_data, 'search_after': ['0@example.com', 0]}
+        other_automatic_email = AutomaticEmailFactory.create()
+        for automatic_email_data, expected_status in [
+                ({}, status.HTTP_400_BAD_REQUEST),
+                ({'automatic_email_id': other_automatic_email.id}, status.HTTP_404_NOT_FOUND),
+        ]:
+            with patch(
+                'mail.views.iter_query_matching_email_pages', autospec=True, return_value=self.email_pages
+            ), patch(
+                'mail.views.MailgunClient'
+            ) as mock_mailgun_client, patch(
+                'mail.views.add_automatic_email', autospec=True,
+            ) as mock_add_automatic_email:
+                resp_post = self.client.post(
+                    self.search_result_mail_url, data={**request_data, **automatic_email_data}, format='json'
+                )
+            assert resp_post.status_code == expected_status
+            assert mock_mailgun_client.send_batch.called is False
+            assert mock_add_automatic_email.called is False
+
+
 class AutomaticEmailViewTests(APITestCase, MockedESTestCase):
     """
     AutomaticEmailViewTests
@@ -538,9 +538,9 @@ CELERY_TASK_ALWAYS_EAGER = get_bool("CELERY_TASK_ALWAYS_EAGER", False) or get_bo
 CELERY_TASK_EAGER_PROPAGATES = (get_bool("CELERY_TASK_EAGER_PROPAGATES", True) or
                                 get_bool("CELERY_EAGER_PROPAGATES_EXCEPTIONS", True))
 CELERY_BEAT_SCHEDULE = {
-    'batch-update-user-data-every-friday-every-6-hrs': {
+    'batch-update-user-data-every-minute': {
         'task': 'dashboard.tasks.batch_update_user_data',
-        'schedule': crontab(minute=0, hour='*/6', day_of_week=5)
+        'schedule': crontab(minute='*')
     },
     'authorize_exam_runs-every-1-hrs': {
         'task': 'exams.tasks.authorize_exam_runs',
@@ -566,9 +566,24 @@ REDIS_MAX_CONNECTIONS = get_int(
 )
 DJANGO_REDIS_CLOSE_CONNECTION = True
 
-# Celery parallel rate limit for batch_update_user_data
-# This is the number of tasks per minute, each task updates data for 20 users
-BATCH_UPDATE_RATE_LIMIT = get_string('BATCH_UPDATE_RATE_LIMIT', '5/m')
+# Number of users whose edX data is refreshed together by a batch_update_user_data sub task
+BATCH_UPDATE_CHUNK_SIZE = get_int('BATCH_UPDATE_CHUNK_SIZE', 10)
+# Maximum number of batch_update_user_data sub tasks running at the same time,
+# the actual number adapts to the latency of edX and to its 429 responses
+BATCH_UPDATE_MAX_CONCURRENCY = get_int('BATCH_UPDATE_MAX_CONCURRENCY', 10)
+# Time in seconds above which refreshing the edX data of a user is considered slow
+# and fewer batch_update_user_data sub tasks are run at the same time
+BATCH_UPDATE_TARGET_LATENCY_SECONDS = get_int('BATCH_UPDATE_TARGET_LATENCY_SECONDS', 10)
+
+# Number of users whose MMTracks are loaded together by bulk jobs
+MMTRACK_BULK_CHUNK_SIZE = get_int('MMTRACK_BULK_CHUNK_SIZE', 500)
+
+# Time in milliseconds the dashboard waits for the edX caches of the user to be refreshed
+DASHBOARD_EDX_REFRESH_BUDGET_MS = get_int('DASHBOARD_EDX_REFRESH_BUDGET_MS', 5000)
+# Serve the cached dashboard right away and refresh the expired edX caches of the user in background
+DASHBOARD_STALE_WHILE_REVALIDATE = get_bool('DASHBOARD_STALE_WHILE_REVALIDATE', False)
+# Time in seconds given to a background refresh of the edX caches of a user
+DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS = get_int('DASHBOARD_BACKGROUND_REFRESH_TIMEOUT_SECONDS', 120)
 
 
 # django cache back-ends
@@ -591,7 +606,9 @@ CACHES = {
 
 # Opensearch
 
+OPENSEARCH_ALIAS_CACHE_SECONDS = get_int("OPENSEARCH_ALIAS_CACHE_SECONDS", 10)
 OPENSEARCH_DEFAULT_PAGE_SIZE = get_int('OPENSEARCH_DEFAULT_PAGE_SIZE', 50)
+OPENSEARCH_EXPORT_PAGE_SIZE = get_int('OPENSEARCH_EXPORT_PAGE_SIZE', 1000)
 OPENSEARCH_URL = get_string("OPENSEARCH_URL", None)
 if get_string("HEROKU_PARENT_APP_NAME", None) is not None:
     OPENSEARCH_INDEX = get_string('HEROKU_APP_NAME', None)
@@ -601,6 +618,13 @@ if not OPENSEARCH_INDEX:
     raise ImproperlyConfigured("Missing OPENSEARCH_INDEX")
 OPENSEARCH_HTTP_AUTH = get_string("OPENSEARCH_HTTP_AUTH", None)
 OPENSEARCH_INDEXING_CHUNK_SIZE = get_int("OPENSEARCH_INDEXING_CHUNK_SIZE", 100)
+OPENSEARCH_INDEXING_MAX_CHUNK_BYTES = get_int("OPENSEARCH_INDEXING_MAX_CHUNK_BYTES", 10 * 1024 * 1024)
+OPENSEARCH_INDEX_QUEUE_BATCH_SIZE = get_int("OPENSEARCH_INDEX_QUEUE_BATCH_SIZE", 500)
+OPENSEARCH_INDEX_QUEUE_FLUSH_SECONDS = get_int("OPENSEARCH_INDEX_QUEUE_FLUSH_SECONDS", 5)
+OPENSEARCH_INDEX_QUEUE_MAX_FAILURES = get_int("OPENSEARCH_INDEX_QUEUE_MAX_FAILURES", 5)
+OPENSEARCH_LOG_DOCUMENT_DIFFS = get_bool("OPENSEARCH_LOG_DOCUMENT_DIFFS", False)
+OPENSEARCH_REINDEX_CHUNK_MAX_ATTEMPTS = get_int("OPENSEARCH_REINDEX_CHUNK_MAX_ATTEMPTS", 3)
+OPENSEARCH_SEARCH_SCOPE_CACHE_SECONDS = get_int("OPENSEARCH_SEARCH_SCOPE_CACHE_SECONDS", 600)
 OPENSEARCH_SHARD_COUNT = get_int('OPENSEARCH_SHARD_COUNT', 5)
 
 # django-role-permissions
@@ -7,6 +7,7 @@ import json
 import logging
 import os
 from itertools import islice
+from time import time_ns
 
 import pytz
 import sentry_sdk as client
@@ -309,3 +310,39 @@ def _merge_strings(list_or_str, list_to_return):
             _merge_strings(item, list_to_return)
     elif list_or_str is not None:
         list_to_return.append(list_or_str)
+
+
+def get_redis_counters(con, keys):
+    """
+    Returns the values of counters kept in Redis. A missing counter, never incremented or lost along with
+    the data of Redis, starts from the current time in microseconds, so that it never goes back to
+    a value it already had and the data stored for one of its former values is not considered current again.
+
+    Args:
+        con (redis.Redis): a redis connection
+        keys (list of str): the keys of the counters
+
+    Returns:
+        list of int: the value of each counter
+    """
+    start = time_ns() // 1000
+    with con.pipeline() as pipe:
+        for key in keys:
+            pipe.set(key, start, nx=True)
+        pipe.mget(keys)
+        *_, values = pipe.execute()
+    return [int(value) for value in values]
+
+
+def incr_redis_counter(con, key):
+    """
+    Increments a counter kept in Redis, starting it the same way get_redis_counters does if it is missing
+
+    Args:
+        con (redis.Redis): a redis connection
+        key (str): the key of the counter
+    """
+    with con.pipeline() as pipe:
+        pipe.set(key, time_ns() // 1000, nx=True)
+        pipe.incr(key)
+        pipe.execute()
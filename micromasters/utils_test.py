@@ -6,6 +6,7 @@ from math import ceil
 import os
 import pathlib
 import unittest
+import uuid
 from unittest.mock import patch
 
 import ddt
@@ -16,6 +17,7 @@ from django.test import (
 )
 import pytz
 import pytest
+from django_redis import get_redis_connection
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
 
@@ -28,6 +30,8 @@ from micromasters.utils import (
     dict_with_keys,
     first_matching_item,
     generate_hash_32,
+    get_redis_counters,
+    incr_redis_counter,
     is_near_now,
     is_subset_dict,
     now_in_utc,
@@ -315,3 +319,22 @@ def test_merge_strings(list_or_string, output):
     merge_strings should flatten a nested list of strings
     """
     assert merge_strings(list_or_string) == output
+
+
+def test_redis_counters():
+    """
+    A counter kept in Redis should never go back to a value it already had, even if Redis loses it
+    """
+    con = get_redis_connection("redis")
+    keys = [f"test_counter_{uuid.uuid4().hex}" for _ in range(2)]
+    try:
+        first, other = get_redis_counters(con, keys)
+        assert get_redis_counters(con, keys) == [first, other]
+        incr_redis_counter(con, keys[0])
+        assert get_redis_counters(con, keys) == [first + 1, other]
+
+        con.delete(keys[0])
+        incr_redis_counter(con, keys[0])
+        assert get_redis_counters(con, keys)[0] > first + 1
+    finally:
+        con.delete(*keys)
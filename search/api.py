@@ -3,6 +3,7 @@ Functions for executing ES searches
 """
 import json
 import logging
+from collections import defaultdict
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -16,18 +17,27 @@ from opensearchpy.exceptions import NotFoundError
 
 from courses.models import Program
 from dashboard.models import ProgramEnrollment
+from dashboard.utils import prefetch_mmtracks
+from micromasters.utils import chunks
 from profiles.models import Profile
-from roles.api import get_advance_searchable_program_ids
 from search.connection import (PERCOLATE_INDEX_TYPE,
                                PRIVATE_ENROLLMENT_INDEX_TYPE,
                                PUBLIC_ENROLLMENT_INDEX_TYPE, get_conn,
                                get_default_alias)
 from search.exceptions import NoProgramAccessException, PercolateException
-from search.indexing_api import serialize_program_enrolled_user
-from search.models import PercolateQuery, PercolateQueryMembership
+from search.indexing_api import (get_document_hash_alias, hash_document,
+                                 serialize_program_enrolled_user)
+from search.models import (IndexedDocumentHash, PercolateQuery,
+                           PercolateQueryMembership)
+from search.percolator import (compile_percolate_queries,
+                               match_percolate_queries)
+from search.scope import get_search_scope
+from search.util import fix_nested_filter
 
 User = get_user_model()
 DEFAULT_ES_LOOP_PAGE_SIZE = 100
+# number of PercolateQueryMemberships inserted or updated by a single statement
+MEMBERSHIP_CHUNK_SIZE = 1000
 
 
 log = logging.getLogger(__name__)
@@ -95,7 +105,7 @@ def get_searchable_programs(user, staff_program_ids):
     ).distinct())
 
 
-def create_program_limit_query(user, staff_program_ids, filter_on_email_optin=False):
+def create_program_limit_query(user, staff_program_ids, filter_on_email_optin=False, program_ids=None):
     """
     Constructs and returns a query that limits a user to data for their allowed programs
 
@@ -103,16 +113,18 @@ def create_program_limit_query(user, staff_program_ids, filter_on_email_optin=Fa
         user (django.contrib.auth.models.User): A user
         staff_program_ids (list of int): the list of program ids the user is staff for if any
         filter_on_email_optin (bool): If true, filter out profiles where email_optin != true
+        program_ids (list of int): the ids of the programs the user can search, if already known
 
     Returns:
         opensearch_dsl.query.Q: An opensearch query
     """
-    users_allowed_programs = get_searchable_programs(user, staff_program_ids)
+    if program_ids is None:
+        program_ids = sorted(program.id for program in get_searchable_programs(user, staff_program_ids))
     # if the user cannot search any program, raise an exception.
     # in theory this should never happen because `UserCanAdvanceSearchPermission`
     # takes care of doing the same check, but better to keep it to avoid
     # that a theoretical bug exposes all the data in the index
-    if not users_allowed_programs:
+    if not program_ids:
         raise NoProgramAccessException()
 
     must = [
@@ -127,7 +139,7 @@ def create_program_limit_query(user, staff_program_ids, filter_on_email_optin=Fa
     return Q(
         'bool',
         should=[
-            Q('term', **{'program.id': program.id}) for program in users_allowed_programs
+            Q('term', **{'program.id': program_id}) for program_id in program_ids
         ],
         # require that at least one program id matches the user's allowed programs
         minimum_should_match=1,
@@ -148,11 +160,9 @@ def create_search_obj(user, search_param_dict=None, filter_on_email_optin=False)
     Returns:
         Search: opensearch_dsl Search object
     """
-    staff_program_ids = get_advance_searchable_program_ids(user)
-    is_advance_search_capable = bool(staff_program_ids)
-    index_type = PRIVATE_ENROLLMENT_INDEX_TYPE if is_advance_search_capable else PUBLIC_ENROLLMENT_INDEX_TYPE
-    index = get_default_alias(index_type)
-    search_obj = Search(index=index)
+    scope = get_search_scope(user)
+    is_advance_search_capable = bool(scope.staff_program_ids)
+    search_obj = Search(index=scope.alias)
     # Update from search params first so our server-side filtering will overwrite it if necessary
     if search_param_dict is not None:
         search_obj.update_from_dict(search_param_dict)
@@ -166,8 +176,9 @@ def create_search_obj(user, search_param_dict=None, filter_on_email_optin=False)
     # Limit results to one of the programs the user is staff on
     search_obj = search_obj.filter(create_program_limit_query(
         user,
-        staff_program_ids,
-        filter_on_email_optin=filter_on_email_optin
+        scope.staff_program_ids,
+        filter_on_email_optin=filter_on_email_optin,
+        program_ids=scope.program_ids,
     ))
     # Filter so that only filled_out profiles are seen
     search_obj = search_obj.filter(
@@ -204,6 +215,57 @@ def prepare_and_execute_search(user, search_param_dict=None, search_func=execute
     return search_func(search_obj)
 
 
+def iter_search_field_pages(search_obj, field_name, search_after=None, page_size=DEFAULT_ES_LOOP_PAGE_SIZE):
+    """
+    Pages through the unique values of a field for documents that match an ES query, in the order of the values.
+
+    Only the doc values of the field are fetched, and each page is requested with search_after, so memory
+    use is bounded by the page size however many documents match. The cursor yielded with a page can be passed
+    back as search_after to resume right after it.
+
+    Args:
+        search_obj (Search): Search object
+        field_name (str): The name of the field for the value to get
+        search_after (list): A cursor yielded by a previous call, to resume after it
+        page_size (int): Number of documents per request
+
+    Yields:
+        tuple of (list, list): The unique values of a page and the cursor of its last document
+    """
+    if search_obj._index is None:  # pylint: disable=protected-access
+        raise ImproperlyConfigured("search object is missing an index")
+
+    # only the query is kept, and documents without the field are left out since they can't be sorted on
+    search_obj = adjust_search_for_percolator(search_obj).filter('exists', field=field_name)
+    body = {
+        **search_obj.to_dict(),
+        '_source': False,
+        'docvalue_fields': [field_name],
+        'size': page_size,
+        # documents of the same user share the value, so the id is needed to make the order total
+        'sort': [{field_name: 'asc'}, {'id': 'asc'}],
+    }
+    conn = get_conn()
+    # the documents of a value can span several pages, so the last value of the cursor is kept to skip duplicates
+    last_value = search_after[0] if search_after else None
+    while True:
+        if search_after:
+            body['search_after'] = search_after
+        hits = conn.search(index=search_obj._index, body=body)['hits']['hits']  # pylint: disable=protected-access
+        if not hits:
+            return
+        values = []
+        for hit in hits:
+            value = hit['fields'][field_name][0]
+            if value != last_value:
+                values.append(value)
+                last_value = value
+        search_after = hits[-1]['sort']
+        yield values, search_after
+        if len(hits) < page_size:
+            return
+
+
 def search_for_field(search_obj, field_name):
     """
     Retrieves all unique instances of a field for documents that match an ES query
@@ -216,14 +278,8 @@ def search_for_field(search_obj, field_name):
         set: Set of unique values
     """
     results = set()
-    # Maintaining a consistent sort on '_doc' will help prevent bugs where the
-    # index is altered during the loop.
-    # This also limits the query to only return the field value.
-    search_obj = search_obj.sort('_doc').source(includes=[field_name])
-    search_results = scan_search(search_obj)
-    # add the field value for every search result hit to the set
-    for hit in search_results:
-        results.add(getattr(hit, field_name))
+    for values, _ in iter_search_field_pages(search_obj, field_name, page_size=settings.OPENSEARCH_EXPORT_PAGE_SIZE):
+        results.update(values)
     return results
 
 
@@ -241,6 +297,22 @@ def get_all_query_matching_emails(search_obj):
     return search_for_field(search_obj, "email")
 
 
+def iter_query_matching_email_pages(search_obj, search_after=None):
+    """
+    Pages through the unique emails for documents that match an ES query
+
+    Args:
+        search_obj (Search): Search object
+        search_after (list): A cursor yielded by a previous call, to resume after it
+
+    Yields:
+        tuple of (list, list): The emails of a page and the cursor of its last document
+    """
+    yield from iter_search_field_pages(
+        search_obj, "email", search_after=search_after, page_size=settings.OPENSEARCH_EXPORT_PAGE_SIZE
+    )
+
+
 def search_percolate_queries(program_enrollment_id, source_type):
     """
     Find all PercolateQuery objects whose queries match a user document
@@ -293,6 +365,95 @@ def _search_percolate_queries(program_enrollment):
     return [int(row['_id']) for row in result['hits']['hits']]
 
 
+def _match_percolate_queries(program_enrollment, percolate_queries):
+    """
+    Find the PercolateQuerys whose queries match a user document, evaluating the queries in process
+    and percolating the document only if some of them are not supported
+
+    Args:
+        program_enrollment (ProgramEnrollment): A ProgramEnrollment
+        percolate_queries (list of PercolateQuery): The PercolateQuerys to check
+
+    Returns:
+        set of int: The ids of the matching PercolateQuerys
+    """
+    doc = serialize_program_enrolled_user(program_enrollment)
+    if not doc:
+        return set()
+    query_ids, unsupported_queries = match_percolate_queries(doc, percolate_queries)
+    if unsupported_queries:
+        query_ids.update(
+            set(_search_percolate_queries(program_enrollment)).intersection(query.id for query in unsupported_queries)
+        )
+    return query_ids
+
+
+def search_percolate_queries_in_bulk(documents_by_enrollment_id, source_type, chunk_size=DEFAULT_ES_LOOP_PAGE_SIZE):
+    """
+    Find the PercolateQuery ids whose queries match some user documents. The supported queries are
+    evaluated in process, and each chunk of documents is percolated against the other ones with a single request
+
+    Args:
+        documents_by_enrollment_id (dict):
+            ProgramEnrollment id -> the private document of the enrollment, as serialized by
+            serialize_program_enrolled_user
+        source_type (str): The type of the percolate query to filter on
+        chunk_size (int): The number of documents percolated by a request
+
+    Returns:
+        dict: ProgramEnrollment id -> set of ids of the matching PercolateQuery objects,
+            for the enrollments which match at least one
+    """
+    percolate_queries = list(PercolateQuery.objects.filter(source_type=source_type).exclude(is_deleted=True))
+    if not percolate_queries or not documents_by_enrollment_id:
+        return {}
+
+    predicates, unsupported_queries = compile_percolate_queries(percolate_queries)
+    matches = defaultdict(set)
+    for enrollment_id, document in documents_by_enrollment_id.items():
+        for query_id, predicate in predicates.items():
+            if predicate(document):
+                matches[enrollment_id].add(query_id)
+    if not unsupported_queries:
+        return dict(matches)
+
+    # only the queries which can't be evaluated in process are percolated
+    query_ids = [query.id for query in unsupported_queries]
+    conn = get_conn()
+    percolate_index = get_default_alias(PERCOLATE_INDEX_TYPE)
+    for chunk in chunks(documents_by_enrollment_id.items(), chunk_size=chunk_size):
+        enrollment_ids = [enrollment_id for enrollment_id, _ in chunk]
+        body = {
+            "_source": False,
+            "size": len(query_ids),
+            "query": {
+                "bool": {
+                    "must": {
+                        "percolate": {
+                            "field": "query",
+                            # _id causes a dynamic mapping failure
+                            "documents": [
+                                {key: value for key, value in document.items() if key != '_id'}
+                                for _, document in chunk
+                            ],
+                        }
+                    },
+                    "filter": {"ids": {"values": query_ids}},
+                }
+            },
+        }
+        result = conn.search(index=percolate_index, body=body)
+        failures = result.get('_shards', {}).get('failures', [])
+        if len(failures) > 0:
+            raise PercolateException(f"Failed to percolate: {failures}")
+
+        for row in result['hits']['hits']:
+            # the positions of the matching documents in the request
+            for slot in row.get('fields', {}).get('_percolator_document_slot', [0]):
+                matches[enrollment_ids[slot]].add(int(row['_id']))
+    return dict(matches)
+
+
 def adjust_search_for_percolator(search):
     """
     Returns an updated Search which can be used with percolator.
@@ -354,6 +515,40 @@ def document_needs_updating(enrollment):
     return False
 
 
+def get_enrollments_needing_update(enrollments, chunk_size=DEFAULT_ES_LOOP_PAGE_SIZE):
+    """
+    Serializes program enrollments and compares the hashes of their documents with the ones stored
+    when they were last indexed, without reading the documents from Opensearch. If
+    settings.OPENSEARCH_LOG_DOCUMENT_DIFFS is set, the differences are read from Opensearch and logged.
+
+    Args:
+        enrollments (list of ProgramEnrollment): Program enrollments
+        chunk_size (int): The number of enrollments whose mmtracks are loaded together
+
+    Returns:
+        list of ProgramEnrollment: The enrollments which need to be updated via reindex
+    """
+    stored_hashes = dict(
+        IndexedDocumentHash.objects.filter(
+            alias=get_document_hash_alias(),
+            program_enrollment__in=[enrollment.id for enrollment in enrollments],
+        ).values_list('program_enrollment_id', 'content_hash')
+    )
+    needs_update = []
+    for chunk in chunks(enrollments, chunk_size=chunk_size):
+        prefetch_mmtracks(chunk)
+        for enrollment in chunk:
+            document = serialize_program_enrolled_user(enrollment)
+            if document is None:
+                # it would not be indexed anyway
+                continue
+            if hash_document(document) != stored_hashes.get(enrollment.id):
+                if settings.OPENSEARCH_LOG_DOCUMENT_DIFFS:
+                    document_needs_updating(enrollment)
+                needs_update.append(enrollment)
+    return needs_update
+
+
 def update_percolate_memberships(user, source_type):
     """
     Updates membership in a PercolateQuery
@@ -371,7 +566,7 @@ def update_percolate_memberships(user, source_type):
 
     # if there are no percolate queries or memberships then there's nothing to do
     if membership_ids:
-        _update_memberships([query.id for query in percolate_queries], membership_ids, user)
+        _update_memberships(percolate_queries, membership_ids, user)
 
 
 def _ensure_memberships_for_queries(percolate_queries, user):
@@ -390,46 +585,74 @@ def _ensure_memberships_for_queries(percolate_queries, user):
     return membership_ids
 
 
-def _update_memberships(percolate_query_ids, membership_ids, user, force_save=False):
+def _update_memberships(percolate_queries, membership_ids, user):
     """
     Atomically determine and update memberships
 
     Args:
-        percolate_query_ids (set of int): a set of PercolateQuery.id
+        percolate_queries (list of PercolateQuery): the PercolateQuerys to check
         membership_ids (list of int): A list of ids for PercolateQueryMemberships to update
         user (User): A User to check for membership changes
-        force_save (bool): True if membership saves should be force even if no change
     """
 
     with transaction.atomic():
         memberships = PercolateQueryMembership.objects.filter(id__in=membership_ids).select_for_update()
 
-        # limit the query_ids to the queries we are trying to update
         query_ids = set()
         for enrollment in user.programenrollment_set.all():
-            query_ids.update(set(_search_percolate_queries(enrollment)))
-        query_ids.intersection_update(percolate_query_ids)
+            query_ids.update(_match_percolate_queries(enrollment, percolate_queries))
 
         for membership in memberships:
             # only update if there's a delta in membership status
             is_member = membership.query_id in query_ids
-            if force_save or (membership.is_member is not is_member):
+            if membership.is_member is not is_member:
                 membership.is_member = is_member
                 membership.needs_update = True
                 membership.save()
 
 
+def _search_query_member_ids(percolate_query):
+    """
+    Runs the query of a PercolateQuery as a regular search against the private enrollment index,
+    which matches the same documents as percolating each of them
+
+    Args:
+        percolate_query (PercolateQuery): A PercolateQuery
+
+    Returns:
+        set of int: The ids of the users with an enrollment matching the query
+    """
+    search_obj = Search(index=get_default_alias(PRIVATE_ENROLLMENT_INDEX_TYPE))
+    search_obj.update_from_dict(fix_nested_filter(percolate_query.query, None))
+    return search_for_field(search_obj, 'user_id')
+
+
 def populate_query_memberships(percolate_query_id):
     """
-    Populates PercolateQueryMemberships for the given query and enrollments
+    Populates PercolateQueryMemberships for the given query and all active users.
+    Every membership is marked as needing an update, whether or not its status changed.
 
     Args:
         percolate_query_id (int): Database id for the PercolateQuery to populate
     """
-    # practically this is a list of 1 query, but _ensure_memberships_for_queries requires a list
     query = PercolateQuery.objects.get(id=percolate_query_id)
-    users = User.objects.filter(is_active=True).iterator()
+    member_ids = _search_query_member_ids(query)
 
-    for user in users:
-        membership_ids = _ensure_memberships_for_queries([query], user)
-        _update_memberships({query.id}, membership_ids, user, force_save=True)
+    with transaction.atomic():
+        memberships = PercolateQueryMembership.objects.filter(query=query, user__is_active=True)
+        memberships.update(is_member=False, needs_update=True)
+        for user_ids in chunks(sorted(member_ids), chunk_size=MEMBERSHIP_CHUNK_SIZE):
+            memberships.filter(user_id__in=user_ids).update(is_member=True)
+
+        new_user_ids = User.objects.filter(is_active=True).exclude(
+            percolate_memberships__query=query
+        ).values_list('id', flat=True)
+        for user_ids in chunks(new_user_ids.iterator(), chunk_size=MEMBERSHIP_CHUNK_SIZE):
+            PercolateQueryMembership.objects.bulk_create([
+                PercolateQueryMembership(
+                    query=query,
+                    user_id=user_id,
+                    is_member=user_id in member_ids,
+                    needs_update=True,
+                ) for user_id in user_ids
+            ], ignore_conflicts=True)
@@ -20,16 +20,22 @@ from roles.roles import Staff
 from search.api import (adjust_search_for_percolator, create_search_obj,
                         document_needs_updating, execute_search,
                         get_all_query_matching_emails,
+                        get_enrollments_needing_update,
+                        iter_search_field_pages,
                         populate_query_memberships, prepare_and_execute_search,
                         search_for_field, search_percolate_queries,
+                        search_percolate_queries_in_bulk,
                         update_percolate_memberships)
-from search.base import ESTestCase
+from search.base import ESTestCase, MockedESTestCase
 from search.connection import (PRIVATE_ENROLLMENT_INDEX_TYPE,
                                PUBLIC_ENROLLMENT_INDEX_TYPE, get_default_alias)
 from search.exceptions import NoProgramAccessException, PercolateException
 from search.factories import (PercolateQueryFactory,
                               PercolateQueryMembershipFactory)
-from search.models import PercolateQuery, PercolateQueryMembership
+from search.indexing_api import (get_document_hash_alias, hash_document,
+                                 serialize_program_enrolled_user)
+from search.models import (IndexedDocumentHash, PercolateQuery,
+                           PercolateQueryMembership)
 
 
 # pylint: disable=unused-argument
@@ -214,6 +220,24 @@ class SearchAPITests(ESTestCase):
         results = search_for_field(search, 'user_id')
         assert results == set(user_ids)
 
+    def test_iter_search_field_pages(self):
+        """
+        iter_search_field_pages should page through the values in order and resume after a cursor
+        """
+        search = create_search_obj(self.user)
+        user_ids = sorted(self.program.programenrollment_set.values_list(
+            "user__id", flat=True
+        ).exclude(
+            user__id=self.user.id
+        ))
+        pages = list(iter_search_field_pages(search, 'user_id', page_size=2))
+        assert [value for values, _ in pages for value in values] == user_ids
+        assert all(len(values) <= 2 for values, _ in pages)
+
+        _, cursor = pages[0]
+        resumed = list(iter_search_field_pages(search, 'user_id', search_after=cursor, page_size=2))
+        assert [value for values, _ in resumed for value in values] == user_ids[len(pages[0][0]):]
+
     def test_all_query_matching_emails(self):
         """
         Test that a set of search results will yield an expected set of emails
@@ -251,6 +275,182 @@ class SearchAPITests(ESTestCase):
         assert document_needs_updating(enrollment) is True
 
 
+@ddt.ddt
+class DocumentHashTests(MockedESTestCase):
+    """Tests for the comparison of enrollments with the hashes of their indexed documents"""
+
+    def test_enrollments_needing_update(self):
+        """
+        Only the enrollments whose documents differ from the last indexed ones should need to be updated
+        """
+        unchanged, changed, never_indexed = ProgramEnrollmentFactory.create_batch(3)
+        for enrollment in (unchanged, changed):
+            IndexedDocumentHash.objects.create(
+                program_enrollment=enrollment,
+                alias=get_document_hash_alias(),
+                content_hash=hash_document(serialize_program_enrolled_user(enrollment)),
+            )
+        with mute_signals(post_save):
+            changed.user.profile.first_name = "Changed"
+            changed.user.profile.save()
+
+        with patch('search.api.document_needs_updating', autospec=True) as document_needs_updating_mock:
+            assert get_enrollments_needing_update([unchanged, changed, never_indexed]) == [changed, never_indexed]
+        assert document_needs_updating_mock.called is False
+
+    @ddt.data(True, False)
+    def test_log_document_diffs(self, log_diffs):
+        """
+        The differences with the indexed document should only be read from Opensearch in debug mode
+        """
+        enrollment = ProgramEnrollmentFactory.create()
+        with override_settings(OPENSEARCH_LOG_DOCUMENT_DIFFS=log_diffs), patch(
+            'search.api.document_needs_updating', autospec=True
+        ) as document_needs_updating_mock:
+            assert get_enrollments_needing_update([enrollment]) == [enrollment]
+        assert document_needs_updating_mock.called is log_diffs
+
+
+class BulkPercolateTests(MockedESTestCase):
+    """Tests for the percolation of many documents at once"""
+
+    @patch('search.api.get_default_alias', autospec=True, return_value='percolate_alias')
+    @patch('search.api.get_conn', autospec=True)
+    def test_search_percolate_queries_in_bulk(self, get_conn_mock, get_default_alias_mock):
+        """
+        search_percolate_queries_in_bulk should percolate a chunk of documents with one request
+        and map the matching queries back to the enrollments
+        """
+        with mute_signals(post_save):
+            query1, query2 = PercolateQueryFactory.create_batch(2, source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+            PercolateQueryFactory.create(source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE, is_deleted=True)
+        documents = {enrollment_id: {'_id': enrollment_id, 'id': enrollment_id} for enrollment_id in (5, 6, 7)}
+        get_conn_mock.return_value.search.side_effect = [
+            {'hits': {'hits': [
+                {'_id': str(query1.id), 'fields': {'_percolator_document_slot': [0, 1]}},
+                {'_id': str(query2.id), 'fields': {'_percolator_document_slot': [1]}},
+            ]}},
+            {'hits': {'hits': []}},
+        ]
+
+        assert search_percolate_queries_in_bulk(documents, PercolateQuery.AUTOMATIC_EMAIL_TYPE, chunk_size=2) == {
+            5: {query1.id},
+            6: {query1.id, query2.id},
+        }
+        assert get_conn_mock.return_value.search.call_count == 2
+        first_request = get_conn_mock.return_value.search.call_args_list[0][1]
+        assert first_request['index'] == get_default_alias_mock.return_value
+        assert first_request['body']['size'] == 2
+        bool_query = first_request['body']['query']['bool']
+        assert bool_query['must']['percolate']['documents'] == [{'id': 5}, {'id': 6}]
+        assert sorted(bool_query['filter']['ids']['values']) == sorted([query1.id, query2.id])
+
+    @patch('search.api.get_conn', autospec=True)
+    def test_search_percolate_queries_in_bulk_in_process(self, get_conn_mock):
+        """The queries which can be evaluated in process should not be percolated by Opensearch"""
+        with mute_signals(post_save):
+            query = PercolateQueryFactory.create(
+                source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE, query={'query': {'term': {'program.id': 3}}},
+            )
+        documents = {5: {'program': {'id': 3}}, 6: {'program': {'id': 4}}}
+        assert search_percolate_queries_in_bulk(documents, PercolateQuery.AUTOMATIC_EMAIL_TYPE) == {5: {query.id}}
+        assert get_conn_mock.called is False
+
+    @patch('search.api.get_conn', autospec=True)
+    def test_search_percolate_queries_in_bulk_no_query(self, get_conn_mock):
+        """If there is no query of the source type, nothing should be sent to Opensearch"""
+        assert search_percolate_queries_in_bulk({1: {'id': 1}}, PercolateQuery.AUTOMATIC_EMAIL_TYPE) == {}
+        assert get_conn_mock.called is False
+
+
+@ddt.ddt
+class QueryMembershipTests(MockedESTestCase):
+    """Tests for populating the memberships of a query"""
+
+    @ddt.data(*product([True, False], [True, False]))
+    @ddt.unpack
+    @patch('search.api.get_default_alias', autospec=True, return_value='private_alias')
+    def test_populate_query_memberships(self, query_matches, has_membership, get_default_alias_mock):
+        """
+        populate_query_memberships should run the query once and create or update the memberships of all users
+        """
+        with mute_signals(post_save):
+            query = PercolateQueryFactory.create(
+                source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE,
+                query={'query': {'nested': {'path': 'program', 'filter': {'term': {'program.id': 1}}}}},
+            )
+            profiles = [ProfileFactory.create(filled_out=True) for _ in range(3)]
+        for profile in profiles:
+            ProgramEnrollmentFactory.create(user=profile.user)
+            if has_membership:
+                PercolateQueryMembershipFactory.create(
+                    user=profile.user, query=query, is_member=not query_matches, needs_update=False
+                )
+        user_ids = {profile.user.id for profile in profiles}
+
+        with patch(
+            'search.api.search_for_field', autospec=True, return_value=user_ids if query_matches else set()
+        ) as search_for_field_mock:
+            populate_query_memberships(query.id)
+
+        search_for_field_mock.assert_called_once()
+        search_obj, field_name = search_for_field_mock.call_args[0]
+        assert field_name == 'user_id'
+        get_default_alias_mock.assert_called_once_with(PRIVATE_ENROLLMENT_INDEX_TYPE)
+        assert search_obj._index == ['private_alias']  # pylint: disable=protected-access
+        assert search_obj.to_dict() == {
+            'query': {'nested': {'path': 'program', 'query': {'term': {'program.id': 1}}}}
+        }
+        for profile in profiles:
+            membership = PercolateQueryMembership.objects.get(user=profile.user, query=query)
+            assert membership.is_member is query_matches
+            assert membership.needs_update is True
+
+    @ddt.data(True, False)
+    def test_update_percolate_memberships_in_process(self, query_matches):
+        """
+        The memberships of queries which can be evaluated in process should be updated without percolation
+        """
+        with mute_signals(post_save):
+            profile = ProfileFactory.create(filled_out=True)
+            program_enrollment = ProgramEnrollmentFactory.create(user=profile.user)
+            program_id = program_enrollment.program_id if query_matches else program_enrollment.program_id + 1
+            query = PercolateQueryFactory.create(
+                source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE,
+                query={'query': {'term': {'program.id': program_id}}},
+            )
+
+        with patch('search.api._search_percolate_queries', autospec=True) as search_percolate_queries_mock:
+            update_percolate_memberships(profile.user, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+
+        assert search_percolate_queries_mock.called is False
+        membership = PercolateQueryMembership.objects.get(user=profile.user, query=query)
+        assert membership.is_member is query_matches
+        assert membership.needs_update is query_matches
+
+    @ddt.data(True, False)
+    @patch('search.api.get_default_alias', autospec=True, return_value='private_alias')
+    def test_populate_query_inactive_memberships(self, is_active, get_default_alias_mock):
+        """
+        Memberships should only be created and updated for active users
+        """
+        with mute_signals(post_save):
+            query = PercolateQueryFactory.create(source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+            user, user_with_membership = UserFactory.create_batch(2, is_active=is_active)
+        membership = PercolateQueryMembershipFactory.create(
+            user=user_with_membership, query=query, is_member=False, needs_update=False
+        )
+
+        with patch(
+            'search.api.search_for_field', autospec=True, return_value={user.id, user_with_membership.id}
+        ):
+            populate_query_memberships(query.id)
+
+        assert PercolateQueryMembership.objects.filter(user=user, query=query).count() == (1 if is_active else 0)
+        membership.refresh_from_db()
+        assert membership.is_member is is_active
+        assert membership.needs_update is is_active
+
 # This patch works around on_commit by invoking it immediately, since in TestCase all tests run in transactions
 @ddt.ddt
 @patch('search.signals.transaction.on_commit', side_effect=lambda callback: callback())
@@ -428,59 +628,3 @@ class PercolateTests(ESTestCase):
 
         membership.refresh_from_db()
         assert membership.needs_update is (is_member is not query_matches)
-
-    @ddt.data(*product(
-        [PercolateQuery.AUTOMATIC_EMAIL_TYPE],
-        [True, False],
-        [True, False]
-    ))
-    @ddt.unpack
-    def test_populate_query_memberships(self, source_type, is_member, query_matches, mock_on_commit):
-        """
-        Tests that existing memberships are updated where appropriate
-        """
-        with mute_signals(post_save):
-            query = PercolateQueryFactory.create(source_type=source_type)
-            profiles = [ProfileFactory.create(filled_out=True) for _ in range(3)]
-            program_enrollments = [ProgramEnrollmentFactory.create(user=profile.user) for profile in profiles]
-
-        with patch(
-            'search.api._search_percolate_queries',
-            return_value=[query.id] if query_matches else []
-        ) as search_percolate_queries_mock:
-            populate_query_memberships(query.id)
-
-        assert search_percolate_queries_mock.call_count == len(program_enrollments)
-        for program_enrollment in program_enrollments:
-            search_percolate_queries_mock.assert_any_call(program_enrollment)
-
-        for profile in profiles:
-            membership = PercolateQueryMembership.objects.get(user=profile.user, query=query)
-            assert membership.is_member is query_matches
-            assert membership.needs_update is True
-
-    @ddt.data(
-        [True, False],
-        [True, True],
-        [False, True],
-        [False, False]
-    )
-    @ddt.unpack
-    def test_populate_query_inactive_memberships(self, is_active, has_profile, mock_on_commit):
-        """
-        Tests that memberships are handled correctly for users who are inactive or have no profiles
-        """
-        with mute_signals(post_save):
-            query = PercolateQueryFactory.create(source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE)
-            user = UserFactory.create(is_active=is_active)
-            if has_profile:
-                ProfileFactory.create(user=user, filled_out=True)
-            ProgramEnrollmentFactory.create(user=user)
-
-        with patch('search.api.get_conn') as es_mock:
-            populate_query_memberships(query.id)
-            assert es_mock.return_value.search.call_count == (1 if has_profile and is_active else 0)
-
-        assert PercolateQueryMembership.objects.filter(user=user, query=query).count() == (
-            1 if is_active else 0
-        )
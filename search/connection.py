@@ -1,7 +1,11 @@
 """Manages the Opensearch connection"""
+import threading
+import time
 import uuid
+from collections import Counter
 
 from django.conf import settings
+from django_redis import get_redis_connection
 from opensearch_dsl.connections import connections
 
 from search.exceptions import ReindexException
@@ -10,6 +14,15 @@ _CONN = None
 # When we create the connection, check to make sure all appropriate mappings exist
 _CONN_VERIFIED = False
 
+# index type -> (aliases, monotonic time at which they must be looked up again, alias version), shared by
+# the requests served by this process
+_ALIASES = {}
+_ALIASES_LOCK = threading.Lock()
+# number of alias lookups sent to the cluster, and number of lookups avoided, by this process
+_ALIAS_STATS = Counter()
+# incremented when the aliases are created, swapped or deleted, which discards the aliases cached by every process
+CACHE_KEY_ALIAS_VERSION = "search_alias_version"
+
 PUBLIC_ENROLLMENT_INDEX_TYPE = 'public_enrollment'
 PRIVATE_ENROLLMENT_INDEX_TYPE = 'private_enrollment'
 PERCOLATE_INDEX_TYPE = 'percolate'
@@ -23,22 +36,15 @@ ALL_INDEX_TYPES = [
 ]
 
 
-def get_conn(*, verify=True, verify_indices=None):
+def _connect():
     """
-    Lazily create the connection.
-
-    Args:
-        verify (bool): If true, check the presence of indices and mappings
-        verify_indices (list of str): If set, check the presence of these indices. Else use the defaults.
+    Lazily create the connection, without verifying anything
 
     Returns:
         opensearch.client.Opensearch: An Opensearch client
     """
-    # pylint: disable=global-statement
-    global _CONN
-    global _CONN_VERIFIED
+    global _CONN  # pylint: disable=global-statement
 
-    do_verify = False
     if _CONN is None:
         http_auth = settings.OPENSEARCH_HTTP_AUTH
         use_ssl = bool(http_auth)
@@ -49,19 +55,30 @@ def get_conn(*, verify=True, verify_indices=None):
             # make sure we verify SSL certificates (off by default)
             verify_certs=use_ssl
         )
-        # Verify connection on first connect if verify=True.
-        do_verify = verify
+    return _CONN
 
-    if verify and not _CONN_VERIFIED:
-        # If we have a connection but haven't verified before, do it now.
-        do_verify = True
 
-    if not do_verify:
-        if not verify:
-            # We only skip verification if we're reindexing or
-            # deleting the index. Make sure we verify next time we connect.
-            _CONN_VERIFIED = False
-        return _CONN
+def get_conn(*, verify=True, verify_indices=None):
+    """
+    Lazily create the connection.
+
+    Args:
+        verify (bool): If true, check the presence of indices and mappings
+        verify_indices (list of str): If set, check the presence of these indices. Else use the defaults.
+
+    Returns:
+        opensearch.client.Opensearch: An Opensearch client
+    """
+    global _CONN_VERIFIED  # pylint: disable=global-statement
+
+    conn = _connect()
+    if not verify:
+        # We only skip verification if we're reindexing or
+        # deleting the index. Make sure we verify next time we connect.
+        _CONN_VERIFIED = False
+        return conn
+    if _CONN_VERIFIED:
+        return conn
 
     # Make sure everything exists.
     if verify_indices is None:
@@ -71,11 +88,11 @@ def get_conn(*, verify=True, verify_indices=None):
                 get_aliases(index_type)
             )
     for verify_index in verify_indices:
-        if not _CONN.indices.exists(verify_index):
+        if not conn.indices.exists(verify_index):
             raise ReindexException(f"Unable to find index {verify_index}")
 
     _CONN_VERIFIED = True
-    return _CONN
+    return conn
 
 
 def make_backing_index_name():
@@ -107,6 +124,8 @@ def get_aliases(index_type):
     Return a list of active aliases
 
     There is always one item in the returned list and the first is always the default alias.
+    The aliases are looked up at most once every OPENSEARCH_ALIAS_CACHE_SECONDS by each process,
+    or as soon as any process changed them.
 
     Args:
         index_type (str): The index type
@@ -116,7 +135,15 @@ def get_aliases(index_type):
             A list of aliases.
             The list will always have at least one tuple, and the first is always the default alias
     """
-    conn = get_conn(verify=False)
+    now = time.monotonic()
+    version = _get_alias_version()
+    with _ALIASES_LOCK:
+        cached = _ALIASES.get(index_type)
+        if cached is not None and cached[1] > now and cached[2] == version:
+            _ALIAS_STATS['saved'] += 1
+            return list(cached[0])
+
+    conn = _connect()
 
     default_alias = make_alias_name(index_type, is_reindexing=False)
     reindexing_alias = make_alias_name(index_type, is_reindexing=True)
@@ -124,6 +151,9 @@ def get_aliases(index_type):
     aliases = [default_alias]
     if conn.indices.exists(reindexing_alias):
         aliases.append(reindexing_alias)
+    with _ALIASES_LOCK:
+        _ALIAS_STATS['requests'] += 1
+        _ALIASES[index_type] = (tuple(aliases), now + settings.OPENSEARCH_ALIAS_CACHE_SECONDS, version)
     return aliases
 
 
@@ -137,4 +167,36 @@ def get_default_alias(index_type):
     Returns:
         str: The default alias
     """
-    return get_aliases(index_type)[0]
+    # the default alias always exists, so its name doesn't need to be looked up
+    with _ALIASES_LOCK:
+        _ALIAS_STATS['saved'] += 1
+    return make_alias_name(index_type, is_reindexing=False)
+
+
+def _get_alias_version():
+    """
+    Returns:
+        int: the version of the aliases, which changes every time they are created, swapped or deleted
+    """
+    return int(get_redis_connection("redis").get(CACHE_KEY_ALIAS_VERSION) or 0)
+
+
+def invalidate_aliases():
+    """
+    Makes every process look up the aliases again, after they were created, swapped or deleted
+    """
+    with _ALIASES_LOCK:
+        _ALIASES.clear()
+    get_redis_connection("redis").incr(CACHE_KEY_ALIAS_VERSION)
+
+
+def get_alias_stats():
+    """
+    Returns the number of alias lookups made by this process
+
+    Returns:
+        dict: The number of lookups sent to the cluster ('requests'), and of lookups which
+            were answered without a request ('saved')
+    """
+    with _ALIASES_LOCK:
+        return {'requests': _ALIAS_STATS['requests'], 'saved': _ALIAS_STATS['saved']}
@@ -0,0 +1,83 @@
+"""
+Tests for the Opensearch connection and the aliases registry
+"""
+# pylint: disable=redefined-outer-name
+import pytest
+from django_redis import get_redis_connection
+
+from search import connection
+from search.connection import (ALL_INDEX_TYPES,
+                               PRIVATE_ENROLLMENT_INDEX_TYPE, get_alias_stats,
+                               get_aliases, get_conn, get_default_alias,
+                               invalidate_aliases, make_alias_name)
+
+
+@pytest.fixture
+def conn_mock(mocker):
+    """Mock the Opensearch client"""
+    mocker.patch.object(connection, '_CONN_VERIFIED', False)
+    return mocker.patch('search.connection._connect', autospec=True).return_value
+
+
+@pytest.mark.parametrize('is_reindexing', [True, False])
+def test_get_aliases_cached(conn_mock, is_reindexing):
+    """The aliases should be looked up once"""
+    conn_mock.indices.exists.return_value = is_reindexing
+    stats = get_alias_stats()
+    expected = [make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=False)]
+    if is_reindexing:
+        expected.append(make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=True))
+
+    assert get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE) == expected
+    assert get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE) == expected
+    conn_mock.indices.exists.assert_called_once_with(
+        make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=True)
+    )
+    assert get_alias_stats() == {'requests': stats['requests'] + 1, 'saved': stats['saved'] + 1}
+
+
+def test_get_aliases_expired(conn_mock, settings):
+    """The aliases should be looked up again once they expire"""
+    settings.OPENSEARCH_ALIAS_CACHE_SECONDS = 0
+    get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)
+    get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)
+    assert conn_mock.indices.exists.call_count == 2
+
+
+def test_invalidate_aliases(conn_mock):
+    """The aliases should be looked up again after they are invalidated"""
+    conn_mock.indices.exists.return_value = False
+    assert len(get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)) == 1
+    conn_mock.indices.exists.return_value = True
+    invalidate_aliases()
+    assert len(get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)) == 2
+
+
+def test_aliases_invalidated_by_other_process(conn_mock):
+    """The aliases should be looked up again after another process changed them"""
+    conn_mock.indices.exists.return_value = False
+    assert len(get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)) == 1
+    conn_mock.indices.exists.return_value = True
+    # another process only bumps the version shared in redis
+    get_redis_connection("redis").incr(connection.CACHE_KEY_ALIAS_VERSION)
+    assert len(get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)) == 2
+
+
+def test_get_default_alias(conn_mock):
+    """The default alias should not be looked up"""
+    stats = get_alias_stats()
+    assert get_default_alias(PRIVATE_ENROLLMENT_INDEX_TYPE) == make_alias_name(
+        PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=False
+    )
+    assert conn_mock.indices.exists.called is False
+    assert get_alias_stats()['saved'] == stats['saved'] + 1
+
+
+def test_get_conn_verified_once(conn_mock):
+    """The indices should be verified once, even if the aliases are looked up meanwhile"""
+    conn_mock.indices.exists.side_effect = lambda index: not index.endswith('reindexing')
+    assert get_conn() == conn_mock
+    get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)
+    assert get_conn() == conn_mock
+    # one lookup for the reindexing alias and one check for the default alias of each index type
+    assert conn_mock.indices.exists.call_count == 2 * len(ALL_INDEX_TYPES)
@@ -32,3 +32,9 @@ class IndexTypeException(Exception):
     """
     Exception raised when an unknown index type is encountered
     """
+
+
+class UnsupportedQueryException(Exception):
+    """
+    Exception raised when a query can't be evaluated without Opensearch
+    """
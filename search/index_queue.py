@@ -0,0 +1,151 @@
+"""
+Redis buffer of the users and program enrollments waiting to be reindexed, so that the changes made
+within a few seconds are reindexed by a single task
+"""
+from django_redis import get_redis_connection
+
+# users to reindex only if their serialized documents changed
+CACHE_KEY_INDEX_QUEUE_USERS = "search_index_queue_users"
+# users to reindex unconditionally
+CACHE_KEY_INDEX_QUEUE_FORCED_USERS = "search_index_queue_forced_users"
+CACHE_KEY_INDEX_QUEUE_PROGRAM_ENROLLMENTS = "search_index_queue_program_enrollments"
+# set while a flush of the buffer is scheduled
+CACHE_KEY_INDEX_QUEUE_FLUSH_SCHEDULED = "search_index_queue_flush_scheduled"
+# number of times an id of a buffer failed to be reindexed, by buffer key and id
+CACHE_KEY_INDEX_QUEUE_FAILURES = "search_index_queue_failures_{0}_{1}"
+# the failures of an id are forgotten once it has not failed for this long
+INDEX_QUEUE_FAILURES_EXPIRY_SECONDS = 24 * 60 * 60
+
+
+def add_users(user_ids, check_if_changed=False):
+    """
+    Adds users to the buffer
+
+    Args:
+        user_ids (iterable of int): ids of the users to reindex
+        check_if_changed (bool): if true, the users are only reindexed if their documents changed
+    """
+    user_ids = list(user_ids)
+    if user_ids:
+        key = CACHE_KEY_INDEX_QUEUE_USERS if check_if_changed else CACHE_KEY_INDEX_QUEUE_FORCED_USERS
+        get_redis_connection("redis").sadd(key, *user_ids)
+
+
+def add_program_enrollments(program_enrollment_ids):
+    """
+    Adds program enrollments to the buffer
+
+    Args:
+        program_enrollment_ids (iterable of int): ids of the program enrollments to reindex
+    """
+    program_enrollment_ids = list(program_enrollment_ids)
+    if program_enrollment_ids:
+        get_redis_connection("redis").sadd(CACHE_KEY_INDEX_QUEUE_PROGRAM_ENROLLMENTS, *program_enrollment_ids)
+
+
+def _add_failed(key, ids, max_failures):
+    """
+    Adds back to a buffer ids which failed to be reindexed, unless they failed too many times already
+
+    Args:
+        key (str): the key of the buffer
+        ids (iterable of int): the ids which failed to be reindexed
+        max_failures (int): the number of failures after which an id is given up
+
+    Returns:
+        list of int: the ids which were given up
+    """
+    ids = list(ids)
+    if not ids:
+        return []
+    conn = get_redis_connection("redis")
+    with conn.pipeline() as pipe:
+        for id_ in ids:
+            failures_key = CACHE_KEY_INDEX_QUEUE_FAILURES.format(key, id_)
+            pipe.incr(failures_key)
+            pipe.expire(failures_key, INDEX_QUEUE_FAILURES_EXPIRY_SECONDS)
+        failures = pipe.execute()[::2]
+    retried_ids = [id_ for id_, count in zip(ids, failures) if count < max_failures]
+    if retried_ids:
+        conn.sadd(key, *retried_ids)
+    return [id_ for id_, count in zip(ids, failures) if count >= max_failures]
+
+
+def add_failed_users(user_ids, max_failures, check_if_changed=False):
+    """
+    Adds back to the buffer users who failed to be reindexed, unless they failed too many times already
+
+    Args:
+        user_ids (iterable of int): ids of the users who failed to be reindexed
+        max_failures (int): the number of failures after which a user is given up
+        check_if_changed (bool): if true, the users are only reindexed if their documents changed
+
+    Returns:
+        list of int: the ids of the users who were given up
+    """
+    key = CACHE_KEY_INDEX_QUEUE_USERS if check_if_changed else CACHE_KEY_INDEX_QUEUE_FORCED_USERS
+    return _add_failed(key, user_ids, max_failures)
+
+
+def add_failed_program_enrollments(program_enrollment_ids, max_failures):
+    """
+    Adds back to the buffer program enrollments which failed to be reindexed, unless they failed
+    too many times already
+
+    Args:
+        program_enrollment_ids (iterable of int): ids of the program enrollments which failed to be reindexed
+        max_failures (int): the number of failures after which a program enrollment is given up
+
+    Returns:
+        list of int: the ids of the program enrollments which were given up
+    """
+    return _add_failed(CACHE_KEY_INDEX_QUEUE_PROGRAM_ENROLLMENTS, program_enrollment_ids, max_failures)
+
+
+def claim_flush(timeout):
+    """
+    Records that a flush of the buffer is scheduled
+
+    Args:
+        timeout (int): number of seconds after which another flush can be scheduled,
+            in case the scheduled one is lost
+
+    Returns:
+        bool: True if no flush was scheduled yet, meaning that the caller must schedule one
+    """
+    return bool(get_redis_connection("redis").set(CACHE_KEY_INDEX_QUEUE_FLUSH_SCHEDULED, 1, nx=True, ex=timeout))
+
+
+def pop_batch(batch_size):
+    """
+    Removes at most batch_size ids of each kind from the buffer. Since the buffer holds sets,
+    an id added several times is returned once.
+
+    Args:
+        batch_size (int): the maximum number of ids of each kind to return
+
+    Returns:
+        tuple: the ids of the users to reindex unconditionally, the ids of the users to reindex
+            if their documents changed, the ids of the program enrollments to reindex and whether
+            the buffer still has ids
+    """
+    conn = get_redis_connection("redis")
+    # a flush scheduled from now on will pick up the ids added after this one
+    conn.delete(CACHE_KEY_INDEX_QUEUE_FLUSH_SCHEDULED)
+    keys = (
+        CACHE_KEY_INDEX_QUEUE_FORCED_USERS,
+        CACHE_KEY_INDEX_QUEUE_USERS,
+        CACHE_KEY_INDEX_QUEUE_PROGRAM_ENROLLMENTS,
+    )
+    with conn.pipeline() as pipe:
+        for key in keys:
+            pipe.spop(key, batch_size)
+        for key in keys:
+            pipe.scard(key)
+        forced_user_ids, user_ids, program_enrollment_ids, *remaining = pipe.execute()
+
+    forced_user_ids = sorted(int(user_id) for user_id in forced_user_ids)
+    # a user reindexed unconditionally doesn't need to be checked too
+    user_ids = sorted({int(user_id) for user_id in user_ids}.difference(forced_user_ids))
+    program_enrollment_ids = sorted(int(enrollment_id) for enrollment_id in program_enrollment_ids)
+    return forced_user_ids, user_ids, program_enrollment_ids, any(remaining)
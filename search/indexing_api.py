@@ -1,26 +1,36 @@
 """
 Functions for ES indexing
 """
+import hashlib
+import json
 import logging
 
 from django.conf import settings
 from opensearchpy.exceptions import NotFoundError
-from opensearchpy.helpers import bulk
+from opensearchpy.helpers import bulk, streaming_bulk
 
 from dashboard.serializers import UserProgramSearchSerializer
+from dashboard.utils import prefetch_mmtracks
 from micromasters.utils import chunks, dict_with_keys
 from profiles.models import Profile
 from profiles.serializers import ProfileSerializer
 from search.connection import (ALL_INDEX_TYPES, PERCOLATE_INDEX_TYPE,
                                PRIVATE_ENROLLMENT_INDEX_TYPE,
                                PUBLIC_ENROLLMENT_INDEX_TYPE, get_aliases,
-                               get_conn, get_default_alias, make_alias_name,
-                               make_backing_index_name)
+                               get_conn, get_default_alias, invalidate_aliases,
+                               make_alias_name, make_backing_index_name)
 from search.exceptions import IndexTypeException, ReindexException
-from search.util import fix_nested_filter, open_json_stream
+from search.models import IndexedDocumentHash
+from search.util import fix_nested_filter
 
 log = logging.getLogger(__name__)
 
+# settings of the backing indices while a reindex fills them
+BULK_LOAD_INDEX_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0,
+}
+
 # Used for cases where we support folding of
 FOLDED_SEARCHABLE_KEYWORD_TYPE = {
     'type': 'keyword',
@@ -234,11 +244,10 @@ def _index_chunk(chunk, *, index):
     if len(errors) > 0:
         raise ReindexException(f"Error during bulk insert: {errors}")
 
-    refresh_index(index)
     return insert_count
 
 
-def _index_chunks(items, *, index, chunk_size=100):
+def _index_chunks(items, *, index, chunk_size=100, refresh=True):
     """
     Add/update records in Opensearch.
 
@@ -248,6 +257,7 @@ def _index_chunks(items, *, index, chunk_size=100):
         index (str): An Opensearch index
         chunk_size (int):
             How many items to index at once.
+        refresh (bool): Whether to refresh the index once the items are indexed
 
     Returns:
         int: Number of indexed items
@@ -258,8 +268,53 @@ def _index_chunks(items, *, index, chunk_size=100):
     for chunk in chunks(items, chunk_size=chunk_size):
         count += _index_chunk(chunk, index=index)
         log.info("Indexed %d items...", count)
-    log.info("Indexing done, refreshing index...")
-    refresh_index(index)
+    if refresh:
+        log.info("Indexing done, refreshing index...")
+        refresh_index(index)
+    log.info("Finished indexing")
+    return count
+
+
+def _stream_index_actions(actions, *, indices, chunk_size=100, max_chunk_bytes=None, refresh=True):
+    """
+    Add/update records in several Opensearch indices with a single stream of bulk requests,
+    refreshing the indices once at the end unless refresh is false.
+
+    Args:
+        actions (iterable of dict):
+            Iterable of serialized items to index, each with the '_index' it should be stored in
+        indices (list of str): The Opensearch indices targeted by the actions
+        chunk_size (int): The maximum number of actions sent in a bulk request
+        max_chunk_bytes (int): The maximum size in bytes of a bulk request
+        refresh (bool): Whether to refresh the indices once the items are indexed
+
+    Returns:
+        int: Number of indexed items
+    """
+    if max_chunk_bytes is None:
+        max_chunk_bytes = settings.OPENSEARCH_INDEXING_MAX_CHUNK_BYTES
+    conn = get_conn(verify_indices=indices)
+    log.info("Indexing into %s, chunk_size=%d, max_chunk_bytes=%d...", indices, chunk_size, max_chunk_bytes)
+    count = 0
+    errors = []
+    for ok, item in streaming_bulk(
+            conn,
+            actions,
+            chunk_size=chunk_size,
+            max_chunk_bytes=max_chunk_bytes,
+            raise_on_error=False,
+    ):
+        if ok:
+            count += 1
+        else:
+            errors.append(item)
+    if len(errors) > 0:
+        raise ReindexException(f"Error during bulk insert: {errors}")
+    log.info("Indexed %d items into %s", count, indices)
+    if refresh:
+        log.info("Refreshing indices...")
+        for index in indices:
+            refresh_index(index)
     log.info("Finished indexing")
     return count
 
@@ -330,38 +385,118 @@ def serialize_public_enrolled_user(serialized_enrolled_user):
     }
 
 
-def _get_public_documents(private_documents):
+def _get_enrollment_actions(private_documents, *, public_indices, private_indices):
     """
-    Generator for private documents to be indexed given a set of program enrollments
+    Generator for the bulk actions storing private documents and their public version in some indices,
+    which serializes the public version of each document once
+
     Args:
         private_documents (iterable of dict):
-            iterable of private documents to generate public documents for
+            iterable of private documents to index
+        public_indices (list of str): The indices to store public enrollment documents
+        private_indices (list of str): The indices to store private enrollment documents
     Yields:
-        for each enrollment:
-            a public (learner-learner search) document
+        for each private document and index:
+            a bulk action storing the public or the private document in the index
     """
     for document in private_documents:
-        yield serialize_public_enrolled_user(document)
+        if public_indices:
+            public_document = serialize_public_enrolled_user(document)
+            for index in public_indices:
+                yield {**public_document, '_index': index}
+        for index in private_indices:
+            yield {**document, '_index': index}
 
 
-def _get_private_documents(program_enrollments):
+def _get_private_documents(program_enrollments, chunk_size=100):
     """
     Generator for private documents to be indexed given a set of program enrollments
     Args:
         program_enrollments(iterable of ProgramEnrollment):
             iterable of enrollments to generate documents for
+        chunk_size (int): The number of enrollments whose mmtracks are loaded together
     Yields:
         for each enrollment:
             a private (staff-only search) document
             a public (learner-learner search) document
     """
-    for program_enrollment in program_enrollments:
-        document = serialize_program_enrolled_user(program_enrollment)
-        if document is None:
-            continue
+    for chunk in chunks(program_enrollments, chunk_size=chunk_size):
+        prefetch_mmtracks(chunk)
+        for program_enrollment in chunk:
+            document = serialize_program_enrolled_user(program_enrollment)
+            if document is None:
+                continue
+            yield document
+
+
+def hash_document(document):
+    """
+    Computes a hash of the content of a private enrollment document
+
+    Args:
+        document (dict): A document serialized by serialize_program_enrolled_user
+
+    Returns:
+        str: The hex digest of the hash
+    """
+    content = {key: value for key, value in document.items() if key != '_id'}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, separators=(',', ':'), default=str).encode()
+    ).hexdigest()
+
+
+def get_document_hash_alias():
+    """
+    Returns the alias the stored document hashes are kept for, which is the default private enrollment alias
+    """
+    return make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
+
+
+def _record_documents(private_documents, *, hashes=None, documents_by_id=None):
+    """
+    Generator which records each private document, or its hash, in a dict as it is yielded
+
+    Args:
+        private_documents (iterable of dict): iterable of private documents to index
+        hashes (dict): if given, program enrollment id -> hash, updated with the documents yielded
+        documents_by_id (dict): if given, program enrollment id -> document, updated with the documents yielded
+    Yields:
+        each of the private documents
+    """
+    for document in private_documents:
+        if hashes is not None:
+            hashes[document['id']] = hash_document(document)
+        if documents_by_id is not None:
+            documents_by_id[document['id']] = document
         yield document
 
 
+def _save_document_hashes(hashes):
+    """
+    Stores the hashes of the documents just indexed behind the default aliases
+
+    Args:
+        hashes (dict): program enrollment id -> hash
+    """
+    alias = get_document_hash_alias()
+    IndexedDocumentHash.objects.bulk_create(
+        [
+            IndexedDocumentHash(program_enrollment_id=program_enrollment_id, alias=alias, content_hash=content_hash)
+            for program_enrollment_id, content_hash in hashes.items()
+        ],
+        update_conflicts=True,
+        unique_fields=['program_enrollment', 'alias'],
+        update_fields=['content_hash'],
+    )
+
+
+def clear_document_hashes():
+    """
+    Forgets the hashes of the indexed documents, for when the documents behind the default aliases are replaced
+    """
+    IndexedDocumentHash.objects.filter(alias=get_document_hash_alias()).delete()
+
+
 def _get_percolate_documents(percolate_queries):
     """
     Generator for percolate query documents
@@ -378,42 +513,53 @@ def _get_percolate_documents(percolate_queries):
 
 def index_program_enrolled_users(
         program_enrollments, *,
-        public_indices=None, private_indices=None, chunk_size=100
+        public_indices=None, private_indices=None, chunk_size=100, max_chunk_bytes=None, refresh=True,
+        documents_by_id=None
 ):
     """
-    Bulk index an iterable of ProgramEnrollments
+    Bulk index an iterable of ProgramEnrollments. Each enrollment is serialized once and streamed
+    to all the public and private indices, which are refreshed once at the end. When indexing
+    behind the default aliases the hashes of the documents are stored, see hash_document.
 
     Args:
         program_enrollments (iterable of ProgramEnrollment): An iterable of program enrollments
         public_indices (list of str): The indices to store public enrollment documents
         private_indices (list of str): The indices to store private enrollment documents
-        chunk_size (int): The number of items per chunk to index
+        chunk_size (int): The number of enrollments serialized together, and of documents per bulk request
+        max_chunk_bytes (int): The maximum size in bytes of a bulk request,
+            settings.OPENSEARCH_INDEXING_MAX_CHUNK_BYTES by default
+        refresh (bool): Whether to refresh the indices once the enrollments are indexed
+        documents_by_id (dict): if given, filled with the private documents indexed, by program enrollment id,
+            so that they can be reused without serializing the enrollments again
     """
     if public_indices is None:
         public_indices = get_aliases(PUBLIC_ENROLLMENT_INDEX_TYPE)
 
+    hashes = None
     if private_indices is None:
         private_indices = get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)
-
-    # Serialize to a temporary file so we don't serialize twice (serializing is expensive)
-    with open_json_stream() as json_stream:
-        json_stream.write_stream(
-            document for document in _get_private_documents(program_enrollments)
-        )
-
-        for index in public_indices:
-            _index_chunks(
-                _get_public_documents(json_stream.read_stream()),
-                index=index,
-                chunk_size=chunk_size,
-            )
-
-        for index in private_indices:
-            _index_chunks(
-                json_stream.read_stream(),
-                index=index,
-                chunk_size=chunk_size,
-            )
+        hashes = {}
+
+    indices = list(public_indices) + list(private_indices)
+    if not indices:
+        return
+
+    private_documents = _get_private_documents(program_enrollments, chunk_size=chunk_size)
+    if hashes is not None or documents_by_id is not None:
+        private_documents = _record_documents(private_documents, hashes=hashes, documents_by_id=documents_by_id)
+    _stream_index_actions(
+        _get_enrollment_actions(
+            private_documents,
+            public_indices=public_indices,
+            private_indices=private_indices,
+        ),
+        indices=indices,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        refresh=refresh,
+    )
+    if hashes:
+        _save_document_hashes(hashes)
 
 
 def remove_program_enrolled_user(program_enrollment_id):
@@ -430,6 +576,7 @@ def remove_program_enrolled_user(program_enrollment_id):
     private_indices = get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)
     for index in private_indices:
         _delete_item(program_enrollment_id, index=index)
+    IndexedDocumentHash.objects.filter(program_enrollment_id=program_enrollment_id).delete()
 
 
 def serialize_program_enrolled_user(program_enrollment):
@@ -509,6 +656,8 @@ def clear_and_create_index(index_name, *, index_type, skip_mapping=False):
     conn = get_conn(verify=False)
     if conn.indices.exists(index_name):
         conn.indices.delete(index_name)
+        # the aliases of the index were deleted with it
+        invalidate_aliases()
     # from https://www.elastic.co/guide/en/elasticsearch/guide/current/asciifolding-token-filter.html
     conn.indices.create(index_name, body={
         'settings': {
@@ -539,11 +688,14 @@ def delete_indices():
     Drop all the indices. Used in testing.
     """
     conn = get_conn(verify=False)
+    invalidate_aliases()
     for index_type in ALL_INDEX_TYPES:
         aliases = get_aliases(index_type)
         for alias in aliases:
             if conn.indices.exists(alias):
                 conn.indices.delete_alias(index=INDEX_WILDCARD, name=alias)
+    invalidate_aliases()
+    clear_document_hashes()
 
 
 def _serialize_percolate_query(query):
@@ -602,6 +754,26 @@ def delete_percolate_query(percolate_query_id):
         _delete_item(percolate_query_id, index=index)
 
 
+def set_bulk_load_settings(backing_indices, *, is_bulk_load):
+    """
+    Disables the refreshes and the replicas of backing indices while they are filled by a reindex,
+    or restores the default settings once they are
+
+    Args:
+        backing_indices (list of tuples):
+            A list of tuples containing the created backing indices for reindexing
+        is_bulk_load (bool): Whether the indices are about to be filled
+    """
+    conn = get_conn(verify=False)
+    if is_bulk_load:
+        index_settings = BULK_LOAD_INDEX_SETTINGS
+    else:
+        # null resets a setting to its default value
+        index_settings = {key: None for key in BULK_LOAD_INDEX_SETTINGS}
+    for backing_index, _ in backing_indices:
+        conn.indices.put_settings(index=backing_index, body={'index': index_settings})
+
+
 def delete_backing_indices(backing_indices):
     """
     Remove the temporary backing indices
@@ -615,6 +787,7 @@ def delete_backing_indices(backing_indices):
     for new_backing_index, index_type in backing_indices:
         temp_alias = make_alias_name(index_type, is_reindexing=True)
         conn.indices.delete_alias(name=temp_alias, index=new_backing_index)
+    invalidate_aliases()
 
 
 def create_backing_indices():
@@ -641,4 +814,5 @@ def create_backing_indices():
         # Point temp_alias toward new backing index
         conn.indices.put_alias(index=backing_index, name=temp_alias)
 
+    invalidate_aliases()
     return backing_index_tuples
@@ -2,7 +2,7 @@
 Tests for search API functions.
 """
 import itertools
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
 from ddt import data, ddt, unpack
 from django.conf import settings
@@ -35,12 +35,13 @@ from search.factories import PercolateQueryFactory
 from search.indexing_api import (clear_and_create_index,
                                  create_backing_indices, delete_indices,
                                  delete_percolate_query, filter_current_work,
-                                 get_conn, index_percolate_queries,
+                                 get_conn, hash_document,
+                                 index_percolate_queries,
                                  index_program_enrolled_users, refresh_index,
                                  remove_program_enrolled_user,
                                  serialize_program_enrolled_user,
                                  serialize_public_enrolled_user)
-from search.models import PercolateQuery
+from search.models import IndexedDocumentHash, PercolateQuery
 from search.util import traverse_mapping
 
 DOC_TYPES_PER_ENROLLMENT = 1
@@ -283,36 +284,50 @@ class IndexTests(ESTestCase):
         public = [serialize_public_enrolled_user(serialized) for serialized in private]
         public_dicts = {serialized['id']: serialized for serialized in public}
 
+        public_index = make_alias_name(PUBLIC_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
+        private_index = make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
+        streamed = []
+
+        def _streaming_bulk(conn, actions, **kwargs):  # pylint: disable=unused-argument
+            """Consume the actions like streaming_bulk does"""
+            for action in actions:
+                streamed.append(action)
+                yield True, {}
+
         with patch(
-            'search.indexing_api._index_chunk', autospec=True, return_value=0
-        ) as index_chunk, patch(
+            'search.indexing_api.streaming_bulk', autospec=True, side_effect=_streaming_bulk
+        ) as streaming_bulk_mock, patch(
+            'search.indexing_api.refresh_index', autospec=True
+        ) as refresh_index_mock, patch(
             'search.indexing_api.serialize_program_enrolled_user', autospec=True,
             side_effect=lambda x: private_dicts[x.id]
         ) as serialize_mock, patch(
             'search.indexing_api.serialize_public_enrolled_user', autospec=True,
             side_effect=lambda x: public_dicts[x['id']]
         ) as serialize_public_mock:
-            index_program_enrolled_users(program_enrollments, chunk_size=chunk_size)
-            assert index_chunk.call_count == 6  # 10 enrollments divided in chunks of 4, times the number of types (2)
-
-            public_index = make_alias_name(PUBLIC_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
-            private_index = make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
-            for offset in range(0, num_enrollments, chunk_size):
-                # each enrollment should get yielded twice to account for each doctype
-                index_chunk.assert_any_call(
-                    public[offset:offset+4],  # ordered dicts FTW
-                    index=public_index
-                )
-                index_chunk.assert_any_call(
-                    private[offset:offset+4],
-                    index=private_index
-                )
-
+            index_program_enrolled_users(program_enrollments, chunk_size=chunk_size, max_chunk_bytes=1000)
+            # a single stream of bulk requests for both indices, which are refreshed once
+            streaming_bulk_mock.assert_called_once_with(
+                ANY, ANY, chunk_size=chunk_size, max_chunk_bytes=1000, raise_on_error=False
+            )
+            assert sorted(call[0][0] for call in refresh_index_mock.call_args_list) == sorted(
+                [public_index, private_index]
+            )
+
+            assert streamed == [
+                action
+                for public_doc, private_doc in zip(public, private)
+                for action in ({**public_doc, '_index': public_index}, {**private_doc, '_index': private_index})
+            ]
             assert serialize_mock.call_count == len(program_enrollments)
             assert serialize_public_mock.call_count == len(program_enrollments)
             for enrollment in program_enrollments:
                 serialize_mock.assert_any_call(enrollment)
                 serialize_public_mock.assert_any_call(private_dicts[enrollment.id])
+        # the hashes of the private documents are stored for the default alias
+        assert dict(
+            IndexedDocumentHash.objects.filter(alias=private_index).values_list('program_enrollment_id', 'content_hash')
+        ) == {enrollment_id: hash_document(document) for enrollment_id, document in private_dicts.items()}
 
     def test_index_program_enrolled_users_missing_profiles(self, mock_on_commit):
         """
@@ -320,9 +335,11 @@ class IndexTests(ESTestCase):
         """
         with mute_signals(post_save):
             program_enrollments = [ProgramEnrollmentFactory.build() for _ in range(10)]
+        streamed = []
         with patch(
-            'search.indexing_api._index_chunk', autospec=True, return_value=0
-        ) as index_chunk, patch(
+            'search.indexing_api.streaming_bulk', autospec=True,
+            side_effect=lambda conn, actions, **kwargs: ((True, streamed.append(action)) for action in actions)
+        ), patch(
             'search.indexing_api.serialize_program_enrolled_user',
             autospec=True,
             side_effect=lambda x: None  # simulate a missing profile
@@ -330,7 +347,7 @@ class IndexTests(ESTestCase):
             'search.indexing_api.serialize_public_enrolled_user', autospec=True, side_effect=lambda x: x
         ) as serialize_public_mock:
             index_program_enrolled_users(program_enrollments)
-            assert index_chunk.call_count == 0
+            assert streamed == []
             assert serialize_public_mock.call_count == 0
             assert serialize_mock.call_count == len(program_enrollments)
 
@@ -5,7 +5,8 @@ Management command to recreate the Opensearch index
 from django.core.management.base import BaseCommand, CommandError
 
 from micromasters.utils import log, now_in_utc
-from search.tasks import start_recreate_index
+from search.models import ReindexRun
+from search.tasks import resume_recreate_index, start_recreate_index
 
 
 class Command(BaseCommand):
@@ -14,11 +15,53 @@ class Command(BaseCommand):
     """
     help = "Starts a new celery task that clears existing Opensearch indices and creates a new index and mapping."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Resume the last unfinished reindex, indexing only the chunks which were not indexed yet",
+        )
+        parser.add_argument(
+            "--status",
+            action="store_true",
+            help="Show the progress of the last reindex",
+        )
+
+    def show_status(self):
+        """
+        Writes the progress of the last reindex
+        """
+        run = ReindexRun.objects.order_by("-created_on").first()
+        if run is None:
+            self.stdout.write("No reindex was started")
+            return
+        progress = run.get_progress()
+        self.stdout.write(f"Reindex run {run.id} started on {run.created_on}: {run.status}")
+        self.stdout.write(
+            f"{progress['completed_chunks']}/{progress['total_chunks']} chunks, "
+            f"{progress['indexed_documents']}/{progress['total_documents']} documents indexed, "
+            f"{progress['failed_chunks']} chunks failed at least once"
+        )
+        if progress['documents_per_second'] is not None:
+            self.stdout.write(f"{progress['documents_per_second']:.1f} documents/second")
+            if run.status == ReindexRun.IN_PROGRESS:
+                self.stdout.write(f"About {progress['eta_seconds']:.0f} seconds left")
+
     def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
         """
         Recreates the index
         """
-        task = start_recreate_index.delay()
+        if kwargs["status"]:
+            self.show_status()
+            return
+
+        if kwargs["resume"]:
+            run = ReindexRun.objects.filter(status=ReindexRun.IN_PROGRESS).order_by("-created_on").first()
+            if run is None:
+                raise CommandError("There is no unfinished reindex to resume")
+            task = resume_recreate_index.delay(run.id)
+        else:
+            task = start_recreate_index.delay()
         self.stdout.write(
             f"Started celery task {task} to index content for all indexes"
         )
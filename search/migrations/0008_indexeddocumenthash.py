@@ -0,0 +1,27 @@
+# Generated by Django 5.2.15 on 2026-10-18 21:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0015_dashboard_document_expires_on'),
+        ('search', '0007_alter_percolatequery_original_query_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexedDocumentHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(max_length=255)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('program_enrollment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='indexed_document_hashes', to='dashboard.programenrollment')),
+            ],
+            options={
+                'unique_together': {('program_enrollment', 'alias')},
+            },
+        ),
+    ]
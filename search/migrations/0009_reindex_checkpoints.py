@@ -0,0 +1,47 @@
+# Generated by Django 5.2.15 on 2026-10-18 22:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0008_indexeddocumenthash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReindexRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('backing_indices', models.JSONField()),
+                ('status', models.CharField(choices=[('in_progress', 'in_progress'), ('complete', 'complete'), ('failed', 'failed')], default='in_progress', max_length=30)),
+                ('finished_on', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ReindexChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('index_type', models.CharField(max_length=30)),
+                ('object_ids', models.JSONField()),
+                ('size', models.IntegerField()),
+                ('is_complete', models.BooleanField(default=False)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('completed_on', models.DateTimeField(blank=True, null=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='search.reindexrun')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
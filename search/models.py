@@ -1,9 +1,10 @@
 """Models related to search"""
 from django.conf import settings
 from django.db import models
-from django.db.models import JSONField
+from django.db.models import Count, JSONField, Q, Sum
 
 from micromasters.models import TimestampedModel
+from micromasters.utils import now_in_utc
 
 
 class PercolateQuery(TimestampedModel):
@@ -41,3 +42,123 @@ class PercolateQueryMembership(TimestampedModel):
 
     class Meta:
         unique_together = (('user', 'query'),)
+
+
+class IndexedDocumentHash(models.Model):
+    """
+    A hash of the document of a ProgramEnrollment last indexed behind an Opensearch alias, used to know
+    whether the enrollment needs to be reindexed without reading its document from Opensearch
+    """
+    program_enrollment = models.ForeignKey(
+        'dashboard.ProgramEnrollment', on_delete=models.CASCADE, related_name="indexed_document_hashes"
+    )
+    alias = models.CharField(max_length=255)
+    content_hash = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f"Indexed document hash: program enrollment: {self.program_enrollment_id}, alias: {self.alias}"
+
+    class Meta:
+        unique_together = (('program_enrollment', 'alias'),)
+
+
+class ReindexRun(TimestampedModel):
+    """
+    A full reindex of the enrollments and percolate queries into new backing indices,
+    split into ReindexChunks which are indexed in parallel
+    """
+    IN_PROGRESS = 'in_progress'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+
+    STATUSES = [
+        IN_PROGRESS,
+        COMPLETE,
+        FAILED,
+    ]
+
+    # list of [backing index, index type] pairs
+    backing_indices = JSONField()
+    status = models.CharField(
+        max_length=30, choices=[(status, status) for status in STATUSES], default=IN_PROGRESS
+    )
+    finished_on = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Reindex run {self.id}: {self.status}"
+
+    def finish(self, status):
+        """
+        Records the end of the reindex
+
+        Args:
+            status (str): COMPLETE or FAILED
+        """
+        self.status = status
+        self.finished_on = now_in_utc()
+        self.save()
+
+    def get_progress(self):
+        """
+        Computes how far the reindex went
+
+        Returns:
+            dict: the numbers of chunks and documents indexed so far and in total, the number of documents
+                indexed per second and the estimated number of seconds left, which are None until a chunk completes
+        """
+        totals = self.chunks.aggregate(
+            total_chunks=Count('id'),
+            completed_chunks=Count('id', filter=Q(is_complete=True)),
+            failed_chunks=Count('id', filter=Q(is_complete=False, attempts__gt=0)),
+            total_documents=Sum('size', default=0),
+            indexed_documents=Sum('size', filter=Q(is_complete=True), default=0),
+        )
+        end = self.finished_on or now_in_utc()
+        elapsed_seconds = (end - self.created_on).total_seconds()
+        throughput = None
+        eta_seconds = None
+        if totals['indexed_documents'] and elapsed_seconds > 0:
+            throughput = totals['indexed_documents'] / elapsed_seconds
+            eta_seconds = (totals['total_documents'] - totals['indexed_documents']) / throughput
+        return {
+            **totals,
+            'elapsed_seconds': elapsed_seconds,
+            'documents_per_second': throughput,
+            'eta_seconds': eta_seconds,
+        }
+
+
+class ReindexChunk(TimestampedModel):
+    """
+    A checkpoint of a ReindexRun: a chunk of enrollments or percolate queries and whether it was indexed
+    """
+    run = models.ForeignKey(ReindexRun, on_delete=models.CASCADE, related_name="chunks")
+    # PRIVATE_ENROLLMENT_INDEX_TYPE for enrollments, which are indexed in the public index too,
+    # or PERCOLATE_INDEX_TYPE
+    index_type = models.CharField(max_length=30)
+    object_ids = JSONField()
+    size = models.IntegerField()
+    is_complete = models.BooleanField(default=False)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    completed_on = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Reindex chunk {self.id} of run {self.run_id}: {self.index_type}, complete: {self.is_complete}"
+
+    @classmethod
+    def record_attempt(cls, chunk_id, *, error=None):
+        """
+        Records that a chunk was indexed, or that indexing it failed
+
+        Args:
+            chunk_id (int): the id of a ReindexChunk, or None if the indexing is not part of a run
+            error (str): the error raised while indexing the chunk, if any
+        """
+        if chunk_id is None:
+            return
+        if error is None:
+            updates = {'is_complete': True, 'error': '', 'completed_on': now_in_utc()}
+        else:
+            updates = {'error': error}
+        cls.objects.filter(id=chunk_id).update(attempts=models.F('attempts') + 1, **updates)
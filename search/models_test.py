@@ -1,8 +1,14 @@
 """Tests for search models"""
+from datetime import timedelta
 from unittest.mock import patch
 
+import pytest
+
+from micromasters.utils import now_in_utc
 from search.base import MockedESTestCase
+from search.connection import PRIVATE_ENROLLMENT_INDEX_TYPE
 from search.factories import PercolateQueryFactory
+from search.models import ReindexChunk, ReindexRun
 
 
 class SearchModelsTests(MockedESTestCase):
@@ -46,3 +52,32 @@ class SearchModelsTests(MockedESTestCase):
             assert self.mocked_delete_percolate_query.call_count == 1
             assert len(self.mocked_delete_percolate_query.call_args[0]) == 1
             assert self.mocked_delete_percolate_query.call_args[0][0] == percolate_query_id
+
+
+class ReindexRunTests(MockedESTestCase):
+    """Tests for the progress of a reindex"""
+
+    def test_get_progress(self):
+        """get_progress should count the indexed chunks and documents and estimate the time left"""
+        run = ReindexRun.objects.create(backing_indices=[])
+        chunks = [
+            ReindexChunk.objects.create(run=run, index_type=PRIVATE_ENROLLMENT_INDEX_TYPE, object_ids=[], size=size)
+            for size in (10, 20, 30)
+        ]
+        progress = run.get_progress()
+        assert progress['completed_chunks'] == 0
+        assert progress['documents_per_second'] is None
+        assert progress['eta_seconds'] is None
+
+        ReindexChunk.record_attempt(chunks[0].id)
+        ReindexChunk.record_attempt(chunks[1].id, error='error')
+        ReindexRun.objects.filter(id=run.id).update(created_on=now_in_utc() - timedelta(seconds=10))
+        run.refresh_from_db()
+        progress = run.get_progress()
+        assert progress['total_chunks'] == 3
+        assert progress['completed_chunks'] == 1
+        assert progress['failed_chunks'] == 1
+        assert progress['total_documents'] == 60
+        assert progress['indexed_documents'] == 10
+        assert progress['documents_per_second'] == pytest.approx(1, rel=0.1)
+        assert progress['eta_seconds'] == pytest.approx(50, rel=0.1)
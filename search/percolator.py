@@ -0,0 +1,370 @@
+"""
+In process evaluation of percolate queries against serialized enrollment documents.
+
+Only the term level queries built by the learner search are supported: term, terms, range, exists,
+match_all, bool and nested queries over the fields of the private enrollment mapping. The other queries
+must be percolated by Opensearch.
+"""
+import operator
+import re
+
+from search.exceptions import UnsupportedQueryException
+from search.indexing_api import PRIVATE_ENROLLMENT_MAPPING
+from search.util import fix_nested_filter
+
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+RANGE_OPERATORS = {
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+BOOL_OCCURRENCE_TYPES = ('must', 'filter', 'should', 'must_not')
+
+
+def _get_field_type(field, nested_path):
+    """
+    Looks up a field in the private enrollment mapping
+
+    Args:
+        field (str): The full path of the field, like program.enrollments.final_grade
+        nested_path (str): The path of the nested query the field is used in, or None
+
+    Returns:
+        str: The mapping type of the field
+    """
+    properties = PRIVATE_ENROLLMENT_MAPPING['properties']
+    mapping = None
+    field_nested_path = None
+    parts = field.split('.')
+    for index, part in enumerate(parts):
+        if properties is None or part not in properties:
+            raise UnsupportedQueryException(f"Unknown field {field}")
+        mapping = properties[part]
+        if mapping.get('type') == 'nested':
+            field_nested_path = '.'.join(parts[:index + 1])
+        properties = mapping.get('properties')
+    if properties is not None:
+        raise UnsupportedQueryException(f"{field} is an object")
+    # a field of a nested object is only visible from a nested query on that object
+    if field_nested_path != nested_path:
+        raise UnsupportedQueryException(f"{field} is used outside of a nested query on {field_nested_path}")
+    return mapping['type']
+
+
+def _normalize_value(value, field_type):
+    """
+    Converts a value the way Opensearch does when indexing or querying a field of the given type
+
+    Args:
+        value (any): A value from a query or a document
+        field_type (str): The mapping type of the field
+
+    Returns:
+        any: The value to compare
+    """
+    if field_type == 'keyword':
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, (int, float, str)):
+            return str(value)
+    elif field_type == 'long':
+        if isinstance(value, bool):
+            pass
+        elif isinstance(value, int):
+            return value
+        elif isinstance(value, float) and value.is_integer():
+            return int(value)
+        elif isinstance(value, str) and re.fullmatch(r'-?\d+', value):
+            return int(value)
+    elif field_type == 'boolean':
+        if isinstance(value, bool):
+            return value
+        if value in ('true', 'false'):
+            return value == 'true'
+    elif field_type == 'date':
+        if isinstance(value, str) and DATE_PATTERN.match(value):
+            return value
+    raise UnsupportedQueryException(f"Unsupported value {value!r} for a {field_type} field")
+
+
+def _normalize_document_value(value, field_type):
+    """
+    Converts a value of a document the way Opensearch does when indexing a field of the given type
+
+    Args:
+        value (any): A value from a document
+        field_type (str): The mapping type of the field
+
+    Returns:
+        any: The value to compare, or None if it can't be compared
+    """
+    if field_type == 'long' and isinstance(value, (int, float, str)) and not isinstance(value, bool):
+        # fractions are truncated when indexing a long field
+        try:
+            return int(float(value))
+        except ValueError:
+            return None
+    try:
+        return _normalize_value(value, field_type)
+    except UnsupportedQueryException:
+        return None
+
+
+def _get_values(obj, field, nested_path):
+    """
+    Returns the values of a field in a document or in a nested object
+
+    Args:
+        obj (dict): The document, or the nested object when evaluating a nested query
+        field (str): The full path of the field
+        nested_path (str): The path of the nested object, or None for the document
+
+    Returns:
+        list: The values of the field, excluding the missing ones
+    """
+    if nested_path is not None:
+        field = field[len(nested_path) + 1:]
+    values = [obj]
+    for part in field.split('.'):
+        next_values = []
+        for value in values:
+            value = value.get(part) if isinstance(value, dict) else None
+            if isinstance(value, list):
+                next_values.extend(value)
+            elif value is not None:
+                next_values.append(value)
+        values = next_values
+    return [value for value in values if value is not None]
+
+
+def _get_field_clause(clause, query_type):
+    """
+    Returns the field and the parameters of a query on a single field
+
+    Args:
+        clause (dict): The body of the query, like {"program.id": 1}
+        query_type (str): The type of the query, for error messages
+
+    Returns:
+        tuple: The field and its parameters
+    """
+    if not isinstance(clause, dict) or len(clause) != 1:
+        raise UnsupportedQueryException(f"Unsupported {query_type} query {clause}")
+    return next(iter(clause.items()))
+
+
+def _compile_term(clause, nested_path):
+    """Compiles a term query"""
+    field, value = _get_field_clause(clause, 'term')
+    if isinstance(value, dict):
+        if set(value) != {'value'}:
+            raise UnsupportedQueryException(f"Unsupported term query {clause}")
+        value = value['value']
+    return _compile_terms({field: [value]}, nested_path)
+
+
+def _compile_terms(clause, nested_path):
+    """Compiles a terms query"""
+    field, values = _get_field_clause(clause, 'terms')
+    if not isinstance(values, list):
+        raise UnsupportedQueryException(f"Unsupported terms query {clause}")
+    field_type = _get_field_type(field, nested_path)
+    expected = {_normalize_value(value, field_type) for value in values}
+
+    def predicate(obj):
+        """Matches if any value of the field is one of the expected values"""
+        return any(
+            _normalize_document_value(value, field_type) in expected
+            for value in _get_values(obj, field, nested_path)
+        )
+    return predicate
+
+
+def _compile_range(clause, nested_path):
+    """Compiles a range query"""
+    field, bounds = _get_field_clause(clause, 'range')
+    if not isinstance(bounds, dict) or not bounds or not set(bounds).issubset(RANGE_OPERATORS):
+        raise UnsupportedQueryException(f"Unsupported range query {clause}")
+    field_type = _get_field_type(field, nested_path)
+    if field_type == 'boolean':
+        raise UnsupportedQueryException(f"Unsupported range query {clause}")
+    if field_type == 'long':
+        # a fractional bound is valid on a long field
+        for bound in bounds.values():
+            if isinstance(bound, bool) or not isinstance(bound, (int, float)):
+                raise UnsupportedQueryException(f"Unsupported range query {clause}")
+        comparisons = [(RANGE_OPERATORS[key], bound) for key, bound in bounds.items()]
+    else:
+        comparisons = [
+            (RANGE_OPERATORS[key], _normalize_value(bound, field_type)) for key, bound in bounds.items()
+        ]
+
+    def predicate(obj):
+        """Matches if any value of the field is within all the bounds"""
+        values = (_normalize_document_value(value, field_type) for value in _get_values(obj, field, nested_path))
+        return any(
+            all(compare(value, bound) for compare, bound in comparisons)
+            for value in values if value is not None
+        )
+    return predicate
+
+
+def _compile_exists(clause, nested_path):
+    """Compiles an exists query"""
+    if not isinstance(clause, dict) or set(clause) != {'field'}:
+        raise UnsupportedQueryException(f"Unsupported exists query {clause}")
+    field = clause['field']
+    _get_field_type(field, nested_path)
+
+    def predicate(obj):
+        """Matches if the field has a value"""
+        return bool(_get_values(obj, field, nested_path))
+    return predicate
+
+
+def _compile_match_all(clause, nested_path):  # pylint: disable=unused-argument
+    """Compiles a match_all query"""
+    if clause:
+        raise UnsupportedQueryException(f"Unsupported match_all query {clause}")
+    return lambda obj: True
+
+
+def _compile_bool(clause, nested_path):
+    """Compiles a bool query"""
+    if not isinstance(clause, dict) or not set(clause).issubset(BOOL_OCCURRENCE_TYPES + ('minimum_should_match', )):
+        raise UnsupportedQueryException(f"Unsupported bool query {clause}")
+    compiled = {}
+    for occurrence_type in BOOL_OCCURRENCE_TYPES:
+        queries = clause.get(occurrence_type, [])
+        if isinstance(queries, dict):
+            queries = [queries]
+        compiled[occurrence_type] = [_compile(query, nested_path) for query in queries]
+
+    required = compiled['must'] + compiled['filter']
+    should = compiled['should']
+    minimum_should_match = clause.get('minimum_should_match', 1 if should and not required else 0)
+    if isinstance(minimum_should_match, str) and re.fullmatch(r'\d+', minimum_should_match):
+        minimum_should_match = int(minimum_should_match)
+    if isinstance(minimum_should_match, bool) or not isinstance(minimum_should_match, int) or minimum_should_match < 0:
+        raise UnsupportedQueryException(f"Unsupported minimum_should_match in {clause}")
+
+    def predicate(obj):
+        """Matches if all required clauses match, no excluded one does and enough optional ones do"""
+        return (
+            all(query(obj) for query in required) and
+            not any(query(obj) for query in compiled['must_not']) and
+            sum(1 for query in should if query(obj)) >= minimum_should_match
+        )
+    return predicate
+
+
+def _compile_nested(clause, nested_path):
+    """Compiles a nested query"""
+    if not isinstance(clause, dict) or not {'path', 'query'}.issubset(clause) or not set(clause).issubset(
+            {'path', 'query', 'score_mode'}
+    ):
+        raise UnsupportedQueryException(f"Unsupported nested query {clause}")
+    if nested_path is not None:
+        raise UnsupportedQueryException(f"Unsupported nested query {clause} within a nested query")
+    path = clause['path']
+    properties = PRIVATE_ENROLLMENT_MAPPING['properties']
+    mapping = {}
+    for part in path.split('.'):
+        mapping = (properties or {}).get(part, {})
+        properties = mapping.get('properties')
+    if mapping.get('type') != 'nested':
+        raise UnsupportedQueryException(f"{path} is not a nested field")
+    query = _compile(clause['query'], path)
+
+    def predicate(obj):
+        """Matches if one of the nested objects matches the query"""
+        return any(query(nested_obj) for nested_obj in _get_values(obj, path, None))
+    return predicate
+
+
+QUERY_COMPILERS = {
+    'term': _compile_term,
+    'terms': _compile_terms,
+    'range': _compile_range,
+    'exists': _compile_exists,
+    'match_all': _compile_match_all,
+    'bool': _compile_bool,
+    'nested': _compile_nested,
+}
+
+
+def _compile(query, nested_path):
+    """
+    Compiles a query clause
+
+    Args:
+        query (dict): A query clause, like {"term": {"program.id": 1}}
+        nested_path (str): The path of the nested query the clause is in, or None
+
+    Returns:
+        callable: A function which takes a document or nested object and returns whether it matches
+    """
+    if not isinstance(query, dict) or len(query) != 1:
+        raise UnsupportedQueryException(f"Unsupported query {query}")
+    query_type, clause = next(iter(query.items()))
+    if query_type not in QUERY_COMPILERS:
+        raise UnsupportedQueryException(f"Unsupported query type {query_type}")
+    return QUERY_COMPILERS[query_type](clause, nested_path)
+
+
+def compile_query(query):
+    """
+    Compiles the query of a PercolateQuery into a Python predicate
+
+    Args:
+        query (dict): The query of a PercolateQuery, like {"query": {...}}
+
+    Returns:
+        callable: A function which takes a document serialized by serialize_program_enrolled_user
+            and returns whether the query matches it
+
+    Raises:
+        UnsupportedQueryException: If the query uses something which is not supported
+    """
+    if not isinstance(query, dict) or set(query) != {'query'}:
+        raise UnsupportedQueryException(f"Unsupported query {query}")
+    return _compile(fix_nested_filter(query, None)['query'], None)
+
+
+def compile_percolate_queries(percolate_queries):
+    """
+    Compiles the supported queries
+
+    Args:
+        percolate_queries (iterable of PercolateQuery): The queries to compile
+
+    Returns:
+        tuple: A dict of PercolateQuery id -> predicate for the supported queries, and the list
+            of the queries which are not supported and must be percolated by Opensearch
+    """
+    predicates = {}
+    unsupported = []
+    for percolate_query in percolate_queries:
+        try:
+            predicates[percolate_query.id] = compile_query(percolate_query.query)
+        except UnsupportedQueryException:
+            unsupported.append(percolate_query)
+    return predicates, unsupported
+
+
+def match_percolate_queries(document, percolate_queries):
+    """
+    Evaluates the supported queries against a document
+
+    Args:
+        document (dict): A document serialized by serialize_program_enrolled_user
+        percolate_queries (iterable of PercolateQuery): The queries to evaluate
+
+    Returns:
+        tuple: The set of ids of the matching queries, and the list of the queries which are not supported
+            and must be percolated by Opensearch
+    """
+    predicates, unsupported = compile_percolate_queries(percolate_queries)
+    query_ids = {query_id for query_id, predicate in predicates.items() if predicate(document)}
+    return query_ids, unsupported
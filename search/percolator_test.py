@@ -0,0 +1,171 @@
+"""
+Tests for the in process evaluation of percolate queries
+"""
+import ddt
+import pytest
+from django.db.models.signals import post_save
+from factory.django import mute_signals
+
+from search.base import ESTestCase
+from search.connection import PERCOLATE_INDEX_TYPE, get_conn, get_default_alias
+from search.exceptions import UnsupportedQueryException
+from search.factories import PercolateQueryFactory
+from search.indexing_api import index_percolate_queries, refresh_index
+from search.models import PercolateQuery
+from search.percolator import compile_query, match_percolate_queries
+
+DOCUMENT = {
+    'id': 1,
+    'user_id': 2,
+    'email': 'learner@example.com',
+    'profile': {
+        'country': 'US',
+        'filled_out': True,
+        'email_optin': False,
+        'date_of_birth': '1990-05-01',
+        'student_id': 12,
+        'education': [],
+        'work_history': [
+            {'company_name': 'MIT', 'country': 'US', 'start_date': '2015-01-01'},
+            {'company_name': 'Acme', 'country': 'FR', 'start_date': '2019-01-01'},
+        ],
+    },
+    'program': {
+        'id': 3,
+        'is_learner': True,
+        'grade_average': 82.6,
+        'num_courses_passed': 2,
+        'total_courses': 4,
+        'enrollments': [
+            {'final_grade': 75.5, 'semester': '2016 - Spring', 'payment_status': 'Paid', 'course_title': 'A'},
+            {'final_grade': None, 'semester': '2017 - Fall', 'payment_status': 'Auditing', 'course_title': 'B'},
+        ],
+        'course_runs': [{'semester': '2016 - Spring'}, {'semester': '2017 - Fall'}],
+        'courses': [{'final_grade': 75.5, 'course_title': 'A', 'status': 'Passed', 'payment_status': 'Paid'}],
+    },
+}
+OTHER_DOCUMENT = {
+    **DOCUMENT,
+    'profile': {**DOCUMENT['profile'], 'country': 'DE', 'email_optin': True, 'work_history': []},
+    'program': {**DOCUMENT['program'], 'id': 4, 'grade_average': 55, 'enrollments': [], 'courses': []},
+}
+
+# queries shaped like the ones built by the learner search, and whether they match DOCUMENT
+SUPPORTED_QUERIES = [
+    ({'match_all': {}}, True),
+    ({'term': {'program.id': 3}}, True),
+    ({'term': {'program.id': '3'}}, True),
+    ({'term': {'program.id': {'value': 4}}}, False),
+    ({'term': {'program.is_learner': True}}, True),
+    ({'term': {'profile.email_optin': 'true'}}, False),
+    ({'term': {'profile.student_id': '12'}}, True),
+    ({'terms': {'profile.country': ['FR', 'US']}}, True),
+    ({'terms': {'profile.country': []}}, False),
+    ({'range': {'program.grade_average': {'gte': 80, 'lt': 90}}}, True),
+    ({'range': {'program.grade_average': {'gt': 82}}}, False),
+    ({'range': {'profile.date_of_birth': {'lte': '1990-01-01'}}}, False),
+    ({'exists': {'field': 'profile.date_of_birth'}}, True),
+    ({'exists': {'field': 'profile.birth_country'}}, False),
+    ({'bool': {'should': [{'term': {'program.id': 1}}, {'term': {'program.id': 3}}]}}, True),
+    ({'bool': {'must': {'term': {'program.id': 3}}, 'should': [{'term': {'program.id': 1}}]}}, True),
+    ({'bool': {
+        'must': {'term': {'program.id': 3}}, 'should': [{'term': {'program.id': 1}}], 'minimum_should_match': 1,
+    }}, False),
+    ({'bool': {'must_not': [{'term': {'profile.country': 'US'}}]}}, False),
+    ({'bool': {
+        'filter': [
+            {'bool': {
+                'should': [{'term': {'program.id': 3}}],
+                'minimum_should_match': 1,
+                'must': [{'term': {'program.is_learner': True}}],
+            }},
+            {'term': {'profile.filled_out': True}},
+        ],
+    }}, True),
+    ({'nested': {'path': 'program.enrollments', 'filter': {'term': {'program.enrollments.semester': '2017 - Fall'}}}},
+     True),
+    ({'nested': {'path': 'program.enrollments', 'query': {'bool': {'must': [
+        {'term': {'program.enrollments.semester': '2017 - Fall'}},
+        {'term': {'program.enrollments.payment_status': 'Paid'}},
+    ]}}}}, False),
+    ({'nested': {'path': 'program.courses', 'query': {'range': {'program.courses.final_grade': {'gte': 75.2}}}}},
+     False),
+    ({'nested': {'path': 'program.courses', 'query': {'range': {'program.courses.final_grade': {'gte': 75}}}}},
+     True),
+    ({'nested': {'path': 'profile.work_history', 'query': {'bool': {'filter': [
+        {'term': {'profile.work_history.company_name': 'MIT'}},
+        {'term': {'profile.work_history.country': 'US'}},
+    ]}}}}, True),
+    ({'nested': {'path': 'profile.education', 'query': {'match_all': {}}}}, False),
+]
+UNSUPPORTED_QUERIES = [
+    {'multi_match': {'query': 'p', 'fields': ['profile.first_name.folded'], 'type': 'phrase_prefix'}},
+    {'term': {'profile.first_name.folded': 'jane'}},
+    {'term': {'program.enrollments.semester': '2017 - Fall'}},
+    {'term': {'profile': 'US'}},
+    {'term': {'program.id': {'value': 3, 'boost': 2}}},
+    {'range': {'profile.date_of_birth': {'gte': 'now-30y'}}},
+    {'range': {'program.is_learner': {'gte': True}}},
+    {'bool': {'should': [{'term': {'program.id': 3}}], 'minimum_should_match': '50%'}},
+    {'nested': {'path': 'program', 'query': {'match_all': {}}}},
+    {'nested': {'path': 'program.enrollments', 'query': {'match_all': {}}, 'inner_hits': {}}},
+]
+
+
+@pytest.mark.parametrize('query,is_match', SUPPORTED_QUERIES)
+def test_compile_query(query, is_match):
+    """compile_query should evaluate the query against a document like Opensearch does"""
+    assert compile_query({'query': query})(DOCUMENT) is is_match
+
+
+@pytest.mark.parametrize('query', UNSUPPORTED_QUERIES)
+def test_compile_unsupported_query(query):
+    """compile_query should refuse the queries it can't evaluate exactly"""
+    with pytest.raises(UnsupportedQueryException):
+        compile_query({'query': query})
+
+
+def test_compile_query_without_query():
+    """Only the query part of a search can be evaluated"""
+    with pytest.raises(UnsupportedQueryException):
+        compile_query({'query': {'match_all': {}}, 'size': 10})
+
+
+def test_match_percolate_queries():
+    """match_percolate_queries should return the matching supported queries, and the unsupported ones"""
+    matching = PercolateQuery(id=1, query={'query': {'term': {'program.id': 3}}})
+    not_matching = PercolateQuery(id=2, query={'query': {'term': {'program.id': 4}}})
+    unsupported = PercolateQuery(id=3, query={'query': UNSUPPORTED_QUERIES[0]})
+    assert match_percolate_queries(DOCUMENT, [matching, not_matching, unsupported]) == ({1}, [unsupported])
+
+
+@ddt.ddt
+class PercolatorDifferentialTests(ESTestCase):
+    """Compares the in process evaluation of the queries with Opensearch percolation"""
+
+    def percolate(self, document):
+        """Returns the ids of the queries which Opensearch matches with a document"""
+        result = get_conn().search(
+            index=get_default_alias(PERCOLATE_INDEX_TYPE),
+            body={
+                '_source': False,
+                'size': len(SUPPORTED_QUERIES),
+                'query': {'percolate': {'field': 'query', 'document': document}},
+            },
+        )
+        return {int(hit['_id']) for hit in result['hits']['hits']}
+
+    @ddt.data(DOCUMENT, OTHER_DOCUMENT)
+    def test_same_matches(self, document):
+        """The supported queries should match the same documents as when percolated"""
+        with mute_signals(post_save):
+            percolate_queries = [
+                PercolateQueryFactory.create(query={'query': query}, source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+                for query, _ in SUPPORTED_QUERIES
+            ]
+        index_percolate_queries(percolate_queries)
+        refresh_index(get_default_alias(PERCOLATE_INDEX_TYPE))
+
+        query_ids, unsupported = match_percolate_queries(document, percolate_queries)
+        assert unsupported == []
+        assert query_ids == self.percolate(document)
@@ -0,0 +1,112 @@
+"""
+Cached search scope of a user: the programs the user can search and the alias of the index to search them in
+"""
+import json
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from courses.models import Program
+from roles.api import get_advance_searchable_program_ids
+from search.connection import (PRIVATE_ENROLLMENT_INDEX_TYPE,
+                               PUBLIC_ENROLLMENT_INDEX_TYPE, get_default_alias)
+
+CACHE_KEY_SEARCH_SCOPE_BY_USER = "search_scope_{0}"
+# incremented when the roles or program enrollments of a user change
+CACHE_KEY_SEARCH_SCOPE_GENERATION_BY_USER = "search_scope_generation_{0}"
+# incremented when the indices behind the aliases are swapped, which discards every cached scope
+CACHE_KEY_SEARCH_SCOPE_VERSION = "search_scope_version"
+
+SearchScope = namedtuple('SearchScope', ['staff_program_ids', 'program_ids', 'alias'])
+
+
+def _load_search_scope(user):
+    """
+    Computes the search scope of a user
+
+    Args:
+        user (User): the user who searches
+
+    Returns:
+        SearchScope: the search scope of the user
+    """
+    staff_program_ids = get_advance_searchable_program_ids(user)
+    # NOTE: this has an accepted limitation that if you are staff on any program,
+    # you can't use search on non-staff programs
+    program_ids = sorted(set(Program.objects.filter(
+        Q(id__in=staff_program_ids) if staff_program_ids else Q(programenrollment__user=user)
+    ).values_list('id', flat=True)))
+    index_type = PRIVATE_ENROLLMENT_INDEX_TYPE if staff_program_ids else PUBLIC_ENROLLMENT_INDEX_TYPE
+    return SearchScope(
+        staff_program_ids=staff_program_ids,
+        program_ids=program_ids,
+        alias=get_default_alias(index_type),
+    )
+
+
+def get_search_scope(user):
+    """
+    Returns the search scope of a user, computing it only if it changed since it was last cached
+
+    Args:
+        user (User): the user who searches
+
+    Returns:
+        SearchScope: the search scope of the user
+    """
+    conn = get_redis_connection("redis")
+    cached, generation, version = conn.mget([
+        CACHE_KEY_SEARCH_SCOPE_BY_USER.format(user.id),
+        CACHE_KEY_SEARCH_SCOPE_GENERATION_BY_USER.format(user.id),
+        CACHE_KEY_SEARCH_SCOPE_VERSION,
+    ])
+    generation = int(generation or 0)
+    version = int(version or 0)
+    if cached is not None:
+        cached = json.loads(cached)
+        if cached['generation'] == generation and cached['version'] == version:
+            return SearchScope(**cached['scope'])
+
+    # the generation and the version are read before loading so that a change committed meanwhile is not missed
+    scope = _load_search_scope(user)
+    conn.set(
+        CACHE_KEY_SEARCH_SCOPE_BY_USER.format(user.id),
+        json.dumps({'generation': generation, 'version': version, 'scope': scope._asdict()}),
+        ex=settings.OPENSEARCH_SEARCH_SCOPE_CACHE_SECONDS,
+    )
+    return scope
+
+
+def _bump_generation(user_id):
+    """
+    Makes the cached search scope of a user stale
+    """
+    key = CACHE_KEY_SEARCH_SCOPE_GENERATION_BY_USER.format(user_id)
+    with get_redis_connection("redis").pipeline() as pipe:
+        pipe.incr(key)
+        # a scope is cached for less time than this, so it can't outlive the generation it was computed for
+        pipe.expire(key, settings.OPENSEARCH_SEARCH_SCOPE_CACHE_SECONDS * 2)
+        pipe.execute()
+
+
+def invalidate_search_scope(user_id):
+    """
+    Discards the cached search scope of a user right away, and again once the current transaction
+    is committed, so that a scope computed before the commit is not kept
+
+    Args:
+        user_id (int): the id of the user
+    """
+    _bump_generation(user_id)
+    # robust, so that a failure of this callback doesn't prevent the other callbacks of the commit from running
+    transaction.on_commit(lambda: _bump_generation(user_id), robust=True)
+
+
+def invalidate_search_scopes():
+    """
+    Discards the cached search scopes of all users
+    """
+    get_redis_connection("redis").incr(CACHE_KEY_SEARCH_SCOPE_VERSION)
@@ -0,0 +1,109 @@
+"""
+Tests for the cached search scopes
+"""
+from unittest.mock import patch
+
+import ddt
+from django.db.models.signals import post_save
+from factory.django import mute_signals
+
+from courses.factories import ProgramFactory
+from dashboard.factories import ProgramEnrollmentFactory
+from dashboard.models import ProgramEnrollment
+from profiles.factories import ProfileFactory
+from roles.models import Role
+from roles.roles import Staff
+from search.base import MockedESTestCase
+from search.connection import (PRIVATE_ENROLLMENT_INDEX_TYPE,
+                               PUBLIC_ENROLLMENT_INDEX_TYPE)
+from search.scope import (SearchScope, get_search_scope,
+                          invalidate_search_scopes)
+
+
+@ddt.ddt
+@patch('search.scope.get_default_alias', autospec=True, side_effect=lambda index_type: f'{index_type}_alias')
+class SearchScopeTests(MockedESTestCase):
+    """Tests for the search scope of a user"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.program, cls.other_program = ProgramFactory.create_batch(2)
+        with mute_signals(post_save):
+            cls.user = ProfileFactory.create().user
+        ProgramEnrollmentFactory.create(user=cls.user, program=cls.program)
+
+    def test_learner(self, get_default_alias_mock):
+        """A learner should search the public index, in the programs they are enrolled in"""
+        assert get_search_scope(self.user) == SearchScope(
+            staff_program_ids=[],
+            program_ids=[self.program.id],
+            alias=f'{PUBLIC_ENROLLMENT_INDEX_TYPE}_alias',
+        )
+        get_default_alias_mock.assert_called_once_with(PUBLIC_ENROLLMENT_INDEX_TYPE)
+
+    def test_staff(self, get_default_alias_mock):
+        """A staff user should search the private index, in the programs they are staff of"""
+        Role.objects.create(user=self.user, program=self.other_program, role=Staff.ROLE_ID)
+        assert get_search_scope(self.user) == SearchScope(
+            staff_program_ids=[self.other_program.id],
+            program_ids=[self.other_program.id],
+            alias=f'{PRIVATE_ENROLLMENT_INDEX_TYPE}_alias',
+        )
+        get_default_alias_mock.assert_called_once_with(PRIVATE_ENROLLMENT_INDEX_TYPE)
+
+    def test_cached(self, get_default_alias_mock):
+        """The scope should be computed only once"""
+        scope = get_search_scope(self.user)
+        with self.assertNumQueries(0):
+            assert get_search_scope(self.user) == scope
+        assert get_default_alias_mock.call_count == 1
+
+    def test_invalidated_on_role_change(self, get_default_alias_mock):
+        """The scope should be computed again when a role of the user is added or removed"""
+        get_search_scope(self.user)
+        role = Role.objects.create(user=self.user, program=self.other_program, role=Staff.ROLE_ID)
+        assert get_search_scope(self.user).program_ids == [self.other_program.id]
+        role.delete()
+        assert get_search_scope(self.user).program_ids == [self.program.id]
+        assert get_default_alias_mock.call_count == 3
+
+    def test_invalidated_on_enrollment_change(self, get_default_alias_mock):
+        """The scope should be computed again when the user enrolls in a program or is unenrolled"""
+        get_search_scope(self.user)
+        ProgramEnrollmentFactory.create(user=self.user, program=self.other_program)
+        assert get_search_scope(self.user).program_ids == sorted([self.program.id, self.other_program.id])
+        ProgramEnrollment.objects.get(user=self.user, program=self.other_program).delete()
+        assert get_search_scope(self.user).program_ids == [self.program.id]
+        assert get_default_alias_mock.call_count == 3
+
+    @ddt.data('add_role', 'remove_role', 'enroll', 'unenroll')
+    def test_cached_before_commit(self, change, get_default_alias_mock):  # pylint: disable=unused-argument
+        """
+        A scope computed by another request between a change and its commit, from the data before the change,
+        should be discarded once the change is committed
+        """
+        role = Role.objects.create(
+            user=self.user, program=self.other_program, role=Staff.ROLE_ID
+        ) if change == 'remove_role' else None
+        stale_scope = get_search_scope(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            if change == 'add_role':
+                Role.objects.create(user=self.user, program=self.other_program, role=Staff.ROLE_ID)
+            elif change == 'remove_role':
+                role.delete()
+            elif change == 'enroll':
+                ProgramEnrollmentFactory.create(user=self.user, program=self.other_program)
+            else:
+                ProgramEnrollment.objects.get(user=self.user, program=self.program).delete()
+            # the other request doesn't see the change yet
+            with patch('search.scope._load_search_scope', autospec=True, return_value=stale_scope):
+                assert get_search_scope(self.user) == stale_scope
+        assert get_search_scope(self.user) != stale_scope
+
+    def test_invalidate_search_scopes(self, get_default_alias_mock):
+        """The scopes of all users should be computed again after the aliases are swapped"""
+        get_search_scope(self.user)
+        invalidate_search_scopes()
+        get_search_scope(self.user)
+        assert get_default_alias_mock.call_count == 2
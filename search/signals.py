@@ -11,8 +11,9 @@ from django.dispatch import receiver
 from profiles.models import Education, Employment, Profile
 from roles.models import Role
 from search.models import PercolateQuery
+from search.scope import invalidate_search_scope
 from search.tasks import (delete_percolate_query, index_percolate_queries,
-                          index_users)
+                          queue_index_users)
 
 log = logging.getLogger(__name__)
 
@@ -26,31 +27,31 @@ log = logging.getLogger(__name__)
 @receiver(post_save, sender=Profile, dispatch_uid="profile_post_save_index")
 def handle_update_profile(sender, instance, **kwargs):
     """Update index when Profile model is updated."""
-    transaction.on_commit(lambda: index_users.delay([instance.user.id], check_if_changed=True))
+    transaction.on_commit(lambda: queue_index_users([instance.user.id], check_if_changed=True))
 
 
 @receiver(post_save, sender=Education, dispatch_uid="education_post_save_index")
 def handle_update_education(sender, instance, **kwargs):
     """Update index when Education model is updated."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id], check_if_changed=True))
+    transaction.on_commit(lambda: queue_index_users([instance.profile.user.id], check_if_changed=True))
 
 
 @receiver(post_save, sender=Employment, dispatch_uid="employment_post_save_index")
 def handle_update_employment(sender, instance, **kwargs):
     """Update index when Employment model is updated."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id], check_if_changed=True))
+    transaction.on_commit(lambda: queue_index_users([instance.profile.user.id], check_if_changed=True))
 
 
 @receiver(post_delete, sender=Education, dispatch_uid="education_post_delete_index")
 def handle_delete_education(sender, instance, **kwargs):
     """Update index when Education model instance is deleted."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id]))
+    transaction.on_commit(lambda: queue_index_users([instance.profile.user.id]))
 
 
 @receiver(post_delete, sender=Employment, dispatch_uid="employment_post_delete_index")
 def handle_delete_employment(sender, instance, **kwargs):
     """Update index when Employment model instance is deleted."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id]))
+    transaction.on_commit(lambda: queue_index_users([instance.profile.user.id]))
 
 
 @receiver(post_save, sender=PercolateQuery, dispatch_uid="percolate_query_save")
@@ -67,11 +68,16 @@ def handle_delete_percolate(sender, instance, **kwargs):
 
 @receiver(post_save, sender=Role, dispatch_uid="role_post_create_index")
 def handle_create_role(sender, instance, **kwargs):
-    """Update index when Role model instance is created."""
-    transaction.on_commit(lambda: index_users.delay([instance.user.id]))
+    """Update index and search scope when Role model instance is created."""
+    user_id = instance.user_id
+    invalidate_search_scope(user_id)
+    transaction.on_commit(lambda: queue_index_users([user_id]))
 
 
 @receiver(post_delete, sender=Role, dispatch_uid="role_post_remove_index")
 def handle_remove_role(sender, instance, **kwargs):
-    """Update index when Role model instance is deleted."""
-    transaction.on_commit(lambda: index_users.delay([instance.user.id]))
+    """Update index and search scope when Role model instance is deleted."""
+    # the user may be deleted along with the role, so it is not loaded once the deletion is committed
+    user_id = instance.user_id
+    invalidate_search_scope(user_id)
+    transaction.on_commit(lambda: queue_index_users([user_id]))
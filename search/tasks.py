@@ -2,22 +2,31 @@
 Celery tasks for search
 """
 import logging
+import traceback
+from functools import partial
 
 import celery
 from celery.exceptions import Ignore
 from django.conf import settings
+from opensearchpy.exceptions import ConnectionError as OpenSearchConnectionError
 
 from dashboard.models import ProgramEnrollment
-from mail.api import send_automatic_emails as _send_automatic_emails
+from mail.api import \
+    send_automatic_emails_in_bulk as _send_automatic_emails_in_bulk
 from micromasters.celery import app
 from micromasters.utils import chunks, merge_strings
-from search import api
-from search.api import document_needs_updating as _document_needs_updating
-from search.connection import get_conn, make_alias_name
+from search import api, index_queue
+from search.api import \
+    get_enrollments_needing_update as _get_enrollments_needing_update
+from search.connection import (PERCOLATE_INDEX_TYPE,
+                               PRIVATE_ENROLLMENT_INDEX_TYPE,
+                               PUBLIC_ENROLLMENT_INDEX_TYPE, get_conn,
+                               invalidate_aliases, make_alias_name)
 from search.exceptions import ReindexException, RetryException
 from search.indexing_api import (_get_percolate_documents, _index_chunks,
-                                 create_backing_indices,
-                                 delete_backing_indices)
+                                 clear_document_hashes, create_backing_indices,
+                                 delete_backing_indices,
+                                 set_bulk_load_settings)
 from search.indexing_api import \
     delete_percolate_query as _delete_percolate_query
 from search.indexing_api import \
@@ -29,7 +38,8 @@ from search.indexing_api import \
 from search.indexing_api import refresh_index
 from search.indexing_api import \
     remove_program_enrolled_user as _remove_program_enrolled_user
-from search.models import PercolateQuery
+from search.models import PercolateQuery, ReindexChunk, ReindexRun
+from search.scope import invalidate_search_scopes
 
 # The imports which are prefixed with _ are mocked to be ignored in MockedESTestCase
 
@@ -38,19 +48,20 @@ from search.models import PercolateQuery
 log = logging.getLogger(__name__)
 
 
-def post_indexing_handler(program_enrollments):
+def post_indexing_handler(program_enrollments, documents_by_enrollment_id=None):
     """
     Do the work which happens after a profile is reindexed
 
     Args:
         program_enrollments (list of ProgramEnrollment): A list of ProgramEnrollments
+        documents_by_enrollment_id (dict):
+            ProgramEnrollment id -> the private document just indexed for the enrollment
     """
     _refresh_all_default_indices()
-    for program_enrollment in program_enrollments:
-        try:
-            _send_automatic_emails(program_enrollment)
-        except:  # pylint: disable=bare-except
-            log.exception("Error sending automatic email for enrollment %s", program_enrollment)
+    try:
+        _send_automatic_emails_in_bulk(program_enrollments, documents_by_enrollment_id)
+    except:  # pylint: disable=bare-except
+        log.exception("Error sending automatic emails for enrollments %s", program_enrollments)
 
 
 @app.task
@@ -72,11 +83,14 @@ def index_program_enrolled_users(program_enrollment_ids):
     Args:
         program_enrollment_ids (list of int): A list of program enrollment ids
     """
-    program_enrollments = ProgramEnrollment.objects.filter(id__in=program_enrollment_ids)
-    _index_program_enrolled_users(program_enrollments)
+    program_enrollments = ProgramEnrollment.objects.filter(
+        id__in=program_enrollment_ids
+    ).select_related('user', 'program')
+    documents_by_enrollment_id = {}
+    _index_program_enrolled_users(program_enrollments, documents_by_id=documents_by_enrollment_id)
 
     # Send email for profiles that newly fit the search query for an automatic email
-    post_indexing_handler(program_enrollments)
+    post_indexing_handler(program_enrollments, documents_by_enrollment_id)
 
 
 @app.task(acks_late=True)
@@ -87,21 +101,129 @@ def index_users(user_ids, check_if_changed=False):
     Args:
         user_ids (list of int): Ids of users to update in the Opensearch index
         check_if_changed (bool):
-            If true, read the document from opensearch before indexing and
-            check if the serialized value would be different.
+            If true, compare the hash of the serialized value with the one of the
+            indexed document and only index the documents which would be different.
     """
-    enrollments = list(ProgramEnrollment.objects.filter(user__in=user_ids))
+    enrollments = list(ProgramEnrollment.objects.filter(user__in=user_ids).select_related('user', 'program'))
 
     if check_if_changed:
-        enrollments = [
-            enrollment for enrollment in enrollments if _document_needs_updating(enrollment)
-        ]
+        enrollments = _get_enrollments_needing_update(enrollments)
 
     if len(enrollments) > 0:
-        _index_program_enrolled_users(enrollments)
+        documents_by_enrollment_id = {}
+        _index_program_enrolled_users(enrollments, documents_by_id=documents_by_enrollment_id)
 
         # Send email for profiles that newly fit the search query for an automatic email
-        post_indexing_handler(enrollments)
+        post_indexing_handler(enrollments, documents_by_enrollment_id)
+
+
+def schedule_index_queue_flush():
+    """
+    Schedules a flush of the indexing queue unless one is already scheduled
+    """
+    delay = settings.OPENSEARCH_INDEX_QUEUE_FLUSH_SECONDS
+    # if the scheduled flush is lost the next change schedules another one after a while
+    if index_queue.claim_flush(timeout=max(delay * 10, 60)):
+        flush_index_queue.apply_async(countdown=delay)
+
+
+def queue_index_users(user_ids, check_if_changed=False):
+    """
+    Queues users to be reindexed by the next flush of the indexing queue, so that the changes
+    made to a user within a few seconds are reindexed only once
+
+    Args:
+        user_ids (list of int): Ids of users to update in the Opensearch index
+        check_if_changed (bool): If true, the users are only reindexed if their documents changed
+    """
+    index_queue.add_users(user_ids, check_if_changed=check_if_changed)
+    schedule_index_queue_flush()
+
+
+def queue_index_program_enrolled_users(program_enrollment_ids):
+    """
+    Queues program enrollments to be reindexed by the next flush of the indexing queue
+
+    Args:
+        program_enrollment_ids (list of int): A list of program enrollment ids
+    """
+    index_queue.add_program_enrollments(program_enrollment_ids)
+    schedule_index_queue_flush()
+
+
+# not prefixed with _, since the tests mock the functions of this module imported from indexing_api that way
+def reindex_queued_ids(index_func, ids):
+    """
+    Reindexes ids popped from the indexing queue. If they can't be reindexed together, unless Opensearch
+    can't be reached, they are reindexed one at a time so that an id which always fails doesn't hold back the others.
+
+    Args:
+        index_func (callable): the function reindexing a list of ids
+        ids (list of int): the ids to reindex
+
+    Returns:
+        list of int: the ids which failed to be reindexed
+    """
+    if not ids:
+        return []
+    try:
+        index_func(ids)
+        return []
+    except OpenSearchConnectionError:
+        raise
+    except Exception:  # pylint: disable=broad-except
+        log.exception("Unable to reindex the ids %s popped from the indexing queue", ids)
+        if len(ids) == 1:
+            return ids
+    return [failed_id for id_ in ids for failed_id in reindex_queued_ids(index_func, [id_])]
+
+
+@app.task(acks_late=True)
+def flush_index_queue():
+    """
+    Reindexes the users and program enrollments collected by the indexing queue, in batches.
+    If Opensearch can't be reached, the ids which were not reindexed are put back in the queue for the next flush.
+    The ids which fail for another reason are retried by the next flushes until they failed
+    settings.OPENSEARCH_INDEX_QUEUE_MAX_FAILURES times, after which they are logged and given up.
+    """
+    forced_user_ids, user_ids, program_enrollment_ids, has_more = index_queue.pop_batch(
+        settings.OPENSEARCH_INDEX_QUEUE_BATCH_SIZE
+    )
+    max_failures = settings.OPENSEARCH_INDEX_QUEUE_MAX_FAILURES
+    given_up_user_ids = []
+    given_up_program_enrollment_ids = []
+    try:
+        failed_ids = reindex_queued_ids(index_users, forced_user_ids)
+        given_up_user_ids += index_queue.add_failed_users(failed_ids, max_failures)
+        has_more = has_more or bool(failed_ids)
+        forced_user_ids = []
+
+        failed_ids = reindex_queued_ids(partial(index_users, check_if_changed=True), user_ids)
+        given_up_user_ids += index_queue.add_failed_users(failed_ids, max_failures, check_if_changed=True)
+        has_more = has_more or bool(failed_ids)
+        user_ids = []
+
+        failed_ids = reindex_queued_ids(index_program_enrolled_users, program_enrollment_ids)
+        given_up_program_enrollment_ids += index_queue.add_failed_program_enrollments(failed_ids, max_failures)
+        has_more = has_more or bool(failed_ids)
+        program_enrollment_ids = []
+    except OpenSearchConnectionError:
+        # Opensearch may be reachable again by the next flush
+        index_queue.add_users(forced_user_ids)
+        index_queue.add_users(user_ids, check_if_changed=True)
+        index_queue.add_program_enrollments(program_enrollment_ids)
+        has_more = True
+        raise
+    finally:
+        if given_up_user_ids or given_up_program_enrollment_ids:
+            log.error(
+                "Gave up reindexing the users %s and the program enrollments %s after %d failures",
+                given_up_user_ids,
+                given_up_program_enrollment_ids,
+                max_failures,
+            )
+        if has_more:
+            schedule_index_queue_flush()
 
 
 @app.task
@@ -138,10 +260,85 @@ def populate_query_memberships(percolate_query_id):
     api.populate_query_memberships(percolate_query_id)
 
 
+def create_reindex_run(backing_index_tuples):
+    """
+    Records a reindex into new backing indices, split into chunks of enrollments and percolate queries
+
+    Args:
+        backing_index_tuples (list of tuple): The backing indices and their index types
+
+    Returns:
+        ReindexRun: the reindex, with its chunks
+    """
+    run = ReindexRun.objects.create(backing_indices=backing_index_tuples)
+    ReindexChunk.objects.bulk_create(
+        ReindexChunk(run=run, index_type=index_type, object_ids=object_ids, size=len(object_ids))
+        for index_type, queryset in [
+            (PRIVATE_ENROLLMENT_INDEX_TYPE, ProgramEnrollment.objects.order_by("id")),
+            (PERCOLATE_INDEX_TYPE, PercolateQuery.objects.order_by("id")),
+        ]
+        for object_ids in chunks(
+            queryset.values_list("id", flat=True),
+            chunk_size=settings.OPENSEARCH_INDEXING_CHUNK_SIZE,
+        )
+    )
+    return run
+
+
+def get_reindex_chain(run, reindex_chunks):
+    """
+    Creates the celery chain which indexes some chunks of a reindex in parallel, then finishes the reindex
+
+    Args:
+        run (ReindexRun): A reindex
+        reindex_chunks (list of ReindexChunk): The chunks of the reindex to index
+
+    Returns:
+        celery.canvas.Signature: the chain
+    """
+    backing_index_by_type = {index_type: backing_index for backing_index, index_type in run.backing_indices}
+    index_tasks = [
+        bulk_index_percolate_queries.si(
+            chunk.object_ids, backing_index_by_type[PERCOLATE_INDEX_TYPE], chunk_id=chunk.id
+        ) if chunk.index_type == PERCOLATE_INDEX_TYPE else bulk_index_program_enrollments.si(
+            chunk.object_ids,
+            backing_index_by_type[PUBLIC_ENROLLMENT_INDEX_TYPE],
+            backing_index_by_type[PRIVATE_ENROLLMENT_INDEX_TYPE],
+            chunk_id=chunk.id,
+        )
+        for chunk in reindex_chunks
+    ]
+    return celery.chain(
+        celery.group(index_tasks), finish_recreate_index.s(run.backing_indices, run_id=run.id)
+    )
+
+
+def log_reindex_progress(run):
+    """
+    Logs how far a reindex went, with its throughput and the estimated time left
+
+    Args:
+        run (ReindexRun): A reindex
+    """
+    progress = run.get_progress()
+    log.info(
+        "Reindex run %d: %d/%d chunks, %d/%d documents indexed in %d seconds, %s documents/second, "
+        "%s seconds left",
+        run.id,
+        progress['completed_chunks'],
+        progress['total_chunks'],
+        progress['indexed_documents'],
+        progress['total_documents'],
+        progress['elapsed_seconds'],
+        f"{progress['documents_per_second']:.1f}" if progress['documents_per_second'] is not None else "unknown",
+        f"{progress['eta_seconds']:.0f}" if progress['eta_seconds'] is not None else "unknown",
+    )
+
+
 # pylint: disable=inconsistent-return-statements
-@app.task(autoretry_for=(RetryException,), retry_backoff=True, rate_limit="600/m")
+@app.task(autoretry_for=(RetryException,), retry_backoff=True, rate_limit="600/m", acks_late=True)
 def bulk_index_program_enrollments(program_enrollment_ids, enrollment_public_backing_index,
-                                   enrollment_private_backing_index):
+                                   enrollment_private_backing_index, chunk_id=None):
     """
     Bulk index user enrollments for provided program enrollment Ids
 
@@ -149,45 +346,55 @@ def bulk_index_program_enrollments(program_enrollment_ids, enrollment_public_bac
         program_enrollment_ids (list of int) Ids of program enrollments to index
         enrollment_public_backing_index (string): name of public enrollments backing index
         enrollment_private_backing_index (string): name of private enrollments backing index
+        chunk_id (int): The id of the ReindexChunk of these enrollments, if any
     """
 
     try:
-        program_enrollments = ProgramEnrollment.objects.filter(id__in=program_enrollment_ids)
+        program_enrollments = ProgramEnrollment.objects.filter(
+            id__in=program_enrollment_ids
+        ).select_related('user', 'program')
         log.info("Indexing %d program enrollments...", program_enrollments.count())
         _index_program_enrolled_users(
             program_enrollments,
             public_indices=[enrollment_public_backing_index],
             private_indices=[enrollment_private_backing_index],
+            # the backing indices are refreshed once by finish_recreate_index
+            refresh=False,
         )
     except (RetryException, Ignore):
         raise
     except:  # pylint: disable=bare-except
         error = "bulk_index_program_enrollments threw an error"
         log.exception(error)
+        ReindexChunk.record_attempt(chunk_id, error=traceback.format_exc())
         return error
+    ReindexChunk.record_attempt(chunk_id)
 
 
 # pylint: disable=inconsistent-return-statements
-@app.task(autoretry_for=(RetryException,), retry_backoff=True, rate_limit="600/m")
-def bulk_index_percolate_queries(percolate_ids, percolate_backing_index):
+@app.task(autoretry_for=(RetryException,), retry_backoff=True, rate_limit="600/m", acks_late=True)
+def bulk_index_percolate_queries(percolate_ids, percolate_backing_index, chunk_id=None):
     """
     Bulk index percolate queries for provided percolate query Ids
 
     Args:
         percolate_backing_index (string): name of percolate backing index
         percolate_ids (list of int): Ids of percolates queries to index
+        chunk_id (int): The id of the ReindexChunk of these percolate queries, if any
     """
     try:
         percolates = PercolateQuery.objects.filter(id__in=percolate_ids).exclude(is_deleted=True)
         log.info("Indexing %d percolator queries...", percolates.count())
 
-        _index_chunks(_get_percolate_documents(percolates.iterator()), index=percolate_backing_index)
+        _index_chunks(_get_percolate_documents(percolates.iterator()), index=percolate_backing_index, refresh=False)
     except (RetryException, Ignore):
         raise
     except:  # pylint: disable=bare-except
         error = "bulk_index_percolate_queries threw an error"
         log.exception(error)
+        ReindexChunk.record_attempt(chunk_id, error=traceback.format_exc())
         return error
+    ReindexChunk.record_attempt(chunk_id)
 
 
 @app.task(acks_late=True, bind=True)
@@ -204,49 +411,69 @@ def start_recreate_index(self, backing_indices=None):
             backing_index_tuples = backing_indices
         else:
             backing_index_tuples = create_backing_indices()
+        set_bulk_load_settings(backing_index_tuples, is_bulk_load=True)
 
-        index_tasks = []
-        index_tasks = index_tasks + [
-            bulk_index_program_enrollments.si(enrollment_ids, backing_index_tuples[0][0], backing_index_tuples[1][0])
-            for enrollment_ids in chunks(
-                ProgramEnrollment.objects.order_by("id").values_list("id", flat=True),
-                chunk_size=settings.OPENSEARCH_INDEXING_CHUNK_SIZE,
-            )
-        ]
-
-        index_tasks = index_tasks + [
-            bulk_index_percolate_queries.si(percolate_ids, backing_index_tuples[2][0])
-            for percolate_ids in chunks(
-                PercolateQuery.objects.order_by("id").values_list("id", flat=True),
-                chunk_size=settings.OPENSEARCH_INDEXING_CHUNK_SIZE,
-            )
-        ]
-
-        index_tasks = celery.group(index_tasks)
+        run = create_reindex_run(backing_index_tuples)
+        log.info("Starting reindex run %d", run.id)
+        reindex_chain = get_reindex_chain(run, run.chunks.order_by("id"))
 
     except:  # pylint: disable=bare-except
         error = "start_recreate_index threw an error"
         log.exception(error)
         return error
 
-    raise self.replace(
-        celery.chain(index_tasks, finish_recreate_index.s(backing_index_tuples))
-    )
+    raise self.replace(reindex_chain)
 
 
-@app.task
-def finish_recreate_index(results, backing_indices):
+@app.task(acks_late=True, bind=True)
+def resume_recreate_index(self, run_id):
+    """
+    Index the chunks of an interrupted reindex which were not indexed yet, then finish it
+
+    Args:
+        run_id (int): The id of a ReindexRun in progress
+    """
+    run = ReindexRun.objects.get(id=run_id, status=ReindexRun.IN_PROGRESS)
+    incomplete_chunks = list(run.chunks.filter(is_complete=False).order_by("id"))
+    log.info("Resuming reindex run %d with %d chunks left", run.id, len(incomplete_chunks))
+    if not incomplete_chunks:
+        raise self.replace(finish_recreate_index.si([], run.backing_indices, run_id=run.id))
+    raise self.replace(get_reindex_chain(run, incomplete_chunks))
+
+
+@app.task(bind=True)
+def finish_recreate_index(self, results, backing_indices, run_id=None):
     """
     Swap and delete reindex backing index with default backing index
 
     Args:
         results (list or bool): Results saying whether the error exists
         backing_indices (list of tuples): The backing opensearch indices tuple
+        run_id (int): The id of the ReindexRun, if any. Its failed chunks are retried
+            up to settings.OPENSEARCH_REINDEX_CHUNK_MAX_ATTEMPTS times before giving up.
     """
     errors = merge_strings(results)
+    run = None
+    if run_id is not None:
+        run = ReindexRun.objects.get(id=run_id)
+        if run.status != ReindexRun.IN_PROGRESS:
+            log.warning("Reindex run %d was already finished", run.id)
+            return
+        log_reindex_progress(run)
+        if errors:
+            incomplete_chunks = list(run.chunks.filter(is_complete=False).order_by("id"))
+            if incomplete_chunks and all(
+                    chunk.attempts < settings.OPENSEARCH_REINDEX_CHUNK_MAX_ATTEMPTS for chunk in incomplete_chunks
+            ):
+                log.warning("Retrying %d chunks of reindex run %d", len(incomplete_chunks), run.id)
+                raise self.replace(get_reindex_chain(run, incomplete_chunks))
+
     if errors:
+        if run is not None:
+            run.finish(ReindexRun.FAILED)
         delete_backing_indices(backing_indices)
         raise ReindexException(f"Errors occurred during recreate_index: {errors}")
+    set_bulk_load_settings(backing_indices, is_bulk_load=False)
     conn = get_conn(verify=False)
 
     # Point default alias to new index and delete the old backing index, if any
@@ -274,8 +501,14 @@ def finish_recreate_index(results, backing_indices):
         conn.indices.update_aliases({
             "actions": actions
         })
+        invalidate_aliases()
         refresh_index(new_backing_index)
         for index in old_backing_indexes:
             conn.indices.delete(index)
+    # The documents written by the reindex may be older than the last hashed ones
+    clear_document_hashes()
+    invalidate_search_scopes()
+    if run is not None:
+        run.finish(ReindexRun.COMPLETE)
     # Remove the temporary backing indices
     delete_backing_indices(backing_indices)
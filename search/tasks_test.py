@@ -2,21 +2,33 @@
 
 """Tests for search tasks"""
 from types import SimpleNamespace
+from unittest.mock import ANY, call, patch
 
 import pytest
 from ddt import data, ddt, unpack
 from django.conf import settings
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from opensearchpy.exceptions import ConnectionError as OpenSearchConnectionError
 
 from dashboard.factories import ProgramEnrollmentFactory
+from dashboard.utils import prefetch_mmtracks
 from search.base import MockedESTestCase
+from search.connection import (PERCOLATE_INDEX_TYPE,
+                               PRIVATE_ENROLLMENT_INDEX_TYPE,
+                               PUBLIC_ENROLLMENT_INDEX_TYPE)
 from search.exceptions import ReindexException
 from search.factories import PercolateQueryFactory
 from search.indexing_api import create_backing_indices
+from search.models import ReindexChunk, ReindexRun
 from search.tasks import (bulk_index_percolate_queries,
                           bulk_index_program_enrollments,
-                          finish_recreate_index, index_program_enrolled_users,
-                          index_users, start_recreate_index)
+                          finish_recreate_index, flush_index_queue,
+                          index_program_enrolled_users, index_users,
+                          queue_index_program_enrolled_users,
+                          queue_index_users, resume_recreate_index,
+                          start_recreate_index)
 
 FAKE_INDEX = 'fake'
 
@@ -41,19 +53,6 @@ def mocked_celery(mocker):
     )
 
 
-def fail_first():
-    """Returns a function which raises an exception the first time then does nothing on subsequent calls"""
-    first = False
-
-    def func(*args, **kwargs):  # pylint: disable=unused-argument
-        """Raises first time, does nothing subsequent calls"""
-        nonlocal first
-        if not first:
-            first = True
-            raise KeyError()
-    return func
-
-
 @ddt
 @override_settings(
     OPENSEARCH_INDEX=FAKE_INDEX,
@@ -69,9 +68,9 @@ class SearchTasksTests(MockedESTestCase):
         for mock in self.patcher_mocks:
             if mock.name == "_index_program_enrolled_users":
                 self.index_program_enrolled_users_mock = mock
-            elif mock.name == "_document_needs_updating":
-                self.document_needs_updating_mock = mock
-            elif mock.name == "_send_automatic_emails":
+            elif mock.name == "_get_enrollments_needing_update":
+                self.get_enrollments_needing_update_mock = mock
+            elif mock.name == "_send_automatic_emails_in_bulk":
                 self.send_automatic_emails_mock = mock
             elif mock.name == "_refresh_all_default_indices":
                 self.refresh_index_mock = mock
@@ -91,8 +90,11 @@ class SearchTasksTests(MockedESTestCase):
             [enrollment1, enrollment2],
             key=lambda _enrollment: _enrollment.id
         )
-        for enrollment in [enrollment1, enrollment2]:
-            self.send_automatic_emails_mock.assert_any_call(enrollment)
+        # the documents serialized by the indexer are reused to percolate the enrollments
+        documents_by_id = self.index_program_enrolled_users_mock.call_args[1]['documents_by_id']
+        self.send_automatic_emails_mock.assert_called_once_with(
+            self.index_program_enrolled_users_mock.call_args[0][0], documents_by_id
+        )
         self.refresh_index_mock.assert_called_with()
 
     @data(*[
@@ -115,25 +117,20 @@ class SearchTasksTests(MockedESTestCase):
         if enrollment2_needs_update:
             needs_update_list.append(enrollment2)
 
-        def fake_needs_updating(_enrollment):
-            """Fake document_needs_update to conform to test data"""
-            return _enrollment in needs_update_list
+        def fake_needs_updating(_enrollments):
+            """Fake get_enrollments_needing_update to conform to test data"""
+            return [_enrollment for _enrollment in _enrollments if _enrollment in needs_update_list]
 
-        self.document_needs_updating_mock.side_effect = fake_needs_updating
+        self.get_enrollments_needing_update_mock.side_effect = fake_needs_updating
         index_users([enrollment1.user.id, enrollment2.user.id], check_if_changed=True)
 
-        expected_enrollments = []
-        if enrollment1_needs_update:
-            expected_enrollments.append(enrollment1)
-        if enrollment2_needs_update:
-            expected_enrollments.append(enrollment2)
-
-        self.document_needs_updating_mock.assert_any_call(enrollment1)
-        self.document_needs_updating_mock.assert_any_call(enrollment2)
+        self.get_enrollments_needing_update_mock.assert_called_once_with(ANY)
+        assert sorted(
+            self.get_enrollments_needing_update_mock.call_args[0][0], key=lambda _enrollment: _enrollment.id
+        ) == [enrollment1, enrollment2]
         if len(needs_update_list) > 0:
-            self.index_program_enrolled_users_mock.assert_called_once_with(needs_update_list)
-            for enrollment in needs_update_list:
-                self.send_automatic_emails_mock.assert_any_call(enrollment)
+            self.index_program_enrolled_users_mock.assert_called_once_with(needs_update_list, documents_by_id={})
+            self.send_automatic_emails_mock.assert_called_once_with(needs_update_list, {})
         else:
             assert self.index_program_enrolled_users_mock.called is False
             assert self.send_automatic_emails_mock.called is False
@@ -149,28 +146,139 @@ class SearchTasksTests(MockedESTestCase):
         assert list(
             self.index_program_enrolled_users_mock.call_args[0][0].values_list('id', flat=True)
         ) == enrollment_ids
-        for enrollment in enrollments:
-            self.send_automatic_emails_mock.assert_any_call(enrollment)
+        assert self.send_automatic_emails_mock.call_count == 1
+        assert sorted(
+            enrollment.id for enrollment in self.send_automatic_emails_mock.call_args[0][0]
+        ) == sorted(enrollment_ids)
         self.refresh_index_mock.assert_called_with()
 
+    def test_index_program_enrolled_users_query_count(self):
+        """
+        The users, programs and mmtracks of the program enrollments should be loaded with the same number
+        of queries no matter how many enrollments are indexed
+        """
+        self.index_program_enrolled_users_mock.side_effect = (
+            lambda program_enrollments, **kwargs: prefetch_mmtracks(program_enrollments)
+        )
+        program = ProgramEnrollmentFactory.create().program
+        enrollment_ids = [enrollment.id for enrollment in ProgramEnrollmentFactory.create_batch(4, program=program)]
+        # loads the cached program structure
+        index_program_enrolled_users(enrollment_ids[:1])
+
+        with CaptureQueriesContext(connection) as single_enrollment_queries:
+            index_program_enrolled_users(enrollment_ids[:1])
+        with self.assertNumQueries(len(single_enrollment_queries)):
+            index_program_enrolled_users(enrollment_ids)
+
     def test_failed_automatic_email(self):
         """
-        If we fail to send automatic email for one enrollment we should still send them for other enrollments
+        If we fail to send automatic emails the enrollments should still be indexed
         """
         enrollments = [ProgramEnrollmentFactory.create() for _ in range(2)]
         enrollment_ids = [enrollment.id for enrollment in enrollments]
 
-        self.send_automatic_emails_mock.side_effect = fail_first()
+        self.send_automatic_emails_mock.side_effect = KeyError
 
         index_program_enrolled_users(enrollment_ids)
         assert list(
             self.index_program_enrolled_users_mock.call_args[0][0].values_list('id', flat=True)
         ) == enrollment_ids
-        for enrollment in enrollments:
-            self.send_automatic_emails_mock.assert_any_call(enrollment)
-        assert self.send_automatic_emails_mock.call_count == len(enrollments)
+        assert self.send_automatic_emails_mock.call_count == 1
         self.refresh_index_mock.assert_called_with()
 
+    @patch('search.tasks.index_program_enrolled_users', autospec=True)
+    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.flush_index_queue.apply_async', autospec=True)
+    def test_queue(self, apply_async_mock, index_users_mock, index_enrollments_mock):
+        """
+        The users and program enrollments queued within a flush interval should be reindexed once by a single task
+        """
+        for user_id in [3, 1, 2, 1]:
+            queue_index_users([user_id], check_if_changed=True)
+        queue_index_users([2, 4])
+        queue_index_program_enrolled_users([5])
+        queue_index_program_enrolled_users([5, 6])
+        apply_async_mock.assert_called_once_with(countdown=settings.OPENSEARCH_INDEX_QUEUE_FLUSH_SECONDS)
+
+        flush_index_queue()
+        assert index_users_mock.call_args_list == [call([2, 4]), call([1, 3], check_if_changed=True)]
+        index_enrollments_mock.assert_called_once_with([5, 6])
+
+        # the next change schedules another flush
+        queue_index_users([1])
+        assert apply_async_mock.call_count == 2
+
+    @override_settings(OPENSEARCH_INDEX_QUEUE_BATCH_SIZE=2)
+    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.flush_index_queue.apply_async', autospec=True)
+    def test_flush_batch_size(self, apply_async_mock, index_users_mock):
+        """
+        A flush should reindex at most a batch of ids and schedule another flush for the rest
+        """
+        queue_index_users([1, 2, 3])
+        flush_index_queue()
+        assert len(index_users_mock.call_args[0][0]) == 2
+        assert apply_async_mock.call_count == 2
+
+        flush_index_queue()
+        assert len(index_users_mock.call_args[0][0]) == 1
+        assert sorted(
+            user_id for args, _ in index_users_mock.call_args_list for user_id in args[0]
+        ) == [1, 2, 3]
+        assert apply_async_mock.call_count == 2
+
+    @patch('search.tasks.index_program_enrolled_users', autospec=True)
+    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.flush_index_queue.apply_async', autospec=True)
+    def test_flush_failed(self, apply_async_mock, index_users_mock, index_enrollments_mock):
+        """
+        The ids which were not reindexed because of an error should be put back in the queue
+        """
+        queue_index_users([1])
+        queue_index_users([2], check_if_changed=True)
+        queue_index_program_enrolled_users([3])
+        index_users_mock.side_effect = [None, OpenSearchConnectionError("N/A", "timed out", None)]
+
+        with self.assertRaises(OpenSearchConnectionError):
+            flush_index_queue()
+        assert apply_async_mock.call_count == 2
+
+        index_users_mock.reset_mock(side_effect=True)
+        flush_index_queue()
+        index_users_mock.assert_called_once_with([2], check_if_changed=True)
+        assert index_enrollments_mock.call_args_list == [call([3])]
+
+    @override_settings(OPENSEARCH_INDEX_QUEUE_MAX_FAILURES=2)
+    @patch('search.tasks.index_program_enrolled_users', autospec=True)
+    @patch('search.tasks.index_users', autospec=True)
+    @patch('search.tasks.flush_index_queue.apply_async', autospec=True)
+    def test_flush_failed_id(self, apply_async_mock, index_users_mock, index_enrollments_mock):
+        """
+        An id which fails to be reindexed should not hold back the other ids, and should be given up
+        once it failed too many times
+        """
+        def fail_user(user_ids, check_if_changed=False):  # pylint: disable=unused-argument
+            """Fails to reindex one of the users"""
+            if 1 in user_ids:
+                raise ValueError
+
+        index_users_mock.side_effect = fail_user
+        queue_index_users([1, 2, 3])
+        queue_index_program_enrolled_users([4])
+
+        flush_index_queue()
+        assert index_users_mock.call_args_list == [call([1, 2, 3]), call([1]), call([2]), call([3])]
+        index_enrollments_mock.assert_called_once_with([4])
+        assert apply_async_mock.call_count == 2
+
+        index_users_mock.reset_mock()
+        flush_index_queue()
+        assert index_users_mock.call_args_list == [call([1])]
+
+        index_users_mock.reset_mock()
+        flush_index_queue()
+        assert index_users_mock.called is False
+
 
 def test_start_recreate_index(mocker, mocked_celery):
     """
@@ -181,6 +289,7 @@ def test_start_recreate_index(mocker, mocked_celery):
     percolates = sorted(PercolateQueryFactory.create_batch(4), key=lambda percolate: percolate.id)
     index_enrollments_mock = mocker.patch("search.tasks.bulk_index_program_enrollments", autospec=True)
     index_percolates_mock = mocker.patch("search.tasks.bulk_index_percolate_queries", autospec=True)
+    set_bulk_load_settings_mock = mocker.patch("search.tasks.set_bulk_load_settings", autospec=True)
 
     test_backing_indices = create_backing_indices()
     enrollment_public_index = test_backing_indices[0][0]
@@ -199,17 +308,20 @@ def test_start_recreate_index(mocker, mocked_celery):
     list(mocked_celery.group.call_args[0][0])
     assert mocked_celery.group.call_count == 1
 
-    finish_recreate_index_mock.s.assert_called_once_with(test_backing_indices)
+    run = ReindexRun.objects.get()
+    assert run.chunks.count() == 4
+    finish_recreate_index_mock.s.assert_called_once_with(test_backing_indices, run_id=run.id)
+    set_bulk_load_settings_mock.assert_called_once_with(test_backing_indices, is_bulk_load=True)
 
     assert index_enrollments_mock.si.call_count == 2
     index_enrollments_mock.si.assert_any_call([enrollments[0].id, enrollments[1].id], enrollment_public_index,
-                                              enrollment_private_index)
+                                              enrollment_private_index, chunk_id=ANY)
     index_enrollments_mock.si.assert_any_call([enrollments[2].id, enrollments[3].id], enrollment_public_index,
-                                              enrollment_private_index)
+                                              enrollment_private_index, chunk_id=ANY)
 
     assert index_percolates_mock.si.call_count == 2
-    index_percolates_mock.si.assert_any_call([percolates[0].id, percolates[1].id], percolate_index)
-    index_percolates_mock.si.assert_any_call([percolates[2].id, percolates[3].id], percolate_index)
+    index_percolates_mock.si.assert_any_call([percolates[0].id, percolates[1].id], percolate_index, chunk_id=ANY)
+    index_percolates_mock.si.assert_any_call([percolates[2].id, percolates[3].id], percolate_index, chunk_id=ANY)
 
     assert mocked_celery.replace.call_count == 1
     assert mocked_celery.replace.call_args[0][1] == mocked_celery.chain.return_value
@@ -230,6 +342,29 @@ def test_bulk_index_program_enrollments(mocker):
     assert index_enrollments_mock.call_count == 1
 
 
+def test_bulk_index_program_enrollments_query_count(mocker, django_assert_num_queries):
+    """
+    bulk_index_program_enrollments should load the users, programs and mmtracks of the program enrollments
+    with the same number of queries no matter how many enrollments are indexed
+    """
+    mocker.patch(
+        "search.tasks._index_program_enrolled_users",
+        autospec=True,
+        side_effect=lambda program_enrollments, **kwargs: prefetch_mmtracks(program_enrollments),
+    )
+    program = ProgramEnrollmentFactory.create().program
+    enrollment_ids = [enrollment.id for enrollment in ProgramEnrollmentFactory.create_batch(4, program=program)]
+    test_backing_indices = create_backing_indices()
+    index_args = (test_backing_indices[0][0], test_backing_indices[1][0])
+    # loads the cached program structure
+    bulk_index_program_enrollments(enrollment_ids[:1], *index_args)
+
+    with CaptureQueriesContext(connection) as single_enrollment_queries:
+        bulk_index_program_enrollments(enrollment_ids[:1], *index_args)
+    with django_assert_num_queries(len(single_enrollment_queries)):
+        bulk_index_program_enrollments(enrollment_ids, *index_args)
+
+
 def test_bulk_index_percolate_queries(mocker):
     """
     bulk_index_percolate_queries should index the percolate queries correctly
@@ -252,6 +387,7 @@ def test_finish_recreate_index(mocker, with_error):
     """
     refresh_index_mock = mocker.patch("search.tasks.refresh_index", autospec=True)
     delete_backing_indices_mock = mocker.patch("search.tasks.delete_backing_indices", autospec=True)
+    set_bulk_load_settings_mock = mocker.patch("search.tasks.set_bulk_load_settings", autospec=True)
     results = ["error"] if with_error else []
     test_backing_indices = create_backing_indices()
 
@@ -263,3 +399,91 @@ def test_finish_recreate_index(mocker, with_error):
         finish_recreate_index(results, test_backing_indices)
         assert refresh_index_mock.call_count == len(test_backing_indices)
         assert delete_backing_indices_mock.call_count == 1
+        set_bulk_load_settings_mock.assert_called_once_with(test_backing_indices, is_bulk_load=False)
+
+
+FAKE_BACKING_INDICES = [
+    ["public", PUBLIC_ENROLLMENT_INDEX_TYPE],
+    ["private", PRIVATE_ENROLLMENT_INDEX_TYPE],
+    ["percolate", PERCOLATE_INDEX_TYPE],
+]
+
+
+@pytest.fixture
+def reindex_run():
+    """A reindex run with a chunk of enrollments and a chunk of percolate queries"""
+    run = ReindexRun.objects.create(backing_indices=FAKE_BACKING_INDICES)
+    enrollment_chunk = ReindexChunk.objects.create(
+        run=run, index_type=PRIVATE_ENROLLMENT_INDEX_TYPE, object_ids=[1, 2], size=2
+    )
+    percolate_chunk = ReindexChunk.objects.create(
+        run=run, index_type=PERCOLATE_INDEX_TYPE, object_ids=[3], size=1
+    )
+    return SimpleNamespace(run=run, enrollment_chunk=enrollment_chunk, percolate_chunk=percolate_chunk)
+
+
+@pytest.mark.parametrize("fails", [True, False])
+def test_bulk_index_records_chunk(mocker, reindex_run, fails):
+    """
+    The bulk indexing tasks should record whether the chunk of a reindex was indexed
+    """
+    index_enrollments_mock = mocker.patch(
+        "search.tasks._index_program_enrolled_users", autospec=True, side_effect=KeyError if fails else None
+    )
+    chunk = reindex_run.enrollment_chunk
+    result = bulk_index_program_enrollments(chunk.object_ids, "public", "private", chunk_id=chunk.id)
+    assert index_enrollments_mock.call_args[1]["refresh"] is False
+
+    chunk.refresh_from_db()
+    assert chunk.attempts == 1
+    assert chunk.is_complete is not fails
+    assert (result is not None) is fails
+    assert ("KeyError" in chunk.error) is fails
+
+
+@pytest.mark.parametrize("attempts", [1, settings.OPENSEARCH_REINDEX_CHUNK_MAX_ATTEMPTS])
+def test_finish_recreate_index_retries_chunks(mocker, mocked_celery, reindex_run, attempts):
+    """
+    finish_recreate_index should index again the failed chunks of a reindex,
+    until they failed settings.OPENSEARCH_REINDEX_CHUNK_MAX_ATTEMPTS times
+    """
+    delete_backing_indices_mock = mocker.patch("search.tasks.delete_backing_indices", autospec=True)
+    index_enrollments_mock = mocker.patch("search.tasks.bulk_index_program_enrollments", autospec=True)
+    index_percolates_mock = mocker.patch("search.tasks.bulk_index_percolate_queries", autospec=True)
+    ReindexChunk.record_attempt(reindex_run.percolate_chunk.id)
+    ReindexChunk.objects.filter(id=reindex_run.enrollment_chunk.id).update(attempts=attempts, error="error")
+
+    if attempts < settings.OPENSEARCH_REINDEX_CHUNK_MAX_ATTEMPTS:
+        with pytest.raises(mocked_celery.replace_exception_class):
+            finish_recreate_index(["error"], FAKE_BACKING_INDICES, run_id=reindex_run.run.id)
+        # only the failed chunk is indexed again
+        index_enrollments_mock.si.assert_called_once_with(
+            [1, 2], "public", "private", chunk_id=reindex_run.enrollment_chunk.id
+        )
+        assert index_percolates_mock.si.called is False
+        assert delete_backing_indices_mock.called is False
+        expected_status = ReindexRun.IN_PROGRESS
+    else:
+        with pytest.raises(ReindexException):
+            finish_recreate_index(["error"], FAKE_BACKING_INDICES, run_id=reindex_run.run.id)
+        assert mocked_celery.replace.called is False
+        delete_backing_indices_mock.assert_called_once_with(FAKE_BACKING_INDICES)
+        expected_status = ReindexRun.FAILED
+    reindex_run.run.refresh_from_db()
+    assert reindex_run.run.status == expected_status
+
+
+def test_resume_recreate_index(mocker, mocked_celery, reindex_run):
+    """
+    resume_recreate_index should only index the chunks of a reindex which were not indexed yet
+    """
+    index_enrollments_mock = mocker.patch("search.tasks.bulk_index_program_enrollments", autospec=True)
+    index_percolates_mock = mocker.patch("search.tasks.bulk_index_percolate_queries", autospec=True)
+    finish_recreate_index_mock = mocker.patch("search.tasks.finish_recreate_index", autospec=True)
+    ReindexChunk.record_attempt(reindex_run.enrollment_chunk.id)
+
+    with pytest.raises(mocked_celery.replace_exception_class):
+        resume_recreate_index(reindex_run.run.id)
+    assert index_enrollments_mock.si.called is False
+    index_percolates_mock.si.assert_called_once_with([3], "percolate", chunk_id=reindex_run.percolate_chunk.id)
+    finish_recreate_index_mock.s.assert_called_once_with(FAKE_BACKING_INDICES, run_id=reindex_run.run.id)